@@ -11,11 +11,26 @@ import pandas as pd
 from binance.client import Client
 from binance.exceptions import BinanceAPIException
 from config import API_KEY, API_SECRET
+from weight_budget import ENDPOINT_WEIGHTS
 import json
 
 class AccountAnalyzer:
-    def __init__(self):
-        self.client = Client(API_KEY, API_SECRET)
+    def __init__(self, weight_budget=None, client: Optional[Client] = None):
+        # 傳入 client 時共用交易機器人的客戶端（已掛上權重預算），不另建連接
+        self.client = client or Client(API_KEY, API_SECRET)
+        # 與交易機器人共用請求權重預算（同一IP），只使用下單路徑保留額度之外的部分
+        self.weight_budget = weight_budget
+        if weight_budget is not None and client is None:
+            weight_budget.attach_to_client(self.client)
+
+    def _wait_budget(self, weight: int) -> bool:
+        """申請背景權重，額度不足時最多等待一個窗口"""
+        if self.weight_budget is None:
+            return True
+        if self.weight_budget.acquire_background(weight, timeout=65):
+            return True
+        print(f"權重預算不足，跳過查詢: {self.weight_budget.format_status()}")
+        return False
         
     def get_account_income_history(self, symbol: str = None, start_time: int = None, end_time: int = None) -> List[Dict]:
         """獲取帳戶收入歷史（包含資金費率、手續費等）"""
@@ -35,6 +50,8 @@ class AccountAnalyzer:
             if symbol:
                 params['symbol'] = symbol
             
+            if not self._wait_budget(ENDPOINT_WEIGHTS['futures_income_history']):
+                return []
             income_history = self.client.futures_income_history(**params)
             
             print(f"獲取到 {len(income_history)} 條收入記錄")
@@ -62,6 +79,8 @@ class AccountAnalyzer:
             if symbol:
                 params['symbol'] = symbol
             
+            if not self._wait_budget(ENDPOINT_WEIGHTS['futures_account_trades']):
+                return []
             trade_history = self.client.futures_account_trades(**params)
             
             print(f"獲取到 {len(trade_history)} 條交易記錄")
@@ -255,51 +274,107 @@ class AccountAnalyzer:
                     trade['trade_direction'] = period.get('direction', 'unknown')
                     all_trades.append(trade)
             
-            # 分析所有記錄
-            income_by_type = self.analyze_income_by_type(all_income)
-            realized_pnl = self.calculate_realized_pnl(all_trades)
-            funding_income = self.get_funding_rate_income(all_income)
+            return self._summarize_periods(trade_periods, all_income, all_trades)
             
-            # 按交易期間分組
-            trades_by_period = {}
-            for i, period in enumerate(trade_periods):
-                period_income = [inc for inc in all_income if inc.get('trade_period_index') == i]
-                period_trades = [trd for trd in all_trades if trd.get('trade_period_index') == i]
-                
-                period_pnl = sum(float(trd['realizedPnl']) for trd in period_trades)
-                period_commission = sum(float(trd['commission']) for trd in period_trades)
-                period_funding = sum(float(inc['income']) for inc in period_income if inc['incomeType'] == 'FUNDING_FEE')
-                
-                trades_by_period[i] = {
-                    'symbol': period['symbol'],
-                    'direction': period['direction'],
-                    'entry_time': period['entry_time'],
-                    'exit_time': period['exit_time'],
-                    'duration_seconds': (period['exit_time'] - period['entry_time']) / 1000,
-                    'realized_pnl': period_pnl,
-                    'commission': period_commission,
-                    'funding_fee': period_funding,
-                    'net_profit': period_pnl + period_funding - period_commission,
-                    'income_records': period_income,
-                    'trade_records': period_trades
-                }
+        except Exception as e:
+            print(f"按時間範圍分析失敗: {e}")
+            return None
+    
+    def analyze_trades_batch(self, trade_periods: List[Dict]) -> Dict:
+        """
+        合併查詢多筆時間相近的交易（參數與返回同 analyze_trades_by_time_range）
+        收入記錄在所有交易的時間範圍內查詢一次，成交記錄每個交易對查詢一次，再按交易對和時間範圍分配到各筆交易
+        """
+        try:
+            if not trade_periods:
+                return None
+            windows = [(period['entry_time'], period['exit_time'] + 60000) for period in trade_periods]  # 延長1分鐘，同單筆查詢
+            
+            def owner(symbol: str, timestamp: int) -> Optional[int]:
+                for i, period in enumerate(trade_periods):
+                    if period['symbol'] == symbol and windows[i][0] <= timestamp <= windows[i][1]:
+                        return i
+                return None
+            
+            def tag(record: Dict, i: int) -> Dict:
+                record['trade_period_index'] = i
+                record['trade_symbol'] = trade_periods[i]['symbol']
+                record['trade_direction'] = trade_periods[i].get('direction', 'unknown')
+                return record
+            
+            print(f"合併分析 {len(trade_periods)} 筆交易: {', '.join(period['symbol'] for period in trade_periods)}")
+            all_income = []
+            income_records = self.get_account_income_history(
+                start_time=min(start for start, _ in windows),
+                end_time=max(end for _, end in windows)
+            )
+            for income in income_records:
+                i = owner(income.get('symbol', ''), int(income.get('time', 0)))
+                if i is not None:
+                    all_income.append(tag(income, i))
             
-            return {
-                'total_trades': len(trade_periods),
-                'total_realized_pnl': realized_pnl['total_pnl'],
-                'total_commission': realized_pnl['total_commission'],
-                'total_funding': funding_income['total_funding'],
-                'total_net_profit': realized_pnl['total_pnl'] + funding_income['total_funding'] - realized_pnl['total_commission'],
-                'trades_by_period': trades_by_period,
-                'income_by_type': income_by_type,
-                'realized_pnl': realized_pnl,
-                'funding_income': funding_income
-            }
+            all_trades = []
+            for symbol in dict.fromkeys(period['symbol'] for period in trade_periods):
+                symbol_windows = [windows[i] for i, period in enumerate(trade_periods) if period['symbol'] == symbol]
+                trade_records = self.get_trade_history(
+                    symbol=symbol,
+                    start_time=min(start for start, _ in symbol_windows),
+                    end_time=max(end for _, end in symbol_windows)
+                )
+                for trade in trade_records:
+                    i = owner(symbol, int(trade.get('time', 0)))
+                    if i is not None:
+                        all_trades.append(tag(trade, i))
+            
+            return self._summarize_periods(trade_periods, all_income, all_trades)
             
         except Exception as e:
-            print(f"按時間範圍分析失敗: {e}")
+            print(f"合併分析失敗: {e}")
             return None
     
+    def _summarize_periods(self, trade_periods: List[Dict], all_income: List[Dict], all_trades: List[Dict]) -> Dict:
+        """已標記 trade_period_index 的收入和成交記錄按交易期間分組統計"""
+        # 分析所有記錄
+        income_by_type = self.analyze_income_by_type(all_income)
+        realized_pnl = self.calculate_realized_pnl(all_trades)
+        funding_income = self.get_funding_rate_income(all_income)
+        
+        # 按交易期間分組
+        trades_by_period = {}
+        for i, period in enumerate(trade_periods):
+            period_income = [inc for inc in all_income if inc.get('trade_period_index') == i]
+            period_trades = [trd for trd in all_trades if trd.get('trade_period_index') == i]
+            
+            period_pnl = sum(float(trd['realizedPnl']) for trd in period_trades)
+            period_commission = sum(float(trd['commission']) for trd in period_trades)
+            period_funding = sum(float(inc['income']) for inc in period_income if inc['incomeType'] == 'FUNDING_FEE')
+            
+            trades_by_period[i] = {
+                'symbol': period['symbol'],
+                'direction': period['direction'],
+                'entry_time': period['entry_time'],
+                'exit_time': period['exit_time'],
+                'duration_seconds': (period['exit_time'] - period['entry_time']) / 1000,
+                'realized_pnl': period_pnl,
+                'commission': period_commission,
+                'funding_fee': period_funding,
+                'net_profit': period_pnl + period_funding - period_commission,
+                'income_records': period_income,
+                'trade_records': period_trades
+            }
+        
+        return {
+            'total_trades': len(trade_periods),
+            'total_realized_pnl': realized_pnl['total_pnl'],
+            'total_commission': realized_pnl['total_commission'],
+            'total_funding': funding_income['total_funding'],
+            'total_net_profit': realized_pnl['total_pnl'] + funding_income['total_funding'] - realized_pnl['total_commission'],
+            'trades_by_period': trades_by_period,
+            'income_by_type': income_by_type,
+            'realized_pnl': realized_pnl,
+            'funding_income': funding_income
+        }
+    
     def load_program_trades_from_json(self, json_file: str = 'trade_history.json') -> List[Dict]:
         """從程式的 trade_history.json 載入交易記錄並轉換為時間範圍"""
         try:
@@ -0,0 +1,181 @@
+"""
+API 調用准入控制器
+按優先級分道（下單 > 帳戶 > 背景），每條通道獨立的信號量與併發上限，互不排隊；
+背景通道（診斷、輪詢、預載）在下單通道有請求進行中時直接讓路，
+取代全域 is_api_calling 旗標 + 單一鎖的做法，並統計各通道的併發與排隊深度
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+LANE_ORDER = 'order'            # 下單、撤單、進場路徑上的槓桿設置
+LANE_ACCOUNT = 'account'        # 持倉核對等交易相關查詢
+LANE_BACKGROUND = 'background'  # 診斷、輪詢、緩存預載
+
+# 通道 -> (優先級（越小越高）, 併發上限, 是否讓路給更高優先級通道)
+DEFAULT_LANES = {
+    LANE_ORDER: (0, 8, False),
+    LANE_ACCOUNT: (1, 3, False),
+    LANE_BACKGROUND: (2, 2, True),
+}
+
+# 默認歸入下單通道的 python-binance 方法
+ORDER_METHODS = frozenset({
+    'futures_create_order', 'futures_cancel_order', 'futures_cancel_all_open_orders',
+    'futures_place_batch_order', 'futures_cancel_orders',
+})
+
+
+class ApiBusyError(Exception):
+    """通道已滿或需讓路給更高優先級的請求"""
+
+
+class Lane:
+    """單一通道 - 信號量控制併發，計數僅由本通道的調用方更新"""
+
+    def __init__(self, name: str, priority: int, limit: int, yields: bool):
+        self.name = name
+        self.priority = priority
+        self.limit = limit
+        self.yields = yields
+        self._semaphore = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()  # 只保護本通道的統計，不與其他通道共用
+        self.in_flight = 0
+        self.waiting = 0
+        self.max_in_flight = 0
+        self.max_waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    def summary(self) -> Dict:
+        return {
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'limit': self.limit,
+            'max_in_flight': self.max_in_flight,
+            'max_waiting': self.max_waiting,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'avg_wait_ms': self.total_wait_ms / self.admitted if self.admitted else 0.0,
+            'max_wait_ms': self.max_wait_ms,
+        }
+
+
+class AdmissionController:
+    """准入控制器 - admit(lane) 取得通道名額，下單通道不會排在低優先級請求之後"""
+
+    def __init__(self, lanes: Optional[Dict] = None):
+        self.lanes = {name: Lane(name, *spec) for name, spec in (lanes or DEFAULT_LANES).items()}
+
+    @staticmethod
+    def lane_for(api_func) -> str:
+        """按 python-binance 方法名推斷通道：下單/撤單走下單通道，其餘默認背景通道"""
+        return LANE_ORDER if getattr(api_func, '__name__', '') in ORDER_METHODS else LANE_BACKGROUND
+
+    def _higher_busy(self, lane: Lane) -> bool:
+        return any(other.in_flight for other in self.lanes.values() if other.priority < lane.priority)
+
+    @contextmanager
+    def admit(self, lane_name: str, timeout: float = 0.1):
+        """取得通道名額（最多等待 timeout 秒），失敗拋出 ApiBusyError"""
+        lane = self.lanes[lane_name]
+        if lane.yields and self._higher_busy(lane):
+            lane.rejected += 1
+            raise ApiBusyError(f"{lane_name} 通道讓路給進行中的高優先級請求")
+
+        start = time.perf_counter()
+        with lane._lock:
+            lane.waiting += 1
+            lane.max_waiting = max(lane.max_waiting, lane.waiting)
+        acquired = lane._semaphore.acquire(timeout=timeout)
+        wait_ms = (time.perf_counter() - start) * 1000
+        with lane._lock:
+            lane.waiting -= 1
+            if not acquired:
+                lane.rejected += 1
+            else:
+                lane.in_flight += 1
+                lane.admitted += 1
+                lane.max_in_flight = max(lane.max_in_flight, lane.in_flight)
+                lane.total_wait_ms += wait_ms
+                lane.max_wait_ms = max(lane.max_wait_ms, wait_ms)
+        if not acquired:
+            raise ApiBusyError(f"{lane_name} 通道已滿（上限{lane.limit}），等待{wait_ms:.0f}ms後放棄")
+
+        try:
+            yield lane
+        finally:
+            with lane._lock:
+                lane.in_flight -= 1
+            lane._semaphore.release()
+
+    @contextmanager
+    def track(self, lane_name: str):
+        """只計入通道的進行中請求，不佔名額、不排隊、不拒絕（網關事件循環中的下單不可阻塞）
+        讓低優先級通道在下單發送期間照常讓路"""
+        lane = self.lanes[lane_name]
+        with lane._lock:
+            lane.in_flight += 1
+            lane.admitted += 1
+            lane.max_in_flight = max(lane.max_in_flight, lane.in_flight)
+        try:
+            yield lane
+        finally:
+            with lane._lock:
+                lane.in_flight -= 1
+
+    def in_flight(self, lane_name: Optional[str] = None) -> int:
+        if lane_name is not None:
+            return self.lanes[lane_name].in_flight
+        return sum(lane.in_flight for lane in self.lanes.values())
+
+    def stats(self) -> Dict[str, Dict]:
+        return {name: lane.summary() for name, lane in self.lanes.items()}
+
+    def format_status(self) -> str:
+        """單行狀態：各通道 進行中/上限 與排隊數"""
+        return " ".join(f"{name}:{lane.in_flight}/{lane.limit}(排隊{lane.waiting})" for name, lane in self.lanes.items())
+
+    def format_stats(self) -> str:
+        lines = []
+        for name, stats in self.stats().items():
+            lines.append(f"{name:>10} | 通過 {stats['admitted']:>6} | 拒絕 {stats['rejected']:>4} | "
+                         f"最大併發 {stats['max_in_flight']}/{stats['limit']} | 最大排隊 {stats['max_waiting']} | "
+                         f"平均等待 {stats['avg_wait_ms']:.2f}ms | 最大等待 {stats['max_wait_ms']:.1f}ms")
+        return "\n".join(lines)
+
+
+# 使用示例：python admission_controller.py
+# 背景通道持續佔滿時，下單通道的等待時間
+if __name__ == "__main__":
+    controller = AdmissionController()
+    stop = threading.Event()
+
+    def background_poller():
+        while not stop.is_set():
+            try:
+                with controller.admit(LANE_BACKGROUND):
+                    time.sleep(0.05)  # 模擬慢速輪詢請求
+            except ApiBusyError:
+                time.sleep(0.01)
+
+    pollers = [threading.Thread(target=background_poller, daemon=True) for _ in range(6)]
+    for poller in pollers:
+        poller.start()
+
+    waits = []
+    for _ in range(50):
+        start = time.perf_counter()
+        with controller.admit(LANE_ORDER, timeout=1.0):
+            waits.append((time.perf_counter() - start) * 1000)
+            time.sleep(0.005)  # 模擬下單往返
+        time.sleep(0.01)
+    stop.set()
+
+    waits.sort()
+    print(f"下單通道等待: p50 {waits[len(waits) // 2]:.3f}ms | 最大 {waits[-1]:.3f}ms")
+    print(controller.format_stats())
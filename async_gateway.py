@@ -0,0 +1,590 @@
+"""
+asyncio 行情與下單網關
+單一事件循環（獨立線程）統一負責：WebSocket 行情讀取、共用 keep-alive 連接池的簽名 REST 請求、
+以 asyncio.wait_for 控制每個請求的超時，取代每筆訂單新建線程 + 每次嘗試新建線程/佇列的做法；
+進場前預熱連接池，並統計 TLS 握手與請求本身的延遲；
+倒數階段預先簽名訂單，觸發時只需把請求寫入熱連接
+"""
+
+import asyncio
+import hashlib
+import hmac
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlencode
+
+import aiohttp
+from binance.exceptions import BinanceAPIException
+
+FAPI_BASE_URL = "https://fapi.binance.com"
+FSTREAM_BASE_URL = "wss://fstream.binance.com"
+PREWARM_CONNECTIONS = 2      # 進場前保持熱連接的數量（槓桿設置 + 下單）
+PREWARM_INTERVAL = 2.0       # 預熱最小間隔（秒）
+STAGED_ORDER_MAX_AGE = 1.0   # 預簽名訂單的最長有效時間（秒），超過後發送前重新簽名
+ORDER_PATH = '/fapi/v1/order'
+# 非冪等端點：請求已寫入連接後失敗（連接中斷、超時）時交易所可能已執行，不直接重送
+NON_IDEMPOTENT_PATHS = frozenset({ORDER_PATH, '/fapi/v1/batchOrders'})
+# 可重送的幣安錯誤（交易所確定未執行）：限流、時間戳超出 recvWindow（重送時重新簽名）
+# 其餘如 -2019 保證金不足、-2022 reduceOnly 被拒、-1111 精度錯誤，重送結果相同
+RETRYABLE_CODES = frozenset({-1003, -1021})
+ORDER_LOOKUP_ATTEMPTS = 4    # 狀態未知的下單按 clientOrderId 查詢的次數（查詢本身失敗時退避重查：0.2s, 0.4s, 0.8s）
+
+# python-binance 方法名 -> (HTTP方法, 路徑, 是否簽名)，供 call() 直接走原生請求
+CLIENT_ENDPOINTS = {
+    'futures_create_order': ('POST', '/fapi/v1/order', True),
+    'futures_cancel_order': ('DELETE', '/fapi/v1/order', True),
+    'futures_get_order': ('GET', '/fapi/v1/order', True),
+    'futures_change_leverage': ('POST', '/fapi/v1/leverage', True),
+    'futures_position_information': ('GET', '/fapi/v2/positionRisk', True),
+    'futures_account': ('GET', '/fapi/v2/account', True),
+    'futures_account_balance': ('GET', '/fapi/v2/balance', True),
+    'futures_order_book': ('GET', '/fapi/v1/depth', False),
+    'futures_symbol_ticker': ('GET', '/fapi/v1/ticker/price', False),
+    'futures_24hr_ticker': ('GET', '/fapi/v1/ticker/24hr', False),
+    'futures_time': ('GET', '/fapi/v1/time', False),
+}
+
+
+def new_client_order_id() -> str:
+    """下單的 newClientOrderId（交易所限 36 字符內的 [.A-Z:/a-z0-9_-]），重送和查詢都使用同一個"""
+    return f"fr{uuid.uuid4().hex[:30]}"
+
+
+def is_retryable(error: Exception, sent: bool, idempotent: bool = True) -> bool:
+    """失敗的請求能否直接重送：幣安錯誤只重送 RETRYABLE_CODES；連接錯誤在請求尚未寫出時、或冪等請求可以重送"""
+    if isinstance(error, BinanceAPIException):
+        return error.code in RETRYABLE_CODES
+    if isinstance(error, aiohttp.ClientError):
+        return not sent or idempotent
+    return False
+
+
+def point_client_at(client, base_url: str):
+    """讓 python-binance Client 的合約請求改發到指定地址（本地模擬交易所等），現貨時間/ping 端點一併指向"""
+    client.FUTURES_URL = f"{base_url}/fapi"
+    client.FUTURES_DATA_URL = f"{base_url}/futures/data"
+    client.API_URL = f"{base_url}/api"
+    return client
+
+
+class MarketStream:
+    """由網關事件循環讀取的 WebSocket 行情流，提供 close()/connected 供主程式使用"""
+
+    def __init__(self, gateway: 'AsyncGateway', url: str, on_message: Callable[[str], None],
+                 on_open: Optional[Callable[[], None]] = None,
+                 on_close: Optional[Callable[[Optional[int], str], None]] = None,
+                 on_error: Optional[Callable[[Exception], None]] = None,
+                 heartbeat: float = 30.0):
+        self.gateway = gateway
+        self.url = url
+        self.on_message = on_message
+        self.on_open = on_open
+        self.on_close = on_close
+        self.on_error = on_error
+        self.heartbeat = heartbeat
+        self._ws = None
+        self._closing = False
+        self._future = gateway.submit(self._run())
+
+    @property
+    def connected(self) -> bool:
+        return self._ws is not None and not self._ws.closed
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            async with self.gateway.stream_session.ws_connect(self.url, heartbeat=self.heartbeat, autoping=True) as ws:
+                self._ws = ws
+                # 回調可能阻塞（sleep/重連），交給執行緒池，避免卡住事件循環
+                if self.on_open:
+                    loop.run_in_executor(None, self.on_open)
+                async for msg in ws:
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        # 消息處理很短，直接在事件循環中執行
+                        self.on_message(msg.data)
+                    elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                        break
+                close_code, close_msg = ws.close_code, str(ws.exception() or '')
+            self._ws = None
+            if not self._closing and self.on_close:
+                loop.run_in_executor(None, self.on_close, close_code, close_msg)
+        except asyncio.CancelledError:
+            self._ws = None
+            raise
+        except Exception as e:
+            self._ws = None
+            if not self._closing and self.on_error:
+                loop.run_in_executor(None, self.on_error, e)
+
+    def close(self):
+        """主動關閉（不觸發 on_close/on_error 回調）"""
+        self._closing = True
+        ws = self._ws
+        if ws is not None and not ws.closed:
+            self.gateway.submit(ws.close())
+        self._future.cancel()
+
+
+class StagedOrder:
+    """預簽名訂單 - 參數、recvWindow、時間戳和簽名已算好，發送時直接使用完整URL"""
+
+    __slots__ = ('method', 'path', 'params', 'url', 'signed_at', 'trigger_at', 'wire_at')
+
+    def __init__(self, method: str, path: str, params: Dict):
+        self.method = method
+        self.path = path
+        self.params = params
+        self.url = ''
+        self.signed_at = 0.0              # 簽名時間（time.time）
+        self.trigger_at: Optional[float] = None  # 觸發時間（perf_counter）
+        self.wire_at: Optional[float] = None     # 請求寫入連接的時間（perf_counter）
+
+    def is_stale(self, max_age: float = STAGED_ORDER_MAX_AGE) -> bool:
+        return time.time() - self.signed_at > max_age
+
+    def matches(self, **params) -> bool:
+        return all(self.params.get(key) == value for key, value in params.items())
+
+    @property
+    def trigger_to_wire_ms(self) -> Optional[float]:
+        if self.trigger_at is None or self.wire_at is None:
+            return None
+        return (self.wire_at - self.trigger_at) * 1000
+
+
+class RequestTrace:
+    """單次請求的寫出標記：請求頭寫入連接時記錄 wire_at，失敗時據此判斷交易所是否可能已收到"""
+
+    __slots__ = ('wire_at',)
+
+    def __init__(self):
+        self.wire_at: Optional[float] = None
+
+
+class ConnectionStats:
+    """連接延遲統計 - 新建連接（TCP+TLS握手）耗時 vs 請求本身耗時，區分冷/熱連接"""
+
+    def __init__(self, maxlen: int = 500):
+        self.handshake_ms = deque(maxlen=maxlen)     # 新建連接耗時
+        self.cold_request_ms = deque(maxlen=maxlen)  # 新連接上的請求總耗時（含握手）
+        self.warm_request_ms = deque(maxlen=maxlen)  # 復用連接上的請求耗時
+        self.trigger_to_wire_ms = deque(maxlen=maxlen)  # 預簽名訂單：觸發到請求寫入連接的耗時
+        self.new_connections = 0
+        self.reused_connections = 0
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self._on_request_start)
+        trace.on_connection_create_start.append(self._on_connection_create_start)
+        trace.on_connection_create_end.append(self._on_connection_create_end)
+        trace.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        trace.on_request_headers_sent.append(self._on_request_headers_sent)
+        trace.on_request_end.append(self._on_request_end)
+        return trace
+
+    async def _on_request_start(self, session, ctx, params):
+        ctx.request_start = time.perf_counter()
+        ctx.new_connection = False
+
+    async def _on_connection_create_start(self, session, ctx, params):
+        ctx.connect_start = time.perf_counter()
+
+    async def _on_connection_create_end(self, session, ctx, params):
+        self.handshake_ms.append((time.perf_counter() - ctx.connect_start) * 1000)
+        ctx.new_connection = True
+        self.new_connections += 1
+
+    async def _on_connection_reuseconn(self, session, ctx, params):
+        self.reused_connections += 1
+
+    async def _on_request_headers_sent(self, session, ctx, params):
+        traced = ctx.trace_request_ctx
+        if isinstance(traced, RequestTrace):
+            traced.wire_at = time.perf_counter()
+        elif isinstance(traced, StagedOrder) and traced.trigger_at is not None:
+            traced.wire_at = time.perf_counter()
+            self.trigger_to_wire_ms.append(traced.trigger_to_wire_ms)
+
+    async def _on_request_end(self, session, ctx, params):
+        elapsed_ms = (time.perf_counter() - ctx.request_start) * 1000
+        (self.cold_request_ms if ctx.new_connection else self.warm_request_ms).append(elapsed_ms)
+
+    @staticmethod
+    def _percentile(values, q: float) -> float:
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+    def summary(self) -> Dict:
+        total = self.new_connections + self.reused_connections
+        return {
+            'new_connections': self.new_connections,
+            'reused_connections': self.reused_connections,
+            'reuse_ratio': self.reused_connections / total if total else 0.0,
+            'handshake_ms_p50': self._percentile(self.handshake_ms, 0.5),
+            'handshake_ms_max': max(self.handshake_ms) if self.handshake_ms else 0.0,
+            'cold_request_ms_p50': self._percentile(self.cold_request_ms, 0.5),
+            'warm_request_ms_p50': self._percentile(self.warm_request_ms, 0.5),
+            'warm_request_ms_p99': self._percentile(self.warm_request_ms, 0.99),
+            'trigger_to_wire_ms_p50': self._percentile(self.trigger_to_wire_ms, 0.5),
+            'trigger_to_wire_ms_max': max(self.trigger_to_wire_ms) if self.trigger_to_wire_ms else 0.0,
+        }
+
+    def format_summary(self) -> str:
+        stats = self.summary()
+        return (f"連接池: 新建{stats['new_connections']}次 握手p50 {stats['handshake_ms_p50']:.1f}ms "
+                f"(最大{stats['handshake_ms_max']:.1f}ms) | 冷請求p50 {stats['cold_request_ms_p50']:.1f}ms | "
+                f"熱請求p50 {stats['warm_request_ms_p50']:.1f}ms p99 {stats['warm_request_ms_p99']:.1f}ms | "
+                f"復用率 {stats['reuse_ratio'] * 100:.0f}% | "
+                f"觸發→寫入p50 {stats['trigger_to_wire_ms_p50']:.2f}ms (最大{stats['trigger_to_wire_ms_max']:.2f}ms)")
+
+
+class AsyncGateway:
+    """asyncio 網關 - 單一事件循環線程 + 共用 aiohttp 連接池"""
+
+    def __init__(self, api_key: str, api_secret: str, base_url: str = FAPI_BASE_URL,
+                 time_provider: Optional[Callable[[], int]] = None, recv_window: int = 5000,
+                 pool_size: int = 10, executor_workers: int = 8, weight_budget=None):
+        self.api_key = api_key
+        self._secret = api_secret.encode()
+        self.base_url = base_url
+        # 簽名時間戳來源（校正後的伺服器時間，毫秒）
+        self.time_provider = time_provider or (lambda: int(time.time() * 1000))
+        self.recv_window = recv_window
+        self.pool_size = pool_size
+        self.executor_workers = executor_workers
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.session: Optional[aiohttp.ClientSession] = None         # REST 連接池（帶延遲統計）
+        self.stream_session: Optional[aiohttp.ClientSession] = None  # 行情流連接（不計入REST統計）
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+        self.connection_stats = ConnectionStats()
+        self._last_prewarm = 0.0
+        self._prewarm_future: Optional[Future] = None
+        # 請求權重預算（weight_budget.WeightBudget），每個響應的用量標頭都回報給它
+        self.weight_budget = weight_budget
+
+    # ========== 生命週期 ==========
+
+    def start(self):
+        """啟動事件循環線程並建立連接池（重複調用無副作用）"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._ready.clear()
+        self._thread = threading.Thread(target=self._run_loop, name='async-gateway', daemon=True)
+        self._thread.start()
+        self._ready.wait(timeout=10)
+
+    def _run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        # 固定大小的執行緒池：阻塞回調和未對應原生端點的 python-binance 調用都在這裡執行
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=self.executor_workers,
+                                                          thread_name_prefix='gateway-worker'))
+        self.loop.run_until_complete(self._open_session())
+        self._ready.set()
+        self.loop.run_forever()
+
+    async def _open_session(self):
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.pool_size, keepalive_timeout=60,
+                                         ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(connector=connector, headers={'X-MBX-APIKEY': self.api_key},
+                                             trace_configs=[self.connection_stats.trace_config()])
+        self.stream_session = aiohttp.ClientSession()
+
+    def stop(self):
+        if self.loop is None or not self.loop.is_running():
+            return
+        self.run(self._cancel_tasks(), timeout=5)
+        for session in (self.session, self.stream_session):
+            if session is not None:
+                self.run(session.close(), timeout=5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+
+    async def _cancel_tasks(self, timeout: float = 2.0):
+        """取消事件循環中尚未完成的協程（背景預載、行情流等）並等待結束，避免停止後任務被直接銷毀"""
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+    def in_loop_thread(self) -> bool:
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def submit(self, coro) -> Future:
+        """從任意線程提交協程到事件循環，立即返回 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """同步等待協程結果（不可在事件循環線程內調用）"""
+        if self.in_loop_thread():
+            coro.close()
+            raise RuntimeError("不可在網關事件循環線程內同步等待")
+        return self.submit(coro).result(timeout)
+
+    async def run_blocking(self, func, *args):
+        """在網關執行緒池中執行阻塞函數（記錄、通知等），不卡住事件循環"""
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    # ========== REST ==========
+
+    def _sign(self, params: Dict) -> str:
+        params['timestamp'] = self.time_provider()
+        params.setdefault('recvWindow', self.recv_window)
+        query = urlencode(params)
+        signature = hmac.new(self._secret, query.encode(), hashlib.sha256).hexdigest()
+        return f"{query}&signature={signature}"
+
+    @staticmethod
+    def _normalize(params: Optional[Dict]) -> Dict:
+        # 與 python-binance 一致：布林值轉為 'true'/'false'，略過 None
+        normalized = {}
+        for key, value in (params or {}).items():
+            if value is None:
+                continue
+            normalized[key] = ('true' if value else 'false') if isinstance(value, bool) else value
+        return normalized
+
+    async def request(self, method: str, path: str, params: Optional[Dict] = None,
+                      signed: bool = False, timeout: float = 1.0, trace: Optional[RequestTrace] = None):
+        """單次 REST 請求，超時拋出 TimeoutError，幣安錯誤拋出 BinanceAPIException；trace 記錄請求是否已寫出"""
+        params = self._normalize(params)
+        query = self._sign(params) if signed else urlencode(params)
+        url = f"{self.base_url}{path}?{query}" if query else f"{self.base_url}{path}"
+
+        async def _do():
+            async with self.session.request(method, url, trace_request_ctx=trace) as response:
+                if self.weight_budget is not None:
+                    self.weight_budget.update_from_headers(response.headers, response.status)
+                text = await response.text()
+                if response.status >= 400:
+                    raise BinanceAPIException(response, response.status, text)
+                return await response.json(content_type=None)
+
+        try:
+            return await asyncio.wait_for(_do(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"API調用超時: {timeout}秒")
+
+    async def request_with_retry(self, method: str, path: str, params: Optional[Dict] = None,
+                                 signed: bool = False, timeout: float = 1.0, max_retries: int = 2):
+        """帶重試的 REST 請求 - 只重送確定未執行的失敗（見 _after_failure），以指數退避
+        下單自動帶上 newClientOrderId，各次重送與查詢使用同一個"""
+        params = dict(params or {})
+        if path == ORDER_PATH:
+            params.setdefault('newClientOrderId', new_client_order_id())
+        for attempt in range(max_retries + 1):
+            trace = RequestTrace()
+            try:
+                return await self.request(method, path, params, signed=signed, timeout=timeout, trace=trace)
+            except Exception as e:
+                existing = await self._after_failure(e, trace.wire_at is not None, path, params, timeout,
+                                                     last=attempt >= max_retries)
+                if existing is not None:
+                    return existing
+            await asyncio.sleep(0.5 * (2 ** attempt))  # 指數退避：0.5s, 1s, 2s
+
+    async def _after_failure(self, error: Exception, sent: bool, path: str, params: Dict, timeout: float,
+                             last: bool) -> Optional[Dict]:
+        """請求失敗後的判斷：返回按 clientOrderId 查到的已執行訂單；返回 None 表示可以重送；否則拋出原錯誤
+        - 下單已寫出後任何失敗（連接中斷、超時、無法解析的回應等）：先查詢，已存在則視為成功；
+          查無此單時連接中斷可重送，超時仍拋出（可能還在處理）
+        - 幣安錯誤只重送限流/時間戳（RETRYABLE_CODES），非冪等端點已寫出後的連接錯誤不重送"""
+        if sent and path == ORDER_PATH and not isinstance(error, BinanceAPIException) \
+                and params.get('newClientOrderId'):
+            try:
+                existing = await self.lookup_order(params['symbol'], params['newClientOrderId'], timeout=timeout)
+            except Exception:
+                raise error  # 無法確認訂單狀態，不重送
+            if existing is not None:
+                return existing
+            if not isinstance(error, aiohttp.ClientError) or last:
+                raise error
+            return None
+        if last or not is_retryable(error, sent, idempotent=path not in NON_IDEMPOTENT_PATHS):
+            raise error
+        return None
+
+    async def find_order(self, symbol: str, client_order_id: str, timeout: float = 1.0) -> Optional[Dict]:
+        """按 clientOrderId 查詢訂單，不存在（-2013）時返回 None"""
+        try:
+            return await self.request('GET', ORDER_PATH, {'symbol': symbol, 'origClientOrderId': client_order_id},
+                                      signed=True, timeout=timeout)
+        except BinanceAPIException as e:
+            if e.code == -2013:
+                return None
+            raise
+
+    async def lookup_order(self, symbol: str, client_order_id: str, timeout: float = 1.0,
+                           attempts: int = ORDER_LOOKUP_ATTEMPTS) -> Optional[Dict]:
+        """確認狀態未知的下單：find_order 本身逾時、斷線或被限流時退避重查（查詢是冪等的），其他錯誤直接拋出"""
+        for attempt in range(attempts):
+            try:
+                return await self.find_order(symbol, client_order_id, timeout=timeout)
+            except (TimeoutError, aiohttp.ClientError, BinanceAPIException) as e:
+                if attempt + 1 >= attempts or (isinstance(e, BinanceAPIException) and e.code not in RETRYABLE_CODES):
+                    raise
+            await asyncio.sleep(0.2 * (2 ** attempt))
+
+    async def call(self, api_func, *args, timeout: float = 1.0, **kwargs):
+        """執行 python-binance 方法：有對應原生端點時走連接池，否則在執行緒池中執行並以 wait_for 控制超時"""
+        endpoint = CLIENT_ENDPOINTS.get(getattr(api_func, '__name__', ''))
+        if endpoint is not None and not args:
+            method, path, signed = endpoint
+            return await self.request(method, path, kwargs, signed=signed, timeout=timeout)
+        loop = asyncio.get_running_loop()
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(None, lambda: api_func(*args, **kwargs)), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"API調用超時: {timeout}秒")
+
+    # ========== 連接預熱 ==========
+
+    async def prewarm(self, connections: int = PREWARM_CONNECTIONS, timeout: float = 2.0) -> int:
+        """併發發送無簽名 ping，讓連接池中保持 N 條已完成握手的連接，返回成功數"""
+        results = await asyncio.gather(
+            *(self.request('GET', '/fapi/v1/ping', timeout=timeout) for _ in range(connections)),
+            return_exceptions=True)
+        return sum(1 for result in results if not isinstance(result, BaseException))
+
+    def keep_warm(self, connections: int = PREWARM_CONNECTIONS, min_interval: float = PREWARM_INTERVAL):
+        """非阻塞預熱：距上次預熱超過 min_interval 且沒有進行中的預熱時才提交（可在主循環每個 tick 調用）"""
+        now = time.time()
+        if now - self._last_prewarm < min_interval:
+            return
+        if self._prewarm_future is not None and not self._prewarm_future.done():
+            return
+        self._last_prewarm = now
+        self._prewarm_future = self.submit(self.prewarm(connections))
+
+    # ========== 預簽名訂單 ==========
+
+    def _presign(self, staged: StagedOrder):
+        params = dict(staged.params)
+        staged.url = f"{self.base_url}{staged.path}?{self._sign(params)}"
+        staged.signed_at = time.time()
+
+    def stage_order(self, **params) -> StagedOrder:
+        """預先構建並簽名下單請求（可在任意線程調用），觸發時交給 send_staged() 發送"""
+        params.setdefault('newClientOrderId', new_client_order_id())
+        staged = StagedOrder('POST', ORDER_PATH, self._normalize(params))
+        self._presign(staged)
+        return staged
+
+    def stage_batch(self, orders: List[Dict]) -> StagedOrder:
+        """把多筆下單參數簽名為一個 /fapi/v1/batchOrders 請求（交易所每個請求最多5筆，參數值以字符串傳遞）
+        沒有 newClientOrderId 的訂單就地補上，單獨重送時沿用"""
+        for order in orders:
+            order.setdefault('newClientOrderId', new_client_order_id())
+        batch = [{key: str(value) for key, value in self._normalize(order).items()} for order in orders]
+        staged = StagedOrder('POST', '/fapi/v1/batchOrders', {'batchOrders': json.dumps(batch, separators=(',', ':'))})
+        self._presign(staged)
+        return staged
+
+    def refresh_staged(self, staged: Optional[StagedOrder], max_age: float = STAGED_ORDER_MAX_AGE) -> bool:
+        """簽名超過 max_age 時以校正後的時間重新簽名，返回是否已重簽（倒數階段每個 tick 調用）"""
+        if staged is None or not staged.is_stale(max_age):
+            return False
+        self._presign(staged)
+        return True
+
+    async def send_staged(self, staged: StagedOrder, trigger_at: Optional[float] = None,
+                          timeout: float = 1.0, max_retries: int = 2):
+        """發送預簽名訂單，首次嘗試直接寫入預先構建的URL；失敗時退回正常簽名重試"""
+        staged.trigger_at = trigger_at if trigger_at is not None else time.perf_counter()
+        staged.wire_at = None
+        # 觸發前未及時刷新（例如先設置了槓桿）時就地重簽，仍省去參數構建
+        self.refresh_staged(staged)
+
+        async def _do():
+            async with self.session.request(staged.method, staged.url, trace_request_ctx=staged) as response:
+                if self.weight_budget is not None:
+                    self.weight_budget.update_from_headers(response.headers, response.status)
+                text = await response.text()
+                if response.status >= 400:
+                    raise BinanceAPIException(response, response.status, text)
+                return await response.json(content_type=None)
+
+        try:
+            return await asyncio.wait_for(_do(), timeout)
+        except asyncio.TimeoutError:
+            error = TimeoutError(f"API調用超時: {timeout}秒")
+        except Exception as e:
+            error = e
+        existing = await self._after_failure(error, staged.wire_at is not None, staged.path, staged.params, timeout,
+                                             last=max_retries <= 0)
+        if existing is not None:
+            return existing
+        await asyncio.sleep(0.5)
+        return await self.request_with_retry(staged.method, staged.path, staged.params, signed=True,
+                                             timeout=timeout, max_retries=max_retries - 1)
+
+    # ========== 常用端點 ==========
+
+    async def create_order(self, timeout: float = 1.0, max_retries: int = 2, **params):
+        return await self.request_with_retry('POST', ORDER_PATH, params, signed=True,
+                                             timeout=timeout, max_retries=max_retries)
+
+    async def change_leverage(self, symbol: str, leverage: int, timeout: float = 1.0, max_retries: int = 2):
+        return await self.request_with_retry('POST', '/fapi/v1/leverage', {'symbol': symbol, 'leverage': leverage},
+                                             signed=True, timeout=timeout, max_retries=max_retries)
+
+    async def position_information(self, timeout: float = 1.0, max_retries: int = 2, **params):
+        return await self.request_with_retry('GET', '/fapi/v2/positionRisk', params, signed=True,
+                                             timeout=timeout, max_retries=max_retries)
+
+    # ========== WebSocket ==========
+
+    def open_market_stream(self, url: str, on_message: Callable[[str], None], **callbacks) -> MarketStream:
+        """在網關事件循環中打開行情流"""
+        return MarketStream(self, url, on_message, **callbacks)
+
+
+# 使用示例：python async_gateway.py  （公開端點，不需要API金鑰）
+if __name__ == "__main__":
+    gateway = AsyncGateway('', '')
+    gateway.start()
+
+    async def demo():
+        start = time.perf_counter()
+        await gateway.request('GET', '/fapi/v1/time', timeout=3)
+        first_ms = (time.perf_counter() - start) * 1000
+
+        # 10 個併發請求共用同一連接池
+        start = time.perf_counter()
+        await asyncio.gather(*(gateway.request('GET', '/fapi/v1/time', timeout=3) for _ in range(10)))
+        concurrent_ms = (time.perf_counter() - start) * 1000
+        return first_ms, concurrent_ms
+
+    try:
+        first_ms, concurrent_ms = gateway.run(demo(), timeout=30)
+        print(f"首次請求（含握手）: {first_ms:.1f}ms | 10個併發請求（共用連接池）: {concurrent_ms:.1f}ms")
+        gateway.run(gateway.prewarm(), timeout=10)
+        print(gateway.connection_stats.format_summary())
+
+        # 下單路徑的本地準備耗時：發送時構建參數並簽名 vs 使用預簽名URL
+        rounds = 10000
+        start = time.perf_counter()
+        for _ in range(rounds):
+            params = gateway._normalize({'symbol': 'BTCUSDT', 'side': 'BUY', 'type': 'MARKET', 'quantity': 1})
+            f"{gateway.base_url}/fapi/v1/order?{gateway._sign(params)}"
+        sign_us = (time.perf_counter() - start) / rounds * 1e6
+        staged = gateway.stage_order(symbol='BTCUSDT', side='BUY', type='MARKET', quantity=1)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            gateway.refresh_staged(staged)
+            staged.url
+        staged_us = (time.perf_counter() - start) / rounds * 1e6
+        print(f"下單前準備: 即時簽名 {sign_us:.1f}µs | 預簽名 {staged_us:.2f}µs")
+    except Exception as e:
+        print(f"網關示例失敗: {e}")
+    finally:
+        gateway.stop()
@@ -0,0 +1,194 @@
+"""
+熱路徑日誌的專用寫入線程
+log_trade_step / log_trade_event / log_system_event 在調用線程上只把 (類型, 校正時間ms, 欄位...) 放入佇列，
+時間格式化、numpy 轉換、JSON 編碼以及輪轉文件/控制台寫入都在寫入線程完成，進場路徑不再被磁碟 I/O 阻塞
+"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+_STOP = object()
+
+
+class AsyncLogWriter:
+    """單一寫入線程 - submit() 只做一次 SimpleQueue.put，format_entry(entry) 在寫入線程把條目轉成日誌行"""
+
+    def __init__(self, logger: logging.Logger, format_entry: Callable[[Tuple], Optional[str]],
+                 name: str = 'log-writer'):
+        self.logger = logger
+        self.format_entry = format_entry
+        self.name = name
+        self.written = 0
+        self.errors = 0
+        self._queue = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> 'AsyncLogWriter':
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+                atexit.register(self.stop)
+        return self
+
+    def submit(self, entry: Tuple):
+        """熱路徑調用：entry 內的 dict 所有權交給寫入線程，調用方之後不得再修改"""
+        self._queue.put(entry)
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """等待此前提交的條目全部寫出（寫入線程未運行時在當前線程直接寫出）"""
+        if self._thread is None or not self._thread.is_alive():
+            self._drain()
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def stop(self, timeout: float = 5.0):
+        """寫出剩餘條目後結束寫入線程，可重複調用"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join(timeout)
+        self._drain()
+
+    def _drain(self):
+        while True:
+            try:
+                entry = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            self._handle(entry)
+
+    def _run(self):
+        while True:
+            entry = self._queue.get()
+            if entry is _STOP:
+                return
+            self._handle(entry)
+
+    def _handle(self, entry):
+        if isinstance(entry, threading.Event):
+            entry.set()
+            return
+        if entry is _STOP:
+            return
+        if not self.logger.isEnabledFor(logging.INFO):  # 日誌器被停用（如回放）時不做格式化
+            return
+        try:
+            line = self.format_entry(entry)
+            if line is not None:
+                self.logger.info(line)
+                self.written += 1
+        except Exception:
+            self.errors += 1
+
+
+# 使用示例：python async_log.py [次數]  （進場路徑約15條 STEP 日誌：同步寫入 vs 佇列寫入的調用線程開銷）
+if __name__ == "__main__":
+    import json
+    import os
+    import sys
+    import tempfile
+    from datetime import datetime
+    from logging.handlers import RotatingFileHandler
+
+    import numpy as np
+
+    def safe_json_serialize(obj):
+        if isinstance(obj, np.integer):
+            return int(obj)
+        elif isinstance(obj, np.floating):
+            return float(obj)
+        elif isinstance(obj, dict):
+            return {key: safe_json_serialize(value) for key, value in obj.items()}
+        elif isinstance(obj, list):
+            return [safe_json_serialize(item) for item in obj]
+        return obj
+
+    def format_ms(ms: float) -> str:
+        return datetime.fromtimestamp(int(ms) / 1000).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+    def format_step(entry: Tuple) -> str:
+        _, ms, step, symbol, action, details = entry
+        log_entry = {'timestamp': format_ms(ms), 'step': step, 'symbol': symbol, 'action': action,
+                     'details': safe_json_serialize(details or {})}
+        return f"STEP: {json.dumps(log_entry, ensure_ascii=False)}"
+
+    entry_steps = ['start', 'leverage_skipped', 'fetch_price_start', 'price_from_websocket', 'fetch_price_success',
+                   'calculate_quantity_start', 'calculate_quantity_success', 'prepare_order', 'send_order_start',
+                   'send_order_async', 'entry_complete', 'entry_success_wait_settlement', 'time_triggered',
+                   'start_entry', 'send_order_success']
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    def make_logger(name: str, directory: str) -> logging.Logger:
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        file_handler = RotatingFileHandler(os.path.join(directory, f'{name}.txt'), maxBytes=5 * 1024 * 1024,
+                                           backupCount=7, encoding='utf-8')
+        file_handler.setFormatter(formatter)
+        console_handler = logging.StreamHandler(open(os.devnull, 'w', encoding='utf-8'))  # 控制台輸出丟棄，只計格式化與寫入開銷
+        console_handler.setFormatter(formatter)
+        logger = logging.getLogger(f'bench.{name}')
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(file_handler)
+        logger.addHandler(console_handler)
+        return logger
+
+    def details_for(index: int) -> dict:
+        return {'direction': 'long', 'price': np.float64(27123.4 + index), 'quantity': 0.012,
+                'funding_rate': -0.0123, 'order_id': f'entry_{index}'}
+
+    def run(log_step) -> np.ndarray:
+        samples = np.empty(entries)
+        for index in range(entries):
+            start = time.perf_counter()
+            for step in entry_steps:
+                log_step(step, details_for(index))
+            samples[index] = (time.perf_counter() - start) * 1e6
+        return samples
+
+    with tempfile.TemporaryDirectory() as directory:
+        sync_logger = make_logger('sync', directory)
+
+        def sync_step(step, details):
+            ms = time.time() * 1000
+            sync_logger.info(format_step(('STEP', ms, 'entry', 'BTCUSDT', step, details)))
+
+        writer = AsyncLogWriter(make_logger('queued', directory), format_step).start()
+
+        def queued_step(step, details):
+            writer.submit(('STEP', time.time() * 1000, 'entry', 'BTCUSDT', step, details))
+
+        results = {}
+        for label, log_step in (('同步寫入', sync_step), ('佇列寫入', queued_step)):
+            run(log_step)  # 預熱
+            writer.flush(30)
+            results[label] = run(log_step)
+            drain_start = time.perf_counter()
+            writer.flush(30)
+            results[label + '（寫入線程清空）'] = np.array([(time.perf_counter() - drain_start) * 1e6])
+        writer.stop()
+
+        print(f"每次進場 {len(entry_steps)} 條 STEP 日誌，{entries} 次進場，調用線程耗時（µs）")
+        print(f"  {'p50':>10}{'p99':>10}{'p999':>10}{'最大':>10}  寫入方式")
+        for label in ('同步寫入', '佇列寫入'):
+            samples = results[label]
+            print(f"  {np.percentile(samples, 50):>10.1f}{np.percentile(samples, 99):>10.1f}"
+                  f"{np.percentile(samples, 99.9):>10.1f}{samples.max():>10.1f}  {label}")
+        sync_p50 = np.percentile(results['同步寫入'], 50)
+        queued_p50 = np.percentile(results['佇列寫入'], 50)
+        print(f"p50 縮短 {sync_p50 / queued_p50:.1f} 倍；寫入線程清空 {entries * len(entry_steps)} 條積壓耗時 "
+              f"{results['佇列寫入（寫入線程清空）'][0] / 1000:.1f}ms，已寫出 {writer.written} 條，錯誤 {writer.errors} 條")
+        with open(os.path.join(directory, 'queued.txt'), encoding='utf-8') as f:
+            last_line = f.readlines()[-1]
+        assert writer.errors == 0 and last_line.split(' - INFO - ')[1].startswith('STEP: {"timestamp"')
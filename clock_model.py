@@ -0,0 +1,218 @@
+"""
+服務器時鐘模型
+以本機單調時鐘（perf_counter）為基準，對每次同步的一組 serverTime 樣本只保留往返延遲最低的部分，
+擬合 偏移 + 線性漂移，提供校正後的服務器時間與誤差上界；
+距離下次資金費率結算越近，採樣間隔越短，進場前最後幾秒停止採樣避免佔用連接
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+BURST_SIZE = 5               # 每次同步連續採樣數
+BURST_SPACING = 0.02         # 同一組樣本之間的間隔（秒）
+KEEP_FRACTION = 0.3          # 擬合時保留往返延遲最低的樣本比例
+MIN_DRIFT_SPAN_MS = 60000    # 樣本時間跨度不足時不估計漂移
+SERVER_TIME_RESOLUTION_MS = 1.0  # serverTime 為整數毫秒
+
+# (距離結算的毫秒數上限, 採樣間隔秒數)，由遠到近；最後一段返回 None 表示停止採樣
+SYNC_CADENCE = (
+    (float('inf'), 300.0),
+    (600000, 60.0),
+    (120000, 15.0),
+    (30000, 5.0),
+    (5000, None),
+)
+
+
+class ClockSample:
+    """一次 serverTime 採樣 - 本機時間為 perf_counter 毫秒"""
+
+    __slots__ = ('local_send', 'local_recv', 'server_time')
+
+    def __init__(self, local_send: float, local_recv: float, server_time: float):
+        self.local_send = local_send
+        self.local_recv = local_recv
+        self.server_time = server_time
+
+    @property
+    def rtt(self) -> float:
+        return self.local_recv - self.local_send
+
+    @property
+    def local_mid(self) -> float:
+        return (self.local_send + self.local_recv) / 2
+
+    @property
+    def offset(self) -> float:
+        """假設往返對稱時的偏移：服務器時間 - 本機中點時間"""
+        return self.server_time - self.local_mid
+
+
+class ServerClockModel:
+    """時鐘模型 - 服務器時間 = 本機單調時間 + 偏移 + 漂移 × (本機時間 - 參考點)"""
+
+    def __init__(self, window: int = 60, keep_fraction: float = KEEP_FRACTION):
+        self.samples = deque(maxlen=window)
+        self.keep_fraction = keep_fraction
+        self._lock = threading.Lock()
+        # 本機單調時鐘 -> epoch 毫秒 的基準，擬合前用於輸出本機時間
+        self._epoch_base = time.time() * 1000 - time.perf_counter() * 1000
+        # (參考點, 偏移, 漂移 ms/ms, 誤差上界 ms)，整體替換，讀取端不需加鎖
+        self._fit: Optional[Tuple[float, float, float, float]] = None
+        self.last_sync = 0.0  # 上次同步的 time.time()
+
+    @staticmethod
+    def local_ms() -> float:
+        return time.perf_counter() * 1000
+
+    @property
+    def ready(self) -> bool:
+        return self._fit is not None
+
+    # ========== 採樣 ==========
+
+    def add_sample(self, local_send: float, server_time: float, local_recv: float):
+        with self._lock:
+            self.samples.append(ClockSample(local_send, local_recv, server_time))
+
+    def sample_burst(self, fetch_server_time: Callable[[], float], count: int = BURST_SIZE,
+                     spacing: float = BURST_SPACING) -> int:
+        """連續採樣 count 次並重新擬合，返回成功的樣本數；fetch_server_time 返回 serverTime 毫秒"""
+        collected = 0
+        for i in range(count):
+            local_send = self.local_ms()
+            try:
+                server_time = fetch_server_time()
+            except Exception:
+                continue
+            self.add_sample(local_send, server_time, self.local_ms())
+            collected += 1
+            if spacing > 0 and i < count - 1:
+                time.sleep(spacing)
+        if collected:
+            self.fit()
+            self.last_sync = time.time()
+        return collected
+
+    # ========== 擬合 ==========
+
+    def _selected(self) -> List[ClockSample]:
+        """保留往返延遲最低的樣本（至少3個）"""
+        ordered = sorted(self.samples, key=lambda sample: sample.rtt)
+        keep = max(3, int(len(ordered) * self.keep_fraction))
+        return ordered[:keep]
+
+    def fit(self) -> Optional[Dict]:
+        """以低延遲樣本做最小二乘擬合，返回擬合摘要"""
+        with self._lock:
+            if not self.samples:
+                return None
+            selected = self._selected()
+
+        xs = [sample.local_mid for sample in selected]
+        ys = [sample.offset for sample in selected]
+        n = len(selected)
+        x_mean = sum(xs) / n
+        y_mean = sum(ys) / n
+        sxx = sum((x - x_mean) ** 2 for x in xs)
+
+        drift = 0.0
+        if n >= 3 and max(xs) - min(xs) >= MIN_DRIFT_SPAN_MS and sxx > 0:
+            drift = sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) / sxx
+        residuals = [y - (y_mean + drift * (x - x_mean)) for x, y in zip(xs, ys)]
+        residual_std = (sum(r * r for r in residuals) / max(n - 1, 1)) ** 0.5
+
+        # 誤差上界：真實偏移必在單一樣本 ±RTT/2 之內，取最小者，加上擬合殘差與 serverTime 的整數毫秒量化
+        min_half_rtt = min(sample.rtt for sample in selected) / 2
+        uncertainty = min_half_rtt + 2 * residual_std + SERVER_TIME_RESOLUTION_MS
+        self._fit = (x_mean, y_mean, drift, uncertainty)
+        return {
+            'samples': len(self.samples),
+            'used': n,
+            'offset_ms': self.offset_ms(),
+            'drift_ppm': drift * 1e6,
+            'min_rtt_ms': min_half_rtt * 2,
+            'residual_std_ms': residual_std,
+            'uncertainty_ms': uncertainty
+        }
+
+    # ========== 讀取 ==========
+
+    def server_ms(self, local_ms: Optional[float] = None) -> float:
+        """校正後的服務器時間（epoch 毫秒，帶小數）"""
+        if local_ms is None:
+            local_ms = self.local_ms()
+        fit = self._fit
+        if fit is None:
+            return local_ms + self._epoch_base
+        x_ref, offset, drift, _ = fit
+        return local_ms + offset + drift * (local_ms - x_ref)
+
+    def offset_ms(self) -> float:
+        """目前相對本機系統時間（time.time）的偏移，供顯示與兼容舊的 time_offset"""
+        return self.server_ms() - time.time() * 1000
+
+    def uncertainty_ms(self) -> float:
+        """目前校正時間的誤差上界（毫秒），未同步時為無限大；距上次擬合越久，漂移外推誤差越大"""
+        fit = self._fit
+        if fit is None:
+            return float('inf')
+        x_ref, _, drift, uncertainty = fit
+        newest = self.samples[-1].local_mid if self.samples else x_ref
+        # 未估計漂移時，按 50ppm 的典型晶振誤差外推
+        drift_error = abs(drift) if drift else 50e-6
+        return uncertainty + drift_error * max(self.local_ms() - newest, 0.0)
+
+    def sync_interval(self, ms_to_settlement: Optional[float]) -> Optional[float]:
+        """按距離結算的時間返回採樣間隔（秒），None 表示此時不應採樣"""
+        if ms_to_settlement is None or ms_to_settlement <= 0:
+            return SYNC_CADENCE[0][1]
+        interval = SYNC_CADENCE[0][1]
+        for limit, cadence in SYNC_CADENCE:
+            if ms_to_settlement <= limit:
+                interval = cadence
+        return interval
+
+    def should_sync(self, ms_to_settlement: Optional[float]) -> bool:
+        if not self.ready:
+            return True
+        interval = self.sync_interval(ms_to_settlement)
+        return interval is not None and time.time() - self.last_sync >= interval
+
+
+# 使用示例：python clock_model.py
+# 經 AsyncGateway 對本地模擬交易所（時鐘偏移已知）採樣 /fapi/v1/time，驗證擬合的偏移落在誤差上界之內，不需要網路
+if __name__ == "__main__":
+    import sys
+    from async_gateway import AsyncGateway
+    from fake_exchange import FakeBinanceServer, FakeMarket, LatencyProfile
+
+    true_offset = 1234.6  # 模擬交易所時鐘比本機快 1234.6ms
+    server = FakeBinanceServer(FakeMarket(clock_offset_ms=true_offset), latency=LatencyProfile('lognormal', 2.0, 0.5)).start()
+    gateway = AsyncGateway('key', 'secret', base_url=server.base_url)
+    gateway.start()
+
+    def fetch_server_time():
+        return gateway.run(gateway.request('GET', '/fapi/v1/time', timeout=1.0), timeout=2.0)['serverTime']
+
+    model = ServerClockModel()
+    try:
+        for _ in range(3):
+            model.sample_burst(fetch_server_time)
+            summary = model.fit()
+            print(f"偏移 {summary['offset_ms']:+.2f}ms | 漂移 {summary['drift_ppm']:+.1f}ppm | "
+                  f"最低RTT {summary['min_rtt_ms']:.1f}ms | 殘差 {summary['residual_std_ms']:.2f}ms | "
+                  f"誤差上界 ±{summary['uncertainty_ms']:.2f}ms（{summary['used']}/{summary['samples']}個樣本）")
+            time.sleep(0.2)
+    finally:
+        gateway.stop()
+        server.stop()
+
+    error = model.offset_ms() - true_offset
+    print(f"實際偏移 {true_offset:+.2f}ms，擬合誤差 {error:+.2f}ms")
+    if abs(error) > model.uncertainty_ms():
+        print(f"❌ 擬合誤差超出誤差上界 ±{model.uncertainty_ms():.2f}ms")
+        sys.exit(1)
+    print("✅ 擬合偏移落在誤差上界之內")
@@ -42,6 +42,10 @@ LEVERAGE = 2  # 槓桿倍數 - 建議 1-3x，避免過高風險
 MIN_FUNDING_RATE = 0.1  # 最小淨收益閾值 (%) - 淨收益 = |資金費率| - 點差
 MAX_SPREAD = 5.0  # 最大點差閾值 (%) - 點差超過此值不進場
 
+# 組合模式設定 (同一結算時間按淨收益取前N個交易對同時進場，每個交易對保證金仍不超過 MAX_POSITION_SIZE)
+PORTFOLIO_MAX_POSITIONS = 1  # 最多同時持倉數 - 1 = 單一持倉
+PORTFOLIO_TOTAL_MARGIN = 0  # 保證金總額上限 (USDT) - 0 = MAX_POSITION_SIZE × PORTFOLIO_MAX_POSITIONS，且不超過可用餘額
+
 # 進場時機設定 (使用校正時間，已包含網絡延遲補償)
 ENTRY_BEFORE_SECONDS = 0.25  # 進場提前秒數 (結算前 N 秒)
 ENTRY_TIME_TOLERANCE = 100  # 進場時間容差 (毫秒) - 時間誤差允許範圍
@@ -0,0 +1,200 @@
+"""
+高精度截止時間調度器
+以校正後的服務器時間為準，在精確的目標時間點執行進場/平倉動作：
+先粗略睡眠到目標前幾毫秒，再以短暫忙等待（spin-wait）對齊，取代 100ms 輪詢，
+並以直方圖記錄每個事件實際觸發時間相對目標時間的偏差
+"""
+
+import heapq
+import itertools
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Callable, Dict, Hashable, Optional
+
+SPIN_MS = 2.0  # 目標前最後多少毫秒改為忙等待
+
+# 偏差直方圖的桶上限（毫秒）
+SKEW_BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 50.0, 100.0, float('inf'))
+
+
+class SkewHistogram:
+    """觸發偏差直方圖 - 偏差 = 實際觸發時間 - 目標時間（毫秒，正數為延遲）"""
+
+    def __init__(self, buckets=SKEW_BUCKETS_MS, maxlen: int = 1000):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.early = 0  # 提前觸發次數（偏差 < 0）
+        self.samples = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def record(self, skew_ms: float):
+        with self._lock:
+            self.samples.append(skew_ms)
+            if skew_ms < 0:
+                self.early += 1
+                return
+            for i, upper in enumerate(self.buckets):
+                if skew_ms <= upper:
+                    self.counts[i] += 1
+                    return
+
+    def percentile(self, q: float) -> float:
+        with self._lock:
+            ordered = sorted(self.samples)
+        if not ordered:
+            return 0.0
+        return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+    def format(self, width: int = 30) -> str:
+        """多行文字直方圖"""
+        total = sum(self.counts) + self.early
+        if total == 0:
+            return "觸發偏差: 尚無數據"
+        lines = [f"觸發偏差（共{total}次）p50 {self.percentile(0.5):.3f}ms | p99 {self.percentile(0.99):.3f}ms | "
+                 f"最大 {self.percentile(1.0):.3f}ms"]
+        if self.early:
+            lines.append(f"  {'< 0':>10} | {self.early}")
+        lower = 0.0
+        peak = max(self.counts) or 1
+        for upper, count in zip(self.buckets, self.counts):
+            if count:
+                label = f"{lower:g}-{upper:g}ms" if upper != float('inf') else f"> {lower:g}ms"
+                lines.append(f"  {label:>10} | {'█' * max(1, int(count / peak * width))} {count}")
+            lower = upper
+        return "\n".join(lines)
+
+
+class DeadlineScheduler:
+    """截止時間調度器 - 單一線程，事件以 key 區分，同 key 重複安排時更新目標時間與動作，每個 key 只觸發一次"""
+
+    def __init__(self, time_provider: Callable[[], float], spin_ms: float = SPIN_MS, name: str = 'deadline-scheduler'):
+        # time_provider 返回校正後的服務器時間（毫秒，可帶小數）
+        self.time_provider = time_provider
+        self.spin_ms = spin_ms
+        self.name = name
+        self.histogram = SkewHistogram()
+        self._heap = []
+        self._events: Dict[Hashable, tuple] = {}  # key -> (目標時間, 序號, 動作, 參數)
+        self._fired = deque(maxlen=256)           # 最近已觸發的 key，防止重複觸發
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+    # ========== 生命週期 ==========
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+    # ========== 安排 / 取消 ==========
+
+    def schedule(self, key: Hashable, target_ms: float, action: Callable, *args) -> bool:
+        """安排（或更新）在 target_ms 執行 action(*args)，key 已觸發過時返回False"""
+        with self._condition:
+            if key in self._fired:
+                return False
+            event = self._events.get(key)
+            if event is not None and event[0] == target_ms and event[2:] == (action, args):
+                return True
+            seq = next(self._counter)
+            self._events[key] = (target_ms, seq, action, args)
+            heapq.heappush(self._heap, (target_ms, seq, key))
+            self._condition.notify()
+            return True
+
+    def cancel(self, key: Hashable) -> bool:
+        with self._condition:
+            return self._events.pop(key, None) is not None
+
+    def pending(self, key: Hashable) -> Optional[float]:
+        """返回 key 的目標時間，未安排時返回None"""
+        event = self._events.get(key)
+        return event[0] if event is not None else None
+
+    def has_fired(self, key: Hashable) -> bool:
+        return key in self._fired
+
+    # ========== 調度線程 ==========
+
+    def _next_event(self):
+        """返回堆頂的有效事件 (目標時間, key)，惰性丟棄已取消或已更新的條目"""
+        heap = self._heap
+        while heap:
+            target_ms, seq, key = heap[0]
+            event = self._events.get(key)
+            if event is not None and event[1] == seq:
+                return target_ms, key
+            heapq.heappop(heap)
+        return None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+                head = self._next_event()
+                if head is None:
+                    self._condition.wait()
+                    continue
+                target_ms, key = head
+                remaining_ms = target_ms - self.time_provider()
+                if remaining_ms > self.spin_ms:
+                    # 粗略睡眠：可被更早的新事件喚醒；時間同步改變偏移後醒來重新計算
+                    self._condition.wait(min(remaining_ms - self.spin_ms, 1000.0) / 1000)
+                    continue
+                target_ms, seq, action, args = self._events.pop(key)
+                heapq.heappop(self._heap)
+                self._fired.append(key)
+
+            # 忙等待到目標時間（最多 spin_ms 毫秒），不持有鎖
+            time_provider = self.time_provider
+            while time_provider() < target_ms:
+                pass
+            self.histogram.record(time_provider() - target_ms)
+
+            try:
+                action(*args)
+            except Exception as e:
+                print(f"[ERROR] 調度事件執行失敗 {key}: {e}")
+                print(traceback.format_exc())
+
+
+def run_benchmark(events: int = 50, interval_ms: float = 20.0) -> SkewHistogram:
+    """以本機時鐘安排一串事件，返回觸發偏差直方圖"""
+    scheduler = DeadlineScheduler(lambda: time.time() * 1000)
+    scheduler.start()
+    done = threading.Event()
+    start_ms = time.time() * 1000 + 100
+    for i in range(events):
+        last = i == events - 1
+        scheduler.schedule(('bench', i), start_ms + i * interval_ms, done.set if last else (lambda: None))
+    done.wait(timeout=events * interval_ms / 1000 + 5)
+    scheduler.stop()
+    return scheduler.histogram
+
+
+# 使用示例：python deadline_scheduler.py
+if __name__ == "__main__":
+    print("=== 截止時間調度器：觸發偏差 ===")
+    print(run_benchmark().format())
+
+    # 對照：100ms 輪詢在目標時間後的第一個 tick 才觸發
+    polling = SkewHistogram()
+    for _ in range(50):
+        target_ms = time.time() * 1000 + 150
+        while time.time() * 1000 < target_ms:
+            time.sleep(0.1)
+        polling.record(time.time() * 1000 - target_ms)
+    print("=== 對照：100ms 輪詢 ===")
+    print(polling.format())
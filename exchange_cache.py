@@ -0,0 +1,243 @@
+"""
+交易所信息持久化緩存（SQLite）
+保存 futures_exchange_info（以其 serverTime 為版本鍵）、各交易對的數量/價格精度與過濾器、已確認的槓桿，
+重啟時直接從本地讀取即可進入可交易狀態，過期或下單報過濾器錯誤時才在背景重新下載（惰性校驗）
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+EXCHANGE_CACHE_FILE = 'exchange_cache.db'
+EXCHANGE_INFO_MAX_AGE = 6 * 3600  # 交易所信息超過6小時視為過期（秒）
+
+# 下單被拒且代表本地精度/過濾器可能過時的錯誤碼：精度、過濾器、數量上下限、tick、最小名義價值
+FILTER_ERROR_CODES = frozenset({-1013, -1111, -4003, -4005, -4014, -4164})
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS symbols (
+    symbol TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    quantity_precision INTEGER,
+    price_precision INTEGER,
+    step_size TEXT,
+    tick_size TEXT,
+    min_qty TEXT,
+    max_qty TEXT,
+    market_step_size TEXT,
+    market_min_qty TEXT,
+    market_max_qty TEXT,
+    min_notional TEXT,
+    filters TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leverage (
+    symbol TEXT PRIMARY KEY,
+    leverage INTEGER NOT NULL,
+    confirmed_at REAL NOT NULL
+);
+"""
+
+
+def _filter_map(symbol_info: Dict) -> Dict[str, Dict]:
+    return {item['filterType']: item for item in symbol_info.get('filters', [])}
+
+
+def symbol_row(symbol_info: Dict) -> Tuple:
+    """把 exchange_info['symbols'] 的一項轉為 symbols 表的一行"""
+    filters = _filter_map(symbol_info)
+    lot = filters.get('LOT_SIZE', {})
+    market_lot = filters.get('MARKET_LOT_SIZE', {})
+    price = filters.get('PRICE_FILTER', {})
+    notional = filters.get('MIN_NOTIONAL', {})
+    return (
+        symbol_info['symbol'],
+        symbol_info.get('status', ''),
+        symbol_info.get('quantityPrecision'),
+        symbol_info.get('pricePrecision'),
+        lot.get('stepSize'),
+        price.get('tickSize'),
+        lot.get('minQty'),
+        lot.get('maxQty'),
+        market_lot.get('stepSize'),
+        market_lot.get('minQty'),
+        market_lot.get('maxQty'),
+        notional.get('notional', notional.get('minNotional')),
+        json.dumps(symbol_info.get('filters', []), separators=(',', ':')),
+    )
+
+
+class ExchangeCache:
+    """交易所信息緩存 - 單一 SQLite 連接（WAL），多線程共用一把鎖"""
+
+    def __init__(self, path: str = EXCHANGE_CACHE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')  # WAL 下提交不強制刷盤，槓桿寫入不拖慢進場路徑
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # ========== meta ==========
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value):
+        self._conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    # ========== exchange info ==========
+
+    def save_exchange_info(self, exchange_info: Dict):
+        """保存完整的 exchange_info，並按交易對拆出精度與過濾器"""
+        rows = [symbol_row(item) for item in exchange_info.get('symbols', [])]
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM symbols')
+            self._conn.executemany('INSERT INTO symbols VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self._set_meta('exchange_info', json.dumps(exchange_info, separators=(',', ':')))
+            self._set_meta('exchange_info_server_time', exchange_info.get('serverTime', 0))
+            self._set_meta('exchange_info_saved_at', time.time())
+
+    def load_exchange_info(self) -> Optional[Dict]:
+        """讀取緩存的完整 exchange_info，沒有時返回None"""
+        with self._lock:
+            raw = self._get_meta('exchange_info')
+        return json.loads(raw) if raw else None
+
+    def exchange_info_server_time(self) -> int:
+        with self._lock:
+            value = self._get_meta('exchange_info_server_time')
+        return int(value) if value else 0
+
+    def is_stale(self, now_ms: float, max_age: float = EXCHANGE_INFO_MAX_AGE) -> bool:
+        """以 exchange_info 的 serverTime 判斷是否過期"""
+        server_time = self.exchange_info_server_time()
+        return server_time == 0 or now_ms - server_time > max_age * 1000
+
+    def invalidate_exchange_info(self):
+        """下單遇到精度/過濾器錯誤時調用，下次讀取時視為過期"""
+        with self._lock, self._conn:
+            self._set_meta('exchange_info_server_time', 0)
+
+    def symbol(self, symbol: str) -> Optional[Dict]:
+        """單一交易對的精度與過濾器"""
+        with self._lock:
+            cursor = self._conn.execute('SELECT * FROM symbols WHERE symbol = ?', (symbol,))
+            row = cursor.fetchone()
+            columns = [column[0] for column in cursor.description]
+        if row is None:
+            return None
+        data = dict(zip(columns, row))
+        data['filters'] = json.loads(data['filters'])
+        return data
+
+    def all_symbols(self) -> List[Dict]:
+        """全部交易對的精度與過濾器欄位（不含原始 filters），供啟動時一次性構建過濾器表"""
+        with self._lock:
+            cursor = self._conn.execute('SELECT * FROM symbols')
+            rows = cursor.fetchall()
+            columns = [column[0] for column in cursor.description if column[0] != 'filters']
+        return [dict(zip(columns, row[:-1])) for row in rows]
+
+    def symbols(self, status: Optional[str] = 'TRADING') -> Iterable[str]:
+        with self._lock:
+            if status is None:
+                rows = self._conn.execute('SELECT symbol FROM symbols').fetchall()
+            else:
+                rows = self._conn.execute('SELECT symbol FROM symbols WHERE status = ?', (status,)).fetchall()
+        return [row[0] for row in rows]
+
+    # ========== 槓桿 ==========
+
+    def leverage_map(self) -> Dict[str, Tuple[int, float]]:
+        """{symbol: (槓桿, 確認時間)}"""
+        with self._lock:
+            rows = self._conn.execute('SELECT symbol, leverage, confirmed_at FROM leverage').fetchall()
+        return {symbol: (leverage, confirmed_at) for symbol, leverage, confirmed_at in rows}
+
+    def set_leverage(self, symbol: str, leverage: int, confirmed_at: Optional[float] = None):
+        self.set_leverage_many([(symbol, leverage)], confirmed_at)
+
+    def set_leverage_many(self, items: Iterable[Tuple[str, int]], confirmed_at: Optional[float] = None):
+        confirmed_at = confirmed_at or time.time()
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO leverage (symbol, leverage, confirmed_at) VALUES (?, ?, ?)',
+                                   [(symbol, int(leverage), confirmed_at) for symbol, leverage in items])
+
+    def invalidate_leverage(self, symbol: str):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM leverage WHERE symbol = ?', (symbol,))
+
+
+# 使用示例：python exchange_cache.py         （本地模擬交易所，不需要網路）
+#          python exchange_cache.py --live  （幣安正式環境，寫入 exchange_cache.db）
+# 經 AsyncGateway 下載一次 exchange_info 後測量冷/熱啟動耗時，並驗證交易對與槓桿在重新打開後仍可讀取
+if __name__ == "__main__":
+    import asyncio
+    import os
+    import sys
+    import tempfile
+
+    import aiohttp
+    from async_gateway import AsyncGateway
+
+    live = '--live' in sys.argv
+    server = None
+    if live:
+        gateway = AsyncGateway('', '')
+        path = EXCHANGE_CACHE_FILE
+    else:
+        from fake_exchange import FakeBinanceServer
+        server = FakeBinanceServer().start()
+        gateway = AsyncGateway('', '', base_url=server.base_url)
+        path = os.path.join(tempfile.mkdtemp(), EXCHANGE_CACHE_FILE)
+    gateway.start()
+
+    cache = ExchangeCache(path)
+    try:
+        start = time.perf_counter()
+        info = cache.load_exchange_info()
+        warm_ms = (time.perf_counter() - start) * 1000
+        if info is None or cache.is_stale(time.time() * 1000):
+            start = time.perf_counter()
+            try:
+                info = gateway.run(gateway.request('GET', '/fapi/v1/exchangeInfo', timeout=10.0), timeout=15.0)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                print(f"❌ 無法下載 exchange_info（{gateway.base_url}）: {type(e).__name__}: {e}")
+                sys.exit(1)
+            cache.save_exchange_info(info)
+            print(f"下載並緩存 exchange_info: {(time.perf_counter() - start) * 1000:.0f}ms（{len(info['symbols'])}個交易對）")
+            start = time.perf_counter()
+            cache.load_exchange_info()
+            warm_ms = (time.perf_counter() - start) * 1000
+        print(f"從本地緩存讀取 exchange_info: {warm_ms:.1f}ms")
+        start = time.perf_counter()
+        print(cache.symbol('BTCUSDT'))
+        print(f"單一交易對查詢: {(time.perf_counter() - start) * 1000:.3f}ms")
+        if not live:
+            cache.set_leverage_many([('BTCUSDT', 20), ('ETHUSDT', 20)])
+    finally:
+        cache.close()
+        gateway.stop()
+        if server is not None:
+            server.stop()
+
+    if not live:
+        reopened = ExchangeCache(path)
+        symbols = {item['symbol'] for item in info['symbols']}
+        assert set(reopened.symbols(status=None)) == symbols, "重新打開後交易對不一致"
+        assert {symbol: leverage for symbol, (leverage, _) in reopened.leverage_map().items()} == \
+            {'BTCUSDT': 20, 'ETHUSDT': 20}, "重新打開後槓桿不一致"
+        reopened.close()
+        print(f"✅ 重新打開緩存後 {len(symbols)} 個交易對與已確認槓桿均可直接讀取")
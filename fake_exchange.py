@@ -0,0 +1,1033 @@
+"""
+本地模擬幣安U本位合約交易所（HTTP + WebSocket）
+實現交易器用到的端點：premiumIndex、order、batchOrders、positionRisk、leverage、depth、income、userTrades、time、exchangeInfo、
+account/balance、ticker，以及 !markPrice@arr / !bookTicker 行情流和 listenKey 用戶數據流（ORDER_TRADE_UPDATE / ACCOUNT_UPDATE）；
+每個端點可配置響應延遲分佈，可按機率注入 -1003（限流）、-1021（時間戳超出 recvWindow）與超時，
+按窗口計算請求權重與下單數並回傳 X-MBX-* 標頭，超限時返回429；
+python-binance Client 與 AsyncGateway 都可以指向它，用於不經網路測試重試/退避、重連與下單路徑的尾延遲
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from aiohttp import web
+
+from async_gateway import CLIENT_ENDPOINTS, AsyncGateway
+from symbol_filters import SAMPLE_EXCHANGE_INFO, SymbolFilter
+from weight_budget import ENDPOINT_WEIGHTS, ORDER_LIMIT_1M, ORDER_LIMIT_10S, WEIGHT_LIMIT_1M, WeightBudget
+
+FAKE_EXCHANGE_HOST = '127.0.0.1'
+FUNDING_INTERVAL_MS = 8 * 3600 * 1000
+TAKER_FEE_RATE = 0.0005
+STARTING_BALANCE = 10000.0
+MARK_INTERVAL = 1.0    # !markPrice@arr 推送間隔（秒）
+BOOK_INTERVAL = 0.1    # !bookTicker 推送間隔（秒）
+
+# 樣本交易對的參考價格
+REFERENCE_PRICES = {
+    'BTCUSDT': 67250.0, 'ETHUSDT': 3120.0, 'SOLUSDT': 150.0,
+    'DOGEUSDT': 0.1234, '1000PEPEUSDT': 0.0112, 'XRPUSDT': 0.55,
+}
+
+# 路徑 -> 請求權重（與 weight_budget.ENDPOINT_WEIGHTS 一致，未列出的按1計）
+PATH_WEIGHTS = {path: ENDPOINT_WEIGHTS[name] for name, (_, path, _) in CLIENT_ENDPOINTS.items()
+                if name in ENDPOINT_WEIGHTS}
+PATH_WEIGHTS.update({
+    '/fapi/v1/premiumIndex': ENDPOINT_WEIGHTS['futures_mark_price'],
+    '/fapi/v1/income': ENDPOINT_WEIGHTS['futures_income_history'],
+    '/fapi/v1/userTrades': ENDPOINT_WEIGHTS['futures_account_trades'],
+    '/fapi/v1/exchangeInfo': ENDPOINT_WEIGHTS['futures_exchange_info'],
+    '/fapi/v1/batchOrders': ENDPOINT_WEIGHTS['futures_place_batch_order'],
+})
+ORDER_PATHS = frozenset({'/fapi/v1/order', '/fapi/v1/batchOrders'})
+MAX_BATCH_ORDERS = 5
+_SIGNATURE = re.compile(r'&?signature=[0-9a-fA-F]*')
+
+
+class FakeApiError(Exception):
+    """以幣安錯誤格式返回的請求錯誤"""
+
+    def __init__(self, status: int, code: int, msg: str):
+        super().__init__(msg)
+        self.status = status
+        self.code = code
+        self.msg = msg
+
+
+# ========== 延遲分佈 / 故障注入 ==========
+
+class LatencyProfile:
+    """響應延遲分佈（毫秒）：fixed:a | uniform:a,b | lognormal:中位數,sigma，可疊加小機率的長尾延遲"""
+
+    def __init__(self, kind: str = 'lognormal', a: float = 2.0, b: float = 0.5,
+                 tail_probability: float = 0.0, tail_ms: float = 0.0):
+        if kind not in ('fixed', 'uniform', 'lognormal'):
+            raise ValueError(f"未知的延遲分佈: {kind}")
+        self.kind = kind
+        self.a = a
+        self.b = b
+        self.tail_probability = tail_probability
+        self.tail_ms = tail_ms
+
+    @classmethod
+    def parse(cls, spec: str) -> 'LatencyProfile':
+        """解析 'lognormal:8,0.5' 或 'fixed:5;tail=0.01:400' 形式的描述"""
+        main, _, tail = spec.partition(';')
+        kind, _, args = main.partition(':')
+        values = [float(value) for value in args.split(',') if value]
+        tail_probability, tail_ms = 0.0, 0.0
+        if tail.startswith('tail='):
+            probability, _, ms = tail[5:].partition(':')
+            tail_probability, tail_ms = float(probability), float(ms)
+        return cls(kind, *values, tail_probability=tail_probability, tail_ms=tail_ms)
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == 'fixed':
+            latency = self.a
+        elif self.kind == 'uniform':
+            latency = rng.uniform(self.a, self.b)
+        else:
+            latency = self.a * rng.lognormvariate(0.0, self.b)
+        if self.tail_probability and rng.random() < self.tail_probability:
+            latency += self.tail_ms
+        return latency
+
+    def __repr__(self):
+        tail = f";tail={self.tail_probability:g}:{self.tail_ms:g}" if self.tail_probability else ''
+        args = f"{self.a:g}" if self.kind == 'fixed' else f"{self.a:g},{self.b:g}"
+        return f"{self.kind}:{args}{tail}"
+
+
+class FaultInjector:
+    """按機率注入故障：rate_limit(-1003/429)、timestamp(-1021)、timeout（請求照常執行但延遲 timeout_ms 才回應，
+    即「發送狀態未知」）、reset（請求照常執行後斷開連接，不回應）；paths 為空時作用於所有 REST 端點；
+    stream_drop 為每次標記價格推送時異常斷開行情流的機率"""
+
+    KINDS = ('rate_limit', 'timestamp', 'timeout', 'reset')
+
+    def __init__(self, rate_limit: float = 0.0, timestamp: float = 0.0, timeout: float = 0.0,
+                 timeout_ms: float = 5000.0, stream_drop: float = 0.0, paths: Optional[List[str]] = None,
+                 reset: float = 0.0):
+        self.rates = {'rate_limit': rate_limit, 'timestamp': timestamp, 'timeout': timeout, 'reset': reset}
+        self.timeout_ms = timeout_ms
+        self.stream_drop = stream_drop
+        self.paths = frozenset(paths or ())
+        self.injected = dict.fromkeys(self.KINDS, 0)
+
+    def pick(self, path: str, rng: random.Random) -> Optional[str]:
+        if self.paths and path not in self.paths:
+            return None
+        roll = rng.random()
+        for kind in self.KINDS:
+            roll -= self.rates[kind]
+            if roll < 0:
+                self.injected[kind] += 1
+                return kind
+        return None
+
+
+# ========== 行情與帳戶 ==========
+
+def _decimals(step: str) -> int:
+    step = step.rstrip('0')
+    return len(step.split('.')[1]) if '.' in step else 0
+
+
+def sample_exchange_info(server_time: int) -> Dict:
+    """以 symbol_filters 的記錄樣本構建 exchangeInfo，補上 quantityPrecision / pricePrecision"""
+    symbols = []
+    for item in SAMPLE_EXCHANGE_INFO['symbols']:
+        filters = {entry['filterType']: entry for entry in item['filters']}
+        symbols.append(dict(item, quantityPrecision=_decimals(filters['LOT_SIZE']['stepSize']),
+                            pricePrecision=_decimals(filters['PRICE_FILTER']['tickSize']),
+                            contractType='PERPETUAL', quoteAsset='USDT', marginAsset='USDT'))
+    return {'timezone': 'UTC', 'serverTime': server_time, 'rateLimits': [
+        {'rateLimitType': 'REQUEST_WEIGHT', 'interval': 'MINUTE', 'intervalNum': 1, 'limit': WEIGHT_LIMIT_1M},
+        {'rateLimitType': 'ORDERS', 'interval': 'SECOND', 'intervalNum': 10, 'limit': ORDER_LIMIT_10S},
+        {'rateLimitType': 'ORDERS', 'interval': 'MINUTE', 'intervalNum': 1, 'limit': ORDER_LIMIT_1M},
+    ], 'symbols': symbols}
+
+
+class FakeMarket:
+    """模擬行情與帳戶 - 標記價格隨機遊走，每個結算週期隨機挑一個交易對給出較大的資金費率；
+    市價單按買一/賣一成交，記錄成交、手續費、已實現盈虧與資金費流水（單向持倉，全倉）"""
+
+    def __init__(self, funding_interval_ms: int = FUNDING_INTERVAL_MS, taker_fee_rate: float = TAKER_FEE_RATE,
+                 balance: float = STARTING_BALANCE, seed: int = 0, clock_offset_ms: float = 0.0):
+        self.clock_offset_ms = clock_offset_ms  # 交易所時鐘相對本機的偏移，用於驗證時間同步
+        self.rng = np.random.default_rng(seed)
+        self.exchange_info = sample_exchange_info(self.now_ms())
+        self.filters = {item['symbol']: SymbolFilter.from_symbol_info(item) for item in self.exchange_info['symbols']}
+        self.symbols = list(self.filters)
+        self.prices = np.array([REFERENCE_PRICES[symbol] for symbol in self.symbols])
+        self.spreads = self.rng.uniform(0.00005, 0.0004, len(self.symbols))
+        self.rates = np.zeros(len(self.symbols))
+        self.funding_interval_ms = funding_interval_ms
+        self.next_funding_time = 0
+        self.taker_fee_rate = taker_fee_rate
+        self.balance = balance
+        self.leverage = dict.fromkeys(self.symbols, 20)
+        self.positions: Dict[str, Dict] = {}   # symbol -> {qty(帶方向), entry_price, update_time}
+        self.orders: Dict[int, Dict] = {}
+        self.trades: List[Dict] = []
+        self.income: List[Dict] = []
+        self.fills_by_client_id: Dict[str, int] = {}
+        self.user_event_listeners: List[Callable[[Dict], None]] = []  # 用戶數據流事件（成交、持倉/餘額變化）
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.step(self.now_ms())
+
+    def now_ms(self) -> int:
+        return int(time.time() * 1000 + self.clock_offset_ms)
+
+    def _index(self, symbol: str) -> int:
+        try:
+            return self.symbols.index(symbol)
+        except ValueError:
+            raise FakeApiError(400, -1121, 'Invalid symbol.')
+
+    def quote(self, symbol: str):
+        i = self._index(symbol)
+        half = self.prices[i] * self.spreads[i] / 2
+        return float(self.prices[i] - half), float(self.prices[i] + half)
+
+    def mark_price(self, symbol: str) -> float:
+        return float(self.prices[self._index(symbol)])
+
+    # ========== 行情推進 / 資金費結算 ==========
+
+    def step(self, now_ms: int):
+        """推進一個標記價格週期；跨過結算時間時按當前費率結算資金費並開始新週期"""
+        with self._lock:
+            self.prices *= np.exp(self.rng.normal(0, 0.0002, len(self.symbols)))
+            if now_ms < self.next_funding_time:
+                return
+            if self.next_funding_time:
+                self._settle_funding(self.next_funding_time)
+            self.next_funding_time = (now_ms // self.funding_interval_ms + 1) * self.funding_interval_ms
+            self.rates[:] = self.rng.normal(0, 0.0001, len(self.symbols))
+            hot = int(self.rng.integers(len(self.symbols)))
+            self.rates[hot] = self.rng.choice([-1, 1]) * self.rng.uniform(0.002, 0.006)
+
+    def _settle_funding(self, funding_time: int):
+        for symbol, position in self.positions.items():
+            i = self.symbols.index(symbol)
+            payment = -position['qty'] * float(self.prices[i]) * float(self.rates[i])
+            self.balance += payment
+            self._record_income(symbol, 'FUNDING_FEE', payment, funding_time)
+        if self.positions:
+            self._emit(self._account_update('FUNDING_FEE', list(self.positions), funding_time))
+
+    # ========== 用戶數據流事件 ==========
+
+    def _emit(self, event: Dict):
+        for listener in self.user_event_listeners:
+            listener(event)
+
+    def _account_update(self, reason: str, symbols: List[str], now_ms: int) -> Dict:
+        positions = []
+        for symbol in symbols:
+            position = self.positions.get(symbol, {'qty': 0.0, 'entry_price': 0.0})
+            mark_price = self.mark_price(symbol)
+            positions.append({'s': symbol, 'pa': f"{position['qty']:g}", 'ep': f"{position['entry_price']:.8f}",
+                              'cr': '0', 'up': f"{(mark_price - position['entry_price']) * position['qty']:.8f}",
+                              'mt': 'cross', 'iw': '0', 'ps': 'BOTH'})
+        return {'e': 'ACCOUNT_UPDATE', 'E': now_ms, 'T': now_ms,
+                'a': {'m': reason, 'B': [{'a': 'USDT', 'wb': f"{self.balance:.8f}", 'cw': f"{self.balance:.8f}",
+                                          'bc': '0'}],
+                      'P': positions}}
+
+    @staticmethod
+    def _order_trade_update(order: Dict, trade: Dict, now_ms: int) -> Dict:
+        return {'e': 'ORDER_TRADE_UPDATE', 'E': now_ms, 'T': now_ms,
+                'o': {'s': order['symbol'], 'c': order['clientOrderId'], 'S': order['side'], 'o': 'MARKET',
+                      'f': 'GTC', 'q': order['origQty'], 'p': '0', 'ap': order['avgPrice'], 'sp': '0',
+                      'x': 'TRADE', 'X': order['status'], 'i': order['orderId'], 'l': trade['qty'],
+                      'z': order['executedQty'], 'L': trade['price'], 'N': 'USDT', 'n': trade['commission'],
+                      'T': now_ms, 't': trade['id'], 'b': '0', 'a': '0', 'm': False, 'R': order['reduceOnly'],
+                      'wt': 'CONTRACT_PRICE', 'ot': 'MARKET', 'ps': 'BOTH', 'cp': False,
+                      'rp': trade['realizedPnl']}}
+
+    def _record_income(self, symbol: str, income_type: str, amount: float, time_ms: int, trade_id: str = ''):
+        self.income.append({'symbol': symbol, 'incomeType': income_type, 'income': f"{amount:.8f}", 'asset': 'USDT',
+                            'info': income_type, 'time': time_ms, 'tranId': next(self._ids), 'tradeId': trade_id})
+
+    def mark_price_frame(self, now_ms: int) -> List[Dict]:
+        return [{'e': 'markPriceUpdate', 'E': now_ms, 's': symbol, 'p': f"{self.prices[i]:.8f}",
+                 'i': f"{self.prices[i]:.8f}", 'P': f"{self.prices[i]:.8f}", 'r': f"{self.rates[i]:.8f}",
+                 'T': self.next_funding_time} for i, symbol in enumerate(self.symbols)]
+
+    def book_ticker_frames(self, now_ms: int, count: int) -> List[Dict]:
+        frames = []
+        for i in self.rng.choice(len(self.symbols), min(count, len(self.symbols)), replace=False):
+            bid, ask = self.quote(self.symbols[i])
+            frames.append({'e': 'bookTicker', 'u': next(self._ids), 'E': now_ms, 'T': now_ms, 's': self.symbols[i],
+                           'b': f"{bid:.8f}", 'B': '100', 'a': f"{ask:.8f}", 'A': '100'})
+        return frames
+
+    # ========== REST 端點 ==========
+
+    def premium_index(self, params: Dict):
+        now_ms = self.now_ms()
+        items = [{'symbol': symbol, 'markPrice': f"{self.prices[i]:.8f}", 'indexPrice': f"{self.prices[i]:.8f}",
+                  'estimatedSettlePrice': f"{self.prices[i]:.8f}", 'lastFundingRate': f"{self.rates[i]:.8f}",
+                  'interestRate': '0.00010000', 'nextFundingTime': self.next_funding_time, 'time': now_ms}
+                 for i, symbol in enumerate(self.symbols)]
+        if 'symbol' in params:
+            return items[self._index(params['symbol'])]
+        return items
+
+    def depth(self, params: Dict):
+        bid, ask = self.quote(params['symbol'])
+        limit = int(params.get('limit', 5))
+        tick = self.filters[params['symbol']].price.step
+        now_ms = self.now_ms()
+        return {'lastUpdateId': next(self._ids), 'E': now_ms, 'T': now_ms,
+                'bids': [[f"{bid - tick * level:.8f}", '100'] for level in range(limit)],
+                'asks': [[f"{ask + tick * level:.8f}", '100'] for level in range(limit)]}
+
+    def ticker_price(self, params: Dict):
+        if 'symbol' not in params:
+            return [self.ticker_price({'symbol': symbol}) for symbol in self.symbols]
+        return {'symbol': params['symbol'], 'price': f"{self.mark_price(params['symbol']):.8f}", 'time': self.now_ms()}
+
+    def ticker_24hr(self, params: Dict):
+        if 'symbol' not in params:
+            return [self.ticker_24hr({'symbol': symbol}) for symbol in self.symbols]
+        price = self.mark_price(params['symbol'])
+        return {'symbol': params['symbol'], 'lastPrice': f"{price:.8f}", 'volume': '1000000',
+                'quoteVolume': f"{price * 1000000:.2f}", 'priceChangePercent': '0.0'}
+
+    def change_leverage(self, params: Dict):
+        symbol, leverage = params['symbol'], int(params['leverage'])
+        self._index(symbol)
+        if not 1 <= leverage <= 125:
+            raise FakeApiError(400, -4028, f"Leverage {leverage} is not valid")
+        self.leverage[symbol] = leverage
+        return {'symbol': symbol, 'leverage': leverage, 'maxNotionalValue': '1000000'}
+
+    def position_risk(self, params: Dict):
+        symbols = [params['symbol']] if 'symbol' in params else self.symbols
+        result = []
+        for symbol in symbols:
+            position = self.positions.get(symbol, {'qty': 0.0, 'entry_price': 0.0, 'update_time': 0})
+            mark_price = self.mark_price(symbol)
+            result.append({
+                'symbol': symbol, 'positionAmt': f"{position['qty']:g}", 'entryPrice': f"{position['entry_price']:.8f}",
+                'markPrice': f"{mark_price:.8f}",
+                'unRealizedProfit': f"{(mark_price - position['entry_price']) * position['qty']:.8f}",
+                'liquidationPrice': '0', 'leverage': str(self.leverage[symbol]), 'marginType': 'cross',
+                'isolatedMargin': '0', 'positionSide': 'BOTH', 'notional': f"{position['qty'] * mark_price:.8f}",
+                'updateTime': position['update_time']})
+        return result
+
+    def account(self, params: Dict):
+        unrealized = sum(float(item['unRealizedProfit']) for item in self.position_risk({}))
+        return {'totalWalletBalance': f"{self.balance:.8f}", 'totalUnrealizedProfit': f"{unrealized:.8f}",
+                'totalMarginBalance': f"{self.balance + unrealized:.8f}", 'availableBalance': f"{self.balance:.8f}",
+                'maxWithdrawAmount': f"{self.balance:.8f}",
+                'assets': [{'asset': 'USDT', 'walletBalance': f"{self.balance:.8f}"}],
+                'positions': [item for item in self.position_risk({}) if float(item['positionAmt'])]}
+
+    def balance_list(self, params: Dict):
+        return [{'asset': 'USDT', 'balance': f"{self.balance:.8f}", 'availableBalance': f"{self.balance:.8f}",
+                 'crossWalletBalance': f"{self.balance:.8f}", 'updateTime': self.now_ms()}]
+
+    @staticmethod
+    def _window(items: List[Dict], params: Dict, time_key: str, default_limit: int) -> List[Dict]:
+        start, end = int(params.get('startTime', 0)), int(params.get('endTime', 2 ** 62))
+        selected = [item for item in items if start <= item[time_key] <= end
+                    and ('symbol' not in params or item['symbol'] == params['symbol'])]
+        return selected[-int(params.get('limit', default_limit)):]
+
+    def income_history(self, params: Dict):
+        items = self.income
+        if 'incomeType' in params:
+            items = [item for item in items if item['incomeType'] == params['incomeType']]
+        return self._window(items, params, 'time', 100)
+
+    def user_trades(self, params: Dict):
+        items = self.trades
+        if 'orderId' in params:
+            items = [item for item in items if item['orderId'] == int(params['orderId'])]
+        return self._window(items, params, 'time', 500)
+
+    def _check_filters(self, symbol: str, quantity: float, price: float, reduce_only: bool):
+        rule = self.filters[symbol].market_lot
+        if quantity <= 0 or quantity < rule.minimum:
+            raise FakeApiError(400, -4003, 'Quantity less than or equal to zero.' if quantity <= 0 else
+                               f"Quantity less than min qty {rule.minimum:g}.")
+        if not rule.is_aligned(quantity):
+            raise FakeApiError(400, -1111, 'Precision is over the maximum defined for this asset.')
+        if quantity > rule.maximum:
+            raise FakeApiError(400, -4005, 'Quantity greater than max quantity.')
+        if not reduce_only and quantity * price < self.filters[symbol].min_notional:
+            raise FakeApiError(400, -4164, f"Order's notional must be no smaller than "
+                                           f"{self.filters[symbol].min_notional:g} (unless you choose reduce only).")
+
+    def create_order(self, params: Dict):
+        symbol, side = params.get('symbol', ''), params.get('side', '')
+        self._index(symbol)
+        if params.get('type') != 'MARKET':
+            raise FakeApiError(400, -1116, 'Invalid orderType.')
+        if side not in ('BUY', 'SELL'):
+            raise FakeApiError(400, -1117, 'Invalid side.')
+        try:
+            quantity = float(params.get('quantity', 0))
+        except ValueError:
+            raise FakeApiError(400, -1100, "Illegal characters found in parameter 'quantity'.")
+        reduce_only = str(params.get('reduceOnly', 'false')).lower() == 'true'
+        with self._lock:
+            bid, ask = self.quote(symbol)
+            price = ask if side == 'BUY' else bid
+            self._check_filters(symbol, quantity, price, reduce_only)
+            signed = quantity if side == 'BUY' else -quantity
+            position = self.positions.get(symbol)
+            if reduce_only and (position is None or position['qty'] * signed >= 0):
+                raise FakeApiError(400, -2022, 'ReduceOnly Order is rejected.')
+            if reduce_only:
+                quantity = min(quantity, abs(position['qty']))
+                signed = quantity if side == 'BUY' else -quantity
+            return self._fill(symbol, side, quantity, signed, price, reduce_only, params)
+
+    def _fill(self, symbol: str, side: str, quantity: float, signed: float, price: float, reduce_only: bool,
+              params: Dict) -> Dict:
+        now_ms = self.now_ms()
+        order_id = next(self._ids)
+        client_order_id = params.get('newClientOrderId') or f"fake{order_id}"
+        fee = quantity * price * self.taker_fee_rate
+        realized = 0.0
+        position = self.positions.get(symbol)
+        if position is None:
+            self.positions[symbol] = {'qty': signed, 'entry_price': price, 'update_time': now_ms}
+        elif position['qty'] * signed > 0:
+            total = position['qty'] + signed
+            position['entry_price'] = (position['entry_price'] * position['qty'] + price * signed) / total
+            position['qty'], position['update_time'] = total, now_ms
+        else:
+            closed = min(abs(signed), abs(position['qty']))
+            realized = (price - position['entry_price']) * closed * (1 if position['qty'] > 0 else -1)
+            position['qty'] += signed
+            position['update_time'] = now_ms
+            if abs(position['qty']) < 1e-12:
+                del self.positions[symbol]
+            elif position['qty'] * signed > 0:  # 反手：剩餘部分以成交價開新倉
+                position['entry_price'] = price
+        self.balance += realized - fee
+        trade_id = next(self._ids)
+        self.trades.append({'symbol': symbol, 'id': trade_id, 'orderId': order_id, 'side': side,
+                            'price': f"{price:.8f}", 'qty': f"{quantity:g}", 'quoteQty': f"{quantity * price:.8f}",
+                            'realizedPnl': f"{realized:.8f}", 'commission': f"{fee:.8f}", 'commissionAsset': 'USDT',
+                            'buyer': side == 'BUY', 'maker': False, 'positionSide': 'BOTH', 'time': now_ms})
+        self._record_income(symbol, 'COMMISSION', -fee, now_ms, str(trade_id))
+        if realized:
+            self._record_income(symbol, 'REALIZED_PNL', realized, now_ms, str(trade_id))
+        self.fills_by_client_id[client_order_id] = self.fills_by_client_id.get(client_order_id, 0) + 1
+        order = {'orderId': order_id, 'symbol': symbol, 'status': 'FILLED', 'clientOrderId': client_order_id,
+                 'price': '0', 'avgPrice': f"{price:.8f}", 'origQty': f"{quantity:g}", 'executedQty': f"{quantity:g}",
+                 'cumQty': f"{quantity:g}", 'cumQuote': f"{quantity * price:.8f}", 'timeInForce': 'GTC',
+                 'type': 'MARKET', 'reduceOnly': reduce_only, 'closePosition': False, 'side': side,
+                 'positionSide': 'BOTH', 'origType': 'MARKET', 'updateTime': now_ms}
+        self.orders[order_id] = order
+        if self.user_event_listeners:
+            self._emit(self._order_trade_update(order, self.trades[-1], now_ms))
+            self._emit(self._account_update('ORDER', [symbol], now_ms))
+        return order
+
+    def batch_orders(self, params: Dict):
+        """逐筆執行批次中的訂單，被拒的訂單在對應位置返回 {code, msg}（與交易所一致，不影響其他訂單）"""
+        try:
+            orders = json.loads(params['batchOrders'])
+        except ValueError:
+            orders = None
+        if not isinstance(orders, list) or not 0 < len(orders) <= MAX_BATCH_ORDERS:
+            raise FakeApiError(400, -1130, "Data sent for parameter 'batchOrders' is not valid.")
+        results = []
+        for order in orders:
+            try:
+                results.append(self.create_order(order))
+            except FakeApiError as e:
+                results.append({'code': e.code, 'msg': e.msg})
+        return results
+
+    def get_order(self, params: Dict):
+        """按 orderId 或 origClientOrderId 查詢"""
+        if params.get('origClientOrderId'):
+            order = next((order for order in self.orders.values()
+                          if order['clientOrderId'] == params['origClientOrderId']), None)
+        else:
+            order = self.orders.get(int(params.get('orderId', 0)))
+        if order is None:
+            raise FakeApiError(400, -2013, 'Order does not exist.')
+        return order
+
+    def cancel_order(self, params: Dict):
+        # 市價單已全部成交，撤單必然失敗
+        self.get_order(params)
+        raise FakeApiError(400, -2011, 'Unknown order sent.')
+
+
+# ========== HTTP / WebSocket 服務 ==========
+
+class FakeBinanceServer:
+    """在獨立線程的事件循環中運行的模擬交易所；base_url 給 REST 客戶端，stream_url 給行情流"""
+
+    def __init__(self, market: Optional[FakeMarket] = None, latency: Optional[LatencyProfile] = None,
+                 path_latency: Optional[Dict[str, LatencyProfile]] = None, faults: Optional[FaultInjector] = None,
+                 api_keys: Optional[Dict[str, str]] = None, weight_limit: int = WEIGHT_LIMIT_1M,
+                 order_limit_10s: int = ORDER_LIMIT_10S, order_limit_1m: int = ORDER_LIMIT_1M,
+                 mark_interval: float = MARK_INTERVAL, book_interval: float = BOOK_INTERVAL,
+                 host: str = FAKE_EXCHANGE_HOST, port: int = 0, seed: int = 0):
+        self.market = market or FakeMarket(seed=seed)
+        self.latency = latency or LatencyProfile('fixed', 0.0)
+        self.path_latency = path_latency or {}
+        self.faults = faults
+        self.api_keys = api_keys  # {API key: secret}，設置後按 X-MBX-APIKEY 校驗簽名
+        self.weight_limit = weight_limit
+        self.order_limit_10s = order_limit_10s
+        self.order_limit_1m = order_limit_1m
+        self.mark_interval = mark_interval
+        self.book_interval = book_interval
+        self.host = host
+        self.port = port
+        self.rng = random.Random(seed)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._push_task: Optional[asyncio.Task] = None
+        self._ready = threading.Event()
+        self._sockets: Dict[web.WebSocketResponse, tuple] = {}  # ws -> (request, streams, combined)
+        self.listen_key: Optional[str] = None
+        self.market.user_event_listeners.append(self._on_user_event)
+        self._weight_window = -1
+        self._used_weight = 0
+        self._order_times: List[int] = []
+        self.stats = {'requests': 0, 'rejected_rate_limit': 0, 'rejected_timestamp': 0, 'rejected_signature': 0,
+                      'errors': 0, 'frames': 0, 'stream_connections': 0, 'stream_drops': 0}
+        self._routes = {
+            ('GET', '/fapi/v1/ping'): (lambda params: {}, False),
+            ('GET', '/fapi/v1/time'): (lambda params: {'serverTime': self.market.now_ms()}, False),
+            ('GET', '/api/v3/ping'): (lambda params: {}, False),
+            ('GET', '/api/v3/time'): (lambda params: {'serverTime': self.market.now_ms()}, False),
+            ('GET', '/fapi/v1/exchangeInfo'): (self._exchange_info, False),
+            ('GET', '/fapi/v1/premiumIndex'): (self.market.premium_index, False),
+            ('GET', '/fapi/v1/depth'): (self.market.depth, False),
+            ('GET', '/fapi/v1/ticker/price'): (self.market.ticker_price, False),
+            ('GET', '/fapi/v1/ticker/24hr'): (self.market.ticker_24hr, False),
+            ('POST', '/fapi/v1/order'): (self.market.create_order, True),
+            ('POST', '/fapi/v1/batchOrders'): (self.market.batch_orders, True),
+            ('GET', '/fapi/v1/order'): (self.market.get_order, True),
+            ('DELETE', '/fapi/v1/order'): (self.market.cancel_order, True),
+            ('POST', '/fapi/v1/leverage'): (self.market.change_leverage, True),
+            ('GET', '/fapi/v2/positionRisk'): (self.market.position_risk, True),
+            ('GET', '/fapi/v2/account'): (self.market.account, True),
+            ('GET', '/fapi/v2/balance'): (self.market.balance_list, True),
+            ('GET', '/fapi/v1/income'): (self.market.income_history, True),
+            ('GET', '/fapi/v1/userTrades'): (self.market.user_trades, True),
+            ('POST', '/fapi/v1/listenKey'): (self._create_listen_key, False),
+            ('PUT', '/fapi/v1/listenKey'): (self._keepalive_listen_key, False),
+            ('DELETE', '/fapi/v1/listenKey'): (self._delete_listen_key, False),
+        }
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def stream_url(self) -> str:
+        return f"ws://{self.host}:{self.port}"
+
+    # ========== 生命週期 ==========
+
+    def start(self) -> 'FakeBinanceServer':
+        threading.Thread(target=self._serve, name='fake-exchange', daemon=True).start()
+        if not self._ready.wait(10):
+            raise RuntimeError("模擬交易所啟動超時")
+        return self
+
+    def _serve(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        app = web.Application()
+        app.router.add_get('/stream', self._stream)
+        app.router.add_get('/ws/{streams:.*}', self._stream)
+        app.router.add_route('*', '/{tail:.*}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        self.loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, self.host, self.port)
+        self.loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._push_task = self.loop.create_task(self._push_market())
+        self._ready.set()
+        self.loop.run_forever()
+
+    def stop(self):
+        if self.loop is None or not self.loop.is_running():
+            return
+        self.loop.call_soon_threadsafe(self._push_task.cancel)
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def drop_streams(self, abnormal: bool = True):
+        """斷開所有行情流：abnormal 時直接關閉 TCP 連接（客戶端看到1006），否則發送1000正常關閉"""
+        asyncio.run_coroutine_threadsafe(self._drop_streams(abnormal), self.loop).result(5)
+
+    async def _drop_streams(self, abnormal: bool):
+        for ws, (request, _, _) in list(self._sockets.items()):
+            self.stats['stream_drops'] += 1
+            if abnormal:
+                request.transport.close()
+            else:
+                await ws.close(code=1000, message=b'server closing')
+
+    def expire_listen_keys(self):
+        """讓當前 listenKey 立即過期：推送 listenKeyExpired 後不再推送用戶數據"""
+        asyncio.run_coroutine_threadsafe(self._expire_listen_key(), self.loop).result(5)
+
+    async def _expire_listen_key(self):
+        if self.listen_key is None:
+            return
+        key, self.listen_key = self.listen_key, None
+        await self._broadcast_user(key, {'e': 'listenKeyExpired', 'E': self.market.now_ms(), 'listenKey': key})
+
+    # ========== REST ==========
+
+    def _exchange_info(self, params: Dict):
+        return dict(self.market.exchange_info, serverTime=self.market.now_ms())
+
+    def _create_listen_key(self, params: Dict):
+        # 與交易所一致：已有有效的 listenKey 時返回同一個
+        if self.listen_key is None:
+            self.listen_key = '%064x' % self.rng.getrandbits(256)
+        return {'listenKey': self.listen_key}
+
+    def _keepalive_listen_key(self, params: Dict):
+        if params.get('listenKey', self.listen_key) != self.listen_key or self.listen_key is None:
+            raise FakeApiError(400, -1125, 'This listenKey does not exist.')
+        return {}
+
+    def _delete_listen_key(self, params: Dict):
+        self.listen_key = None
+        return {}
+
+    def _error(self, status: int, code: int, msg: str, headers: Optional[Dict] = None) -> web.Response:
+        self.stats['errors'] += 1
+        return web.json_response({'code': code, 'msg': msg}, status=status, headers=headers)
+
+    def _charge(self, method: str, path: str, params: Dict, now_ms: int) -> Dict:
+        """計入權重與下單數，返回用量標頭；窗口與交易所一樣按整分鐘對齊"""
+        window = now_ms // 60000
+        if window != self._weight_window:
+            self._weight_window, self._used_weight = window, 0
+        weight = PATH_WEIGHTS.get(path, 1)
+        if path == '/fapi/v1/premiumIndex' and 'symbol' in params:
+            weight = 1
+        self._used_weight += weight
+        headers = {'X-MBX-USED-WEIGHT-1M': str(self._used_weight)}
+        if method == 'POST' and path in ORDER_PATHS:  # 查詢/撤單不計入下單數
+            self._order_times = [t for t in self._order_times if now_ms - t < 60000]
+            # 批次下單的每筆訂單都計入下單數
+            self._order_times.extend([now_ms] * (params.get('batchOrders', '').count('{') or 1))
+            headers['X-MBX-ORDER-COUNT-10S'] = str(sum(1 for t in self._order_times if now_ms - t < 10000))
+            headers['X-MBX-ORDER-COUNT-1M'] = str(len(self._order_times))
+        return headers
+
+    def _rate_limited(self, headers: Dict) -> Optional[web.Response]:
+        if self._used_weight > self.weight_limit:
+            retry_after = 60 - int(time.time()) % 60
+            message = f"Too many requests; current limit is {self.weight_limit} requests per minute."
+            return self._error(429, -1003, message, dict(headers, **{'Retry-After': str(retry_after)}))
+        if int(headers.get('X-MBX-ORDER-COUNT-10S', 0)) > self.order_limit_10s or \
+                int(headers.get('X-MBX-ORDER-COUNT-1M', 0)) > self.order_limit_1m:
+            return self._error(429, -1015, 'Too many new orders.', dict(headers, **{'Retry-After': '10'}))
+        return None
+
+    def _verify(self, params: Dict, api_key: str, query_string: str, body: str, now_ms: int) -> Optional[web.Response]:
+        try:
+            timestamp = int(params['timestamp'])
+        except (KeyError, ValueError):
+            return self._error(400, -1102, "Mandatory parameter 'timestamp' was not sent, was empty/null, or malformed.")
+        recv_window = int(params.get('recvWindow', 5000))
+        if timestamp > now_ms + 1000 or now_ms - timestamp > recv_window:
+            self.stats['rejected_timestamp'] += 1
+            return self._error(400, -1021, 'Timestamp for this request is outside of the recvWindow.')
+        if self.api_keys is not None:
+            if api_key not in self.api_keys:
+                self.stats['rejected_signature'] += 1
+                return self._error(401, -2015, 'Invalid API-key, IP, or permissions for action.')
+            payload = _SIGNATURE.sub('', query_string) + _SIGNATURE.sub('', body)
+            expected = hmac.new(self.api_keys[api_key].encode(), payload.lstrip('&').encode(), hashlib.sha256).hexdigest()
+            if not hmac.compare_digest(expected, str(params.get('signature', ''))):
+                self.stats['rejected_signature'] += 1
+                return self._error(400, -1022, 'Signature for this request is not valid.')
+        return None
+
+    async def _handle(self, request: web.Request) -> web.StreamResponse:
+        route = self._routes.get((request.method, request.path))
+        if route is None:
+            return self._error(404, -1, f"Unknown path {request.method} {request.path}")
+        handler, signed = route
+        self.stats['requests'] += 1
+        body = await request.text() if request.can_read_body else ''
+        params = dict(request.query)
+        if body:
+            params.update(dict(item.split('=', 1) for item in body.split('&') if '=' in item))
+
+        latency = self.path_latency.get(request.path, self.latency).sample(self.rng)
+        if latency > 0:
+            await asyncio.sleep(latency / 1000)
+        now_ms = self.market.now_ms()
+        headers = self._charge(request.method, request.path, params, now_ms)
+        rejected = self._rate_limited(headers)
+        if rejected is not None:
+            self.stats['rejected_rate_limit'] += 1
+            return rejected
+
+        fault = self.faults.pick(request.path, self.rng) if self.faults else None
+        if fault == 'rate_limit':
+            self.stats['rejected_rate_limit'] += 1
+            return self._error(429, -1003, 'Too many requests; please use the websocket for live updates.',
+                               dict(headers, **{'Retry-After': '1'}))
+        if fault == 'timestamp':
+            self.stats['rejected_timestamp'] += 1
+            return self._error(400, -1021, 'Timestamp for this request is outside of the recvWindow.', headers)
+        if signed:
+            rejected = self._verify(params, request.headers.get('X-MBX-APIKEY', ''), request.query_string, body, now_ms)
+            if rejected is not None:
+                return rejected
+
+        try:
+            result = handler(params)
+        except FakeApiError as e:
+            return self._error(e.status, e.code, e.msg, headers)
+        except (KeyError, ValueError) as e:
+            return self._error(400, -1102, f"Mandatory parameter {e} was not sent, was empty/null, or malformed.",
+                               headers)
+        if fault == 'timeout':
+            # 請求已執行，回應延遲到客戶端超時之後（發送狀態未知）
+            await asyncio.sleep(self.faults.timeout_ms / 1000)
+        if fault == 'reset' and request.transport is not None:
+            # 請求已執行，回應前斷開連接（客戶端收到連接錯誤，發送狀態未知）
+            request.transport.close()
+        return web.json_response(result, headers=headers)
+
+    # ========== WebSocket ==========
+
+    async def _stream(self, request: web.Request) -> web.WebSocketResponse:
+        combined = request.path == '/stream'
+        streams = request.query.get('streams', '') if combined else request.match_info['streams']
+        if not combined and '@' not in streams and not streams.startswith('!') and streams != self.listen_key:
+            return self._error(400, -1125, 'This listenKey does not exist.')
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self._sockets[ws] = (request, set(streams.split('/')), combined)
+        self.stats['stream_connections'] += 1
+        try:
+            async for msg in ws:
+                if msg.type.name == 'TEXT':
+                    # 與幣安一致：回應 SUBSCRIBE/UNSUBSCRIBE 等請求
+                    request_id = json.loads(msg.data).get('id')
+                    await ws.send_str(json.dumps({'result': None, 'id': request_id}))
+        finally:
+            self._sockets.pop(ws, None)
+        return ws
+
+    async def _broadcast(self, stream: str, data):
+        if not self._sockets:
+            return
+        raw = json.dumps(data, separators=(',', ':'))
+        wrapped = json.dumps({'stream': stream, 'data': data}, separators=(',', ':'))
+        for ws, (_, streams, combined) in list(self._sockets.items()):
+            if stream in streams and not ws.closed:
+                try:
+                    await ws.send_str(wrapped if combined else raw)
+                    self.stats['frames'] += 1
+                except ConnectionError:
+                    self._sockets.pop(ws, None)
+
+    def _on_user_event(self, event: Dict):
+        # 由 FakeMarket 在成交/結算時調用（可能在任意線程），推送給持有當前 listenKey 的連接
+        if self.listen_key is not None and self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self._broadcast_user(self.listen_key, event), self.loop)
+
+    async def _broadcast_user(self, listen_key: str, event: Dict):
+        raw = json.dumps(event, separators=(',', ':'))
+        for ws, (_, streams, _) in list(self._sockets.items()):
+            if listen_key in streams and not ws.closed:
+                try:
+                    await ws.send_str(raw)
+                    self.stats['frames'] += 1
+                except ConnectionError:
+                    self._sockets.pop(ws, None)
+
+    async def _push_market(self):
+        next_mark = 0.0
+        while True:
+            now = time.time()
+            now_ms = int(now * 1000)
+            if now >= next_mark:
+                next_mark = now + self.mark_interval
+                self.market.step(now_ms)
+                await self._broadcast('!markPrice@arr', self.market.mark_price_frame(now_ms))
+                if self.faults and self.faults.stream_drop and self._sockets \
+                        and self.rng.random() < self.faults.stream_drop:
+                    await self._drop_streams(abnormal=True)
+            for frame in self.market.book_ticker_frames(now_ms, 3):
+                await self._broadcast('!bookTicker', frame)
+            await asyncio.sleep(self.book_interval)
+
+
+# ========== 壓力測試 ==========
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {'count': 0, 'p50': 0.0, 'p90': 0.0, 'p99': 0.0, 'p999': 0.0, 'max': 0.0}
+    array = np.asarray(values)
+    p50, p90, p99, p999 = np.percentile(array, [50, 90, 99, 99.9])
+    return {'count': len(values), 'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'p999': float(p999),
+            'max': float(array.max())}
+
+
+def _outcome(error: Exception) -> str:
+    code = getattr(error, 'code', None)
+    return f"錯誤{code}" if code is not None else type(error).__name__
+
+
+def _report(name: str, samples: List[tuple], server: FakeBinanceServer, wall: float, injected: Dict) -> Dict:
+    """samples: [(延遲ms, 結果, clientOrderId)]；injected 為測試開始時的故障注入計數"""
+    outcomes: Dict[str, int] = {}
+    for _, outcome, _ in samples:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    client_ids = {client_id for _, _, client_id in samples}
+    fills = server.market.fills_by_client_id
+    return {
+        'name': name,
+        'latency': _percentiles([latency for latency, _, _ in samples]),
+        'ok_latency': _percentiles([latency for latency, outcome, _ in samples if outcome == 'ok']),
+        'outcomes': outcomes,
+        'duplicate_fills': sum(1 for client_id in client_ids if fills.get(client_id, 0) > 1),
+        'unknown_fills': sum(1 for _, outcome, client_id in samples if outcome != 'ok' and fills.get(client_id)),
+        'orders_per_second': len(samples) / wall if wall else 0.0,
+        'injected': {kind: count - injected.get(kind, 0) for kind, count in server.faults.injected.items()}
+        if server.faults else {},
+    }
+
+
+def run_gateway_load_test(server: FakeBinanceServer, orders: int = 150, concurrency: int = 4,
+                          symbol: str = 'DOGEUSDT', quantity: str = '100', timeout: float = 1.0,
+                          max_retries: int = 2, api_key: str = 'key', api_secret: str = 'secret') -> Dict:
+    """進場/平倉的下單路徑：AsyncGateway.create_order（與 fire_entry 相同的超時與重試參數）"""
+    budget = WeightBudget()
+    if server.api_keys is not None:
+        server.api_keys[api_key] = api_secret
+    gateway = AsyncGateway(api_key, api_secret, base_url=server.base_url, weight_budget=budget)
+    gateway.start()
+    injected = dict(server.faults.injected) if server.faults else {}
+    samples = []
+    ids = itertools.count()
+    side = itertools.cycle(['BUY', 'SELL'])
+
+    async def worker():
+        for n in iter(lambda: next(ids), None):
+            if n >= orders:
+                return
+            client_id = f"gw{n}"
+            start = time.perf_counter()
+            try:
+                await gateway.create_order(symbol=symbol, side=next(side), type='MARKET', quantity=quantity,
+                                           newClientOrderId=client_id, timeout=timeout, max_retries=max_retries)
+                outcome = 'ok'
+            except Exception as e:
+                outcome = _outcome(e)
+            samples.append(((time.perf_counter() - start) * 1000, outcome, client_id))
+
+    async def run_all():
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    start = time.perf_counter()
+    gateway.run(run_all())
+    wall = time.perf_counter() - start
+    gateway.stop()
+    result = _report('AsyncGateway.create_order', samples, server, wall, injected)
+    result['budget'] = budget.format_status()
+    return result
+
+
+def create_trader(server: FakeBinanceServer):
+    """建立指向模擬交易所的 FundingRateTrader（交易所緩存放在記憶體、不建立收益追蹤器），記錄最後收到行情的時間"""
+    from config import API_KEY, API_SECRET
+    from exchange_cache import ExchangeCache
+    from test_trading_minute import FundingRateTrader
+
+    if server.api_keys is not None:
+        server.api_keys[API_KEY] = API_SECRET
+
+    class FakeExchangeTrader(FundingRateTrader):
+        fapi_url = server.base_url
+        fstream_url = server.stream_url
+        reconnect_delay_scale = 0.05  # 本地模擬交易所不需要等待網路恢復
+        last_message_at = 0.0
+
+        def _create_exchange_cache(self):
+            return ExchangeCache(':memory:')
+
+        def _create_profit_tracker(self):
+            return None
+
+        def on_message(self, ws, message):
+            self.last_message_at = time.time()
+            super().on_message(ws, message)
+
+    return FakeExchangeTrader()
+
+
+def _quiet(quiet: bool):
+    return contextlib.redirect_stdout(open(os.devnull, 'w')) if quiet else contextlib.nullcontext()
+
+
+def run_trader_load_test(server: FakeBinanceServer, orders: int = 100, concurrency: int = 4,
+                         symbol: str = 'DOGEUSDT', quantity: str = '100', timeout: float = 1.0,
+                         max_retries: int = 2, quiet: bool = True) -> Dict:
+    """交易器的同步調用路徑：execute_api_call_with_timeout(client.futures_create_order)，含分道准入與退避重試；
+    quiet 時不輸出交易器自身的日誌"""
+    output = _quiet(quiet)
+    with output:
+        trader = create_trader(server)
+    injected = dict(server.faults.injected) if server.faults else {}
+    samples = []
+    ids = itertools.count()
+
+    def worker():
+        for n in iter(lambda: next(ids), None):
+            if n >= orders:
+                return
+            client_id = f"tr{n}"
+            start = time.perf_counter()
+            try:
+                trader.execute_api_call_with_timeout(
+                    trader.client.futures_create_order, symbol=symbol, side='BUY' if n % 2 else 'SELL',
+                    type='MARKET', quantity=quantity, newClientOrderId=client_id,
+                    timeout=timeout, max_retries=max_retries)
+                outcome = 'ok'
+            except Exception as e:
+                outcome = _outcome(e)
+            samples.append(((time.perf_counter() - start) * 1000, outcome, client_id))
+
+    start = time.perf_counter()
+    with output, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    wall = time.perf_counter() - start
+    trader.stop_gateway()
+    return _report('execute_api_call_with_timeout', samples, server, wall, injected)
+
+
+def run_reconnect_test(server: FakeBinanceServer, abnormal: bool = True, wait: float = 60.0,
+                       quiet: bool = True) -> Dict:
+    """斷開行情流，測量交易器經 on_close/on_error → reconnect 恢復接收行情所需的時間"""
+    with _quiet(quiet):
+        trader = create_trader(server)
+        trader.start_websocket()
+        deadline = time.time() + 10
+        while not trader.last_message_at and time.time() < deadline:
+            time.sleep(0.05)
+        connections = server.stats['stream_connections']
+        dropped_at = time.time()
+        server.drop_streams(abnormal)
+        deadline = dropped_at + wait
+        # 斷開前已在途的幀可能稍後才處理，以新連接建立為準
+        while time.time() < deadline and (server.stats['stream_connections'] == connections
+                                          or trader.last_message_at <= dropped_at):
+            time.sleep(0.05)
+        recovered = server.stats['stream_connections'] > connections and trader.last_message_at > dropped_at
+        gap_seconds = trader.last_message_at - dropped_at if recovered else None
+        # 重連線程在新連接收到行情後仍在等待啟動確認，結束後再關閉，避免停止網關後仍在重新連接
+        deadline = time.time() + 5
+        while getattr(trader, 'is_reconnecting', False) and time.time() < deadline:
+            time.sleep(0.05)
+        trader.running = False
+        if trader.ws:
+            trader.ws.close()
+        trader.stop_gateway()
+    return {'abnormal': abnormal, 'recovered': recovered,
+            'gap_seconds': gap_seconds,
+            'reconnect_count': trader.ws_reconnect_count}
+
+
+def format_load_report(result: Dict) -> str:
+    latency, ok = result['latency'], result['ok_latency']
+    outcomes = ' '.join(f"{name}:{count}" for name, count in sorted(result['outcomes'].items()))
+    injected = ' '.join(f"{name}:{count}" for name, count in result['injected'].items() if count)
+    return (f"{result['name']}: {latency['count']}筆 {result['orders_per_second']:.0f}筆/秒 | {outcomes}\n"
+            f"  全部 p50 {latency['p50']:.1f}ms p90 {latency['p90']:.1f}ms p99 {latency['p99']:.1f}ms "
+            f"p999 {latency['p999']:.1f}ms 最大 {latency['max']:.1f}ms\n"
+            f"  成功 p50 {ok['p50']:.1f}ms p99 {ok['p99']:.1f}ms 最大 {ok['max']:.1f}ms | "
+            f"注入故障 {injected or '無'} | 重複成交 {result['duplicate_fills']} | 報錯但已成交 {result['unknown_fills']}")
+
+
+# 使用示例：python fake_exchange.py  （壓力測試）
+#          python fake_exchange.py --serve 8765  （常駐運行，以 BINANCE_FAPI_URL=http://127.0.0.1:8765
+#          BINANCE_FSTREAM_URL=ws://127.0.0.1:8765 啟動交易器即指向本地模擬交易所）
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == '--serve':
+        port = int(sys.argv[2]) if len(sys.argv) >= 3 else 8765
+        server = FakeBinanceServer(latency=LatencyProfile('lognormal', 3.0, 0.4), port=port).start()
+        print(f"模擬交易所運行中: REST {server.base_url} | 行情流 {server.stream_url}/stream?streams=!markPrice@arr/!bookTicker")
+        while True:
+            time.sleep(60)
+            print(f"[{time.strftime('%H:%M:%S')}] {server.stats}")
+
+    scenarios = [
+        ('無故障，延遲 lognormal 中位數3ms', LatencyProfile('lognormal', 3.0, 0.4), None),
+        ('長尾延遲：1% 請求額外400ms', LatencyProfile('lognormal', 3.0, 0.4, 0.01, 400.0), None),
+        ('故障注入：-1003 2% / -1021 2% / 超時 1% / 執行後斷線 2%', LatencyProfile('lognormal', 3.0, 0.4),
+         FaultInjector(rate_limit=0.02, timestamp=0.02, timeout=0.01, timeout_ms=1500, reset=0.02,
+                       paths=['/fapi/v1/order'])),
+    ]
+    failures = []
+
+    def check(result: Dict):
+        """重複成交或報錯但已成交（調用方以為失敗、交易所實際已成交）都算失敗"""
+        print(format_load_report(result))
+        if result['duplicate_fills'] or result['unknown_fills']:
+            failures.append(f"{result['name']}: 重複成交 {result['duplicate_fills']} | 報錯但已成交 {result['unknown_fills']}")
+
+    for title, latency, faults in scenarios:
+        print(f"=== {title} ===")
+        server = FakeBinanceServer(latency=latency, faults=faults, api_keys={}, seed=1).start()
+        check(run_gateway_load_test(server))
+        try:
+            check(run_trader_load_test(server))
+        except ImportError as e:
+            print(f"略過交易器路徑（{e}）")
+        server.stop()
+
+    print("=== 行情流異常斷開（1006）後的重連 ===")
+    server = FakeBinanceServer(seed=1).start()
+    try:
+        outcome = run_reconnect_test(server)
+        if outcome['recovered']:
+            print(f"恢復接收行情用時 {outcome['gap_seconds']:.1f} 秒（重連計數 {outcome['reconnect_count']}）")
+        else:
+            failures.append("60秒內未恢復接收行情")
+    except ImportError as e:
+        print(f"略過重連測試（{e}）")
+    server.stop()
+
+    for failure in failures:
+        print(f"❌ {failure}")
+    if failures:
+        sys.exit(1)
+    print("✅ 壓力測試通過：沒有重複成交，沒有報錯但已成交的訂單")
@@ -0,0 +1,201 @@
+"""
+資金費率列式存儲
+以預分配的 NumPy 陣列（結構陣列 SoA）保存全市場資金費率數據，
+WebSocket 推送時原地寫入，讀取端取得零拷貝視圖，可直接做向量化掃描
+"""
+
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+
+class FundingRateStore:
+    """資金費率列式存儲 - symbol→行索引，float64 費率/標記價格列，int64 結算時間/更新時間列"""
+
+    def __init__(self, capacity: int = 512, symbol_filter: Optional[Callable[[str], bool]] = None):
+        self._capacity = max(int(capacity), 1)
+        self._size = 0
+        self._index: Dict[str, int] = {}   # symbol -> 行索引
+        self._symbols: List[str] = []      # 行索引 -> symbol
+        self._symbol_filter = symbol_filter
+        # 只在新增交易對（擴容）時加鎖，原地更新不需要鎖
+        self._grow_lock = threading.Lock()
+        self._allocate(self._capacity)
+
+    def _allocate(self, capacity: int):
+        """分配（或擴容）所有列，保留既有數據"""
+        old_size = self._size
+        columns = {
+            'funding_rate': np.zeros(capacity, dtype=np.float64),      # 資金費率（%）
+            'mark_price': np.full(capacity, np.nan, dtype=np.float64),  # 標記價格，NaN 表示未知
+            'spread': np.full(capacity, np.nan, dtype=np.float64),      # 點差（%），NaN 表示尚未取得
+            'next_funding_time': np.zeros(capacity, dtype=np.int64),    # 下次結算時間（毫秒）
+            'last_update': np.zeros(capacity, dtype=np.int64),          # 最後更新時間（毫秒，校正後）
+            'tradable': np.zeros(capacity, dtype=bool),                 # 是否通過交易對篩選
+        }
+        for name, new_column in columns.items():
+            old_column = getattr(self, '_' + name, None)
+            if old_column is not None and old_size > 0:
+                new_column[:old_size] = old_column[:old_size]
+            setattr(self, '_' + name, new_column)
+        self._capacity = capacity
+
+    # ========== 寫入 ==========
+
+    def row_of(self, symbol: str) -> Optional[int]:
+        """獲取交易對的行索引，不存在時返回None"""
+        return self._index.get(symbol)
+
+    def ensure_row(self, symbol: str) -> int:
+        """獲取交易對的行索引，不存在時分配新行"""
+        row = self._index.get(symbol)
+        if row is not None:
+            return row
+        with self._grow_lock:
+            row = self._index.get(symbol)
+            if row is not None:
+                return row
+            row = self._size
+            if row >= self._capacity:
+                # 擴容時重新分配陣列，舊視圖仍指向舊陣列，不影響正在讀取的一方
+                self._allocate(self._capacity * 2)
+            self._mark_price[row] = np.nan
+            self._spread[row] = np.nan
+            self._tradable[row] = self._symbol_filter(symbol) if self._symbol_filter else True
+            self._symbols.append(symbol)
+            self._index[symbol] = row
+            # 最後才增加行數，讀取端不會看到未初始化的行
+            self._size = row + 1
+            return row
+
+    def update(self, symbol: str, funding_rate: float, mark_price: Optional[float],
+               next_funding_time: int, last_update: int) -> int:
+        """原地更新單一交易對的數據，返回行索引"""
+        row = self.ensure_row(symbol)
+        self._funding_rate[row] = funding_rate
+        if mark_price is not None:
+            self._mark_price[row] = mark_price
+        self._next_funding_time[row] = next_funding_time
+        self._last_update[row] = last_update
+        return row
+
+    def update_batch(self, symbols: List[str], funding_rate: np.ndarray, mark_price: np.ndarray,
+                     next_funding_time: np.ndarray, last_update: int) -> np.ndarray:
+        """整幀批量原地更新（一次花式索引寫入所有列），返回各交易對的行索引"""
+        index = self._index
+        rows = np.fromiter((index[symbol] if symbol in index else self.ensure_row(symbol) for symbol in symbols),
+                           dtype=np.intp, count=len(symbols))
+        self._funding_rate[rows] = funding_rate
+        known_price = ~np.isnan(mark_price)
+        self._mark_price[rows[known_price]] = mark_price[known_price]
+        self._next_funding_time[rows] = next_funding_time
+        self._last_update[rows] = last_update
+        return rows
+
+    def set_spread(self, symbol: str, spread: float) -> Optional[int]:
+        """原地更新單一交易對的點差（%），交易對尚無資金費率數據時忽略並返回None"""
+        row = self._index.get(symbol)
+        if row is not None:
+            self._spread[row] = spread
+        return row
+
+    def set_symbol_filter(self, symbol_filter: Optional[Callable[[str], bool]]):
+        """更換交易對篩選函數，並重新計算所有行的篩選結果"""
+        self._symbol_filter = symbol_filter
+        for row, symbol in enumerate(self._symbols[:self._size]):
+            self._tradable[row] = symbol_filter(symbol) if symbol_filter else True
+
+    # ========== 零拷貝視圖 ==========
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def symbols(self) -> List[str]:
+        """行索引 -> symbol 對照表（只讀使用）"""
+        return self._symbols
+
+    def funding_rate_view(self) -> np.ndarray:
+        return self._funding_rate[:self._size]
+
+    def mark_price_view(self) -> np.ndarray:
+        return self._mark_price[:self._size]
+
+    def spread_view(self) -> np.ndarray:
+        return self._spread[:self._size]
+
+    def next_funding_time_view(self) -> np.ndarray:
+        return self._next_funding_time[:self._size]
+
+    def last_update_view(self) -> np.ndarray:
+        return self._last_update[:self._size]
+
+    def tradable_view(self) -> np.ndarray:
+        return self._tradable[:self._size]
+
+    def columns(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """一次取得同一行數下的 (funding_rate, mark_price, next_funding_time, tradable) 視圖"""
+        size = self._size
+        return (self._funding_rate[:size], self._mark_price[:size],
+                self._next_funding_time[:size], self._tradable[:size])
+
+    # ========== 兼容舊的 dict 介面 ==========
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __bool__(self) -> bool:
+        return self._size > 0
+
+    def __contains__(self, symbol) -> bool:
+        return symbol in self._index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._symbols[:self._size])
+
+    def __getitem__(self, symbol: str) -> Dict:
+        row = self._index[symbol]
+        return self._row_dict(row)
+
+    def get(self, symbol: str, default=None):
+        row = self._index.get(symbol)
+        if row is None:
+            return default
+        return self._row_dict(row)
+
+    def items(self) -> Iterator[Tuple[str, Dict]]:
+        """兼容 dict.items()，每行建立一個 dict，只用於非熱路徑"""
+        for row in range(self._size):
+            yield self._symbols[row], self._row_dict(row)
+
+    def _row_dict(self, row: int) -> Dict:
+        data = {
+            'funding_rate': float(self._funding_rate[row]),
+            'next_funding_time': int(self._next_funding_time[row]),
+            'last_update': int(self._last_update[row])
+        }
+        mark_price = self._mark_price[row]
+        if not np.isnan(mark_price):
+            data['mark_price'] = float(mark_price)
+        spread = self._spread[row]
+        if not np.isnan(spread):
+            data['spread'] = float(spread)
+        return data
+
+    def mark_price(self, symbol: str) -> Optional[float]:
+        """快速獲取標記價格，不建立 dict"""
+        row = self._index.get(symbol)
+        if row is None:
+            return None
+        price = self._mark_price[row]
+        return None if np.isnan(price) else float(price)
+
+    def spread(self, symbol: str) -> Optional[float]:
+        """快速獲取點差（%），尚未取得時返回None，不建立 dict"""
+        row = self._index.get(symbol)
+        if row is None:
+            return None
+        spread = self._spread[row]
+        return None if np.isnan(spread) else float(spread)
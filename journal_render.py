@@ -0,0 +1,819 @@
+"""
+交易事件日誌離線渲染
+把 logs/trade_journal_YYYYMMDD.bin 還原為原 trade_analysis 文字格式，或輸出 JSON 行供查詢/分析；
+渲染只在需要閱讀時離線進行，交易進程只寫二進制記錄
+"""
+
+import json
+import os
+import sys
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+from trade_journal import JOURNAL_DIR, journal_path, read_journal
+
+
+def format_timestamp(timestamp_ms: float) -> str:
+    """校正時間ms -> '2025-06-29 22:00:00.123'（與交易進程的 format_corrected_time 相同）"""
+    return datetime.fromtimestamp(int(timestamp_ms) / 1000).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+
+def render_opportunity_analysis(timestamp: str, details: Dict) -> str:
+    """log_debug_analysis('opportunity_analysis') 的機會分析報告"""
+    display_time = timestamp[:23]
+    content = f"\n{'='*60}\n"
+    content += f"🔍 機會分析報告 - {display_time}\n"
+    content += f"總交易對數量: {details.get('total_pairs', 'N/A')}\n"
+    content += f"資金費率閾值: {details.get('threshold', 'N/A')}%\n"
+    content += f"最大點差閾值: {details.get('max_spread', 'N/A')}%\n"
+    content += f"找到機會: {'是' if details.get('found_opportunity') else '否'}\n"
+    content += f"{'='*60}\n"
+
+    # 添加前5個最高資金費率的詳細信息
+    if 'top_opportunities' in details:
+        for i, opp in enumerate(details['top_opportunities']):
+            content += f"[{display_time}] {i+1}. {opp['symbol']}: 資金費率{opp['funding_rate']:+.4f}% 點差{opp['spread']:.3f}% 淨收益{opp['net_profit']:+.3f}% (閾值:{details.get('threshold', 'N/A')}%)\n"
+
+    content += f"{'='*60}\n\n"
+    return content
+
+
+# 調試分析記錄（symbol 為空）的渲染函數
+ANALYSIS_RENDERERS = {
+    'opportunity_analysis': render_opportunity_analysis,
+}
+
+
+def render_step(step: str, symbol: str, timestamp: str, kwargs: Dict) -> str:
+    """write_trade_analysis 記錄的易讀格式，包含進場、平倉、指令發送接收等"""
+    # 顯示時間時包含毫秒 (取前23個字符：2025-06-29 22:00:00.123)
+    display_time = timestamp[:23]
+
+    # 根據不同步驟記錄不同內容
+    # ========== 進場相關步驟 ==========
+    if step == 'entry_start':
+        content = f"\n{'='*60}\n"
+        content += f"🚀 開始進場: {symbol}\n"
+        content += f"時間: {timestamp}\n"
+        content += f"方向: {kwargs.get('direction', 'N/A')}\n"
+        content += f"資金費率: {kwargs.get('funding_rate', 'N/A')}%\n"
+        content += f"結算時間: {kwargs.get('settlement_time', 'N/A')}\n"
+        content += f"{'='*60}\n"
+
+    elif step == 'leverage_set':
+        content = f"[{display_time}] ⚙️ 槓桿設置完成: {kwargs.get('leverage', 'N/A')}倍\n"
+
+    elif step == 'entry_price_fetched':
+        content = f"[{display_time}] 📊 價格獲取完成: {kwargs.get('price', 'N/A')}\n"
+
+    elif step == 'entry_quantity_calculated':
+        content = f"[{display_time}] 📏 數量計算完成: {kwargs.get('quantity', 'N/A')}\n"
+
+    elif step == 'entry_order_sent':
+        content = f"[{display_time}] 📤 進場訂單發送: ID:{kwargs.get('order_id', 'N/A')} 耗時:{kwargs.get('order_time_ms', 'N/A')}ms\n"
+
+    elif step == 'entry_success':
+        content = f"[{display_time}] ✅ 進場成功: 成交量:{kwargs.get('executed_qty', 'N/A')} 均價:{kwargs.get('avg_price', 'N/A')}\n"
+        content += f"[{display_time}] 🎯 預期盈利: {kwargs.get('expected_profit', 'N/A')} USDT\n"
+
+    elif step == 'entry_failed':
+        content = f"[{display_time}] ❌ 進場失敗: {kwargs.get('error', 'N/A')}\n"
+
+    elif step == 'entry_complete':
+        content = f"[{display_time}] 🏁 進場完成\n"
+        content += f"{'='*60}\n\n"
+
+    # ========== 平倉相關步驟 ==========
+    elif step == 'close_start':
+        content = f"\n{'='*60}\n"
+        content += f"開始平倉: {symbol}\n"
+        content += f"時間: {timestamp}\n"
+        content += f"方向: {kwargs.get('direction', 'N/A')}\n"
+        content += f"數量: {kwargs.get('quantity', 'N/A')}\n"
+        content += f"{'='*60}\n"
+
+    elif step == 'close_price_fetched':
+        content = f"[{display_time}] 價格獲取完成: {kwargs.get('price', 'N/A')}\n"
+
+    elif step == 'close_order_sent':
+        content = f"[{display_time}] 訂單發送完成: ID:{kwargs.get('order_id', 'N/A')} 耗時:{kwargs.get('order_time_ms', 'N/A')}ms\n"
+
+    elif step == 'close_success':
+        content = f"[{display_time}] ✅ 平倉訂單成功: 成交量:{kwargs.get('executed_qty', 'N/A')} 均價:{kwargs.get('avg_price', 'N/A')}\n"
+
+    elif step == 'close_failed':
+        content = f"[{display_time}] ❌ 平倉失敗: {kwargs.get('error', 'N/A')}\n"
+
+    elif step == 'close_position':
+        content = f"[{display_time}] ✅ 平倉完成\n"
+        content += f"[{display_time}] 📊 交易總結:\n"
+        content += f"[{display_time}]    ├─ 方向: {kwargs.get('direction', 'N/A').upper()}\n"
+        content += f"[{display_time}]    ├─ 數量: {kwargs.get('quantity', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 進場價: {kwargs.get('entry_price', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 平倉價: {kwargs.get('exit_price', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 盈虧: {kwargs.get('pnl', 'N/A')} USDT\n"
+        content += f"[{display_time}]    ├─ 資金費率: {kwargs.get('funding_rate', 'N/A')}%\n"
+        content += f"[{display_time}]    ├─ 持倉時間: {kwargs.get('position_duration_seconds', 'N/A')} 秒\n"
+        content += f"[{display_time}]    ├─ 執行時間: {kwargs.get('execution_time_ms', 'N/A')} ms\n"
+        content += f"[{display_time}]    ├─ 重試次數: {kwargs.get('retry_count', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 訂單ID: {kwargs.get('order_id', 'N/A')}\n"
+        content += f"{'='*60}\n\n"
+
+    # 極速平倉相關步驟
+    elif step == 'fast_close_delay':
+        content = f"[{display_time}] ⏰ 平倉延遲: {kwargs.get('delay_seconds', 'N/A')}秒 ({kwargs.get('delay_reason', 'N/A')})\n"
+
+    elif step == 'fast_close_start':
+        content = f"\n{'='*60}\n"
+        content += f"🚀 開始極速平倉: {symbol}\n"
+        content += f"時間: {timestamp}\n"
+        content += f"方向: {kwargs.get('direction', 'N/A')}\n"
+        content += f"數量: {kwargs.get('quantity', 'N/A')}\n"
+        content += f"{'='*60}\n"
+
+    elif step == 'fast_close_success':
+        content = f"[{display_time}] ✅ 極速平倉成功: ID:{kwargs.get('order_id', 'N/A')} 耗時:{kwargs.get('execution_time_ms', 'N/A')}ms\n"
+        content += f"[{display_time}] 成交量:{kwargs.get('executed_qty', 'N/A')} 均價:{kwargs.get('avg_price', 'N/A')}\n"
+        # 如果有詳細信息，則顯示
+        if kwargs.get('direction'):
+            content += f"[{display_time}] 📊 交易總結:\n"
+            content += f"[{display_time}]    ├─ 方向: {kwargs.get('direction', 'N/A').upper()}\n"
+            content += f"[{display_time}]    ├─ 數量: {kwargs.get('quantity', 'N/A')}\n"
+            content += f"[{display_time}]    ├─ 進場價: {kwargs.get('entry_price', 'N/A')}\n"
+            content += f"[{display_time}]    ├─ 平倉價: {kwargs.get('exit_price', 'N/A')}\n"
+            content += f"[{display_time}]    ├─ 盈虧: {kwargs.get('pnl', 'N/A')} USDT\n"
+            content += f"[{display_time}]    ├─ 資金費率: {kwargs.get('funding_rate', 'N/A')}%\n"
+            content += f"[{display_time}]    └─ 持倉時間: {kwargs.get('position_duration_seconds', 'N/A')} 秒\n"
+        content += f"{'='*60}\n\n"
+
+    elif step == 'fast_close_failed':
+        content = f"[{display_time}] ❌ 極速平倉失敗: {kwargs.get('error', 'N/A')}\n"
+        content += f"{'='*60}\n\n"
+
+    # 超級極速平倉相關步驟
+    elif step == 'ultra_fast_close_success':
+        content = f"[{display_time}] ⚡ 超級極速平倉成功: ID:{kwargs.get('order_id', 'N/A')} 耗時:{kwargs.get('execution_time_ms', 'N/A')}ms\n"
+        content += f"[{display_time}] 📊 方向:{kwargs.get('direction', 'N/A').upper()} 數量:{kwargs.get('quantity', 'N/A')}\n"
+        content += f"[{display_time}] 🚀 方法:{kwargs.get('close_method', 'N/A')}\n"
+        content += f"{'='*60}\n\n"
+
+    elif step == 'ultra_fast_close_failed':
+        content = f"[{display_time}] ❌ 超級極速平倉失敗: {kwargs.get('error', 'N/A')}\n"
+        content += f"[{display_time}] 🔄 回退方案: {kwargs.get('fallback', 'N/A')}\n"
+        content += f"{'='*60}\n\n"
+
+    # 即時平倉相關步驟
+    elif step == 'instant_close_success':
+        content = f"[{display_time}] ⚡ 即時平倉成功: {symbol} | {kwargs.get('execution_time_ms', 'N/A')}ms | ID:{kwargs.get('order_id', 'N/A')}\n"
+        content += f"[{display_time}] 🚀 方法: {kwargs.get('method', '即時平倉')}\n"
+        content += f"{'='*60}\n\n"
+
+    elif step == 'instant_close_failed':
+        content = f"[{display_time}] ❌ 即時平倉失敗: {kwargs.get('error', 'N/A')}\n"
+        content += f"[{display_time}] 🔄 回退方案: 強制平倉\n"
+        content += f"{'='*60}\n\n"
+
+    # 超高速平倉相關步驟
+    elif step == 'ultra_speed_close_start':
+        content = f"\n{'='*70}\n"
+        content += f"⚡ 超高速平倉啟動: {symbol}\n"
+        content += f"時間: {timestamp}\n"
+        content += f"優化等級: {kwargs.get('optimization_level', 'N/A')}\n"
+        content += f"方向: {kwargs.get('direction', 'N/A')}\n"
+        content += f"數量: {kwargs.get('quantity', 'N/A')}\n"
+        content += f"進場價: {kwargs.get('entry_price', 'N/A')}\n"
+        content += f"資金費率: {kwargs.get('funding_rate', 'N/A')}%\n"
+        content += f"{'='*70}\n"
+
+    elif step == 'ultra_speed_order_prepare':
+        content = f"[{display_time}] 📤 訂單準備: {kwargs.get('side', 'N/A')} {kwargs.get('quantity', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 類型: {kwargs.get('order_type', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 僅減倉: {kwargs.get('reduce_only', 'N/A')}\n"
+
+    elif step == 'ultra_speed_order_executed':
+        content = f"[{display_time}] ⚡ 訂單執行: ID:{kwargs.get('order_id', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 狀態: {kwargs.get('status', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 成交量: {kwargs.get('executed_qty', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 成交價: {kwargs.get('avg_price', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 訂單耗時: {kwargs.get('order_time_ms', 'N/A')}ms\n"
+        content += f"[{display_time}]    └─ 總耗時: {kwargs.get('total_time_ms', 'N/A')}ms\n"
+
+    elif step == 'ultra_speed_close_success':
+        content = f"[{display_time}] ✅ 超高速平倉成功: 耗時:{kwargs.get('execution_time_ms', 'N/A')}ms\n"
+        content += f"[{display_time}] 📊 交易結果:\n"
+        content += f"[{display_time}]    ├─ 進場價: {kwargs.get('entry_price', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 平倉價: {kwargs.get('exit_price', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 盈虧: {kwargs.get('pnl', 'N/A')} USDT\n"
+        content += f"[{display_time}]    ├─ 盈虧%: {kwargs.get('pnl_percentage', 'N/A')}%\n"
+        content += f"[{display_time}]    └─ 效率: {kwargs.get('close_efficiency', 'N/A')}\n"
+
+    elif step == 'ultra_speed_close_failed':
+        content = f"[{display_time}] ⚠️ 超高速平倉失敗: {kwargs.get('error_reason', 'N/A')}\n"
+        content += f"[{display_time}] 📊 失敗詳情:\n"
+        content += f"[{display_time}]    ├─ 訂單狀態: {kwargs.get('order_status', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 成交量: {kwargs.get('executed_qty', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 執行時間: {kwargs.get('execution_time_ms', 'N/A')}ms\n"
+        content += f"[{display_time}]    └─ 可能原因: {kwargs.get('possible_causes', 'N/A')}\n"
+
+    elif step == 'ultra_speed_close_error':
+        content = f"[{display_time}] ❌ 超高速平倉異常: {kwargs.get('error', 'N/A')}\n"
+        content += f"[{display_time}] 🔧 錯誤詳情:\n"
+        content += f"[{display_time}]    ├─ 錯誤類型: {kwargs.get('error_type', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 執行時間: {kwargs.get('execution_time_ms', 'N/A')}ms\n"
+        content += f"[{display_time}]    └─ 恢復動作: {kwargs.get('recovery_action', 'N/A')}\n"
+
+    elif step == 'ultra_speed_close_complete':
+        content = f"[{display_time}] 🏁 超高速平倉完成: 成功:{kwargs.get('success', 'N/A')}\n"
+        content += f"[{display_time}] 📊 最終狀態:\n"
+        content += f"[{display_time}]    ├─ 清理完成: {kwargs.get('cleanup_completed', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 總執行時間: {kwargs.get('total_execution_time_ms', 'N/A')}ms\n"
+        content += f"{'='*70}\n\n"
+
+    # 平倉完成詳細記錄（延後處理）
+    elif step == 'close_position_detail':
+        content = f"[{display_time}] 📋 平倉詳細總結 ({kwargs.get('processing_type', '延後處理')})\n"
+        content += f"[{display_time}] 📊 完整交易數據:\n"
+        content += f"[{display_time}]    ├─ 交易對: {symbol}\n"
+        content += f"[{display_time}]    ├─ 方向: {kwargs.get('direction', 'N/A').upper()}\n"
+        content += f"[{display_time}]    ├─ 數量: {kwargs.get('quantity', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 進場價: {kwargs.get('entry_price', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 平倉價: {kwargs.get('exit_price', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 盈虧: {kwargs.get('pnl', 'N/A')} USDT\n"
+        content += f"[{display_time}]    ├─ 資金費率: {kwargs.get('funding_rate', 'N/A')}%\n"
+        content += f"[{display_time}]    ├─ 持倉時間: {kwargs.get('position_duration_seconds', 'N/A')} 秒\n"
+        content += f"[{display_time}]    ├─ 訂單ID: {kwargs.get('order_id', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 成交量: {kwargs.get('executed_qty', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 成交均價: {kwargs.get('avg_price', 'N/A')}\n"
+        content += f"[{display_time}] ✅ 所有記錄和統計已完成\n"
+        content += f"{'='*60}\n\n"
+
+    # ========== 新增超詳細記錄類型 ==========
+    elif step == 'close_with_full_context':
+        content = f"\n{'='*90}\n"
+        content += f"🎯 超詳細平倉記錄: {symbol}\n"
+        content += f"時間: {timestamp}\n"
+        content += f"{'='*90}\n"
+
+        # 1. 訂單執行詳情
+        order_details = kwargs.get('order_details', {})
+        content += f"📋 訂單執行詳情:\n"
+        content += f"   ├─ 訂單ID: {order_details.get('order_id', 'N/A')}\n"
+        content += f"   ├─ 訂單狀態: {order_details.get('status', 'N/A')}\n"
+        content += f"   ├─ 訂單類型: {order_details.get('type', 'N/A')}\n"
+        content += f"   ├─ 訂單方向: {order_details.get('side', 'N/A')}\n"
+        content += f"   ├─ 委託數量: {order_details.get('orig_qty', 'N/A')}\n"
+        content += f"   ├─ 成交數量: {order_details.get('executed_qty', 'N/A')}\n"
+        content += f"   ├─ 成交均價: {order_details.get('avg_price', 'N/A')}\n"
+        content += f"   ├─ 成交金額: {order_details.get('cumulative_quote_qty', 'N/A')}\n"
+        content += f"   ├─ 手續費: {order_details.get('commission', 'N/A')}\n"
+        content += f"   ├─ 手續費資產: {order_details.get('commission_asset', 'N/A')}\n"
+        content += f"   ├─ 創建時間: {order_details.get('time', 'N/A')}\n"
+        content += f"   └─ 更新時間: {order_details.get('update_time', 'N/A')}\n"
+
+        # 2. 網絡與API質量
+        network_quality = kwargs.get('network_quality', {})
+        content += f"🌐 網絡與API質量:\n"
+        content += f"   ├─ API響應時間: {network_quality.get('api_response_ms', 'N/A')}ms\n"
+        content += f"   ├─ 連接狀態: {network_quality.get('connection_status', 'N/A')}\n"
+        content += f"   └─ 請求質量評分: {network_quality.get('request_quality_score', 'N/A')}\n"
+
+        # 3. 賬戶餘額變化
+        balance_changes = kwargs.get('balance_changes', {})
+        content += f"💰 賬戶餘額變化:\n"
+        content += f"   ├─ 平倉前餘額: {balance_changes.get('balance_before', 'N/A')} USDT\n"
+        content += f"   ├─ 平倉後餘額: {balance_changes.get('balance_after', 'N/A')} USDT\n"
+        content += f"   ├─ 餘額變化: {balance_changes.get('balance_change', 'N/A')} USDT\n"
+        content += f"   ├─ 可用餘額: {balance_changes.get('available_balance', 'N/A')} USDT\n"
+        content += f"   ├─ 佔用保證金: {balance_changes.get('used_margin', 'N/A')} USDT\n"
+        content += f"   ├─ 未實現盈虧: {balance_changes.get('unrealized_pnl', 'N/A')} USDT\n"
+        content += f"   └─ 錢包餘額: {balance_changes.get('wallet_balance', 'N/A')} USDT\n"
+
+        # 4. 市場深度與流動性
+        market_depth = kwargs.get('market_depth', {})
+        content += f"📊 市場深度與流動性:\n"
+        content += f"   ├─ 最佳買價: {market_depth.get('best_bid', 'N/A')}\n"
+        content += f"   ├─ 最佳賣價: {market_depth.get('best_ask', 'N/A')}\n"
+        content += f"   ├─ 買價量: {market_depth.get('bid_qty', 'N/A')}\n"
+        content += f"   ├─ 賣價量: {market_depth.get('ask_qty', 'N/A')}\n"
+        content += f"   ├─ 點差: {market_depth.get('spread', 'N/A')}\n"
+        content += f"   ├─ 點差百分比: {market_depth.get('spread_percentage', 'N/A')}%\n"
+        content += f"   └─ 流動性評分: {market_depth.get('liquidity_score', 'N/A')}\n"
+
+        # 5. 系統性能指標
+        system_metrics = kwargs.get('system_metrics', {})
+        content += f"⚡ 系統性能指標:\n"
+        content += f"   ├─ CPU使用率: {system_metrics.get('cpu_usage', 'N/A')}%\n"
+        content += f"   ├─ 記憶體使用: {system_metrics.get('memory_usage', 'N/A')}%\n"
+        content += f"   ├─ 線程數: {system_metrics.get('thread_count', 'N/A')}\n"
+        content += f"   ├─ 處理時間: {system_metrics.get('processing_time_ms', 'N/A')}ms\n"
+        content += f"   └─ 系統負載: {system_metrics.get('system_load', 'N/A')}\n"
+
+        content += f"{'='*90}\n\n"
+
+    # ========== 市場數據分析記錄 ==========
+    elif step == 'close_market_analysis':
+        content = f"\n{'='*80}\n"
+        content += f"📊 平倉市場分析: {symbol}\n"
+        content += f"時間: {timestamp}\n"
+        content += f"{'='*80}\n"
+
+        # 24小時統計
+        daily_stats = kwargs.get('daily_stats', {})
+        content += f"📈 24小時統計:\n"
+        content += f"   ├─ 開盤價: {daily_stats.get('open_price', 'N/A')}\n"
+        content += f"   ├─ 最高價: {daily_stats.get('high_price', 'N/A')}\n"
+        content += f"   ├─ 最低價: {daily_stats.get('low_price', 'N/A')}\n"
+        content += f"   ├─ 收盤價: {daily_stats.get('close_price', 'N/A')}\n"
+        content += f"   ├─ 成交量: {daily_stats.get('volume', 'N/A')}\n"
+        content += f"   ├─ 成交額: {daily_stats.get('quote_volume', 'N/A')}\n"
+        content += f"   ├─ 漲跌幅: {daily_stats.get('price_change_percent', 'N/A')}%\n"
+        content += f"   └─ 波動率: {daily_stats.get('volatility', 'N/A')}%\n"
+
+        content += f"{'='*80}\n\n"
+
+    # ========== 極簡平倉相關步驟 ==========
+    elif step == 'minimal_close_start':
+        content = f"\n{'='*60}\n"
+        content += f"⚡ 開始極簡平倉: {symbol}\n"
+        content += f"時間: {timestamp}\n"
+        content += f"策略: {kwargs.get('strategy', 'N/A')}\n"
+        content += f"優化等級: {kwargs.get('optimization_level', 'N/A')}\n"
+        content += f"方向: {kwargs.get('direction', 'N/A')}\n"
+        content += f"數量: {kwargs.get('quantity', 'N/A')}\n"
+        content += f"進場價: {kwargs.get('entry_price', 'N/A')}\n"
+        content += f"資金費率: {kwargs.get('funding_rate', 'N/A')}%\n"
+        content += f"{'='*60}\n"
+
+    elif step == 'minimal_close_prepare':
+        content = f"[{display_time}] 📤 {kwargs.get('action', '準備訂單')}\n"
+        content += f"[{display_time}]    ├─ 訂單方向: {kwargs.get('side', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 訂單類型: {kwargs.get('order_type', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 僅減倉: {kwargs.get('reduce_only', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 優化: {kwargs.get('no_checks', 'N/A')}\n"
+
+    elif step == 'minimal_close_order_success':
+        content = f"[{display_time}] ✅ 極簡訂單成功: ID:{kwargs.get('order_id', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 執行時間: {kwargs.get('execution_time_ms', 'N/A')}ms\n"
+        content += f"[{display_time}]    ├─ 成交量: {kwargs.get('executed_qty', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 成交價: {kwargs.get('avg_price', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 狀態: {kwargs.get('order_status', 'N/A')}\n"
+
+    elif step == 'minimal_close_complete':
+        content = f"[{display_time}] 🎯 極簡平倉完成\n"
+        content += f"[{display_time}] 📊 最終交易總結:\n"
+        content += f"[{display_time}]    ├─ 交易對: {symbol}\n"
+        content += f"[{display_time}]    ├─ 方向: {kwargs.get('direction', 'N/A').upper()}\n"
+        content += f"[{display_time}]    ├─ 數量: {kwargs.get('quantity', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 進場價: {kwargs.get('entry_price', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 平倉價: {kwargs.get('exit_price', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 盈虧: {kwargs.get('pnl', 'N/A')} USDT\n"
+        content += f"[{display_time}]    ├─ 資金費率: {kwargs.get('funding_rate', 'N/A')}%\n"
+        content += f"[{display_time}]    ├─ 持倉時間: {kwargs.get('position_duration_seconds', 'N/A')} 秒\n"
+        content += f"[{display_time}]    ├─ 執行時間: {kwargs.get('execution_time_ms', 'N/A')} ms\n"
+        content += f"[{display_time}]    ├─ 重試次數: {kwargs.get('retry_count', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 檢查次數: {kwargs.get('total_checks', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 處理類型: {kwargs.get('processing_type', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 訂單ID: {kwargs.get('order_id', 'N/A')}\n"
+        content += f"[{display_time}] ⚡ 極簡平倉策略執行完成\n"
+        content += f"{'='*60}\n\n"
+
+    elif step == 'minimal_close_failed':
+        content = f"[{display_time}] ❌ 極簡平倉失敗: {kwargs.get('error', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 方向: {kwargs.get('direction', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 數量: {kwargs.get('quantity', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 重試: {kwargs.get('retry_attempt', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 清理: {kwargs.get('cleanup_action', 'N/A')}\n"
+        content += f"{'='*60}\n\n"
+
+    # ========== 平倉方式選擇 ==========
+    elif step == 'close_decision_start':
+        content = f"\n{'='*60}\n"
+        content += f"🤔 平倉方式選擇開始: {symbol}\n"
+        content += f"時間: {timestamp}\n"
+        content += f"CLOSE_BEFORE_SECONDS: {kwargs.get('close_before_seconds', 'N/A')}\n"
+        content += f"{'='*60}\n"
+
+    elif step == 'close_decision_made':
+        content = f"[{display_time}] ✅ 選擇平倉方式: {kwargs.get('chosen_method', 'N/A')}\n"
+        content += f"[{display_time}] 📋 選擇原因: {kwargs.get('reason', 'N/A')}\n"
+        content += f"[{display_time}] 🔧 處理邏輯: {kwargs.get('logic', 'N/A')}\n"
+
+    # ========== 極速平倉詳細步驟 ==========
+    elif step.startswith('fast_close_step_'):
+        step_name = step.replace('fast_close_step_', '')
+        content = f"[{display_time}] 步驟{kwargs.get('step_number', '?')}: {kwargs.get('action', step_name)}\n"
+
+        if step_name == 'side_determined':
+            content += f"[{display_time}]    └─ {kwargs.get('logic', 'N/A')}\n"
+        elif step_name == 'prepare_api':
+            content += f"[{display_time}]    ├─ API方法: {kwargs.get('api_method', 'N/A')}\n"
+            content += f"[{display_time}]    └─ 參數: {kwargs.get('parameters', 'N/A')}\n"
+        elif step_name == 'api_call_start':
+            content += f"[{display_time}]    └─ 端點: {kwargs.get('api_endpoint', 'N/A')}\n"
+        elif step_name == 'api_response':
+            content += f"[{display_time}]    ├─ 執行時間: {kwargs.get('execution_time_ms', 'N/A')}ms\n"
+            content += f"[{display_time}]    └─ 回傳成功\n"
+        elif step_name == 'extract_info':
+            content += f"[{display_time}]    ├─ 訂單ID: {kwargs.get('order_id', 'N/A')}\n"
+            content += f"[{display_time}]    ├─ 成交量: {kwargs.get('executed_qty', 'N/A')}\n"
+            content += f"[{display_time}]    └─ 均價: {kwargs.get('avg_price', 'N/A')}\n"
+        elif step_name == 'clear_position':
+            content += f"[{display_time}]    └─ 清空: {kwargs.get('cleared_fields', 'N/A')}\n"
+        elif step_name == 'schedule_post_process':
+            content += f"[{display_time}]    ├─ 延遲: {kwargs.get('delay_seconds', 'N/A')}秒\n"
+            content += f"[{display_time}]    └─ 任務: {kwargs.get('post_process_tasks', 'N/A')}\n"
+
+    # ========== 完整平倉詳細步驟 ==========
+    elif step.startswith('complete_close_step_'):
+        step_name = step.replace('complete_close_step_', '')
+        content = f"[{display_time}] 步驟{kwargs.get('step_number', '?')}: {kwargs.get('action', step_name)}\n"
+
+        if step_name == 'retry_check':
+            content += f"[{display_time}]    ├─ 重試次數: {kwargs.get('retry_count', 'N/A')}\n"
+            content += f"[{display_time}]    └─ 原因: {kwargs.get('reason', 'N/A')}\n"
+        elif step_name == 'api_position_check':
+            content += f"[{display_time}]    └─ API方法: {kwargs.get('api_method', 'N/A')}\n"
+        elif step_name == 'no_position':
+            content += f"[{display_time}]    ├─ 結果: {kwargs.get('result', 'N/A')}\n"
+            content += f"[{display_time}]    └─ 清理: {kwargs.get('cleanup_actions', 'N/A')}\n"
+        elif step_name == 'position_validation':
+            content += f"[{display_time}]    ├─ 預期方向/實際: {kwargs.get('expected_direction', 'N/A')}/{kwargs.get('actual_direction', 'N/A')}\n"
+            content += f"[{display_time}]    └─ 預期數量/實際: {kwargs.get('expected_quantity', 'N/A')}/{kwargs.get('actual_quantity', 'N/A')}\n"
+        elif step_name in ['direction_fix', 'quantity_fix']:
+            content += f"[{display_time}]    ├─ 預期: {kwargs.get('expected', 'N/A')}\n"
+            content += f"[{display_time}]    ├─ 實際: {kwargs.get('actual', 'N/A')}\n"
+            content += f"[{display_time}]    └─ 處理: {kwargs.get('action_taken', 'N/A')}\n"
+        elif step_name == 'first_attempt':
+            content += f"[{display_time}]    ├─ 方向: {kwargs.get('direction', 'N/A')}\n"
+            content += f"[{display_time}]    ├─ 數量: {kwargs.get('quantity', 'N/A')}\n"
+            content += f"[{display_time}]    └─ 原因: {kwargs.get('reason', 'N/A')}\n"
+        elif step_name == 'start_process':
+            content += f"[{display_time}]    ├─ 確認方向: {kwargs.get('validated_direction', 'N/A')}\n"
+            content += f"[{display_time}]    └─ 確認數量: {kwargs.get('validated_quantity', 'N/A')}\n"
+        elif step_name == 'fetch_price_start':
+            content += f"[{display_time}]    ├─ API方法: {kwargs.get('api_method', 'N/A')}\n"
+            content += f"[{display_time}]    └─ 原因: {kwargs.get('reason', 'N/A')}\n"
+        elif step_name == 'fetch_price_success':
+            content += f"[{display_time}]    ├─ 價格: {kwargs.get('current_price', 'N/A')}\n"
+            content += f"[{display_time}]    └─ 耗時: {kwargs.get('fetch_time_ms', 'N/A')}ms\n"
+        elif step_name == 'determine_side':
+            content += f"[{display_time}]    └─ {kwargs.get('logic', 'N/A')}\n"
+        elif step_name == 'prepare_order':
+            content += f"[{display_time}]    ├─ 參數: {kwargs.get('order_params', 'N/A')}\n"
+            content += f"[{display_time}]    └─ 參考價格: {kwargs.get('current_price', 'N/A')}\n"
+        elif step_name == 'send_order_start':
+            content += f"[{display_time}]    ├─ API方法: {kwargs.get('api_method', 'N/A')}\n"
+            content += f"[{display_time}]    └─ 參數: {kwargs.get('order_params', 'N/A')}\n"
+        elif step_name == 'order_response':
+            content += f"[{display_time}]    ├─ 執行時間: {kwargs.get('execution_time_ms', 'N/A')}ms\n"
+            content += f"[{display_time}]    ├─ 訂單ID: {kwargs.get('order_id', 'N/A')}\n"
+            content += f"[{display_time}]    ├─ 成交量: {kwargs.get('executed_qty', 'N/A')}\n"
+            content += f"[{display_time}]    └─ 均價: {kwargs.get('avg_price', 'N/A')}\n"
+
+    # ========== 完整平倉開始 ==========
+    elif step == 'complete_close_start':
+        content = f"\n{'='*60}\n"
+        content += f"🔧 開始完整平倉: {symbol}\n"
+        content += f"時間: {timestamp}\n"
+        content += f"方向: {kwargs.get('direction', 'N/A')}\n"
+        content += f"數量: {kwargs.get('quantity', 'N/A')}\n"
+        content += f"重試次數: {kwargs.get('retry_count', 'N/A')}\n"
+        content += f"包含功能: {kwargs.get('includes_features', 'N/A')}\n"
+        content += f"{'='*60}\n"
+
+    # 強制平倉相關步驟
+    elif step == 'force_close_start':
+        content = f"\n{'='*60}\n"
+        content += f"⚡ 開始強制平倉: {symbol}\n"
+        content += f"時間: {timestamp}\n"
+        content += f"方向: {kwargs.get('direction', 'N/A')}\n"
+        content += f"數量: {kwargs.get('quantity', 'N/A')}\n"
+        content += f"{'='*60}\n"
+
+    elif step == 'force_close_success':
+        content = f"[{display_time}] ✅ 強制平倉成功: ID:{kwargs.get('order_id', 'N/A')} 耗時:{kwargs.get('execution_time_ms', 'N/A')}ms\n"
+        content += f"[{display_time}] 重試次數:{kwargs.get('retry_count', 'N/A')} 實際進場價:{kwargs.get('actual_entry_price', 'N/A')} 未實現盈虧:{kwargs.get('unrealized_pnl', 'N/A')}\n"
+        content += f"{'='*60}\n\n"
+
+    elif step == 'force_close_failed':
+        content = f"[{display_time}] ❌ 強制平倉失敗: {kwargs.get('error', 'N/A')} (重試次數:{kwargs.get('retry_count', 'N/A')})\n"
+        content += f"{'='*60}\n\n"
+
+    elif step == 'force_close_no_position':
+        content = f"[{display_time}] ℹ️ 強制平倉檢查: 已無持倉，無需平倉\n"
+        content += f"{'='*60}\n\n"
+
+    # 倉位清理相關步驟
+    elif step == 'cleanup_start':
+        content = f"\n{'='*60}\n"
+        content += f"🧹 開始清理超時倉位: {symbol}\n"
+        content += f"時間: {timestamp}\n"
+        content += f"方向: {kwargs.get('direction', 'N/A')}\n"
+        content += f"數量: {kwargs.get('quantity', 'N/A')}\n"
+        content += f"持倉時間: {kwargs.get('age_seconds', 'N/A')} 秒\n"
+        content += f"清理原因: {kwargs.get('reason', 'N/A')}\n"
+        content += f"{'='*60}\n"
+
+    elif step == 'cleanup_success':
+        content = f"[{display_time}] ✅ 倉位清理成功: ID:{kwargs.get('order_id', 'N/A')} 耗時:{kwargs.get('execution_time_ms', 'N/A')}ms\n"
+        content += f"[{display_time}] 持倉時間:{kwargs.get('age_seconds', 'N/A')}秒 原因:{kwargs.get('reason', 'N/A')}\n"
+        content += f"{'='*60}\n\n"
+
+    elif step == 'cleanup_failed':
+        content = f"[{display_time}] ❌ 倉位清理失敗: {kwargs.get('error', 'N/A')}\n"
+        content += f"[{display_time}] 方向:{kwargs.get('direction', 'N/A')} 數量:{kwargs.get('quantity', 'N/A')}\n"
+        content += f"{'='*60}\n\n"
+
+    # ========== 新增詳細記錄類型 ==========
+    # 超級極速平倉詳細記錄
+    elif step == 'ultra_fast_close_detailed_start':
+        content = f"\n{'='*80}\n"
+        content += f"⚡ 超級極速平倉啟動: {symbol}\n"
+        content += f"時間: {timestamp}\n"
+        content += f"最佳化等級: {kwargs.get('optimization_level', 'N/A')}\n"
+
+        # 交易基本信息
+        trade_info = kwargs.get('trade_basic_info', {})
+        content += f"📊 交易信息:\n"
+        content += f"   ├─ 方向: {trade_info.get('direction', 'N/A')}\n"
+        content += f"   ├─ 數量: {trade_info.get('quantity', 'N/A')}\n"
+        content += f"   ├─ 進場價: {trade_info.get('entry_price', 'N/A')}\n"
+        content += f"   └─ 資金費率: {trade_info.get('funding_rate', 'N/A')}%\n"
+
+        # 市場快照
+        market_info = kwargs.get('market_snapshot', {})
+        content += f"📈 市場狀況:\n"
+        content += f"   ├─ 買價: {market_info.get('bid_price', 'N/A')}\n"
+        content += f"   ├─ 賣價: {market_info.get('ask_price', 'N/A')}\n"
+        content += f"   ├─ 中間價: {market_info.get('mid_price', 'N/A')}\n"
+        content += f"   ├─ 點差: {market_info.get('spread_percentage', 'N/A')}\n"
+        content += f"   └─ 流動性: {market_info.get('liquidity_rating', 'N/A')}\n"
+
+        # 系統狀態
+        system_info = kwargs.get('system_status', {})
+        content += f"🔧 系統狀態:\n"
+        content += f"   ├─ 校正時間: {system_info.get('corrected_time_ms', 'N/A')}ms\n"
+        content += f"   ├─ 時間偏移: {system_info.get('time_offset_ms', 'N/A')}ms\n"
+        content += f"   ├─ 重試次數: {system_info.get('retry_count', 'N/A')}\n"
+        content += f"   └─ 首次嘗試: {system_info.get('is_first_attempt', 'N/A')}\n"
+
+        content += f"{'='*80}\n"
+
+    elif step == 'ultra_fast_close_detailed_success':
+        content = f"[{display_time}] ✅ 超級極速平倉成功: ID:{kwargs.get('order_id', 'N/A')}\n"
+
+        # 執行結果
+        exec_result = kwargs.get('execution_result', {})
+        content += f"[{display_time}] 📊 執行結果:\n"
+        content += f"[{display_time}]    ├─ 訂單狀態: {exec_result.get('order_status', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 成交量: {exec_result.get('executed_qty', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 成交價: {exec_result.get('avg_price', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 執行方向: {exec_result.get('side_executed', 'N/A')}\n"
+
+        # 效能指標
+        performance = kwargs.get('performance_metrics', {})
+        content += f"[{display_time}] ⚡ 效能指標:\n"
+        content += f"[{display_time}]    ├─ API響應: {performance.get('api_response_time_ms', 'N/A')}ms\n"
+        content += f"[{display_time}]    ├─ 總處理時間: {performance.get('total_process_time_ms', 'N/A')}ms\n"
+        content += f"[{display_time}]    ├─ 準備時間: {performance.get('api_prepare_time_ms', 'N/A')}ms\n"
+        content += f"[{display_time}]    ├─ 效率評分: {performance.get('efficiency_score', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 速度評級: {performance.get('speed_rating', 'N/A')}\n"
+
+        # 價格執行分析
+        price_analysis = kwargs.get('price_execution_analysis', {})
+        if price_analysis:
+            content += f"[{display_time}] 💰 價格分析:\n"
+            content += f"[{display_time}]    ├─ 滑點: {price_analysis.get('slippage_percentage', 'N/A')}\n"
+            content += f"[{display_time}]    ├─ 相對中間價: {price_analysis.get('vs_mid_price', 'N/A')}\n"
+            content += f"[{display_time}]    └─ 執行品質: {price_analysis.get('execution_quality', 'N/A')}\n"
+
+        # 市場條件影響
+        market_impact = kwargs.get('market_condition_impact', {})
+        content += f"[{display_time}] 📊 市場影響:\n"
+        content += f"[{display_time}]    ├─ 流動性: {market_impact.get('market_liquidity', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 執行時點差: {market_impact.get('spread_at_execution', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 最佳執行窗口: {market_impact.get('optimal_execution_window', 'N/A')}\n"
+
+        content += f"{'='*80}\n\n"
+
+    elif step == 'ultra_fast_close_detailed_failed':
+        content = f"[{display_time}] ❌ 超級極速平倉失敗: {kwargs.get('error', 'N/A')}\n"
+        content += f"[{display_time}] 錯誤類型: {kwargs.get('error_type', 'N/A')}\n"
+
+        # 失敗分析
+        failure_analysis = kwargs.get('failure_analysis', {})
+        content += f"[{display_time}] 🔍 失敗分析:\n"
+        content += f"[{display_time}]    ├─ 失敗前耗時: {failure_analysis.get('total_time_before_error_ms', 'N/A')}ms\n"
+        content += f"[{display_time}]    ├─ 失敗階段: {failure_analysis.get('failure_stage', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 嚴重程度: {failure_analysis.get('error_severity', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 建議重試: {failure_analysis.get('retry_recommended', 'N/A')}\n"
+
+        # 失敗時上下文
+        context = kwargs.get('context_at_failure', {})
+        content += f"[{display_time}] 📋 失敗上下文:\n"
+        content += f"[{display_time}]    ├─ 方向: {context.get('direction', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 數量: {context.get('quantity', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 重試次數: {context.get('retry_count', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 市場流動性: {context.get('market_liquidity', 'N/A')}\n"
+
+        content += f"[{display_time}] 🔄 回退方案: {kwargs.get('fallback_action', 'N/A')}\n"
+        content += f"[{display_time}] ➡️ 下個方法: {kwargs.get('next_method', 'N/A')}\n"
+        content += f"{'='*80}\n\n"
+
+    # 強制平倉詳細記錄
+    elif step == 'force_close_detailed_start':
+        content = f"\n{'='*80}\n"
+        content += f"🚨 強制平倉開始: {symbol}\n"
+        content += f"時間: {timestamp}\n"
+        content += f"觸發原因: {kwargs.get('trigger_reason', 'N/A')}\n"
+
+        # 初始倉位信息
+        initial_pos = kwargs.get('initial_position', {})
+        content += f"📊 初始倉位:\n"
+        content += f"   ├─ 方向: {initial_pos.get('direction', 'N/A')}\n"
+        content += f"   ├─ 數量: {initial_pos.get('quantity', 'N/A')}\n"
+        content += f"   ├─ 進場價: {initial_pos.get('entry_price', 'N/A')}\n"
+        content += f"   └─ 資金費率: {initial_pos.get('funding_rate', 'N/A')}%\n"
+
+        # 系統狀態
+        system_status = kwargs.get('system_status', {})
+        content += f"🔧 系統狀態:\n"
+        content += f"   ├─ 重試次數: {system_status.get('retry_count', 'N/A')}/{system_status.get('max_retry', 'N/A')}\n"
+        content += f"   ├─ 重試歷時: {system_status.get('retry_duration_seconds', 'N/A')}秒\n"
+        content += f"   └─ 校正時間: {system_status.get('corrected_time_ms', 'N/A')}ms\n"
+
+        # 市場條件
+        market_cond = kwargs.get('market_conditions', {})
+        content += f"📈 市場條件:\n"
+        content += f"   ├─ 買價: {market_cond.get('bid_price', 'N/A')}\n"
+        content += f"   ├─ 賣價: {market_cond.get('ask_price', 'N/A')}\n"
+        content += f"   ├─ 點差: {market_cond.get('spread_percentage', 'N/A')}\n"
+        content += f"   └─ 流動性: {market_cond.get('liquidity_status', 'N/A')}\n"
+
+        content += f"{'='*80}\n"
+
+    elif step == 'force_close_detailed_success':
+        content = f"[{display_time}] ✅ 強制平倉成功: ID:{kwargs.get('order_id', 'N/A')}\n"
+
+        # 執行結果
+        exec_result = kwargs.get('execution_result', {})
+        content += f"[{display_time}] 📊 執行結果:\n"
+        content += f"[{display_time}]    ├─ 訂單狀態: {exec_result.get('order_status', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 成交量: {exec_result.get('executed_qty', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 成交價: {exec_result.get('avg_price', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 執行方向: {exec_result.get('side_executed', 'N/A')}\n"
+
+        # 效能指標
+        performance = kwargs.get('performance_metrics', {})
+        content += f"[{display_time}] ⚡ 效能指標:\n"
+        content += f"[{display_time}]    ├─ API響應: {performance.get('api_response_time_ms', 'N/A')}ms\n"
+        content += f"[{display_time}]    ├─ 總處理時間: {performance.get('total_process_time_ms', 'N/A')}ms\n"
+        content += f"[{display_time}]    ├─ 倉位檢查: {performance.get('position_check_time_ms', 'N/A')}ms\n"
+        content += f"[{display_time}]    └─ 執行品質: {performance.get('execution_quality', 'N/A')}\n"
+
+        # 市場執行分析
+        market_exec = kwargs.get('market_execution_analysis', {})
+        content += f"[{display_time}] 💰 市場執行:\n"
+        content += f"[{display_time}]    ├─ 滑點: {market_exec.get('slippage_percentage', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 流動性消耗: {market_exec.get('liquidity_consumption', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 市場影響: {market_exec.get('market_impact', 'N/A')}\n"
+
+        # 重試上下文
+        retry_context = kwargs.get('retry_context', {})
+        content += f"[{display_time}] 🔄 重試歷程:\n"
+        content += f"[{display_time}]    ├─ 重試次數: {retry_context.get('retry_count', 'N/A')}/{retry_context.get('max_retry', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 重試歷時: {retry_context.get('retry_duration_seconds', 'N/A')}秒\n"
+        content += f"[{display_time}]    └─ 前次狀況: {retry_context.get('previous_attempts', 'N/A')}\n"
+
+        # 倉位校正
+        position_recon = kwargs.get('position_reconciliation', {})
+        content += f"[{display_time}] 📋 倉位校正:\n"
+        content += f"[{display_time}]    ├─ 原始進場價: {position_recon.get('original_entry_price', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 實際進場價: {position_recon.get('actual_entry_price', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 未實現盈虧: {position_recon.get('unrealized_pnl', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 保證金類型: {position_recon.get('margin_type', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 倉位準確性: {position_recon.get('position_accuracy', 'N/A')}\n"
+
+        content += f"{'='*80}\n\n"
+
+    elif step == 'force_close_detailed_failed':
+        content = f"[{display_time}] ❌ 強制平倉失敗: {kwargs.get('error', 'N/A')}\n"
+        content += f"[{display_time}] 錯誤類型: {kwargs.get('error_type', 'N/A')}\n"
+
+        # 失敗分析
+        failure_analysis = kwargs.get('failure_analysis', {})
+        content += f"[{display_time}] 🔍 失敗分析:\n"
+        content += f"[{display_time}]    ├─ 失敗前耗時: {failure_analysis.get('total_time_before_error_ms', 'N/A')}ms\n"
+        content += f"[{display_time}]    ├─ 失敗階段: {failure_analysis.get('failure_stage', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 嚴重程度: {failure_analysis.get('error_severity', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 最終嘗試: {failure_analysis.get('is_final_attempt', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 重試已耗盡: {failure_analysis.get('retry_exhausted', 'N/A')}\n"
+
+        # 重試歷史
+        retry_history = kwargs.get('retry_history', {})
+        content += f"[{display_time}] 📊 重試歷史:\n"
+        content += f"[{display_time}]    ├─ 重試次數: {retry_history.get('retry_count', 'N/A')}/{retry_history.get('max_retry', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 重試歷時: {retry_history.get('retry_duration_seconds', 'N/A')}秒\n"
+        content += f"[{display_time}]    └─ 全部失敗: {retry_history.get('all_attempts_failed', 'N/A')}\n"
+
+        # 失敗時上下文
+        context = kwargs.get('context_at_failure', {})
+        content += f"[{display_time}] 📋 失敗上下文:\n"
+        content += f"[{display_time}]    ├─ 方向: {context.get('direction', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 數量: {context.get('quantity', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 市場流動性: {context.get('market_liquidity', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 有實際倉位: {context.get('has_actual_position', 'N/A')}\n"
+
+        # 影響評估
+        impact = kwargs.get('impact_assessment', {})
+        content += f"[{display_time}] ⚠️ 影響評估:\n"
+        content += f"[{display_time}]    ├─ 倉位狀態: {impact.get('position_status', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 風險等級: {impact.get('risk_level', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 需人工介入: {impact.get('manual_intervention_required', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 建議動作: {impact.get('suggested_actions', 'N/A')}\n"
+
+        content += f"{'='*80}\n\n"
+
+    # 其他新增的詳細記錄類型
+    elif step == 'force_close_no_position_detailed':
+        content = f"[{display_time}] ℹ️ 強制平倉檢查: {kwargs.get('check_result', 'N/A')}\n"
+        content += f"[{display_time}] 檢查耗時: {kwargs.get('position_check_time_ms', 'N/A')}ms\n"
+        content += f"[{display_time}] 清理動作: {kwargs.get('cleanup_actions', 'N/A')}\n"
+        content += f"{'='*60}\n\n"
+
+    elif step == 'force_close_position_validated':
+        content = f"[{display_time}] ✅ 倉位驗證完成: 耗時{kwargs.get('position_check_time_ms', 'N/A')}ms\n"
+
+        # 實際倉位信息
+        actual_pos = kwargs.get('actual_position', {})
+        content += f"[{display_time}] 📊 實際倉位:\n"
+        content += f"[{display_time}]    ├─ 方向: {actual_pos.get('direction', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 數量: {actual_pos.get('quantity', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 進場價: {actual_pos.get('entry_price', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 未實現盈虧: {actual_pos.get('unrealized_pnl', 'N/A')}\n"
+
+        # 倉位比較
+        pos_comp = kwargs.get('position_comparison', {})
+        content += f"[{display_time}] 🔍 倉位比較:\n"
+        content += f"[{display_time}]    ├─ 方向匹配: {pos_comp.get('direction_match', 'N/A')}\n"
+        content += f"[{display_time}]    ├─ 數量匹配: {pos_comp.get('quantity_match', 'N/A')}\n"
+        content += f"[{display_time}]    └─ 有差異: {pos_comp.get('has_discrepancy', 'N/A')}\n"
+
+        content += f"[{display_time}] 將使用實際倉位: {kwargs.get('will_use_actual_position', 'N/A')}\n"
+
+    elif step == 'ultra_fast_api_prepare':
+        content = f"[{display_time}] 🔧 API準備: {kwargs.get('api_method', 'N/A')}\n"
+        content += f"[{display_time}] 預期方向: {kwargs.get('expected_side', 'N/A')}\n"
+        content += f"[{display_time}] 準備耗時: {kwargs.get('prepare_time_ms', 'N/A')}ms\n"
+        content += f"[{display_time}] 訂單參數: {kwargs.get('order_params', 'N/A')}\n"
+
+    else:
+        # 其他步驟的一般記錄
+        content = f"[{display_time}] {step}: {kwargs}\n"
+    return content
+
+
+def render_event(step: str, symbol: str, timestamp_ms: float, fields: Dict) -> str:
+    timestamp = format_timestamp(timestamp_ms)
+    if not symbol and step in ANALYSIS_RENDERERS:
+        return ANALYSIS_RENDERERS[step](timestamp, fields)
+    return render_step(step, symbol, timestamp, fields)
+
+
+def filter_events(events: Iterable[Tuple[str, str, float, Dict]], symbol: Optional[str] = None,
+                  step: Optional[str] = None) -> Iterator[Tuple[str, str, float, Dict]]:
+    for event in events:
+        if (symbol is None or event[1] == symbol) and (step is None or event[0] == step):
+            yield event
+
+
+def resolve_path(target: Optional[str]) -> str:
+    """文件路徑、日期（YYYYMMDD）或留空（今天）"""
+    if target is None:
+        return journal_path(datetime.now())
+    if len(target) == 8 and target.isdigit():
+        return journal_path(datetime.strptime(target, '%Y%m%d'))
+    return target
+
+
+# 使用示例：
+#   python journal_render.py                              今天的日誌渲染為文字
+#   python journal_render.py 20250629 > trade_analysis.txt  指定日期
+#   python journal_render.py logs/trade_journal_20250629.bin --json symbol=BTCUSDT step=entry_success
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    as_json = '--json' in args
+    options = dict(arg.split('=', 1) for arg in args if '=' in arg)
+    targets = [arg for arg in args if '=' not in arg and not arg.startswith('--')]
+    path = resolve_path(targets[0] if targets else None)
+    if not os.path.exists(path):
+        print(f"找不到日誌文件: {path}（目錄 {JOURNAL_DIR}/）")
+        sys.exit(1)
+
+    for step, symbol, timestamp_ms, fields in filter_events(read_journal(path), options.get('symbol'),
+                                                             options.get('step')):
+        if as_json:
+            print(json.dumps({'timestamp': format_timestamp(timestamp_ms), 'step': step, 'symbol': symbol,
+                              'details': fields}, ensure_ascii=False))
+        else:
+            sys.stdout.write(render_event(step, symbol, timestamp_ms, fields))
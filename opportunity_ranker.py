@@ -0,0 +1,272 @@
+"""
+向量化機會排序引擎
+對 FundingRateStore 的全部交易對一次性計算 淨收益 = |資金費率| - 點差，
+以 argpartition 取出前K名，不做整表排序，不逐個呼叫 calculate_net_profit；
+另提供增量維護的機會索引，WebSocket 推送時只更新有變化的交易對，主循環 O(1) 取最佳機會
+"""
+
+import heapq
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from funding_rate_store import FundingRateStore
+
+
+class OpportunityRanker:
+    """機會排序器 - 排序鍵：(結算時間, -淨收益)，結算時間最近的優先，相同時間選淨收益最大的"""
+
+    def __init__(self, store: FundingRateStore, default_spread: float = 0.05):
+        self.store = store
+        # 點差未知時的估算值，與 get_spread() 的默認值一致
+        self.default_spread = default_spread
+
+    def net_profit(self, funding_rate_col: np.ndarray, spread_col: np.ndarray) -> tuple:
+        """向量化計算 (淨收益, 點差)，點差未知（NaN）時使用默認點差"""
+        spread = np.where(np.isnan(spread_col), self.default_spread, spread_col)
+        return np.abs(funding_rate_col) - spread, spread
+
+    def top_k(self, min_net_profit: float, max_spread: float, k: int = 5) -> np.ndarray:
+        """返回前K名的行索引（已按排序鍵排好），沒有符合條件的交易對時返回空陣列"""
+        store = self.store
+        if store.size == 0 or k <= 0:
+            return np.empty(0, dtype=np.intp)
+
+        funding_rate_col, _, next_funding_time_col, tradable = store.columns()
+        spread_col = store.spread_view()[:funding_rate_col.size]
+        net, spread = self.net_profit(funding_rate_col, spread_col)
+
+        # 交易對篩選（TRADING_SYMBOLS / EXCLUDED_SYMBOLS）已預先計算在 tradable 列
+        eligible = tradable & (net >= min_net_profit) & (spread <= max_spread) & (next_funding_time_col > 0)
+        rows = np.flatnonzero(eligible)
+        if rows.size == 0:
+            return rows
+
+        # 結算時間通常只有少數幾個桶（整點結算），逐桶取前K，桶內用 argpartition 避免整表排序
+        nft = next_funding_time_col[rows]
+        result = []
+        remaining = k
+        while remaining > 0 and rows.size > 0:
+            bucket_time = nft.min()
+            in_bucket = nft == bucket_time
+            bucket_rows = rows[in_bucket]
+            bucket_net = net[bucket_rows]
+            if bucket_rows.size > remaining:
+                part = np.argpartition(-bucket_net, remaining - 1)[:remaining]
+                bucket_rows = bucket_rows[part]
+                bucket_net = bucket_net[part]
+            # 只對已取出的（最多K個）行做小排序
+            result.append(bucket_rows[np.argsort(-bucket_net, kind='stable')])
+            remaining -= bucket_rows.size
+            rows = rows[~in_bucket]
+            nft = nft[~in_bucket]
+
+        return np.concatenate(result) if len(result) > 1 else result[0]
+
+    def describe(self, row: int) -> Dict:
+        """把行索引轉為 get_best_opportunity() 使用的機會字典"""
+        store = self.store
+        funding_rate = float(store.funding_rate_view()[row])
+        spread = store.spread_view()[row]
+        spread = self.default_spread if np.isnan(spread) else float(spread)
+        return {
+            'symbol': store.symbols[row],
+            'funding_rate': funding_rate,
+            'net_profit': abs(funding_rate) - spread,
+            'spread': spread,
+            'next_funding_time': int(store.next_funding_time_view()[row]),
+            'direction': 'long' if funding_rate < 0 else 'short'
+        }
+
+    def best(self, min_net_profit: float, max_spread: float) -> Optional[Dict]:
+        """返回排名第一的機會，沒有時返回None"""
+        rows = self.top_k(min_net_profit, max_spread, 1)
+        if rows.size == 0:
+            return None
+        return self.describe(int(rows[0]))
+
+
+class OpportunityIndex:
+    """增量機會索引 - 最小堆，鍵為 (結算時間, -淨收益, 行索引)，過期條目以版本號惰性刪除"""
+
+    def __init__(self, store: FundingRateStore, min_net_profit: float, max_spread: float,
+                 default_spread: float = 0.05):
+        self.store = store
+        self.min_net_profit = min_net_profit
+        self.max_spread = max_spread
+        self.default_spread = default_spread
+        self._lock = threading.Lock()
+        self._heap = []
+        self._live_count = 0
+        # 每行目前在堆中的鍵，用於判斷數據是否真的有變化
+        self._nft = np.zeros(0, dtype=np.int64)
+        self._net = np.zeros(0, dtype=np.float64)
+        self._live = np.zeros(0, dtype=bool)
+        self._version = np.zeros(0, dtype=np.int64)
+
+    def _ensure_capacity(self, size: int):
+        if size <= self._live.size:
+            return
+        capacity = max(size, self._live.size * 2, 64)
+        for name, dtype in (('_nft', np.int64), ('_net', np.float64), ('_live', bool), ('_version', np.int64)):
+            new_column = np.zeros(capacity, dtype=dtype)
+            old_column = getattr(self, name)
+            new_column[:old_column.size] = old_column
+            setattr(self, name, new_column)
+
+    def update_rows(self, rows) -> int:
+        """重新計算指定行的排序鍵，只對鍵有變化的行入堆，返回變化的行數"""
+        rows = np.asarray(rows, dtype=np.intp)
+        if rows.size == 0:
+            return 0
+        store = self.store
+        with self._lock:
+            self._ensure_capacity(store.size)
+            funding_rate_col, _, next_funding_time_col, tradable = store.columns()
+            spread_col = store.spread_view()
+
+            nft = next_funding_time_col[rows]
+            spread = spread_col[rows]
+            spread = np.where(np.isnan(spread), self.default_spread, spread)
+            net = np.abs(funding_rate_col[rows]) - spread
+            eligible = tradable[rows] & (net >= self.min_net_profit) & (spread <= self.max_spread) & (nft > 0)
+
+            changed = (eligible != self._live[rows]) | (eligible & ((nft != self._nft[rows]) | (net != self._net[rows])))
+            if not changed.any():
+                return 0
+
+            changed_rows = rows[changed]
+            self._live_count += int(eligible[changed].sum()) - int(self._live[changed_rows].sum())
+            self._version[changed_rows] += 1
+            self._live[changed_rows] = eligible[changed]
+            self._nft[changed_rows] = nft[changed]
+            self._net[changed_rows] = net[changed]
+
+            heap = self._heap
+            for row in changed_rows[eligible[changed]].tolist():
+                heapq.heappush(heap, (int(self._nft[row]), -float(self._net[row]), row, int(self._version[row])))
+
+            # 惰性刪除累積過多時重建堆，避免堆無限增長
+            if len(heap) > 4 * max(self._live_count, 64):
+                self._compact()
+            return int(changed_rows.size)
+
+    def _compact(self):
+        live_rows = np.flatnonzero(self._live)
+        self._heap = [(int(self._nft[row]), -float(self._net[row]), row, int(self._version[row]))
+                      for row in live_rows.tolist()]
+        heapq.heapify(self._heap)
+
+    def rebuild(self):
+        """以目前存儲內容重建整個索引（閾值變更或冷啟動時使用）"""
+        with self._lock:
+            self._heap = []
+            self._live_count = 0
+            self._live[:] = False
+            self._version += 1
+        self.update_rows(np.arange(self.store.size))
+
+    def set_thresholds(self, min_net_profit: float, max_spread: float):
+        self.min_net_profit = min_net_profit
+        self.max_spread = max_spread
+        self.rebuild()
+
+    def peek(self) -> Optional[int]:
+        """返回最佳機會的行索引（攤銷 O(1)），沒有時返回None"""
+        with self._lock:
+            heap = self._heap
+            while heap:
+                _, _, row, version = heap[0]
+                if self._live[row] and self._version[row] == version:
+                    return row
+                heapq.heappop(heap)
+            return None
+
+    def __len__(self) -> int:
+        return self._live_count
+
+
+def _legacy_best(rates: Dict, spreads: Dict, min_net_profit: float, max_spread: float) -> Optional[Dict]:
+    """舊做法：建立候選列表 + lambda 排序 + 逐個計算淨收益（僅用於基準測試對照）"""
+    candidates = []
+    for symbol, data in rates.items():
+        net_profit = abs(data['funding_rate']) - spreads.get(symbol, 0.05)
+        candidates.append((symbol, data['funding_rate'], net_profit, data['next_funding_time']))
+    candidates.sort(key=lambda x: (x[3], -x[2]))
+    for symbol, funding_rate, net_profit, next_funding_time in candidates:
+        spread = spreads.get(symbol, 0.05)
+        if net_profit >= min_net_profit and spread <= max_spread:
+            return {'symbol': symbol, 'net_profit': net_profit}
+    return None
+
+
+def run_benchmark(symbol_counts=(300, 3000), ticks: int = 2000, seed: int = 7) -> List[Dict]:
+    """微基準測試：每個 tick 找出最佳機會的耗時（微秒）"""
+    rng = np.random.default_rng(seed)
+    results = []
+    for count in symbol_counts:
+        store = FundingRateStore(capacity=count)
+        rates, spreads = {}, {}
+        base_time = int(time.time() * 1000) // 3600000 * 3600000
+        for i in range(count):
+            symbol = f"SYM{i:05d}USDT"
+            funding_rate = float(rng.normal(0, 0.05))
+            next_funding_time = base_time + 3600000 * int(rng.integers(1, 5))
+            spread = float(rng.uniform(0.01, 0.3))
+            store.update(symbol, funding_rate, 1.0, next_funding_time, base_time)
+            store.set_spread(symbol, spread)
+            rates[symbol] = {'funding_rate': funding_rate, 'next_funding_time': next_funding_time}
+            spreads[symbol] = spread
+
+        ranker = OpportunityRanker(store)
+        legacy = _legacy_best(rates, spreads, 0.1, 5.0)
+        vectorized = ranker.best(0.1, 5.0)
+        assert (legacy is None) == (vectorized is None)
+        if legacy:
+            assert legacy['symbol'] == vectorized['symbol']
+
+        start = time.perf_counter()
+        for _ in range(ticks):
+            ranker.top_k(0.1, 5.0, 5)
+        vectorized_us = (time.perf_counter() - start) / ticks * 1e6
+
+        start = time.perf_counter()
+        for _ in range(ticks):
+            _legacy_best(rates, spreads, 0.1, 5.0)
+        legacy_us = (time.perf_counter() - start) / ticks * 1e6
+
+        index = OpportunityIndex(store, 0.1, 5.0)
+        index.rebuild()
+        assert ranker.top_k(0.1, 5.0, 1).tolist()[:1] == ([index.peek()] if index.peek() is not None else [])
+        start = time.perf_counter()
+        for _ in range(ticks):
+            index.peek()
+        peek_us = (time.perf_counter() - start) / ticks * 1e6
+
+        # 模擬一幀推送：約5%交易對資金費率有變化
+        frame_rows = np.arange(count)
+        start = time.perf_counter()
+        frames = max(ticks // 10, 1)
+        for _ in range(frames):
+            moved = rng.random(count) < 0.05
+            for row in np.flatnonzero(moved).tolist():
+                store.update(store.symbols[row], float(rng.normal(0, 0.05)), 1.0,
+                             int(store.next_funding_time_view()[row]), base_time)
+            index.update_rows(frame_rows)
+        frame_us = (time.perf_counter() - start) / frames * 1e6
+
+        results.append({'symbols': count, 'vectorized_us': vectorized_us, 'legacy_us': legacy_us,
+                        'peek_us': peek_us, 'frame_us': frame_us})
+    return results
+
+
+# 基準測試
+if __name__ == "__main__":
+    print("=== 機會排序微基準測試（每個 tick 耗時） ===")
+    for result in run_benchmark():
+        speedup = result['legacy_us'] / result['vectorized_us'] if result['vectorized_us'] > 0 else 0
+        print(f"{result['symbols']:>5}個交易對 | 向量化: {result['vectorized_us']:8.1f}µs | "
+              f"舊做法: {result['legacy_us']:8.1f}µs | 加速: {speedup:.1f}x | "
+              f"索引peek: {result['peek_us']:.2f}µs | 每幀增量更新: {result['frame_us']:.1f}µs")
@@ -0,0 +1,246 @@
+"""
+下單批次層 - 同時觸發的多筆訂單合併為 /fapi/v1/batchOrders 請求（每個請求最多5筆）
+組合模式的多交易對進場、同一結算時間的同時平倉、定期清理發現的多個倉位，在 collect() 區塊內提交的訂單
+由網關事件循環合併為最少的簽名請求；第一筆訂單最多等待 MAX_HOLD 秒（區塊內後續交易對的準備較慢時不拖延已就緒的訂單）；
+批次回應按順序對應回各筆訂單，以可重送錯誤（限流/時間戳）被拒的訂單按原重試次數單獨重送；
+批次請求已寫出後逾時或斷線時各訂單狀態未知：逐筆按 clientOrderId 查詢，已執行的視為成功，其餘不重送
+區塊外或只有一筆時直接走單筆下單（預簽名訂單保留寫入熱連接的快速路徑）
+"""
+
+import asyncio
+import json
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Union
+
+from binance.exceptions import BinanceAPIException
+
+from async_gateway import ORDER_PATH, StagedOrder, is_retryable
+
+MAX_BATCH_ORDERS = 5  # 交易所每個批次請求的訂單上限
+BATCH_RETRY_DELAY = 0.5  # 被拒訂單單獨重送前的等待（與 send_staged 退回正常簽名重試一致）
+MAX_HOLD = 0.005  # 區塊內第一筆訂單最多等待合併的時間（秒），到期即發送已收集的訂單
+
+Order = Union[StagedOrder, Dict]
+
+
+class OrderBatcher:
+    """訂單合併發送 - collect() 在調用方線程標記批次區塊，send() 在網關事件循環中調用
+    max_batch <= 1 時不合併（回放等不支援掛起的網關）"""
+
+    def __init__(self, gateway, max_batch: int = MAX_BATCH_ORDERS, max_hold: float = MAX_HOLD):
+        self.gateway = gateway
+        self.max_batch = min(max_batch, MAX_BATCH_ORDERS)
+        self.max_hold = max_hold
+        self._holds = 0
+        self._lock = threading.Lock()
+        self._pending: List[tuple] = []  # 只在事件循環線程讀寫
+        self._flush_timer: Optional[asyncio.TimerHandle] = None
+        self.stats = {'single_orders': 0, 'batches': 0, 'batched_orders': 0, 'rejected_in_batch': 0}
+
+    @contextmanager
+    def collect(self, size: int = MAX_BATCH_ORDERS):
+        """區塊內提交到網關的下單協程合併發送；size 為預計訂單數，少於2筆時不攔截（單筆不增加任何延遲）
+        下單協程須以 send() 作為第一個 await，區塊結束時提交的釋放動作排在它們之後執行；
+        區塊未結束時，已收集的訂單最遲在第一筆進入 send() 後 max_hold 秒發出"""
+        if size < 2 or self.max_batch < 2:
+            yield
+            return
+        with self._lock:
+            self._holds += 1
+        try:
+            yield
+        finally:
+            self.gateway.submit(self._release())
+
+    async def _release(self):
+        # 區塊內的下單協程已先排入事件循環，讓出一次確保它們都已進入 send()
+        await asyncio.sleep(0)
+        with self._lock:
+            self._holds -= 1
+            released = self._holds == 0
+        if released:
+            await self.flush()
+
+    async def send(self, order: Order, trigger_at: Optional[float] = None, timeout: float = 1.0,
+                   max_retries: int = 2):
+        """發送一筆訂單（預簽名訂單或下單參數），返回交易所的訂單回應；批次區塊內時等待合併發送"""
+        if not self._holds:
+            return await self._send_single(order, trigger_at, timeout, max_retries)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((order, trigger_at, timeout, max_retries, future))
+        if len(self._pending) >= self.max_batch:
+            loop.create_task(self.flush())  # 已滿一個批次，不必再等
+        elif self._flush_timer is None:
+            self._flush_timer = loop.call_later(self.max_hold, lambda: loop.create_task(self.flush()))
+        return await future
+
+    async def flush(self):
+        """把等待中的訂單按 max_batch 分組，各組同時發送"""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        chunks = [pending[index:index + self.max_batch] for index in range(0, len(pending), self.max_batch)]
+        await asyncio.gather(*(self._dispatch(chunk) for chunk in chunks))
+
+    # ========== 發送 ==========
+
+    async def _send_single(self, order: Order, trigger_at: Optional[float], timeout: float, max_retries: int):
+        self.stats['single_orders'] += 1
+        if isinstance(order, StagedOrder):
+            return await self.gateway.send_staged(order, trigger_at, timeout=timeout, max_retries=max_retries)
+        return await self.gateway.create_order(timeout=timeout, max_retries=max_retries, **order)
+
+    async def _dispatch(self, chunk: List[tuple]):
+        """發送一個批次請求（只有一筆時直接下單），結果逐筆設置到等待中的 send()"""
+        if len(chunk) == 1:
+            order, trigger_at, timeout, max_retries, future = chunk[0]
+            await self._resolve(future, self._send_single(order, trigger_at, timeout, max_retries))
+            return
+
+        triggers = [entry[1] for entry in chunk if entry[1] is not None]
+        batch = self.gateway.stage_batch([self._params(entry[0]) for entry in chunk])
+        self.stats['batches'] += 1
+        self.stats['batched_orders'] += len(chunk)
+        try:
+            results = await self.gateway.send_staged(batch, min(triggers) if triggers else None,
+                                                     timeout=max(entry[2] for entry in chunk), max_retries=0)
+        except Exception as e:
+            if batch.wire_at is not None and not isinstance(e, BinanceAPIException):
+                # 批次已寫出後逾時/斷線：各訂單狀態未知，逐筆查詢確認，不重送
+                await asyncio.gather(*(self._resolve(entry[4], self._confirm(self._params(entry[0]), e, entry[2]))
+                                       for entry in chunk))
+                return
+            if not is_retryable(e, batch.wire_at is not None, idempotent=False):
+                # 重送結果相同的拒絕：不重送
+                for *_, future in chunk:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            results = [e] * len(chunk)  # 整個批次未送達或被限流：每筆按自己的重試次數單獨重送
+        if not isinstance(results, list) or len(results) != len(chunk):
+            error = BinanceAPIException(None, 400, json.dumps({'code': -1, 'msg': f"批次回應無法對應: {results}"}))
+            results = [error] * len(chunk)
+
+        retries = []
+        for (order, trigger_at, timeout, max_retries, future), result in zip(chunk, results):
+            if isinstance(order, StagedOrder):
+                order.trigger_at, order.wire_at = trigger_at, batch.wire_at
+            error = result if isinstance(result, Exception) else self._order_error(result)
+            if error is None:
+                if not future.done():
+                    future.set_result(result)
+            elif max_retries <= 0 or not is_retryable(error, sent=False):
+                if not future.done():
+                    future.set_exception(error)
+            else:
+                retries.append(self._resolve(future, self._retry(order, timeout, max_retries)))
+        await asyncio.gather(*retries)
+
+    async def _retry(self, order: Order, timeout: float, max_retries: int):
+        await asyncio.sleep(BATCH_RETRY_DELAY)
+        return await self.gateway.request_with_retry('POST', ORDER_PATH, self._params(order), signed=True,
+                                                     timeout=timeout, max_retries=max_retries - 1)
+
+    async def _confirm(self, params: Dict, error: Exception, timeout: float):
+        """按 clientOrderId 確認狀態未知的訂單：查到即返回，查無此單或無法確認時拋出原錯誤"""
+        try:
+            existing = await self.gateway.lookup_order(params['symbol'], params['newClientOrderId'], timeout=timeout)
+        except Exception:
+            existing = None
+        if existing is None:
+            raise error
+        return existing
+
+    async def _resolve(self, future: asyncio.Future, coro):
+        try:
+            result = await coro
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+
+    # ========== 工具 ==========
+
+    @staticmethod
+    def _params(order: Order) -> Dict:
+        return order.params if isinstance(order, StagedOrder) else order
+
+    def _order_error(self, result) -> Optional[BinanceAPIException]:
+        """批次回應中被拒的訂單為 {code, msg}，轉為與單筆下單相同的 BinanceAPIException"""
+        if isinstance(result, dict) and 'orderId' not in result and 'code' in result:
+            self.stats['rejected_in_batch'] += 1
+            return BinanceAPIException(None, 400, json.dumps(result))
+        return None
+
+
+# 使用示例：python order_batcher.py [交易對數]  （本地模擬交易所：同時平倉 N 個交易對，逐筆下單 vs 批次下單）
+if __name__ == "__main__":
+    import sys
+    import time
+
+    from async_gateway import AsyncGateway
+    from fake_exchange import FakeBinanceServer, LatencyProfile
+
+    symbols = ['BTCUSDT', 'ETHUSDT', 'SOLUSDT', 'DOGEUSDT', '1000PEPEUSDT', 'XRPUSDT']
+    count = min(int(sys.argv[1]) if len(sys.argv) > 1 else 4, len(symbols))
+    quantities = {'BTCUSDT': 0.01, 'ETHUSDT': 0.1, 'SOLUSDT': 2, 'DOGEUSDT': 1000, '1000PEPEUSDT': 10000, 'XRPUSDT': 500}
+    server = FakeBinanceServer(seed=3, latency=LatencyProfile('lognormal', 2.5, 0.3)).start()
+    gateway = AsyncGateway('', '', base_url=server.base_url)
+    gateway.start()
+    batcher = OrderBatcher(gateway)
+
+    def round_trip(side: str, reduce_only: bool, batched: bool) -> tuple:
+        """同時提交 count 筆訂單（與 fire_close 相同：逐個 submit 到網關），返回 (耗時ms, 請求數, 結果)"""
+        requests_before = server.stats['requests']
+        futures = []
+        start = time.perf_counter()
+        with batcher.collect(count if batched else 1):
+            for symbol in symbols[:count]:
+                staged = gateway.stage_order(symbol=symbol, side=side, type='MARKET', quantity=quantities[symbol],
+                                             reduceOnly=reduce_only or None)
+                futures.append(gateway.submit(batcher.send(staged, time.perf_counter(), max_retries=0)))
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(5))
+            except Exception as e:
+                results.append(e)
+        return (time.perf_counter() - start) * 1000, server.stats['requests'] - requests_before, results
+
+    try:
+        for batched in (False, True):
+            label = '批次下單' if batched else '逐筆下單'
+            entry_ms, entry_requests, _ = round_trip('BUY', False, batched)
+            close_ms, close_requests, results = round_trip('SELL', True, batched)
+            filled = sum(1 for result in results if isinstance(result, dict) and result.get('status') == 'FILLED')
+            print(f"{label}: 進場 {count} 筆 {entry_ms:.1f}ms / {entry_requests} 個請求 | "
+                  f"平倉 {close_ms:.1f}ms / {close_requests} 個請求，成交 {filled}/{count}")
+            assert filled == count and not server.market.positions
+
+        # 部分失敗：沒有持倉的 reduceOnly 平倉被拒，其餘訂單照常成交，錯誤對應回該筆訂單
+        round_trip('BUY', False, True)
+        server.market.positions.pop(symbols[0])
+        _, requests, results = round_trip('SELL', True, True)
+        errors = [(symbol, result.code) for symbol, result in zip(symbols, results) if isinstance(result, Exception)]
+        print(f"部分失敗: {requests} 個請求，被拒 {errors}，其餘 {len(results) - len(errors)} 筆成交")
+        assert errors == [(symbols[0], -2022)] and not server.market.positions
+
+        # 區塊內後續交易對準備較慢（冷交易對設置槓桿等）：已就緒的訂單不等區塊結束，最遲 MAX_HOLD 後發出
+        with batcher.collect(count):
+            start = time.perf_counter()
+            staged = gateway.stage_order(symbol=symbols[1], side='BUY', type='MARKET', quantity=quantities[symbols[1]])
+            gateway.submit(batcher.send(staged, start, max_retries=0)).result(5)
+            first_ms = (time.perf_counter() - start) * 1000
+        print(f"區塊內準備較慢: 第一筆 {first_ms:.1f}ms 成交（等待上限 {MAX_HOLD * 1000:.0f}ms，不等區塊結束）")
+        assert first_ms < 100
+        print(f"統計: {batcher.stats}")
+    finally:
+        gateway.stop()
+        server.stop()
@@ -0,0 +1,401 @@
+"""
+持倉狀態機（事件溯源）
+取代 current_position / position_open_time / is_closing / entry_locked_until / position_check_delay_until 這組標誌：
+每筆交易是一條 PositionRecord，狀態只經由下單回應、成交推送或倉位核對驅動轉換
+
+    IDLE ─進場開始→ ENTRY_PENDING ─回應/成交/核對有倉→ OPEN ─平倉發出→ CLOSE_PENDING ─回應/成交→ CLOSED
+                         └─拒單/核對無倉→ FAILED      └─倉位消失→ CLOSED   └─平倉失敗→ OPEN（持倉仍在）
+
+每個交易對同一時間最多一筆進行中的交易，同時進行的交易數不超過 max_positions（組合模式 > 1）
+每次轉換都追加到 logs/position_journal_YYYYMMDD.bin（格式同 trade_journal.py，立即落盤），
+重啟時 recover() 重放今天與昨天的日誌，恢復未結束的交易，再由調用方與交易所持倉核對
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from trade_journal import JournalFormatError, TradeJournal, journal_path, read_journal
+
+IDLE = 'IDLE'
+ENTRY_PENDING = 'ENTRY_PENDING'
+OPEN = 'OPEN'
+CLOSE_PENDING = 'CLOSE_PENDING'
+CLOSED = 'CLOSED'
+FAILED = 'FAILED'
+
+TRANSITIONS = {
+    IDLE: frozenset([ENTRY_PENDING]),
+    ENTRY_PENDING: frozenset([OPEN, FAILED]),
+    OPEN: frozenset([CLOSE_PENDING, CLOSED]),
+    CLOSE_PENDING: frozenset([CLOSED, OPEN]),
+    CLOSED: frozenset(),
+    FAILED: frozenset(),
+}
+TERMINAL_STATES = frozenset([CLOSED, FAILED])
+
+POSITION_JOURNAL_PREFIX = 'position_journal'
+ENTRY_ACK_TIMEOUT = 2.0  # 進場回應超過此秒數未到（發送超時等）時，改由倉位核對決定 OPEN / FAILED
+
+_RECORD_FIELDS = ('trade_id', 'symbol', 'direction', 'quantity', 'entry_price', 'funding_rate', 'next_funding_time',
+                  'order_id', 'close_order_id', 'exit_price', 'opened_at', 'entry_sent_at')
+
+
+class PositionStateError(Exception):
+    """非法的狀態轉換（例如已有進行中的交易時再次進場）"""
+
+
+class PositionRecord:
+    """一筆交易的狀態與持倉信息 - 只由 PositionStateMachine 修改"""
+
+    __slots__ = _RECORD_FIELDS + ('state', 'reason', 'updated_at', 'history')
+
+    def __init__(self, trade_id: str, symbol: str, direction: str, funding_rate: float = 0.0,
+                 next_funding_time: int = 0):
+        self.trade_id = trade_id
+        self.symbol = symbol
+        self.direction = direction
+        self.quantity = 0.0
+        self.entry_price = 0.0
+        self.funding_rate = funding_rate
+        self.next_funding_time = next_funding_time
+        self.order_id = None
+        self.close_order_id = None
+        self.exit_price = 0.0
+        self.opened_at = time.time()     # 進場開始時間（time.time），定期清理以此計算持倉時長
+        self.entry_sent_at = None        # 進場訂單提交到網關的時間（time.time）
+        self.state = IDLE
+        self.reason = ''
+        self.updated_at = 0.0
+        self.history: List[tuple] = []   # [(狀態, 校正時間ms, 原因)]
+
+    @property
+    def active(self) -> bool:
+        return self.state not in TERMINAL_STATES
+
+    def as_position(self) -> Dict:
+        """與舊 current_position 相同的字典（另加 trade_id / state / opened_at），返回副本"""
+        return {
+            'symbol': self.symbol,
+            'direction': self.direction,
+            'quantity': self.quantity,
+            'entry_price': self.entry_price,
+            'funding_rate': self.funding_rate,
+            'next_funding_time': self.next_funding_time,
+            'order_id': self.order_id,
+            'trade_id': self.trade_id,
+            'state': self.state,
+            'opened_at': self.opened_at,
+        }
+
+    def fields(self) -> Dict:
+        return {name: getattr(self, name) for name in _RECORD_FIELDS}
+
+
+class PositionStateMachine:
+    """進行中交易的狀態機（按交易對） - 轉換在鎖內完成，下單回應線程、成交推送線程、主循環可同時調用"""
+
+    def __init__(self, journal: Optional[TradeJournal] = None, clock: Optional[Callable[[], float]] = None,
+                 log: Optional[Callable[[str], None]] = None, max_positions: int = 1):
+        self.journal = journal
+        self.clock = clock or (lambda: time.time() * 1000)
+        self.log = log or print
+        self.max_positions = max_positions
+        self.transitions = 0
+        self._active: Dict[str, PositionRecord] = {}  # 交易對 -> 進行中（未到 CLOSED/FAILED）的交易，按開始順序
+        self._last: Optional[PositionRecord] = None
+        self._lock = threading.RLock()
+
+    # ========== 讀取 ==========
+
+    @property
+    def active(self) -> Optional[PositionRecord]:
+        """最早開始的進行中交易（單一持倉模式下即唯一的一筆），沒有時為None"""
+        return next(iter(self._active.values()), None)
+
+    def records(self) -> List[PositionRecord]:
+        """全部進行中的交易（副本，按開始順序）"""
+        with self._lock:
+            return list(self._active.values())
+
+    @property
+    def last(self) -> Optional[PositionRecord]:
+        """最近一筆交易（含已結束的）"""
+        return self._last
+
+    @property
+    def state(self) -> str:
+        """狀態摘要：沒有進行中的交易為 IDLE，一筆時為其狀態，多筆時如 'OPEN×2,CLOSE_PENDING×1'"""
+        states = [record.state for record in self.records()]
+        if len(states) <= 1:
+            return states[0] if states else IDLE
+        return ','.join(f"{state}×{states.count(state)}" for state in dict.fromkeys(states))
+
+    def find(self, symbol: str) -> Optional[PositionRecord]:
+        return self._active.get(symbol)
+
+    # ========== 轉換 ==========
+
+    def begin_entry(self, symbol: str, direction: str, funding_rate: float = 0.0,
+                    next_funding_time: int = 0) -> PositionRecord:
+        """IDLE → ENTRY_PENDING；該交易對已有進行中的交易、或進行中的交易數已達 max_positions 時
+        拋出 PositionStateError（取代開倉鎖定）"""
+        with self._lock:
+            existing = self._active.get(symbol)
+            if existing is not None:
+                raise PositionStateError(f"已有進行中的交易 {symbol}（{existing.state}）")
+            if len(self._active) >= self.max_positions:
+                raise PositionStateError(f"進行中的交易已達上限 {self.max_positions}（{self.state}）")
+            trade_id = f"{symbol}-{next_funding_time}-{int(self.clock())}"
+            record = PositionRecord(trade_id, symbol, direction, funding_rate, next_funding_time)
+            self._active[symbol] = self._last = record
+            self._transition(record, ENTRY_PENDING, 'entry_start')
+            return record
+
+    def entry_sent(self, record: PositionRecord, quantity: float, entry_price: float):
+        """進場訂單已提交網關（狀態不變，只記錄數量與預期價格）"""
+        with self._lock:
+            record.quantity = quantity
+            record.entry_price = entry_price
+            record.entry_sent_at = time.time()
+
+    def entry_acked(self, record: PositionRecord, order_id, executed_qty: float = 0.0,
+                    avg_price: float = 0.0, reason: str = 'order_ack') -> bool:
+        """ENTRY_PENDING → OPEN（下單回應或成交推送，先到者轉換，後到者只補充訂單號/成交價）"""
+        with self._lock:
+            if order_id is not None:
+                record.order_id = order_id
+            if executed_qty:
+                record.quantity = executed_qty
+            if avg_price:
+                record.entry_price = avg_price
+            if record.state != ENTRY_PENDING:
+                return False
+            return self._transition(record, OPEN, reason)
+
+    def entry_failed(self, record: PositionRecord, reason: str) -> bool:
+        """ENTRY_PENDING → FAILED（拒單、進場前異常、核對後確認沒有持倉）"""
+        with self._lock:
+            if record.state != ENTRY_PENDING:
+                return False
+            return self._transition(record, FAILED, reason)
+
+    def entry_overdue(self, record: PositionRecord, timeout: float = ENTRY_ACK_TIMEOUT) -> bool:
+        """進場訂單已提交但超過 timeout 秒仍無回應/成交推送，需要倉位核對"""
+        return (record.state == ENTRY_PENDING and record.entry_sent_at is not None
+                and time.time() - record.entry_sent_at > timeout)
+
+    def reconcile(self, record: PositionRecord, actual: Optional[Dict], reason: str = 'reconcile') -> str:
+        """以交易所實際持倉核對（check_actual_position 格式，None 為無持倉），返回核對後狀態：
+        ENTRY_PENDING 有倉→OPEN、無倉→FAILED；CLOSE_PENDING 仍有倉→OPEN；OPEN 同步方向與數量"""
+        with self._lock:
+            if not record.active:
+                return record.state
+            if actual is None:
+                if record.state == ENTRY_PENDING:
+                    self._transition(record, FAILED, reason + '_no_position')
+                return record.state
+            record.direction = actual['direction']
+            record.quantity = actual['quantity']
+            if actual.get('entry_price'):
+                record.entry_price = actual['entry_price']
+            if record.state in (ENTRY_PENDING, CLOSE_PENDING):
+                self._transition(record, OPEN, reason)
+            return record.state
+
+    def sync(self, record: PositionRecord, direction: str, quantity: float):
+        """OPEN 狀態下與實際倉位同步方向/數量（不轉換狀態）"""
+        with self._lock:
+            record.direction = direction
+            record.quantity = quantity
+
+    def begin_close(self, record: PositionRecord, reason: str = 'close_sent') -> bool:
+        """OPEN → CLOSE_PENDING；不在 OPEN（進場未確認、已在平倉、已結束）時返回 False（取代 is_closing）"""
+        with self._lock:
+            if record.state != OPEN:
+                return False
+            return self._transition(record, CLOSE_PENDING, reason)
+
+    def close_acked(self, record: PositionRecord, order_id=None, avg_price: float = 0.0,
+                    reason: str = 'close_ack') -> bool:
+        """CLOSE_PENDING → CLOSED（平倉回應或成交推送）"""
+        with self._lock:
+            if order_id is not None:
+                record.close_order_id = order_id
+            if avg_price:
+                record.exit_price = avg_price
+            if record.state != CLOSE_PENDING:
+                return False
+            return self._transition(record, CLOSED, reason)
+
+    def close_rejected(self, record: PositionRecord, reason: str) -> bool:
+        """CLOSE_PENDING → OPEN：平倉單失敗，持倉仍在，交由後備平倉/強制平倉處理"""
+        with self._lock:
+            if record.state != CLOSE_PENDING:
+                return False
+            return self._transition(record, OPEN, reason)
+
+    def mark_closed(self, record: PositionRecord, reason: str) -> bool:
+        """持倉已在交易所消失（清理單、強制平倉、核對無倉）：OPEN/CLOSE_PENDING → CLOSED，ENTRY_PENDING → FAILED"""
+        with self._lock:
+            if record.state == ENTRY_PENDING:
+                return self._transition(record, FAILED, reason)
+            if record.state in (OPEN, CLOSE_PENDING):
+                return self._transition(record, CLOSED, reason)
+            return False
+
+    def on_order_update(self, order: Dict) -> bool:
+        """用戶數據流的訂單推送（PositionBook.order() 格式）：成交推送驅動 ENTRY_PENDING→OPEN、CLOSE_PENDING→CLOSED"""
+        record = self._active.get(order.get('symbol'))
+        if record is None or not order.get('executed_qty'):
+            return False
+        entry_side = 'BUY' if record.direction == 'long' else 'SELL'
+        if record.state == ENTRY_PENDING and not order.get('reduce_only') and order.get('side') == entry_side:
+            if order.get('status') == 'FILLED':
+                return self.entry_acked(record, order['order_id'], order['executed_qty'], order['avg_price'],
+                                        reason='fill')
+        elif record.state == CLOSE_PENDING and order.get('reduce_only') and order.get('side') != entry_side:
+            if order.get('status') == 'FILLED':
+                return self.close_acked(record, order['order_id'], order['avg_price'], reason='fill')
+        return False
+
+    def _transition(self, record: PositionRecord, state: str, reason: str) -> bool:
+        if state not in TRANSITIONS[record.state]:
+            raise PositionStateError(f"{record.symbol} 非法狀態轉換 {record.state} → {state}（{reason}）")
+        previous = record.state
+        now_ms = self.clock()
+        record.state = state
+        record.reason = reason
+        record.updated_at = now_ms
+        record.history.append((state, now_ms, reason))
+        if state in TERMINAL_STATES and self._active.get(record.symbol) is record:
+            del self._active[record.symbol]
+        self.transitions += 1
+        if self.journal is not None:
+            fields = record.fields()
+            fields.update({'state': state, 'from': previous, 'reason': reason})
+            try:
+                self.journal.append(state, record.symbol, now_ms, fields, flush=True)
+            except Exception as e:
+                self.log(f"持倉狀態日誌寫入失敗: {e}")
+        return True
+
+    # ========== 恢復 ==========
+
+    def recover(self, days: int = 2) -> List[PositionRecord]:
+        """重放最近 days 天的狀態日誌，恢復每個交易對最後一筆未結束的交易（狀態保持日誌中的最後狀態）"""
+        if self.journal is None:
+            return []
+        today = datetime.fromtimestamp(self.clock() / 1000)
+        records: Dict[str, Dict] = {}
+        for offset in range(days - 1, -1, -1):
+            path = journal_path(today - timedelta(days=offset), self.journal.directory, self.journal.prefix)
+            if not os.path.exists(path):
+                continue
+            try:
+                for state, _, timestamp_ms, fields in read_journal(path):
+                    if 'trade_id' in fields:
+                        fields['updated_at'] = timestamp_ms
+                        records[fields['trade_id']] = fields
+            except (JournalFormatError, KeyError, ValueError) as e:
+                self.log(f"持倉狀態日誌 {path} 讀取失敗: {e}")
+        latest_by_symbol: Dict[str, Dict] = {}
+        for fields in sorted(records.values(), key=lambda fields: fields['updated_at']):
+            latest_by_symbol[fields['symbol']] = fields
+        recovered = []
+        for latest in latest_by_symbol.values():
+            if latest['state'] in TERMINAL_STATES:
+                continue
+            record = PositionRecord(latest['trade_id'], latest['symbol'], latest['direction'],
+                                    latest.get('funding_rate') or 0.0, latest.get('next_funding_time') or 0)
+            for name in _RECORD_FIELDS:
+                if name in latest:
+                    setattr(record, name, latest[name])
+            record.state = latest['state']
+            record.reason = latest.get('reason', '')
+            record.updated_at = latest['updated_at']
+            record.history.append((record.state, record.updated_at, 'recovered'))
+            recovered.append(record)
+        with self._lock:
+            for record in recovered:
+                self._active[record.symbol] = self._last = record
+        return recovered
+
+
+# 使用示例：python position_state.py  （狀態轉換、成交推送驅動、日誌恢復自檢）
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        machine = PositionStateMachine(TradeJournal(directory, POSITION_JOURNAL_PREFIX))
+
+        # 一次完整的進場 → 平倉：進場由下單回應驅動，平倉由成交推送驅動
+        record = machine.begin_entry('BTCUSDT', 'long', -0.52, 1735718400000)
+        machine.entry_sent(record, 0.012, 27123.4)
+        try:
+            machine.begin_entry('ETHUSDT', 'short')
+            raise AssertionError("單一持倉模式下進行中的交易應拒絕再次進場")
+        except PositionStateError as e:
+            print(f"重複進場被拒: {e}")
+        assert not machine.begin_close(record), "進場未確認時不能平倉"
+        assert machine.entry_acked(record, 8389765492, 0.012, 27123.5)
+        assert not machine.entry_acked(record, 8389765492), "重複回應不再轉換"
+        assert machine.begin_close(record) and not machine.begin_close(record)
+        assert machine.on_order_update({'order_id': 8389765501, 'symbol': 'BTCUSDT', 'side': 'SELL', 'reduce_only': True,
+                                        'status': 'FILLED', 'executed_qty': 0.012, 'avg_price': 27120.1})
+        assert machine.active is None and record.state == CLOSED and record.exit_price == 27120.1
+        print(" → ".join(state for state, _, _ in record.history))
+
+        # 背靠背結算：上一筆結束後立即可以進場；拒單 → FAILED
+        rejected = machine.begin_entry('ETHUSDT', 'short', -0.31, 1735722000000)
+        assert machine.entry_failed(rejected, 'rejected:-2019') and machine.active is None
+
+        # 發送超時：狀態保持 ENTRY_PENDING，由核對決定
+        pending = machine.begin_entry('SOLUSDT', 'short', -0.44, 1735725600000)
+        machine.entry_sent(pending, 3.0, 101.2)
+        pending.entry_sent_at -= ENTRY_ACK_TIMEOUT + 1
+        assert machine.entry_overdue(pending)
+        assert machine.reconcile(pending, {'direction': 'short', 'quantity': 3.0, 'entry_price': 101.25}) == OPEN
+
+        # 模擬崩潰：新的狀態機從日誌恢復進行中的交易
+        recovered_machine = PositionStateMachine(TradeJournal(directory, POSITION_JOURNAL_PREFIX))
+        recovered, = recovered_machine.recover()
+        assert recovered.trade_id == pending.trade_id and recovered.state == OPEN
+        assert recovered.quantity == 3.0 and recovered.entry_price == 101.25
+        print(f"恢復: {recovered.symbol} {recovered.direction} {recovered.quantity} @ {recovered.entry_price}（{recovered.state}）")
+        recovered_machine.mark_closed(recovered, 'cleanup')
+        assert PositionStateMachine(TradeJournal(directory, POSITION_JOURNAL_PREFIX)).recover() == []
+
+        # 組合模式：同一結算時間多個交易對，各自獨立轉換，超過上限或同一交易對重複進場被拒
+        portfolio = PositionStateMachine(max_positions=3)
+        legs = [portfolio.begin_entry(symbol, 'short', 0.5, 1735729200000) for symbol in ('AUSDT', 'BUSDT', 'CUSDT')]
+        for rejected_symbol in ('DUSDT', 'AUSDT'):
+            try:
+                portfolio.begin_entry(rejected_symbol, 'short')
+                raise AssertionError("超過上限/重複交易對應被拒")
+            except PositionStateError as e:
+                print(f"組合進場被拒: {e}")
+        for index, leg in enumerate(legs):
+            portfolio.entry_acked(leg, index)
+        portfolio.begin_close(legs[2])
+        print(f"組合狀態: {portfolio.state}")
+        assert portfolio.state == 'OPEN×2,CLOSE_PENDING×1' and portfolio.find('BUSDT') is legs[1]
+
+        try:
+            machine._transition(record, OPEN, 'test')
+            raise AssertionError("已結束的交易不能再轉換")
+        except PositionStateError:
+            pass
+
+        machine = recovered_machine
+        start = time.perf_counter()
+        rounds = 2000
+        for index in range(rounds):
+            record = machine.begin_entry('BTCUSDT', 'long', -0.5, index)
+            machine.entry_acked(record, index)
+            machine.begin_close(record)
+            machine.close_acked(record, index)
+        per_transition_us = (time.perf_counter() - start) / (rounds * 4) * 1e6
+        print(f"每次轉換（含日誌落盤）: {per_transition_us:.1f}µs，共 {machine.transitions} 次轉換")
@@ -0,0 +1,316 @@
+"""
+平倉後處理流水線 - 固定的階段與工作線程，取代每次平倉新建的 Timer 線程、分析器和 HTTP 客戶端
+交易器的階段依次為：盈虧計算 → 持久化 → 通知 → 對帳；每個階段一個有界佇列和固定數量的工作線程，
+下游佇列滿時上游工作線程阻塞（背壓），入口佇列滿時 submit 等待 SUBMIT_TIMEOUT 後拒絕並計數；
+stop() 先等待各階段處理完已提交的任務（長延後的對帳除外），關閉時剛平倉的交易記錄不會遺失；
+批次階段一次取出已到期的多個任務（持久化只寫一次文件，相近時間平倉的交易合併為一次對帳查詢）；
+status()/format_status() 提供各階段的佇列深度、最大深度、處理數、錯誤數等指標
+"""
+
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+STAGE_QUEUE_SIZE = 64   # 每個階段的佇列上限
+SUBMIT_TIMEOUT = 0.5    # 入口佇列滿時 submit 的最長等待（秒），調用方在網關執行緒池中，不長時間阻塞
+POLL_INTERVAL = 0.5     # 工作線程檢查停止標記的間隔（秒）
+
+
+class PipelineStage:
+    """單一階段 - 有界佇列 + 固定數量的工作線程
+    handler 接收一個任務（batch > 1 時為任務列表），返回交給下一階段的任務（批次階段為列表），None 表示不往下傳；
+    delay > 0 時任務在 job[due_key] + delay 秒後才處理，batch_window 內將到期的任務併入同一批；
+    drain=False 的階段停止時不等待（延後很久的對帳），未處理的任務計為放棄"""
+
+    def __init__(self, name: str, handler: Callable, workers: int = 1, maxsize: int = STAGE_QUEUE_SIZE,
+                 batch: int = 1, delay: float = 0.0, batch_window: float = 0.0, due_key: str = 'closed_at',
+                 drain: bool = True):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.batch = batch
+        self.delay = delay
+        self.batch_window = batch_window
+        self.due_key = due_key
+        self.drain = drain
+        self.queue = queue.Queue(maxsize)
+        self.next_stage: Optional['PipelineStage'] = None
+        self.log: Callable[[str], None] = print
+        self.processed = 0
+        self.errors = 0
+        self.rejected = 0
+        self.batches = 0
+        self.abandoned = 0
+        self.max_depth = 0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    # ========== 入隊 ==========
+
+    def put(self, job: Dict, timeout: Optional[float] = None) -> bool:
+        """放入任務；timeout 為 None 時一直等待（上游工作線程的背壓），超時返回False"""
+        try:
+            self.queue.put(job, timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return True
+
+    # ========== 工作線程 ==========
+
+    def start(self):
+        self._stopped.clear()
+        self._threads = [threading.Thread(target=self._run, name=f"post-trade-{self.name}-{index}", daemon=True)
+                         for index in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout: float = 1.0):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        # 未處理的任務（延後階段尚未到期的對帳等）計為放棄
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                return
+            self.abandoned += 1
+
+    def idle(self) -> bool:
+        return self.queue.empty() and self.in_flight == 0
+
+    def _due(self, job: Dict) -> float:
+        return job.get(self.due_key, 0.0) + self.delay if self.delay else 0.0
+
+    def _take(self, timeout: Optional[float]) -> Optional[Dict]:
+        """取出一個任務並計入進行中（取出到處理完之間 idle() 不會誤判為空閒）"""
+        try:
+            job = self.queue.get(timeout=timeout) if timeout else self.queue.get_nowait()
+        except queue.Empty:
+            return None
+        with self._lock:
+            self.in_flight += 1
+        return job
+
+    def _abandon(self, count: int):
+        with self._lock:
+            self.abandoned += count
+            self.in_flight -= count
+
+    def _run(self):
+        carry = None  # 批次時取出但尚未到期的任務，留到下一批
+        while not self._stopped.is_set():
+            if carry is not None:
+                job, carry = carry, None
+            else:
+                job = self._take(POLL_INTERVAL)
+                if job is None:
+                    continue
+            # 延後階段：等到任務到期（停止時放棄）
+            wait = self._due(job) - time.time()
+            if wait > 0 and self._stopped.wait(wait):
+                self._abandon(1)
+                return
+            jobs = [job]
+            deadline = time.time() + self.batch_window
+            while len(jobs) < self.batch:
+                extra = self._take(None)
+                if extra is None:
+                    break
+                if self._due(extra) > deadline:
+                    carry = extra
+                    break
+                jobs.append(extra)
+            self._process(jobs)
+        if carry is not None:
+            self._abandon(1)
+
+    def _process(self, jobs: List[Dict]):
+        try:
+            outputs = self.handler(jobs if self.batch > 1 else jobs[0])
+        except Exception as e:
+            with self._lock:
+                self.errors += len(jobs)
+                self.in_flight -= len(jobs)
+            self.log(f"平倉後處理階段 {self.name} 失敗: {e}")
+            return
+        if self.batch == 1:
+            outputs = [outputs] if outputs is not None else []
+        # 先交給下一階段再減少進行中計數，idle() 不會在任務轉手時誤判
+        if self.next_stage is not None:
+            for output in outputs or []:
+                self.next_stage.put(output)
+        with self._lock:
+            self.processed += len(jobs)
+            self.batches += 1
+            self.in_flight -= len(jobs)
+
+    def status(self) -> Dict:
+        return {
+            'depth': self.queue.qsize(),
+            'max_depth': self.max_depth,
+            'in_flight': self.in_flight,
+            'processed': self.processed,
+            'batches': self.batches,
+            'errors': self.errors,
+            'rejected': self.rejected,
+            'abandoned': self.abandoned,
+        }
+
+
+class PostTradePipeline:
+    """依序串接的處理階段；工作線程在第一次 submit 時啟動（回放等不平倉的情況不建立線程）"""
+
+    def __init__(self, stages: List[PipelineStage], log: Optional[Callable[[str], None]] = None):
+        self.stages = stages
+        self.log = log or print
+        for stage, next_stage in zip(stages, stages[1:] + [None]):
+            stage.next_stage = next_stage
+            stage.log = self.log
+        self.submitted = 0
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self) -> 'PostTradePipeline':
+        with self._lock:
+            if not self._started:
+                for stage in self.stages:
+                    stage.start()
+                self._started = True
+        return self
+
+    def submit(self, job: Dict, timeout: float = SUBMIT_TIMEOUT) -> bool:
+        """放入第一個階段；入口佇列滿超過 timeout 時返回False（已計入該階段的 rejected）"""
+        self.start()
+        self.submitted += 1
+        return self.stages[0].put(job, timeout)
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """等待 drain 階段處理完已提交的任務（drain=False 的階段不等待）"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if all(stage.idle() for stage in self.stages if stage.drain):
+                return True
+            time.sleep(0.01)
+        return False
+
+    def stop(self, timeout: float = 5.0):
+        """處理完 drain 階段的任務後停止所有工作線程，可重複調用"""
+        with self._lock:
+            started, self._started = self._started, False
+        if not started:
+            return
+        self.flush(timeout)
+        for stage in self.stages:
+            stage.stop()
+
+    def depths(self) -> Dict[str, int]:
+        return {stage.name: stage.queue.qsize() for stage in self.stages}
+
+    def status(self) -> Dict[str, Dict]:
+        return {stage.name: stage.status() for stage in self.stages}
+
+    def format_status(self) -> str:
+        parts = []
+        for stage in self.stages:
+            stats = stage.status()
+            part = (f"{stage.name} 佇列{stats['depth']}(最大{stats['max_depth']}) 完成{stats['processed']}"
+                    f"/{stats['batches']}批")
+            if stats['errors'] or stats['rejected'] or stats['abandoned']:
+                part += f" 錯誤{stats['errors']} 拒絕{stats['rejected']} 放棄{stats['abandoned']}"
+            parts.append(part)
+        return "平倉後處理: " + " | ".join(parts)
+
+
+# 使用示例：python post_trade.py [平倉筆數]  （同一結算時間多筆平倉：每筆新建線程/分析器 vs 固定流水線）
+if __name__ == "__main__":
+    import sys
+
+    closes = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    reconcile_delay = 0.3
+    lookup_ms = 40.0     # 模擬一次帳戶查詢（收入 + 成交）的耗時
+    client_ms = 15.0     # 模擬新建 Client（連接、時間同步）的耗時
+    calls = {'lookups': 0, 'clients': 0, 'saves': 0}
+    lookup_lock = threading.Lock()
+
+    def new_client():
+        with lookup_lock:
+            calls['clients'] += 1
+        time.sleep(client_ms / 1000)
+
+    def lookup(symbols):
+        with lookup_lock:
+            calls['lookups'] += 1
+        time.sleep(lookup_ms / 1000)
+
+    def save_history():
+        calls['saves'] += 1
+
+    # 舊做法：每筆平倉一個 Timer 線程（盈虧、寫文件、通知），再一個 Timer 線程新建分析器查詢
+    def legacy(job, done):
+        save_history()
+
+        def reconcile():
+            new_client()
+            lookup([job['symbol']])
+            done.release()
+        threading.Timer(reconcile_delay, reconcile).start()
+
+    start = time.perf_counter()
+    threads_before = threading.active_count()
+    done = threading.Semaphore(0)
+    peak_threads = 0
+    for index in range(closes):
+        threading.Timer(0.01, legacy, ({'symbol': f"SIM{index:03d}USDT"}, done)).start()
+        peak_threads = max(peak_threads, threading.active_count() - threads_before)
+    time.sleep(0.05)
+    peak_threads = max(peak_threads, threading.active_count() - threads_before)
+    for _ in range(closes):
+        done.acquire()
+    legacy_ms = (time.perf_counter() - start) * 1000
+    legacy_calls = dict(calls)
+
+    # 流水線：盈虧 → 持久化（批次寫一次） → 對帳（延後、合併查詢，共用一個客戶端）
+    calls.update(lookups=0, clients=0, saves=0)
+    reconciled = []
+    new_client()  # 整個流水線只建立一次
+
+    def persist(jobs):
+        save_history()
+        return jobs
+
+    def reconcile(jobs):
+        lookup({job['symbol'] for job in jobs})
+        reconciled.extend(jobs)
+
+    pipeline = PostTradePipeline([
+        PipelineStage('pnl', lambda job: job, workers=2),
+        PipelineStage('persist', persist, batch=16),
+        PipelineStage('reconcile', reconcile, batch=16, delay=reconcile_delay, batch_window=0.5, drain=False),
+    ])
+    start = time.perf_counter()
+    threads_before = threading.active_count()
+    now = time.time()
+    for index in range(closes):
+        assert pipeline.submit({'symbol': f"SIM{index:03d}USDT", 'closed_at': now})
+    pipeline_threads = threading.active_count() - threads_before
+    while pipeline.status()['reconcile']['processed'] < closes:
+        time.sleep(0.005)
+    pipeline_ms = (time.perf_counter() - start) * 1000
+    print(f"{closes} 筆同時平倉的後處理")
+    print(f"  每筆新建線程: 線程峰值 {peak_threads} | 新建客戶端 {legacy_calls['clients']} | "
+          f"帳戶查詢 {legacy_calls['lookups']} | 寫文件 {legacy_calls['saves']} | 耗時 {legacy_ms:.0f}ms")
+    print(f"  固定流水線:   常駐線程 {pipeline_threads} | 新建客戶端 {calls['clients']} | "
+          f"帳戶查詢 {calls['lookups']} | 寫文件 {calls['saves']} | 耗時 {pipeline_ms:.0f}ms")
+    print(pipeline.format_status())
+    pipeline.stop()
+    assert calls['lookups'] == -(-closes // 16) and len(reconciled) == closes
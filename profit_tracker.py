@@ -151,8 +151,8 @@ class ProfitTracker:
         
         print(f"[{datetime.now().strftime('%H:%M:%S')}] 已重置本次套利統計數據")
     
-    def add_trade(self, trade_data: Dict):
-        """添加交易記錄"""
+    def add_trade(self, trade_data: Dict, save: bool = True):
+        """添加交易記錄；save=False 時由調用方在一批交易後統一 save_trade_history()"""
         # 添加時間戳
         trade_data['timestamp'] = datetime.now().isoformat()
         
@@ -186,7 +186,8 @@ class ProfitTracker:
             self.session_max_loss = pnl
         
         # 保存交易歷史
-        self.save_trade_history()
+        if save:
+            self.save_trade_history()
         
         print(f"[{datetime.now().strftime('%H:%M:%S')}] 交易記錄已添加: {trade_data.get('symbol', 'Unknown')} - {pnl:.4f} USDT")
     
@@ -0,0 +1,709 @@
+"""
+回放 / 回測引擎
+把錄製的 !markPrice@arr / !bookTicker 幀（ws_decoder.capture_frames 的格式，每行一幀原始消息）
+按幀內事件時間 E 送入 FundingRateTrader.on_message，以模擬時鐘取代校正後的服務器時間，
+截止時間調度器、網關、REST 客戶端都換成模擬實現，訂單由模擬撮合引擎按當時的最優買賣價成交，
+結算時按當時的資金費率收付資金費；整個過程單線程、確定性，遠快於實時，
+用於在部署參數變更前評估策略收益與熱路徑的 CPU 耗時
+"""
+
+import contextlib
+import gzip
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+import re
+import sys
+import time
+from array import array
+from types import SimpleNamespace
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from async_gateway import ConnectionStats, StagedOrder
+from deadline_scheduler import SkewHistogram
+from exchange_cache import ExchangeCache
+from order_batcher import OrderBatcher
+from position_state import PositionStateMachine
+from test_trading_minute import FundingRateTrader
+
+TAKER_FEE_RATE = 0.0005     # 市價單手續費率
+ORDER_LATENCY_MS = 5.0      # 模擬的下單往返延遲（提交到成交）
+TICK_INTERVAL_MS = 100      # 主循環 tick 的模擬間隔（對應 CHECK_INTERVAL）
+ACTIVE_WINDOW_MS = 120000   # 結算前2分鐘起逐幀回放，直到平倉完成
+IDLE_STRIDE_MS = 60000      # 其餘時間快進：每60秒只回放一幀標記價格，略過 bookTicker；0 表示逐幀回放全部
+DEFAULT_HALF_SPREAD = 0.0002  # 沒有 bookTicker 時，以標記價格 ± 萬分之二 作為買賣價
+
+_EVENT_TIME = re.compile(r'"E":(\d+)')
+
+
+# ========== 幀來源 ==========
+
+def iter_frames(path: str) -> Iterator[str]:
+    """逐行讀取錄製的幀文件（支援 .gz），不一次載入記憶體"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line:
+                yield line
+
+
+def timed_frames(frames: Iterable[str]) -> Iterator[Tuple[int, str]]:
+    """為每幀附上事件時間（幀內第一個 "E" 欄位），沒有時沿用上一幀的時間"""
+    last_ms = 0
+    for frame in frames:
+        match = _EVENT_TIME.search(frame, 0, 200)
+        if match:
+            last_ms = max(last_ms, int(match.group(1)))
+        if last_ms:
+            yield last_ms, frame
+
+
+def synthetic_session(days: float = 2.0, symbol_count: int = 40, mark_interval_ms: int = 1000,
+                      book_tickers_per_mark: int = 5, start_ms: Optional[int] = None,
+                      seed: int = 7, skip_to: Optional[Callable[[int], int]] = None) -> Iterator[str]:
+    """生成合成行情：每8小時結算一次，每次結算前隨機挑幾個交易對出現較大的資金費率
+    skip_to(當前時間) 返回下一幀需要的時間（例如 ReplayEngine.resume_at），其間的幀不生成，價格一次走完"""
+    rng = np.random.default_rng(seed)
+    symbols = [f"SIM{i:03d}USDT" for i in range(symbol_count)]
+    prices = rng.uniform(0.05, 5000, symbol_count)
+    spreads = rng.uniform(0.00005, 0.0008, symbol_count)
+    interval = 8 * 3600 * 1000
+    now = start_ms if start_ms is not None else (int(time.time() * 1000) // interval - int(days * 3) - 1) * interval
+    end = now + int(days * 86400 * 1000)
+    rates = np.zeros(symbol_count)
+    next_funding = now
+
+    while now < end:
+        if now >= next_funding:
+            # 新的結算週期：大部分交易對費率接近0，隨機3個出現 ±0.2%~0.6%
+            next_funding += interval
+            rates[:] = rng.normal(0, 0.0001, symbol_count)
+            hot = rng.choice(symbol_count, 3, replace=False)
+            rates[hot] = rng.choice([-1, 1], 3) * rng.uniform(0.002, 0.006, 3)
+        if skip_to is not None:
+            target = min(skip_to(now), next_funding, end)
+            if target > now:
+                steps = -(-(target - now) // mark_interval_ms)
+                prices *= np.exp(rng.normal(0, 0.0002 * math.sqrt(steps), symbol_count))
+                now += steps * mark_interval_ms
+                continue
+        prices *= np.exp(rng.normal(0, 0.0002, symbol_count))
+        yield json.dumps({'stream': '!markPrice@arr', 'data': [
+            {'e': 'markPriceUpdate', 'E': now, 's': symbol, 'p': f"{prices[i]:.6f}", 'i': f"{prices[i]:.6f}",
+             'P': f"{prices[i]:.6f}", 'r': f"{rates[i]:.8f}", 'T': next_funding}
+            for i, symbol in enumerate(symbols)]}, separators=(',', ':'))
+        for i in rng.choice(symbol_count, book_tickers_per_mark, replace=False):
+            half = prices[i] * spreads[i] / 2
+            yield json.dumps({'stream': '!bookTicker', 'data': {
+                'e': 'bookTicker', 'u': 1, 'E': now + 1, 'T': now + 1, 's': symbols[i],
+                'b': f"{prices[i] - half:.6f}", 'B': '10', 'a': f"{prices[i] + half:.6f}", 'A': '10'}},
+                separators=(',', ':'))
+        now += mark_interval_ms
+
+
+# ========== 模擬時鐘 / 調度器 ==========
+
+class SimulatedClock:
+    """模擬時鐘 - 實現交易器用到的時鐘模型接口，校正後的服務器時間即回放的當前時間"""
+
+    ready = True
+
+    def __init__(self, start_ms: float = 0.0):
+        self.now_ms = float(start_ms)
+        self.last_sync = 0.0
+
+    def set(self, now_ms: float):
+        if now_ms > self.now_ms:
+            self.now_ms = float(now_ms)
+
+    def server_ms(self, local_ms: Optional[float] = None) -> float:
+        return self.now_ms
+
+    def offset_ms(self) -> float:
+        return 0.0
+
+    def uncertainty_ms(self) -> float:
+        return 0.0
+
+    def sync_interval(self, ms_to_settlement: Optional[float]) -> Optional[float]:
+        return None
+
+    def should_sync(self, ms_to_settlement: Optional[float]) -> bool:
+        return False
+
+
+class SimulatedScheduler:
+    """與 DeadlineScheduler 相同的接口，事件由回放引擎在模擬時間到達時觸發"""
+
+    def __init__(self):
+        self.histogram = SkewHistogram()
+        self._heap = []
+        self._events: Dict = {}
+        self._fired = set()
+        self._counter = itertools.count()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def schedule(self, key, target_ms: float, action, *args) -> bool:
+        if key in self._fired:
+            return False
+        seq = next(self._counter)
+        self._events[key] = (target_ms, seq, action, args)
+        heapq.heappush(self._heap, (target_ms, seq, key))
+        return True
+
+    def cancel(self, key) -> bool:
+        return self._events.pop(key, None) is not None
+
+    def pending(self, key) -> Optional[float]:
+        event = self._events.get(key)
+        return event[0] if event is not None else None
+
+    def has_fired(self, key) -> bool:
+        return key in self._fired
+
+    def next_due(self) -> Optional[float]:
+        heap = self._heap
+        while heap:
+            target_ms, seq, key = heap[0]
+            event = self._events.get(key)
+            if event is not None and event[1] == seq:
+                return target_ms
+            heapq.heappop(heap)
+        return None
+
+    def pop_due(self, now_ms: float):
+        """取出一個已到期的事件 (key, 動作, 參數)，沒有時返回None"""
+        target_ms = self.next_due()
+        if target_ms is None or target_ms > now_ms:
+            return None
+        _, _, key = heapq.heappop(self._heap)
+        _, _, action, args = self._events.pop(key)
+        self._fired.add(key)
+        self.histogram.record(now_ms - target_ms)
+        return key, action, args
+
+
+# ========== 模擬撮合引擎 ==========
+
+class SimulatedExchange:
+    """模擬交易所 - 實現交易器用到的 python-binance Client 方法；
+    市價單按當時的 bookTicker 成交（買單吃賣一、賣單吃買一），結算時按當時的資金費率收付資金費"""
+
+    def __init__(self, clock: SimulatedClock, taker_fee_rate: float = TAKER_FEE_RATE):
+        self.clock = clock
+        self.taker_fee_rate = taker_fee_rate
+        self.session = SimpleNamespace(hooks={})  # WeightBudget.attach_to_client 掛載鉤子用
+        self.funding_rates = None  # 由回放引擎綁定交易器的 FundingRateStore / book_tickers
+        self.book_tickers: Dict = {}
+        self.leverage: Dict[str, int] = {}
+        self.positions: Dict[str, Dict] = {}  # symbol -> {qty(帶方向), entry_price, funding_time, ...}
+        self.trades: List[Dict] = []          # 已平倉的交易記錄
+        self.orders = 0
+        self.balance_change = 0.0
+        self._order_ids = itertools.count(1)
+
+    def bind_market(self, funding_rates, book_tickers: Dict):
+        self.funding_rates = funding_rates
+        self.book_tickers = book_tickers
+
+    # ========== 行情 ==========
+
+    def quote(self, symbol: str) -> Tuple[float, float]:
+        book = self.book_tickers.get(symbol)
+        if book and book.get('bid_price', 0) > 0 and book.get('ask_price', 0) > 0:
+            return book['bid_price'], book['ask_price']
+        mark_price = self.funding_rates.mark_price(symbol) if self.funding_rates is not None else None
+        if mark_price is None:
+            raise ValueError(f"{symbol} 沒有行情數據")
+        return mark_price * (1 - DEFAULT_HALF_SPREAD), mark_price * (1 + DEFAULT_HALF_SPREAD)
+
+    # ========== 資金費結算 ==========
+
+    def next_settlement(self) -> Optional[float]:
+        times = [position['funding_time'] for position in self.positions.values() if position['funding_time']]
+        return min(times) if times else None
+
+    def settle_due(self, now_ms: float):
+        """結算時間已到的持倉按當前（結算前最後一幀）的資金費率收付：多頭在費率為正時支付"""
+        for symbol, position in self.positions.items():
+            while position['funding_time'] and now_ms >= position['funding_time']:
+                row = self.funding_rates.get(symbol) or {}
+                rate = row.get('funding_rate', 0.0) / 100
+                mark_price = row.get('mark_price') or position['entry_price']
+                payment = -position['qty'] * mark_price * rate
+                position['funding'] += payment
+                position['settlements'] += 1
+                self.balance_change += payment
+                next_time = row.get('next_funding_time', 0)
+                position['funding_time'] = next_time if next_time > position['funding_time'] else \
+                    position['funding_time'] + 8 * 3600 * 1000
+
+    # ========== 下單 ==========
+
+    def market_order(self, symbol: str, side: str, quantity, reduce_only: bool = False) -> Dict:
+        quantity = float(quantity)
+        if quantity <= 0:
+            raise ValueError(f"無效數量: {quantity}")
+        bid, ask = self.quote(symbol)
+        price = ask if side == 'BUY' else bid
+        signed = quantity if side == 'BUY' else -quantity
+        position = self.positions.get(symbol)
+        if reduce_only:
+            if position is None or position['qty'] * signed >= 0:
+                raise ValueError(f"ReduceOnly Order is rejected: {symbol} 沒有可減少的持倉")
+            signed = max(-abs(position['qty']), min(abs(position['qty']), signed))
+            quantity = abs(signed)
+
+        fee = quantity * price * self.taker_fee_rate
+        self.balance_change -= fee
+        self.orders += 1
+        now_ms = self.clock.now_ms
+        if position is None:
+            row = self.funding_rates.get(symbol) or {} if self.funding_rates is not None else {}
+            self.positions[symbol] = {
+                'symbol': symbol, 'qty': signed, 'entry_price': price, 'entry_time': now_ms,
+                'funding_time': row.get('next_funding_time', 0), 'funding': 0.0, 'fees': fee, 'settlements': 0,
+                'entry_funding_rate': row.get('funding_rate', 0.0)
+            }
+        elif position['qty'] * signed > 0:
+            total = position['qty'] + signed
+            position['entry_price'] = (position['entry_price'] * position['qty'] + price * signed) / total
+            position['qty'] = total
+            position['fees'] += fee
+        else:
+            closed = min(abs(signed), abs(position['qty']))
+            direction = 1 if position['qty'] > 0 else -1
+            price_pnl = (price - position['entry_price']) * closed * direction
+            self.balance_change += price_pnl
+            position['fees'] += fee
+            position['qty'] += signed
+            if abs(position['qty']) < 1e-12:
+                self.trades.append({
+                    'symbol': symbol, 'direction': 'long' if direction > 0 else 'short', 'quantity': closed,
+                    'entry_time': position['entry_time'], 'exit_time': now_ms,
+                    'entry_price': position['entry_price'], 'exit_price': price,
+                    'entry_funding_rate': position['entry_funding_rate'], 'settlements': position['settlements'],
+                    'price_pnl': price_pnl, 'funding': position['funding'], 'fees': position['fees'],
+                    'net_pnl': price_pnl + position['funding'] - position['fees']
+                })
+                del self.positions[symbol]
+        return {
+            'orderId': next(self._order_ids), 'symbol': symbol, 'status': 'FILLED', 'side': side, 'type': 'MARKET',
+            'origQty': str(quantity), 'executedQty': str(quantity), 'avgPrice': f"{price:.8f}",
+            'reduceOnly': reduce_only, 'updateTime': int(now_ms)
+        }
+
+    # ========== python-binance Client 接口 ==========
+
+    def futures_create_order(self, symbol: str, side: str, type: str = 'MARKET', quantity=0, reduceOnly=False, **params):
+        return self.market_order(symbol, side, quantity, reduceOnly in (True, 'true', 'True'))
+
+    def futures_change_leverage(self, symbol: str, leverage: int, **params):
+        self.leverage[symbol] = int(leverage)
+        return {'symbol': symbol, 'leverage': int(leverage), 'maxNotionalValue': '1000000'}
+
+    def futures_position_information(self, symbol: Optional[str] = None, **params):
+        symbols = [symbol] if symbol else sorted(set(self.positions) | set(self.leverage))
+        result = []
+        for name in symbols:
+            position = self.positions.get(name)
+            result.append({'symbol': name, 'positionAmt': str(position['qty'] if position else 0.0),
+                           'entryPrice': str(position['entry_price'] if position else 0.0),
+                           'leverage': str(self.leverage.get(name, 20))})
+        return result
+
+    def futures_order_book(self, symbol: str, limit: int = 5, **params):
+        bid, ask = self.quote(symbol)
+        return {'bids': [[str(bid), '10']], 'asks': [[str(ask), '10']]}
+
+    def futures_symbol_ticker(self, symbol: str, **params):
+        bid, ask = self.quote(symbol)
+        return {'symbol': symbol, 'price': str((bid + ask) / 2)}
+
+    def futures_24hr_ticker(self, symbol: str, **params):
+        bid, ask = self.quote(symbol)
+        return {'symbol': symbol, 'lastPrice': str((bid + ask) / 2)}
+
+    def futures_account(self, **params):
+        return {'totalWalletBalance': str(10000 + self.balance_change),
+                'availableBalance': str(10000 + self.balance_change)}
+
+    def get_server_time(self):
+        return {'serverTime': int(self.clock.now_ms)}
+
+
+# ========== 模擬網關 ==========
+
+def _drive(coro):
+    """同步執行協程：模擬網關的 awaitable 都不會掛起，一次 send 即完成"""
+    try:
+        coro.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coro.close()
+    raise RuntimeError("回放中的協程不應掛起")
+
+
+class SimulatedGateway:
+    """與 AsyncGateway 相同的接口；submit 的協程在 ORDER_LATENCY_MS 後的模擬時間執行（訂單按那時的行情成交）"""
+
+    def __init__(self, exchange: SimulatedExchange, clock: SimulatedClock, latency_ms: float = ORDER_LATENCY_MS):
+        self.exchange = exchange
+        self.clock = clock
+        self.latency_ms = latency_ms
+        self.connection_stats = ConnectionStats()
+        self._pending = []
+        self._counter = itertools.count()
+
+    def start(self):
+        pass
+
+    def in_loop_thread(self) -> bool:
+        # 回放是單線程的，run() 直接驅動協程，同步調用不會卡住任何事件循環
+        return False
+
+    def submit(self, coro):
+        heapq.heappush(self._pending, (self.clock.now_ms + self.latency_ms, next(self._counter), coro))
+
+    def run(self, coro, timeout: Optional[float] = None):
+        return _drive(coro)
+
+    def next_due(self) -> Optional[float]:
+        return self._pending[0][0] if self._pending else None
+
+    def run_due(self, now_ms: float) -> int:
+        count = 0
+        while self._pending and self._pending[0][0] <= now_ms:
+            _, _, coro = heapq.heappop(self._pending)
+            _drive(coro)
+            count += 1
+        return count
+
+    async def run_blocking(self, func, *args):
+        return func(*args)
+
+    async def call(self, func, *args, timeout: float = 1.0, **kwargs):
+        return func(*args, **kwargs)
+
+    async def request(self, method: str, path: str, params: Optional[Dict] = None, **kwargs):
+        if path == '/fapi/v1/time':
+            return self.exchange.get_server_time()
+        raise ValueError(f"回放網關不支援 {method} {path}")
+
+    # ========== 預熱 / 預簽名 ==========
+
+    def keep_warm(self, *args, **kwargs):
+        pass
+
+    async def prewarm(self, *args, **kwargs) -> int:
+        return 0
+
+    def stage_order(self, **params) -> StagedOrder:
+        staged = StagedOrder('POST', '/fapi/v1/order', params)
+        staged.signed_at = time.time()
+        return staged
+
+    def refresh_staged(self, staged: Optional[StagedOrder], max_age: float = 0) -> bool:
+        return staged is not None
+
+    async def send_staged(self, staged: StagedOrder, trigger_at: Optional[float] = None, timeout: float = 1.0,
+                          max_retries: int = 2):
+        staged.trigger_at = trigger_at
+        staged.wire_at = time.perf_counter()
+        return self.exchange.futures_create_order(**staged.params)
+
+    # ========== 端點 ==========
+
+    async def create_order(self, timeout: float = 1.0, max_retries: int = 2, **params):
+        return self.exchange.futures_create_order(**params)
+
+    async def change_leverage(self, symbol: str, leverage: int, timeout: float = 1.0, max_retries: int = 2):
+        return self.exchange.futures_change_leverage(symbol, leverage)
+
+    async def position_information(self, timeout: float = 1.0, max_retries: int = 2, **params):
+        return self.exchange.futures_position_information(**params)
+
+
+# ========== 回放用交易器 ==========
+
+class ReplayTrader(FundingRateTrader):
+    """以模擬依賴構建的 FundingRateTrader：策略、排序、進場/平倉路徑與實盤完全相同，
+    只替換外部依賴，並關閉文件日誌、Excel、通知等與策略無關的副作用"""
+
+    def __init__(self, exchange: SimulatedExchange, gateway: SimulatedGateway, clock: SimulatedClock,
+                 exchange_info: Optional[Dict] = None):
+        self._replay_exchange = exchange
+        self._replay_gateway = gateway
+        self._replay_clock = clock
+        self._replay_exchange_info = exchange_info
+        super().__init__()
+        exchange.bind_market(self.funding_rates, self.book_tickers)
+
+    def _create_client(self):
+        return self._replay_exchange
+
+    def _create_clock_model(self):
+        return self._replay_clock
+
+    def _create_gateway(self):
+        return self._replay_gateway
+
+    def _create_order_batcher(self):
+        # 模擬網關的協程不可掛起，訂單逐筆發送（每筆仍在 ORDER_LATENCY_MS 後成交）
+        return OrderBatcher(self._replay_gateway, max_batch=1)
+
+    def _create_scheduler(self):
+        return SimulatedScheduler()
+
+    def _create_exchange_cache(self):
+        cache = ExchangeCache(':memory:')
+        if self._replay_exchange_info:
+            cache.save_exchange_info(self._replay_exchange_info)
+            self.symbol_filters.load_cache_rows(cache.all_symbols())
+        return cache
+
+    def _create_profit_tracker(self):
+        return None
+
+    def _create_position_state(self):
+        # 狀態轉換不寫日誌文件，也不從上次運行恢復
+        return PositionStateMachine(clock=self._replay_clock.server_ms, max_positions=self.portfolio_max_positions)
+
+    def _setup_logger(self):
+        logger = logging.getLogger('FundingRateTrader.replay')
+        logger.propagate = False
+        logger.disabled = True
+        return logger
+
+    def preload_leverage_cache(self, wait: bool = False):
+        # 槓桿由模擬交易所在首次進場時設置
+        pass
+
+    def write_trade_analysis(self, step: str, symbol: str, **kwargs):
+        pass
+
+    def log_debug_analysis(self, analysis_type: str, details: dict):
+        pass
+
+    def schedule_post_close_processing(self, symbol, direction, quantity, order, position=None):
+        # 盈虧由模擬交易所的成交與資金費記錄計算
+        pass
+
+    def __del__(self):
+        # 回放結束時的未平倉持倉只存在於模擬交易所，不需要關閉時清理
+        pass
+
+
+# ========== 回放引擎 ==========
+
+class LatencySamples:
+    """熱路徑耗時樣本（微秒）"""
+
+    def __init__(self):
+        self.samples = array('d')
+
+    def add(self, us: float):
+        self.samples.append(us)
+
+    def summary(self) -> Dict:
+        if not self.samples:
+            return {'count': 0, 'p50_us': 0.0, 'p99_us': 0.0, 'max_us': 0.0, 'total_ms': 0.0}
+        values = np.frombuffer(self.samples, dtype=np.float64)
+        return {'count': len(values), 'p50_us': float(np.percentile(values, 50)),
+                'p99_us': float(np.percentile(values, 99)), 'max_us': float(values.max()),
+                'total_ms': float(values.sum() / 1000)}
+
+
+class ReplayEngine:
+    """回放引擎 - 按事件時間推進模擬時鐘，依序處理：到期的網關協程 / 調度事件 / 資金費結算 / 主循環 tick / 行情幀"""
+
+    def __init__(self, exchange_info: Optional[Dict] = None, tick_interval_ms: int = TICK_INTERVAL_MS,
+                 latency_ms: float = ORDER_LATENCY_MS, taker_fee_rate: float = TAKER_FEE_RATE,
+                 active_window_ms: int = ACTIVE_WINDOW_MS, idle_stride_ms: int = IDLE_STRIDE_MS,
+                 quiet: bool = True, **params):
+        self.clock = SimulatedClock()
+        self.exchange = SimulatedExchange(self.clock, taker_fee_rate)
+        self.gateway = SimulatedGateway(self.exchange, self.clock, latency_ms)
+        self.quiet = quiet
+        with self._output():
+            self.trader = ReplayTrader(self.exchange, self.gateway, self.clock, exchange_info)
+        # 覆蓋策略參數，例如 funding_rate_threshold / max_spread / entry_before_seconds / close_after_seconds
+        for name, value in params.items():
+            if not hasattr(self.trader, name):
+                raise AttributeError(f"FundingRateTrader 沒有參數 {name}")
+            setattr(self.trader, name, value)
+        self.tick_interval_ms = tick_interval_ms
+        self.active_window_ms = active_window_ms
+        self.idle_stride_ms = idle_stride_ms
+        self.frames = 0
+        self.skipped_frames = 0
+        self.ticks = 0
+        self.first_ms = None
+        self.timings = {'on_message': LatencySamples(), 'tick': LatencySamples(), 'event': LatencySamples()}
+        self._next_tick_ms = 0.0
+        self._next_idle_ms = 0.0
+        self._next_settlement_ms = 0.0
+
+    def _output(self):
+        return contextlib.redirect_stdout(open(os.devnull, 'w')) if self.quiet else contextlib.nullcontext()
+
+    def _is_idle(self, event_ms: int) -> bool:
+        """距離下一次結算超過 active_window_ms、沒有持倉、沒有待觸發事件與在途訂單時可以快進"""
+        if not self.idle_stride_ms or self.trader.current_position is not None:
+            return False
+        if self.gateway.next_due() is not None or self.trader.scheduler.next_due() is not None:
+            return False
+        if event_ms >= self._next_settlement_ms:
+            next_funding_time = self.trader.funding_rates.next_funding_time_view()
+            upcoming = next_funding_time[next_funding_time > event_ms]
+            if not upcoming.size:
+                return False  # 尚未收到標記價格，不緩存，下一幀重新計算
+            self._next_settlement_ms = float(upcoming.min())
+        return event_ms < self._next_settlement_ms - self.active_window_ms
+
+    def resume_at(self, now_ms: int) -> int:
+        """供幀來源查詢：快進期間下一幀會被回放的時間，之前的幀不必生成（synthetic_session 的 skip_to）"""
+        if not self._is_idle(now_ms):
+            return now_ms
+        return int(min(max(now_ms, self._next_idle_ms), self._next_settlement_ms - self.active_window_ms))
+
+    # ========== 推進 ==========
+
+    def _tick(self):
+        """主循環中與交易決策有關的部分（run() 的 schedule_close / get_best_opportunity / schedule_entry）"""
+        trader = self.trader
+        start = time.perf_counter()
+        trader.schedule_close()
+        best_opportunity = trader.get_best_opportunity()
+        if best_opportunity:
+            trader.next_settlement_time = best_opportunity['next_funding_time']
+            trader.schedule_entry(best_opportunity, trader.get_corrected_time())
+        self.timings['tick'].add((time.perf_counter() - start) * 1e6)
+        self.ticks += 1
+
+    def _advance_to(self, target_ms: float):
+        """處理 target_ms 之前（含）所有到期的事件，每個事件都在它自己的時間點執行"""
+        trader = self.trader
+        while True:
+            candidates = [due for due in (self.gateway.next_due(), trader.scheduler.next_due(),
+                                          self.exchange.next_settlement()) if due is not None and due <= target_ms]
+            if not candidates:
+                break
+            due = min(candidates)
+            self.clock.set(due)
+            self.exchange.settle_due(due)
+            if self.gateway.next_due() is not None and self.gateway.next_due() <= due:
+                self.gateway.run_due(due)
+            event = trader.scheduler.pop_due(due)
+            if event is not None:
+                start = time.perf_counter()
+                event[1](*event[2])
+                self.timings['event'].add((time.perf_counter() - start) * 1e6)
+        self.clock.set(target_ms)
+
+    def feed(self, timed: Iterable[Tuple[int, str]]):
+        """回放 (事件時間, 原始幀)"""
+        trader = self.trader
+        on_message = trader.on_message
+        on_message_timings = self.timings['on_message']
+        with self._output():
+            for event_ms, frame in timed:
+                if self.first_ms is None:
+                    self.first_ms = event_ms
+                    self.clock.set(event_ms)
+                    self._next_tick_ms = event_ms
+                if self._is_idle(event_ms):
+                    # 快進：只按步長回放標記價格幀（保持資金費率與結算時間最新），每幀一個tick
+                    if event_ms < self._next_idle_ms or 'markPrice' not in frame[:32]:
+                        self.skipped_frames += 1
+                        continue
+                    self._next_idle_ms = event_ms + self.idle_stride_ms
+                    self._next_tick_ms = event_ms
+                while self._next_tick_ms <= event_ms:
+                    self._advance_to(self._next_tick_ms)
+                    self._tick()
+                    self._next_tick_ms += self.tick_interval_ms
+                self._advance_to(event_ms)
+                start = time.perf_counter()
+                on_message(None, frame)
+                on_message_timings.add((time.perf_counter() - start) * 1e6)
+                self.frames += 1
+            # 收尾：執行已安排但未到時間的平倉與在途訂單
+            for _ in range(100):
+                pending = [due for due in (self.gateway.next_due(), trader.scheduler.next_due()) if due is not None]
+                if not pending:
+                    break
+                self._advance_to(max(pending))
+
+    def run(self, frames: Iterable[str]) -> Dict:
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        self.feed(timed_frames(frames))
+        return self.result(time.perf_counter() - wall_start, time.process_time() - cpu_start)
+
+    # ========== 結果 ==========
+
+    def result(self, wall_seconds: float, cpu_seconds: float) -> Dict:
+        trades = self.exchange.trades
+        simulated_seconds = (self.clock.now_ms - self.first_ms) / 1000 if self.first_ms else 0.0
+        totals = {key: sum(trade[key] for trade in trades) for key in ('price_pnl', 'funding', 'fees', 'net_pnl')}
+        return {
+            'frames': self.frames,
+            'skipped_frames': self.skipped_frames,
+            'ticks': self.ticks,
+            'simulated_seconds': simulated_seconds,
+            'wall_seconds': wall_seconds,
+            'cpu_seconds': cpu_seconds,
+            'speedup': simulated_seconds / wall_seconds if wall_seconds > 0 else math.inf,
+            'trades': trades,
+            'open_positions': list(self.exchange.positions.values()),
+            'totals': totals,
+            'win_rate': sum(1 for trade in trades if trade['net_pnl'] > 0) / len(trades) if trades else 0.0,
+            'timings': {name: samples.summary() for name, samples in self.timings.items()},
+            'scheduler_skew_ms': self.trader.scheduler.histogram.percentile(0.99),
+        }
+
+
+def format_result(result: Dict) -> str:
+    lines = [f"回放 {result['frames']} 幀（快進略過 {result['skipped_frames']} 幀）/ {result['ticks']} 個tick，模擬 {result['simulated_seconds'] / 3600:.1f} 小時，"
+             f"耗時 {result['wall_seconds']:.1f} 秒（CPU {result['cpu_seconds']:.1f} 秒），{result['speedup']:.0f}x 實時"]
+    totals = result['totals']
+    lines.append(f"交易 {len(result['trades'])} 筆（勝率 {result['win_rate'] * 100:.0f}%）| 價差損益 {totals['price_pnl']:+.2f} | "
+                 f"資金費 {totals['funding']:+.2f} | 手續費 -{totals['fees']:.2f} | 淨收益 {totals['net_pnl']:+.2f} USDT")
+    for trade in result['trades'][-10:]:
+        entry = time.strftime('%m-%d %H:%M:%S', time.gmtime(trade['entry_time'] / 1000))
+        hold = (trade['exit_time'] - trade['entry_time']) / 1000
+        lines.append(f"  {entry} {trade['symbol']:<12} {trade['direction']:<5} 費率 {trade['entry_funding_rate']:+.4f}% | "
+                     f"持倉 {hold:.1f}秒 | 價差 {trade['price_pnl']:+.3f} 資金費 {trade['funding']:+.3f} "
+                     f"手續費 -{trade['fees']:.3f} | 淨 {trade['net_pnl']:+.3f}")
+    if result['open_positions']:
+        lines.append(f"  回放結束時仍有 {len(result['open_positions'])} 個未平倉持倉")
+    for name, stats in result['timings'].items():
+        lines.append(f"  熱路徑 {name:>10}: {stats['count']:>8} 次 | p50 {stats['p50_us']:8.1f}µs | "
+                     f"p99 {stats['p99_us']:8.1f}µs | 最大 {stats['max_us']:9.1f}µs | 合計 {stats['total_ms']:.0f}ms")
+    return "\n".join(lines)
+
+
+# 使用示例：
+#   python replay_engine.py                 以合成的兩天行情回放
+#   python replay_engine.py frames.txt[.gz] 回放錄製的幀（python ws_decoder.py --capture frames.txt 錄製）
+if __name__ == "__main__":
+    engine = ReplayEngine()
+    if len(sys.argv) >= 2:
+        source = iter_frames(sys.argv[1])
+        print(f"=== 回放 {sys.argv[1]} ===")
+    else:
+        source = synthetic_session(skip_to=engine.resume_at)
+        print("=== 回放合成行情（2天，40個交易對，每秒標記價格） ===")
+    print(format_result(engine.run(source)))
@@ -0,0 +1,205 @@
+"""
+熱路徑分階段延遲統計
+進場/平倉每個階段（觸發檢查、槓桿、取價、數量計算、簽名、發送、交易所回應、成交確認）以 perf_counter 記錄耗時，
+彙總到 HDR 式對數-線性直方圖（固定記憶體、相對誤差 < 1%），按階段輸出 p50/p99/p999，
+用來判斷 250ms 進場預算被哪個階段用掉
+"""
+
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+SUB_BUCKET_BITS = 7                  # 每個2的冪次區間細分為64格（相對誤差 < 1/64）
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT // 2
+MAX_VALUE_US = 60 * 1000 * 1000      # 超過60秒的記錄按60秒計
+
+# 路徑 -> [(階段, 顯示名稱)]，按發生順序
+STAGES = {
+    'entry': [('trigger', '觸發→檢查完成'), ('leverage', '槓桿檢查'), ('price', '取價'), ('quantity', '數量計算'),
+              ('sign', '訂單簽名'), ('send', '寫入連接'), ('ack', '交易所回應'), ('fill', '成交確認')],
+    'close': [('trigger', '觸發→平倉開始'), ('sign', '訂單簽名'), ('send', '寫入連接'), ('ack', '交易所回應'),
+              ('fill', '成交確認')],
+}
+ENTRY_BUDGET_MS = 250.0  # 進場提前量（ENTRY_BEFORE_SECONDS），整條進場路徑須在此之內完成
+
+
+def _bucket_index(value_us: int) -> int:
+    if value_us < SUB_BUCKET_COUNT:
+        return value_us
+    shift = value_us.bit_length() - SUB_BUCKET_BITS
+    return SUB_BUCKET_COUNT + (shift - 1) * SUB_BUCKET_HALF + ((value_us >> shift) - SUB_BUCKET_HALF)
+
+
+def _bucket_value(index: int) -> float:
+    """桶內中點（微秒）"""
+    if index < SUB_BUCKET_COUNT:
+        return float(index)
+    shift, offset = divmod(index - SUB_BUCKET_COUNT, SUB_BUCKET_HALF)
+    shift += 1
+    return ((offset + SUB_BUCKET_HALF) << shift) + (1 << shift) / 2
+
+
+class LatencyHistogram:
+    """HDR 式延遲直方圖 - 以微秒記錄，O(1) 寫入，百分位由累計計數求得"""
+
+    def __init__(self):
+        self.counts = [0] * (_bucket_index(MAX_VALUE_US) + 1)
+        self.count = 0
+        self.total_us = 0
+        self.min_us = 0
+        self.max_us = 0
+        self._lock = threading.Lock()
+
+    def record(self, value_ms: float):
+        value_us = min(max(int(value_ms * 1000), 0), MAX_VALUE_US)
+        with self._lock:
+            self.counts[_bucket_index(value_us)] += 1
+            if self.count == 0 or value_us < self.min_us:
+                self.min_us = value_us
+            if value_us > self.max_us:
+                self.max_us = value_us
+            self.count += 1
+            self.total_us += value_us
+
+    def percentile(self, q: float) -> float:
+        """第 q 分位（0~1），毫秒"""
+        with self._lock:
+            if self.count == 0:
+                return 0.0
+            target = max(1, int(self.count * q + 0.5)) if q < 1 else self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if seen >= target:
+                    value = min(max(_bucket_value(index), self.min_us), self.max_us)
+                    return value / 1000
+        return self.max_us / 1000
+
+    def mean(self) -> float:
+        return self.total_us / self.count / 1000 if self.count else 0.0
+
+    def summary(self) -> Dict:
+        return {'count': self.count, 'p50': self.percentile(0.5), 'p99': self.percentile(0.99),
+                'p999': self.percentile(0.999), 'max': self.max_us / 1000, 'mean': self.mean()}
+
+
+class StageSpan:
+    """一次進場/平倉的計時：mark(階段) 記錄上一個標記到現在（或到指定的 perf_counter 時間）的耗時"""
+
+    __slots__ = ('tracker', 'path', 'symbol', 'started_at', 'last_at', 'stages', 'finished')
+
+    def __init__(self, tracker: 'StageLatency', path: str, symbol: str = '', started_at: Optional[float] = None):
+        self.tracker = tracker
+        self.path = path
+        self.symbol = symbol
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+        self.last_at = self.started_at
+        self.stages: List[Tuple[str, float]] = []
+        self.finished = False
+
+    def mark(self, stage: str, at: Optional[float] = None) -> float:
+        """記錄階段耗時（毫秒）；at 早於上一個標記時（跨線程的時間戳）按0計"""
+        at = at if at is not None else time.perf_counter()
+        elapsed_ms = max(at - self.last_at, 0.0) * 1000
+        self.last_at = max(at, self.last_at)
+        self.stages.append((stage, elapsed_ms))
+        self.tracker.record(self.path, stage, elapsed_ms)
+        return elapsed_ms
+
+    def finish(self, stage: Optional[str] = None, at: Optional[float] = None) -> float:
+        """記錄最後一個階段與整條路徑的總耗時（毫秒），重複調用無效"""
+        if self.finished:
+            return 0.0
+        if stage is not None:
+            self.mark(stage, at)
+        self.finished = True
+        total_ms = (self.last_at - self.started_at) * 1000
+        self.tracker.record(self.path, 'total', total_ms)
+        return total_ms
+
+    def format(self) -> str:
+        """單次的各階段耗時，如 'trigger 0.41 | leverage 0.02 | ...'"""
+        return ' | '.join(f"{stage} {elapsed_ms:.2f}" for stage, elapsed_ms in self.stages) + ' ms'
+
+
+class StageLatency:
+    """各路徑、各階段的延遲直方圖"""
+
+    def __init__(self):
+        self._histograms: Dict[Tuple[str, str], LatencyHistogram] = {}
+        self._lock = threading.Lock()
+
+    def begin(self, path: str, symbol: str = '', started_at: Optional[float] = None) -> StageSpan:
+        return StageSpan(self, path, symbol, started_at)
+
+    def histogram(self, path: str, stage: str) -> LatencyHistogram:
+        key = (path, stage)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, LatencyHistogram())
+        return histogram
+
+    def record(self, path: str, stage: str, elapsed_ms: float):
+        self.histogram(path, stage).record(elapsed_ms)
+
+    def summary(self) -> Dict[str, Dict[str, Dict]]:
+        """{路徑: {階段: {count, p50, p99, p999, max, mean}}}"""
+        result: Dict[str, Dict[str, Dict]] = {}
+        for (path, stage), histogram in sorted(self._histograms.items()):
+            result.setdefault(path, {})[stage] = histogram.summary()
+        return result
+
+    def format_summary(self, budget_ms: float = ENTRY_BUDGET_MS) -> str:
+        summary = self.summary()
+        if not summary:
+            return "熱路徑階段延遲: 尚無數據"
+        lines = []
+        for path, stages in summary.items():
+            known = [stage for stage, _ in STAGES.get(path, [])]
+            order = known + sorted(stage for stage in stages if stage not in known and stage != 'total') + ['total']
+            labels = dict(STAGES.get(path, []), total='總計')
+            total = stages.get('total', {})
+            header = f"熱路徑階段延遲（{path}，共{total.get('count', 0)}次"
+            if path == 'entry' and total.get('count'):
+                header += f"，預算 {budget_ms:.0f}ms，p99 佔 {total['p99'] / budget_ms * 100:.1f}%"
+            lines.append(header + "）")
+            lines.append(f"  {'次數':>6}{'p50':>10}{'p99':>10}{'p999':>10}{'最大':>10}  階段（毫秒）")
+            for stage in order:
+                stats = stages.get(stage)
+                if stats is None:
+                    continue
+                label = labels.get(stage, stage)
+                lines.append(f"  {stats['count']:>8}{stats['p50']:>10.3f}{stats['p99']:>10.3f}"
+                             f"{stats['p999']:>10.3f}{stats['max']:>10.3f}  {label}")
+        return "\n".join(lines)
+
+
+# 使用示例：python stage_latency.py  （直方圖精度自檢與記錄開銷）
+if __name__ == "__main__":
+    import random
+
+    rng = random.Random(3)
+    values = [rng.lognormvariate(0, 1.5) * 5 for _ in range(200000)]
+    histogram = LatencyHistogram()
+    for value in values:
+        histogram.record(value)
+    ordered = sorted(values)
+    for q in (0.5, 0.99, 0.999):
+        exact = ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+        estimate = histogram.percentile(q)
+        print(f"p{q * 100:g}: 精確 {exact:.4f}ms | 直方圖 {estimate:.4f}ms | 誤差 {abs(estimate - exact) / exact * 100:.2f}%")
+        assert abs(estimate - exact) / exact < 0.02
+    print(f"記憶體: {len(histogram.counts)} 個桶")
+
+    tracker = StageLatency()
+    start = time.perf_counter()
+    for _ in range(10000):
+        span = tracker.begin('entry', 'BTCUSDT')
+        for stage, _ in STAGES['entry'][:-1]:
+            span.mark(stage)
+        span.finish('fill')
+    per_span_us = (time.perf_counter() - start) / 10000 * 1e6
+    print(f"每次進場記錄 {len(STAGES['entry'])} 個階段的開銷: {per_span_us:.1f}µs")
+    print(tracker.format_summary())
@@ -0,0 +1,275 @@
+"""
+交易對過濾器引擎
+啟動時由 futures_exchange_info（或本地交易所信息緩存）預先計算每個交易對的
+LOT_SIZE / MARKET_LOT_SIZE / PRICE_FILTER / MIN_NOTIONAL，下單時數量按 stepSize 取整、
+價格按 tickSize 取整、最小名義價值檢查都是 O(1) 的純計算，不需要任何 API 調用
+"""
+
+import math
+from decimal import Decimal
+from typing import Dict, Iterable, Optional, Tuple, Union
+
+EPSILON = 1e-9  # 浮點比較容忍
+UNIT_DIGITS = 6  # 除以步長後先保留6位小數再取整，消除 22286.17 / 0.001 = 22286169.999996 這類浮點誤差
+
+Number = Union[int, float]
+
+
+def _decimals(step: str) -> int:
+    """步長字串的小數位數：'0.001' -> 3, '1' -> 0, '0.10' -> 1"""
+    exponent = Decimal(step).normalize().as_tuple().exponent
+    return max(-exponent, 0)
+
+
+class StepRule:
+    """單一步長規則（數量或價格）- 以 浮點步長 + 小數位數 取整，結果再 round 消除浮點尾差"""
+
+    __slots__ = ('step', 'decimals', 'minimum', 'maximum')
+
+    def __init__(self, step: Optional[str], minimum: Optional[str] = None, maximum: Optional[str] = None):
+        step = step if step and float(step) > 0 else '1'
+        self.step = float(step)
+        self.decimals = _decimals(step)
+        self.minimum = float(minimum) if minimum else 0.0
+        self.maximum = float(maximum) if maximum and float(maximum) > 0 else math.inf
+
+    def _value(self, units: int) -> Number:
+        value = round(units * self.step, self.decimals)
+        return int(value) if self.decimals == 0 else value
+
+    def floor(self, value: float) -> Number:
+        return self._value(math.floor(round(value / self.step, UNIT_DIGITS)))
+
+    def ceil(self, value: float) -> Number:
+        return self._value(math.ceil(round(value / self.step, UNIT_DIGITS)))
+
+    def nearest(self, value: float) -> Number:
+        return self._value(round(value / self.step))
+
+    def is_aligned(self, value: float) -> bool:
+        units = round(value / self.step, UNIT_DIGITS)
+        return units == math.floor(units)
+
+
+class SymbolFilter:
+    """單一交易對的過濾器 - 市價單數量用 MARKET_LOT_SIZE（沒有時用 LOT_SIZE）"""
+
+    __slots__ = ('symbol', 'lot', 'market_lot', 'price', 'min_notional')
+
+    def __init__(self, symbol: str, step_size: Optional[str], min_qty: Optional[str], max_qty: Optional[str],
+                 tick_size: Optional[str], min_notional: Optional[str],
+                 market_step_size: Optional[str] = None, market_min_qty: Optional[str] = None,
+                 market_max_qty: Optional[str] = None):
+        self.symbol = symbol
+        self.lot = StepRule(step_size, min_qty, max_qty)
+        self.market_lot = StepRule(market_step_size or step_size, market_min_qty or min_qty, market_max_qty or max_qty)
+        self.price = StepRule(tick_size)
+        self.min_notional = float(min_notional) if min_notional else 0.0
+
+    @classmethod
+    def from_symbol_info(cls, symbol_info: Dict) -> 'SymbolFilter':
+        """由 exchange_info['symbols'] 的一項構建"""
+        filters = {item['filterType']: item for item in symbol_info.get('filters', [])}
+        lot = filters.get('LOT_SIZE', {})
+        market_lot = filters.get('MARKET_LOT_SIZE', {})
+        notional = filters.get('MIN_NOTIONAL', {})
+        return cls(symbol_info['symbol'], lot.get('stepSize'), lot.get('minQty'), lot.get('maxQty'),
+                   filters.get('PRICE_FILTER', {}).get('tickSize'), notional.get('notional', notional.get('minNotional')),
+                   market_lot.get('stepSize'), market_lot.get('minQty'), market_lot.get('maxQty'))
+
+    @classmethod
+    def from_cache_row(cls, row: Dict) -> 'SymbolFilter':
+        """由 ExchangeCache.symbol() / all_symbols() 的一行構建"""
+        return cls(row['symbol'], row['step_size'], row['min_qty'], row['max_qty'], row['tick_size'],
+                   row['min_notional'], row['market_step_size'], row['market_min_qty'], row['market_max_qty'])
+
+    def _rule(self, market: bool) -> StepRule:
+        return self.market_lot if market else self.lot
+
+    @property
+    def quantity_precision(self) -> int:
+        return self.market_lot.decimals
+
+    def round_quantity(self, quantity: float, market: bool = True) -> Number:
+        """數量向下取整到步長"""
+        return self._rule(market).floor(quantity)
+
+    def round_price(self, price: float, side: Optional[str] = None) -> Number:
+        """價格取整到 tick：買單向下、賣單向上（不會比原價更差），未指定方向時取最近"""
+        if side == 'BUY':
+            return self.price.floor(price)
+        if side == 'SELL':
+            return self.price.ceil(price)
+        return self.price.nearest(price)
+
+    def min_quantity(self, price: float, market: bool = True) -> Number:
+        """同時滿足 minQty 與 最小名義價值 的最小數量"""
+        rule = self._rule(market)
+        required = max(rule.minimum, self.min_notional / price if price > 0 else 0.0)
+        return rule.ceil(required)
+
+    def quantity_for_notional(self, notional: float, price: float, market: bool = True) -> Number:
+        """目標名義價值對應的下單數量：向下取整到步長，不足最小值時提高到最小可下單數量，超過上限時截斷"""
+        rule = self._rule(market)
+        quantity = rule.floor(notional / price)
+        minimum = self.min_quantity(price, market)
+        if quantity < minimum:
+            quantity = minimum
+        if quantity > rule.maximum:
+            quantity = rule.floor(rule.maximum)
+        return quantity
+
+    def check(self, quantity: float, price: float, market: bool = True, reduce_only: bool = False) -> Tuple[bool, str]:
+        """本地預檢訂單，返回 (是否通過, 原因)；reduceOnly 單不受最小名義價值限制"""
+        rule = self._rule(market)
+        if quantity <= 0:
+            return False, "數量必須大於0"
+        if not rule.is_aligned(quantity):
+            return False, f"數量 {quantity} 不是步長 {rule.step:g} 的整數倍"
+        if quantity < rule.minimum:
+            return False, f"數量 {quantity} 低於最小數量 {rule.minimum:g}"
+        if quantity > rule.maximum:
+            return False, f"數量 {quantity} 超過最大數量 {rule.maximum:g}"
+        if not market and not self.price.is_aligned(price):
+            return False, f"價格 {price} 不是 tick {self.price.step:g} 的整數倍"
+        if not reduce_only and quantity * price < self.min_notional - EPSILON:
+            return False, f"名義價值 {quantity * price:.4f} 低於最小值 {self.min_notional:g}"
+        return True, ""
+
+
+class SymbolFilterTable:
+    """全部交易對的過濾器表 - 整表替換，讀取端不需加鎖"""
+
+    def __init__(self):
+        self._filters: Dict[str, SymbolFilter] = {}
+
+    def load_exchange_info(self, exchange_info: Dict) -> int:
+        return self._replace(SymbolFilter.from_symbol_info(item) for item in exchange_info.get('symbols', []))
+
+    def load_cache_rows(self, rows: Iterable[Dict]) -> int:
+        return self._replace(SymbolFilter.from_cache_row(row) for row in rows)
+
+    def _replace(self, filters: Iterable[SymbolFilter]) -> int:
+        self._filters = {item.symbol: item for item in filters}
+        return len(self._filters)
+
+    def get(self, symbol: str) -> Optional[SymbolFilter]:
+        return self._filters.get(symbol)
+
+    def __contains__(self, symbol: str) -> bool:
+        return symbol in self._filters
+
+    def __len__(self) -> int:
+        return len(self._filters)
+
+
+# 記錄自 futures_exchange_info 的部分交易對，覆蓋 高價（步長0.001）、中價、低價（步長1、tick 1e-7）的情況
+SAMPLE_EXCHANGE_INFO = {'symbols': [
+    {'symbol': 'BTCUSDT', 'status': 'TRADING', 'filters': [
+        {'filterType': 'PRICE_FILTER', 'minPrice': '556.80', 'maxPrice': '4529764', 'tickSize': '0.10'},
+        {'filterType': 'LOT_SIZE', 'stepSize': '0.001', 'maxQty': '1000', 'minQty': '0.001'},
+        {'filterType': 'MARKET_LOT_SIZE', 'stepSize': '0.001', 'maxQty': '120', 'minQty': '0.001'},
+        {'filterType': 'MIN_NOTIONAL', 'notional': '100'}]},
+    {'symbol': 'ETHUSDT', 'status': 'TRADING', 'filters': [
+        {'filterType': 'PRICE_FILTER', 'minPrice': '39.86', 'maxPrice': '306177', 'tickSize': '0.01'},
+        {'filterType': 'LOT_SIZE', 'stepSize': '0.001', 'maxQty': '10000', 'minQty': '0.001'},
+        {'filterType': 'MARKET_LOT_SIZE', 'stepSize': '0.001', 'maxQty': '2000', 'minQty': '0.001'},
+        {'filterType': 'MIN_NOTIONAL', 'notional': '20'}]},
+    {'symbol': 'SOLUSDT', 'status': 'TRADING', 'filters': [
+        {'filterType': 'PRICE_FILTER', 'minPrice': '0.4200', 'maxPrice': '6857', 'tickSize': '0.0100'},
+        {'filterType': 'LOT_SIZE', 'stepSize': '1', 'maxQty': '1000000', 'minQty': '1'},
+        {'filterType': 'MARKET_LOT_SIZE', 'stepSize': '1', 'maxQty': '5000', 'minQty': '1'},
+        {'filterType': 'MIN_NOTIONAL', 'notional': '5'}]},
+    {'symbol': 'DOGEUSDT', 'status': 'TRADING', 'filters': [
+        {'filterType': 'PRICE_FILTER', 'minPrice': '0.002440', 'maxPrice': '30', 'tickSize': '0.000010'},
+        {'filterType': 'LOT_SIZE', 'stepSize': '1', 'maxQty': '50000000', 'minQty': '1'},
+        {'filterType': 'MARKET_LOT_SIZE', 'stepSize': '1', 'maxQty': '30000000', 'minQty': '1'},
+        {'filterType': 'MIN_NOTIONAL', 'notional': '5'}]},
+    {'symbol': '1000PEPEUSDT', 'status': 'TRADING', 'filters': [
+        {'filterType': 'PRICE_FILTER', 'minPrice': '0.0000001', 'maxPrice': '200', 'tickSize': '0.0000001'},
+        {'filterType': 'LOT_SIZE', 'stepSize': '1', 'maxQty': '80000000', 'minQty': '1'},
+        {'filterType': 'MARKET_LOT_SIZE', 'stepSize': '1', 'maxQty': '20000000', 'minQty': '1'},
+        {'filterType': 'MIN_NOTIONAL', 'notional': '5'}]},
+    {'symbol': 'XRPUSDT', 'status': 'TRADING', 'filters': [
+        {'filterType': 'PRICE_FILTER', 'minPrice': '0.0143', 'maxPrice': '100000', 'tickSize': '0.0001'},
+        {'filterType': 'LOT_SIZE', 'stepSize': '0.1', 'maxQty': '10000000', 'minQty': '0.1'},
+        {'filterType': 'MARKET_LOT_SIZE', 'stepSize': '0.1', 'maxQty': '2000000', 'minQty': '0.1'},
+        {'filterType': 'MIN_NOTIONAL', 'notional': '5'}]},
+]}
+
+
+def run_property_checks(exchange_info: Dict, cases_per_symbol: int = 2000, seed: int = 7) -> int:
+    """隨機性質檢查：取整結果對齊步長且不超過原值、名義價值/數量上下限、價格取整方向，返回檢查的用例數"""
+    import random
+
+    rng = random.Random(seed)
+    table = SymbolFilterTable()
+    table.load_exchange_info(exchange_info)
+    cases = 0
+    for symbol_info in exchange_info['symbols']:
+        symbol = symbol_info['symbol']
+        item = table.get(symbol)
+        rule = item.market_lot
+        # 價格在該交易對 PRICE_FILTER 的上下限內隨機取（對數均勻）
+        price_filter = next((f for f in symbol_info.get('filters', []) if f['filterType'] == 'PRICE_FILTER'), {})
+        low = math.log10(max(float(price_filter.get('minPrice') or 0), item.price.step))
+        high = math.log10(max(float(price_filter.get('maxPrice') or 0), 10 ** (low + 1)))
+        for _ in range(cases_per_symbol):
+            price = item.price.nearest(10 ** rng.uniform(low, high)) or item.price.step
+            notional = 10 ** rng.uniform(-1, 6)
+            if rule.maximum != math.inf:
+                notional = min(notional, rule.maximum * price * 1.5)  # 超過最大數量的部分只會被截斷
+            raw = notional / price
+
+            rounded = item.round_quantity(raw)
+            assert rounded <= raw + rule.step * 1e-6, (symbol, raw, rounded)
+            assert raw - rounded < rule.step * (1 + EPSILON), (symbol, raw, rounded)
+            assert rule.is_aligned(rounded), (symbol, rounded)
+            assert item.round_quantity(rounded) == rounded, (symbol, rounded)  # 冪等
+
+            quantity = item.quantity_for_notional(notional, price)
+            assert rule.is_aligned(quantity) and quantity <= rule.maximum, (symbol, quantity)
+            if quantity < rule.floor(rule.maximum):
+                ok, reason = item.check(quantity, price)
+                assert ok, (symbol, quantity, price, reason)
+                # 不足最小值時才會超出目標名義價值，且只超出到最小可下單數量
+                assert quantity * price <= notional + rule.step * price or quantity == item.min_quantity(price), \
+                    (symbol, quantity, price, notional)
+
+            buy, sell = item.round_price(price * 1.0003, 'BUY'), item.round_price(price * 1.0003, 'SELL')
+            assert buy <= price * 1.0003 <= sell + item.price.step * EPSILON, (symbol, price, buy, sell)
+            assert item.price.is_aligned(buy) and item.price.is_aligned(sell), (symbol, buy, sell)
+            cases += 1
+    return cases
+
+
+# 使用示例：python symbol_filters.py
+# 以記錄的交易所信息（有本地緩存 exchange_cache.db 時一併使用）做隨機性質檢查，並對比舊的 int(數量) 算法
+if __name__ == "__main__":
+    import os
+    import time
+
+    fixtures = [('記錄樣本', SAMPLE_EXCHANGE_INFO)]
+    if os.path.exists('exchange_cache.db'):
+        from exchange_cache import ExchangeCache
+        cached = ExchangeCache().load_exchange_info()
+        if cached:
+            fixtures.append(('本地緩存', cached))
+    for name, exchange_info in fixtures:
+        start = time.perf_counter()
+        cases = run_property_checks(exchange_info, cases_per_symbol=200 if len(exchange_info['symbols']) > 50 else 2000)
+        print(f"{name}: {len(exchange_info['symbols'])} 個交易對，{cases} 個用例通過（{time.perf_counter() - start:.2f}秒）")
+
+    table = SymbolFilterTable()
+    table.load_exchange_info(SAMPLE_EXCHANGE_INFO)
+    target = 100 * 20  # 保證金 × 槓桿
+    for symbol, price in (('BTCUSDT', 67250.3), ('ETHUSDT', 3120.45), ('DOGEUSDT', 0.12345), ('1000PEPEUSDT', 0.0112345)):
+        quantity = table.get(symbol).quantity_for_notional(target, price)
+        legacy = max(int(target / price), 1)
+        print(f"{symbol:>13} 價格 {price:<10} 新: {quantity:<10} ({quantity * price:8.2f} USDT) | 舊: {legacy:<10} ({legacy * price:8.2f} USDT)")
+
+    item = table.get('BTCUSDT')
+    start = time.perf_counter()
+    for _ in range(100000):
+        item.quantity_for_notional(target, 67250.3)
+    print(f"quantity_for_notional: {(time.perf_counter() - start) * 10:.2f}µs/次")
@@ -17,13 +17,12 @@ from typing import Dict, Optional
 import logging
 from logging.handlers import RotatingFileHandler
 import requests
-import websocket
 import json
 import threading
 import os
 import sys
 import signal
-from config import API_KEY, API_SECRET, MAX_POSITION_SIZE, LEVERAGE, MIN_FUNDING_RATE, MAX_SPREAD, ENTRY_BEFORE_SECONDS, CLOSE_BEFORE_SECONDS, CHECK_INTERVAL, ENTRY_TIME_TOLERANCE, CLOSE_AFTER_SECONDS, TRADING_HOURS, TRADING_MINUTES, TRADING_SYMBOLS, EXCLUDED_SYMBOLS, MAX_ENTRY_RETRY, ENTRY_RETRY_INTERVAL, ENTRY_RETRY_UNTIL_SETTLEMENT, ACCOUNT_CHECK_INTERVAL, POSITION_TIMEOUT_SECONDS, ENABLE_POSITION_CLEANUP, POSITION_CHECK_INTERVAL
+from config import API_KEY, API_SECRET, MAX_POSITION_SIZE, LEVERAGE, MIN_FUNDING_RATE, MAX_SPREAD, ENTRY_BEFORE_SECONDS, CLOSE_BEFORE_SECONDS, CHECK_INTERVAL, ENTRY_TIME_TOLERANCE, CLOSE_AFTER_SECONDS, TRADING_HOURS, TRADING_MINUTES, TRADING_SYMBOLS, EXCLUDED_SYMBOLS, MAX_ENTRY_RETRY, ENTRY_RETRY_INTERVAL, ENTRY_RETRY_UNTIL_SETTLEMENT, ACCOUNT_CHECK_INTERVAL, POSITION_TIMEOUT_SECONDS, ENABLE_POSITION_CLEANUP, POSITION_CHECK_INTERVAL, PORTFOLIO_MAX_POSITIONS, PORTFOLIO_TOTAL_MARGIN
 import traceback
 from binance.client import Client
 from binance.exceptions import BinanceAPIException
@@ -32,10 +31,39 @@ import hashlib
 from urllib.parse import urlencode
 import numpy as np
 from profit_tracker import ProfitTracker
+from funding_rate_store import FundingRateStore
+from opportunity_ranker import OpportunityIndex, OpportunityRanker
+from ws_decoder import BOOK_TICKER, MARK_PRICE, FrameDecoder
+from async_gateway import FAPI_BASE_URL, FSTREAM_BASE_URL, RETRYABLE_CODES, AsyncGateway, point_client_at
+from order_batcher import OrderBatcher
+from post_trade import PipelineStage, PostTradePipeline
+from account_analyzer import AccountAnalyzer
+from deadline_scheduler import DeadlineScheduler
+from clock_model import ServerClockModel
+from admission_controller import LANE_ACCOUNT, LANE_BACKGROUND, LANE_ORDER, AdmissionController, ApiBusyError
+from weight_budget import ENDPOINT_WEIGHTS, WeightBudget
+from exchange_cache import FILTER_ERROR_CODES, ExchangeCache
+from symbol_filters import SymbolFilterTable
+from stage_latency import StageLatency
+from async_log import AsyncLogWriter
+from trade_journal import FLUSH_STEPS, TradeJournal
+from user_stream import ORDER_TRADE_UPDATE, PositionBook, UserDataStream
+from position_state import CLOSE_PENDING, ENTRY_PENDING, FAILED, OPEN, POSITION_JOURNAL_PREFIX, PositionStateError, PositionStateMachine
+import aiohttp
+import asyncio
 
 # 全局變量，用於信號處理
 trader_instance = None
 
+LEVERAGE_PRELOAD_CONCURRENCY = 8             # 槓桿預載併發數
+# 平倉後處理：平倉後開始處理的延遲、帳戶對帳的延遲和合併窗口（秒，窗口內到期的對帳合併為一次查詢）
+POST_CLOSE_DELAY = 1.0
+RECONCILE_DELAY = 60.0
+RECONCILE_BATCH_WINDOW = 10.0
+# 合約 REST / 行情流地址；壓測時以環境變量指向本地模擬交易所（python fake_exchange.py --serve）
+FAPI_URL = os.environ.get('BINANCE_FAPI_URL', FAPI_BASE_URL)
+FSTREAM_URL = os.environ.get('BINANCE_FSTREAM_URL', FSTREAM_BASE_URL)
+
 def safe_json_serialize(obj):
     """安全的JSON序列化，處理numpy數據類型"""
     if isinstance(obj, np.integer):
@@ -58,8 +86,7 @@ def signal_handler(signum, frame):
     if trader_instance:
         try:
             # 刷新所有緩存的記錄
-            if hasattr(trader_instance, '_analysis_buffer'):
-                trader_instance._flush_analysis_buffer()
+            trader_instance.trade_journal.flush()
                 
             if trader_instance.current_position:
                 print(f"[{trader_instance.format_corrected_time()}] 發現持倉，嘗試清理...")
@@ -173,12 +200,34 @@ def get_log_stats(log_dir='logs'):
         return f"獲取日誌統計時出錯: {e}"
 
 class FundingRateTrader:
+    fapi_url = FAPI_URL        # 子類可覆蓋，指向本地模擬交易所
+    fstream_url = FSTREAM_URL
+    reconnect_delay_scale = 1.0  # 行情流重連等待時間的倍數，測試時可縮短
+
     def __init__(self):
         # 配置API客戶端 - 優化速度設置
-        self.client = Client(API_KEY, API_SECRET)
-        # 設置請求超時時間（秒）- 平衡速度和穩定性
-        self.client.timeout = 1.0  # 1秒超時，平衡速度和穩定性
+        self.client = self._create_client()
+        self.time_offset = 0         # 本地時間與服務器時間的差值（網關簽名時使用）
+        # 服務器時鐘模型：多樣本擬合偏移與漂移，提供校正時間的誤差上界
+        self.clock_model = self._create_clock_model()
+        self.next_settlement_time = 0  # 目前關注的結算時間，用於調整時間同步頻率
+        # 請求權重預算：由響應標頭回報用量，背景任務只用下單路徑保留額度之外的部分
+        self.weight_budget = WeightBudget(self.get_corrected_time_precise)
+        self.weight_budget.attach_to_client(self.client)
+        # asyncio 網關：單一事件循環負責行情流與下單，共用 keep-alive 連接池
+        self.gateway = self._create_gateway()
+        # 同時觸發的多筆訂單（組合進場、同時平倉、定期清理）合併為 batchOrders 請求
+        self.order_batcher = self._create_order_batcher()
+        self.prewarm_before_ms = 5000  # 進場前5秒開始預熱連接、預簽名訂單
+        self.staged_orders = None      # 預簽名的進場/平倉訂單
+        # 進場/平倉在精確的目標時間觸發，不依賴主循環輪詢間隔
+        self.scheduler = self._create_scheduler()
+        self._entry_plan = None        # (調度key, 組合交易對) 每個結算時間只選一次組合，組合變化時才重新安排
+        self.stage_latency = StageLatency()  # 進場/平倉各階段耗時直方圖（每次結算後與關閉時輸出）
         self.max_position_size = MAX_POSITION_SIZE
+        self.portfolio_max_positions = max(PORTFOLIO_MAX_POSITIONS, 1)
+        # 保證金總額上限預設為 MAX_POSITION_SIZE × 交易對數（同時受啟動時的可用餘額限制）
+        self.portfolio_total_margin = PORTFOLIO_TOTAL_MARGIN or MAX_POSITION_SIZE * self.portfolio_max_positions
         self.leverage = LEVERAGE
         self.min_funding_rate = MIN_FUNDING_RATE
         self.max_spread = MAX_SPREAD
@@ -188,35 +237,42 @@ class FundingRateTrader:
         self.funding_rate_threshold = MIN_FUNDING_RATE
         self.entry_time_tolerance = ENTRY_TIME_TOLERANCE  # 進場時間容差（毫秒）
         self.close_after_seconds = CLOSE_AFTER_SECONDS  # 結算後平倉時間 (主要平倉邏輯)
-        self.current_position = None
-        self.position_open_time = None
-        self.funding_rates = {}  # 儲存資金費率數據
+        self.funding_rates = FundingRateStore(symbol_filter=self.is_valid_symbol)  # 儲存資金費率數據（列式陣列，原地更新）
+        self.opportunity_ranker = OpportunityRanker(self.funding_rates)  # 向量化機會排序
+        self.opportunity_index = OpportunityIndex(self.funding_rates, MIN_FUNDING_RATE, MAX_SPREAD)  # 增量機會索引（推送時更新，主循環O(1)讀取）
         self.book_tickers = {}   # 儲存買賣價數據 (來自WebSocket)
+        self.frame_decoder = FrameDecoder()  # WebSocket 幀解碼器（msgspec > orjson > json）
         self.ws = None
-        self.ws_thread = None
         self.running = False
         
         # 🚀 新增：槓桿緩存機制（進場速度優化）
+        # 交易所信息與已確認槓桿持久化在本地 SQLite，重啟時直接讀取，交易所端校驗在背景進行
+        self.exchange_cache = self._create_exchange_cache()
+        self.symbol_filters = SymbolFilterTable()  # 各交易對 stepSize/tickSize/最小名義價值，下單時不需查詢
         self.leverage_cache = {}  # 記錄每個交易對的當前槓桿
         self.leverage_cache_time = {}  # 記錄槓桿設置時間
-        self.leverage_cache_valid_seconds = 300  # 槓桿緩存有效期（5分鐘）
+        self._leverage_futures = {}  # 進行中的槓桿設置（交易對 -> Future），見 prepare_leverage
+        self._preload_future = None  # 啟動時的背景槓桿預載，關閉時取消
+        self.leverage_cache_valid_seconds = 24 * 3600  # 槓桿緩存有效期（持久化，每次啟動由持倉信息校驗）
+        self._exchange_info_refreshing = False
         
 
         self.logger = self._setup_logger()
-        # 新增：防止重複進場的鎖定機制
-        self.entry_locked_until = 0  # 鎖定到哪個時間點
+        self.log_writer = self._create_log_writer()  # 日誌格式化與寫入在專用線程，熱路徑只入佇列
+        self.trade_journal = self._create_trade_journal()  # 交易分析記錄（二進制追加日誌，journal_render.py 離線渲染）
+        # 用戶數據流（listenKey）維護的本地持倉與成交簿，連接正常時持倉檢查與平倉價格不再發送REST請求
+        self.position_book = PositionBook()
+        self.user_stream = None
+        # 持倉狀態機：IDLE → ENTRY_PENDING → OPEN → CLOSE_PENDING → CLOSED/FAILED，由下單回應與成交推送驅動，
+        # 每次轉換寫入 logs/position_journal_YYYYMMDD.bin，重啟時恢復未結束的交易（取代開倉鎖定/平倉中標誌）
+        self.position_state = self._create_position_state()
         self.last_funding_time = 0   # 記錄最後處理的結算時間
-        # 新增：倉位檢查延遲機制
-        self.position_check_delay_until = 0  # 倉位檢查延遲到哪個時間點
         # 新增：訂單狀態追蹤
         self.pending_order = None    # 待確認的訂單
         self.order_status = None
-        # 新增：平倉狀態追蹤
-        self.is_closing = False      # 是否正在平倉
-        # 新增：時間同步相關
-        self.time_offset = 0         # 本地時間與服務器時間的差值
+        # 新增：時間同步相關（time_offset 在建立網關前已初始化）
         self.last_sync_time = 0      # 上次同步時間
-        self.sync_interval = 300     # 每5分鐘同步一次時間
+        self.sync_interval = 300     # 距結算較遠時每5分鐘同步一次時間（近結算時由時鐘模型加密）
         # 添加詳細時間記錄
         self.entry_timestamps = {}
         self.close_timestamps = {}
@@ -239,14 +295,15 @@ class FundingRateTrader:
         self.position_check_interval = POSITION_CHECK_INTERVAL  # 持倉檢查間隔
         
         # 初始化收益追蹤器
-        self.profit_tracker = ProfitTracker()
-        
-        # 設置每日Excel導出
-        try:
-            self.profit_tracker.setup_daily_excel_export()
-        except Exception as e:
-            print(f"[{self.format_corrected_time()}] Excel導出設置失敗: {e}")
+        self.profit_tracker = self._create_profit_tracker()
+        # 平倉後處理流水線：盈虧 → 持久化 → 通知 → 對帳，固定工作線程（第一次平倉時啟動），共用一個帳戶分析器
+        self.post_trade = self._create_post_trade_pipeline()
+        self._account_analyzer = None
         
+        # API調用分道准入：下單 > 帳戶 > 背景，各通道獨立併發上限，下單不排在輪詢之後
+        # 須在預載槓桿之前建立：預載的API調用也經過准入
+        self.admission = AdmissionController()
+
         # 🚀 進場速度優化：啟動時預設槓桿
         self.preload_leverage_cache()
         
@@ -256,13 +313,7 @@ class FundingRateTrader:
         self._spread_update_in_progress = False    # 批量更新進度標志（保留兼容性）
         
         # 🔒 併發保護機制
-        self.api_call_lock = threading.Lock()  # API調用鎖定
         self.retry_state_lock = threading.Lock()  # 重試狀態鎖定
-        self.is_api_calling = False  # API調用狀態
-        self.api_call_start_time = 0  # API調用開始時間
-        self.max_api_call_duration = 15  # 最大API調用時間（秒）
-        self.concurrent_api_calls = 0  # 當前併發API調用數
-        self.max_concurrent_api_calls = 3  # 最大併發API調用數 - 增加併發能力
         
         # 🎯 確定當前平倉模式 (用於顯示)
         self._close_method_display = self._determine_close_method_display()
@@ -272,112 +323,257 @@ class FundingRateTrader:
         self.close_retry_start_time = 0  # 已廢棄
         self.max_close_retry = 0  # 已廢棄
 
+    # ========== 外部依賴（回放引擎以模擬實現覆蓋） ==========
+
+    def _create_client(self):
+        client = Client(API_KEY, API_SECRET, ping=self.fapi_url == FAPI_BASE_URL)
+        if self.fapi_url != FAPI_BASE_URL:
+            point_client_at(client, self.fapi_url)
+        # 設置請求超時時間（秒）- 平衡速度和穩定性
+        client.timeout = 1.0  # 1秒超時，平衡速度和穩定性
+        return client
+
+    def _create_clock_model(self):
+        return ServerClockModel()
+
+    def _create_gateway(self):
+        gateway = AsyncGateway(API_KEY, API_SECRET, base_url=self.fapi_url, time_provider=self.get_corrected_time,
+                               weight_budget=self.weight_budget)
+        gateway.start()
+        return gateway
+
+    def _create_order_batcher(self):
+        return OrderBatcher(self.gateway)
+
+    def _create_scheduler(self):
+        scheduler = DeadlineScheduler(self.get_corrected_time_precise)
+        scheduler.start()
+        return scheduler
+
+    def _create_exchange_cache(self):
+        return ExchangeCache()
+
+    def _create_profit_tracker(self):
+        profit_tracker = ProfitTracker()
+        # 設置每日Excel導出
+        try:
+            profit_tracker.setup_daily_excel_export()
+        except Exception as e:
+            print(f"[{self.format_corrected_time()}] Excel導出設置失敗: {e}")
+        return profit_tracker
+
+    def _create_post_trade_pipeline(self) -> PostTradePipeline:
+        return PostTradePipeline([
+            PipelineStage('pnl', self._post_trade_pnl, workers=2, delay=POST_CLOSE_DELAY),
+            PipelineStage('persist', self._post_trade_persist, batch=16),
+            PipelineStage('notify', self._post_trade_notify, workers=2),
+            PipelineStage('reconcile', self._post_trade_reconcile, batch=16, delay=RECONCILE_DELAY,
+                          batch_window=RECONCILE_BATCH_WINDOW, drain=False),
+        ], log=lambda message: print(f"[{self.format_corrected_time()}] {message}"))
+
     def _determine_close_method_display(self):
         """確定平倉模式的顯示文字 - 簡化版"""
         # 現在所有平倉都使用統一的簡化方法
         return f"⚡簡化平倉(+{self.close_after_seconds}s)"
     
-    def should_set_leverage(self, symbol: str) -> bool:
-        """🚀 智能槓桿檢查 - 只在必要時設置槓桿，大幅提升進場速度"""
+    def leverage_confirmed(self, symbol: str) -> bool:
+        """槓桿緩存有效且與設定一致（只讀緩存，不發請求，可在調度器線程調用）"""
+        confirmed_at = self.leverage_cache_time.get(symbol)
+        return (confirmed_at is not None and self.leverage_cache.get(symbol) == self.leverage
+                and time.time() - confirmed_at < self.leverage_cache_valid_seconds)
+
+    def prepare_leverage(self, symbol: str):
+        """在網關事件循環中設置槓桿（非阻塞）：已確認時返回None，否則返回進行中的設置（Future）
+        倒數階段由 schedule_entry 提前提交；進場時仍未完成則由下單協程先等待它，不阻塞調度器線程"""
+        if self.leverage_confirmed(symbol):
+            return None
+        future = self._leverage_futures.get(symbol)
+        if future is None or future.done():
+            future = self._leverage_futures[symbol] = self.gateway.submit(self._set_leverage_async(symbol))
+        return future
+
+    async def _set_leverage_async(self, symbol: str):
+        start_time = time.perf_counter()
+        with self.admission.track(LANE_ORDER):
+            await self.gateway.change_leverage(symbol, self.leverage, timeout=1.0, max_retries=2)
+        self.leverage_cache[symbol] = self.leverage
+        self.leverage_cache_time[symbol] = time.time()
+        self.log_trade_step('entry', symbol, 'leverage_set', {
+            'leverage': self.leverage,
+            'execution_time_ms': int((time.perf_counter() - start_time) * 1000)
+        })
+        # 持久化到 SQLite 交由網關執行緒池，不在事件循環中寫盤
+        await self.gateway.run_blocking(self.exchange_cache.set_leverage, symbol, self.leverage,
+                                        self.leverage_cache_time[symbol])
+
+    def preload_leverage_cache(self, wait: bool = False):
+        """🚀 預載槓桿緩存 - 先用本地持久化的交易對與已確認槓桿立即就緒，
+        再在背景以交易所持倉信息校驗，按 |資金費率| 由高到低、有界併發、按權重預算設置其餘交易對"""
         try:
-            current_time = time.time()
-            
-            # 檢查是否有緩存記錄
-            if symbol in self.leverage_cache and symbol in self.leverage_cache_time:
-                cache_age = current_time - self.leverage_cache_time[symbol]
-                cached_leverage = self.leverage_cache[symbol]
-                
-                # 如果緩存有效且槓桿相同，跳過設置
-                if cache_age < self.leverage_cache_valid_seconds and cached_leverage == self.leverage:
-                    return False
-            
-            # 查詢當前槓桿（快速檢查）
-            try:
-                positions = self.execute_api_call_with_timeout(
-                    self.client.futures_position_information,
-                    timeout=0.5,  # 0.5秒超時，快速檢查
-                    max_retries=1,  # 只重試1次
-                    symbol=symbol
-                )
-                if positions:
-                    current_leverage = int(positions[0].get('leverage', 0))
-                    
-                    # 更新緩存
-                    self.leverage_cache[symbol] = current_leverage
-                    self.leverage_cache_time[symbol] = current_time
-                    
-                    # 如果槓桿已經正確，跳過設置
-                    if current_leverage == self.leverage:
-                        return False
-            except Exception as e:
-                print(f"[{self.format_corrected_time()}] 檢查槓桿失敗: {symbol} - {e}")
-                # 如果檢查失敗，為安全起見還是設置槓桿
-                
-            return True
+            print(f"[{self.format_corrected_time()}] 🚀 開始預載槓桿緩存...")
+            start_time = time.perf_counter()
+            
+            # 可交易交易對：本地緩存優先，沒有緩存時才同步下載 exchange_info
+            self.ensure_exchange_info()
+            if not self.symbol_filters:
+                self.symbol_filters.load_cache_rows(self.exchange_cache.all_symbols())
+            active_symbols = [symbol for symbol in self.exchange_cache.symbols()
+                              if symbol.endswith('USDT') and self.is_valid_symbol(symbol)]
+            
+            # 按 |資金費率| 排序，最可能進場的交易對先設置
+            if not self.funding_rates:
+                self.update_funding_rates()
+            funding_rate_col = np.abs(self.funding_rates.funding_rate_view())
+            abs_rates = dict(zip(self.funding_rates.symbols, funding_rate_col.tolist()))
+            active_symbols.sort(key=lambda symbol: -abs_rates.get(symbol, -1.0))
+            
+            # 上次運行已確認的槓桿直接生效
+            for symbol, (leverage, confirmed_at) in self.exchange_cache.leverage_map().items():
+                if leverage == self.leverage:
+                    self.leverage_cache[symbol] = leverage
+                    self.leverage_cache_time[symbol] = confirmed_at
+            ready_count = sum(1 for symbol in active_symbols if self.leverage_cache.get(symbol) == self.leverage)
+            
+            print(f"[{self.format_corrected_time()}] 可交易 {len(active_symbols)} 個交易對：本地緩存 {ready_count} 個已是 {self.leverage}x，"
+                  f"就緒耗時 {(time.perf_counter() - start_time) * 1000:.0f}ms，背景校驗其餘交易對（併發{LEVERAGE_PRELOAD_CONCURRENCY}）")
+            
+            # 在網關事件循環中校驗並設置，不阻塞啟動
+            self._preload_future = self.gateway.submit(self._preload_leverage_async(active_symbols))
+            if wait:
+                self._preload_future.result()
             
         except Exception as e:
-            print(f"[{self.format_corrected_time()}] 槓桿檢查異常: {symbol} - {e}")
-            return True  # 異常時為安全起見設置槓桿
-    
-    def preload_leverage_cache(self):
-        """🚀 預載槓桿緩存 - 啟動時批量設置常用交易對槓桿，極大提升進場速度"""
+            print(f"[{self.format_corrected_time()}] 預載槓桿緩存失敗: {e}")
+            print(f"[{self.format_corrected_time()}] 將使用智能槓桿檢查作為備用方案")
+
+    async def _preload_leverage_async(self, active_symbols):
+        """以交易所持倉信息（含各交易對槓桿）校正本地緩存，再有界併發設置不是目標槓桿的交易對：
+        每個請求先申請背景權重額度，下單進行中時讓路"""
+        start_time = time.time()
+        try:
+            positions = await self.gateway.position_information(timeout=2.0, max_retries=1)
+            exchange_leverage = {position['symbol']: int(position['leverage'])
+                                 for position in positions if 'leverage' in position}
+        except Exception as e:
+            print(f"[{self.format_corrected_time()}] 讀取交易所槓桿失敗，沿用本地緩存: {e}")
+            exchange_leverage = {}
+        
+        confirmed = []
+        for symbol, leverage in exchange_leverage.items():
+            if leverage == self.leverage:
+                self.leverage_cache[symbol] = leverage
+                self.leverage_cache_time[symbol] = start_time
+                confirmed.append((symbol, leverage))
+            elif symbol in self.leverage_cache:
+                # 本地緩存與交易所不符（例如網頁端手動改過），以交易所為準
+                self.leverage_cache[symbol] = leverage
+                self.leverage_cache_time[symbol] = start_time
+        if exchange_leverage:
+            await self.gateway.run_blocking(self.exchange_cache.set_leverage_many, confirmed, start_time)
+        
+        symbols = [symbol for symbol in active_symbols if self.leverage_cache.get(symbol) != self.leverage]
+        semaphore = asyncio.Semaphore(LEVERAGE_PRELOAD_CONCURRENCY)
+        counts = {'success': 0, 'failed': 0}
+        newly_set = []
+
+        async def set_leverage(symbol):
+            async with semaphore:
+                while (self.admission.in_flight(LANE_ORDER) > 0
+                       or not self.weight_budget.try_acquire_background(ENDPOINT_WEIGHTS['futures_change_leverage'])):
+                    await asyncio.sleep(0.05 if self.admission.in_flight(LANE_ORDER) > 0
+                                        else self.weight_budget.ms_to_window_reset() / 1000 + 0.01)
+                try:
+                    await self.gateway.change_leverage(symbol, self.leverage, timeout=1.0, max_retries=1)
+                    self.leverage_cache[symbol] = self.leverage
+                    self.leverage_cache_time[symbol] = time.time()
+                    newly_set.append((symbol, self.leverage))
+                    counts['success'] += 1
+                    if counts['success'] % 50 == 0:
+                        print(f"[{self.format_corrected_time()}] 已預載 {counts['success']} 個交易對...")
+                except Exception:
+                    # 單個交易對失敗不影響其他交易對
+                    counts['failed'] += 1
+
+        await asyncio.gather(*(set_leverage(symbol) for symbol in symbols))
+        if newly_set:
+            await self.gateway.run_blocking(self.exchange_cache.set_leverage_many, newly_set)
+        print(f"[{self.format_corrected_time()}] ✅ 槓桿校驗完成: 交易所確認 {len(confirmed)} 個，設置成功 {counts['success']}/{len(symbols)} 個，"
+              f"失敗 {counts['failed']} 個，耗時 {time.time() - start_time:.1f}秒 | {self.weight_budget.format_status()}")
+        return counts
+
+    # ========== 交易所信息緩存 ==========
+
+    def ensure_exchange_info(self):
+        """本地沒有交易所信息時同步下載；已過期（按 serverTime）時先沿用舊數據，在背景刷新"""
+        if not self.exchange_cache.symbols(status=None):
+            self.refresh_exchange_info()
+        elif self.exchange_cache.is_stale(self.get_corrected_time()):
+            self.refresh_exchange_info_async()
+
+    def refresh_exchange_info(self) -> Optional[dict]:
+        """下載 futures_exchange_info 並寫入本地緩存"""
         try:
-            print(f"[{self.format_corrected_time()}] 🚀 開始預載槓桿緩存...")
-            
-            # 獲取所有期貨交易對
             exchange_info = self.execute_api_call_with_timeout(
                 self.client.futures_exchange_info,
                 timeout=2.0,  # 2秒超時，獲取所有交易對信息
                 max_retries=2  # 重試2次，確保獲取成功
             )
-            active_symbols = [s['symbol'] for s in exchange_info['symbols'] 
-                            if s['status'] == 'TRADING' and s['symbol'].endswith('USDT')]
-            
-            # 限制預載數量（避免過多API調用）
-            max_preload = 50  # 預載前50個活躍交易對
-            symbols_to_preload = active_symbols[:max_preload]
-            
-            print(f"[{self.format_corrected_time()}] 預載 {len(symbols_to_preload)} 個交易對的槓桿...")
-            
-            success_count = 0
-            for symbol in symbols_to_preload:
-                try:
-                    # 設置槓桿
-                    self.execute_api_call_with_timeout(
-                        self.client.futures_change_leverage,
-                        timeout=0.5,  # 0.5秒超時，快速設置
-                        max_retries=1,  # 只重試1次
-                        symbol=symbol, 
-                        leverage=self.leverage
-                    )
-                    
-                    # 更新緩存
-                    self.leverage_cache[symbol] = self.leverage
-                    self.leverage_cache_time[symbol] = time.time()
-                    
-                    success_count += 1
-                    
-                    # 避免觸發限流
-                    if success_count % 10 == 0:
-                        print(f"[{self.format_corrected_time()}] 已預載 {success_count} 個交易對...")
-                        time.sleep(0.1)  # 小幅延遲避免限流
-                        
-                except Exception as e:
-                    # 單個交易對失敗不影響其他交易對
-                    continue
-            
-            print(f"[{self.format_corrected_time()}] ✅ 槓桿預載完成: 成功 {success_count}/{len(symbols_to_preload)} 個交易對")
-            print(f"[{self.format_corrected_time()}] 🚀 進場速度優化：槓桿設置耗時預計從 ~750ms 降至 ~0ms")
-            
+            self.exchange_cache.save_exchange_info(exchange_info)
+            self.symbol_filters.load_exchange_info(exchange_info)
+            print(f"[{self.format_corrected_time()}] 交易所信息已更新: {len(exchange_info['symbols'])} 個交易對")
+            return exchange_info
         except Exception as e:
-            print(f"[{self.format_corrected_time()}] 預載槓桿緩存失敗: {e}")
-            print(f"[{self.format_corrected_time()}] 將使用智能槓桿檢查作為備用方案")
+            print(f"[{self.format_corrected_time()}] 更新交易所信息失敗: {e}")
+            return None
+        finally:
+            self._exchange_info_refreshing = False
+
+    def refresh_exchange_info_async(self):
+        """在網關執行緒池中刷新交易所信息，同一時間只有一個刷新"""
+        if self._exchange_info_refreshing:
+            return
+        self._exchange_info_refreshing = True
+        self.gateway.submit(self.gateway.run_blocking(self.refresh_exchange_info))
+
+    def on_order_rejected(self, error):
+        """下單被拒：精度/過濾器類錯誤代表本地交易所信息可能過時，作廢並在背景重新下載"""
+        if getattr(error, 'code', None) in FILTER_ERROR_CODES:
+            print(f"[{self.format_corrected_time()}] 訂單觸發過濾器錯誤({error.code})，刷新交易所信息緩存")
+            self.exchange_cache.invalidate_exchange_info()
+            self.refresh_exchange_info_async()
 
     def _setup_logger(self):
         """設置日誌 - 使用全域日誌器，避免重複"""
         # 直接使用全域設置的日誌器，不再重複設置
         return logging.getLogger('FundingRateTrader')
 
+    def _create_log_writer(self) -> AsyncLogWriter:
+        return AsyncLogWriter(self.logger, self._format_log_entry).start()
+
+    def _create_trade_journal(self) -> TradeJournal:
+        return TradeJournal()
+
+    def _create_user_stream(self):
+        return UserDataStream(self.gateway, self.fstream_url, self.position_book, snapshot=self._position_snapshot,
+                              on_event=self._on_user_event,
+                              log=lambda message: print(f"[{self.format_corrected_time()}] {message}"))
+
+    def _create_position_state(self) -> PositionStateMachine:
+        machine = PositionStateMachine(TradeJournal(prefix=POSITION_JOURNAL_PREFIX), clock=self.get_corrected_time_precise,
+                                       log=lambda message: print(f"[{self.format_corrected_time()}] {message}"),
+                                       max_positions=self.portfolio_max_positions)
+        for record in machine.recover():
+            print(f"[{self.format_corrected_time()}] 從持倉狀態日誌恢復交易: {record.symbol} {record.direction} "
+                  f"數量:{record.quantity} 狀態:{record.state}（啟動後與交易所持倉核對）")
+        return machine
+
+    @property
+    def current_position(self) -> Optional[Dict]:
+        """最早的進行中交易的持倉字典副本（ENTRY_PENDING/OPEN/CLOSE_PENDING），沒有時為None
+        只讀，狀態由 position_state 轉換；組合模式下的全部交易見 position_state.records()"""
+        record = self.position_state.active
+        return record.as_position() if record is not None else None
+
     def is_trading_time(self) -> bool:
         """檢查是否在交易時間內 - 測試版本：每分鐘都允許交易"""
         now = datetime.utcnow()
@@ -409,35 +605,41 @@ class FundingRateTrader:
     def on_message(self, ws, message):
         """處理 WebSocket 消息 - 處理資金費率數據"""
         try:
-            data = json.loads(message)
-            
+            # 組合流消息直接解碼為 (幀類型, 內容)，不建立中間 dict
+            kind, payload = self.frame_decoder.decode(message)
+
+            if kind == BOOK_TICKER:
+                self.on_book_ticker(*payload)
+                return
+
             # 檢查是否是訂閱確認消息
-            if 'result' in data and data['result'] is None:
-                print(f"[{self.format_corrected_time()}] WebSocket 已連接，自動接收標記價格數據")
+            if kind != MARK_PRICE:
+                if isinstance(payload, dict) and 'result' in payload and payload['result'] is None:
+                    print(f"[{self.format_corrected_time()}] WebSocket 已連接，自動接收標記價格數據")
                 return
-            
-            # 處理資金費率數據（標準格式）
-            if isinstance(data, list):
-                updated_count = 0
-                for item in data:
-                    symbol = item['s']
-                    if self.is_valid_symbol(symbol):
-                        funding_rate = float(item['r']) * 100  # 轉換為百分比
-                        mark_price = float(item['p'])  # 標記價格
-                        next_funding_time = item['T']
-                        
-                        # 更新資金費率數據
-                        self.funding_rates[symbol] = {
-                            'funding_rate': funding_rate,
-                            'mark_price': mark_price,
-                            'next_funding_time': next_funding_time,
-                            'last_update': self.get_corrected_time()
-                        }
-                        updated_count += 1
-                
+
+            # 處理資金費率數據（整幀列式批量寫入）
+            batch = payload
+            if len(batch) > 0:
+                last_update = self.get_corrected_time()  # 同一幀共用同一個更新時間
+                # 交割合約沒有資金費率（NaN），直接略過
+                valid = ~np.isnan(batch.funding_rate)
+                symbols = batch.symbols if valid.all() else [symbol for symbol, ok in zip(batch.symbols, valid) if ok]
+                updated_rows = self.funding_rates.update_batch(
+                    symbols,
+                    batch.funding_rate[valid] * 100,  # 轉換為百分比
+                    batch.mark_price[valid],
+                    batch.next_funding_time[valid],
+                    last_update)
+                # 交易對篩選已預先計算在 tradable 列
+                updated_count = int(np.count_nonzero(self.funding_rates.tradable_view()[updated_rows]))
+
+                # 只為資金費率或結算時間真正變化的交易對更新機會索引
+                self.opportunity_index.update_rows(updated_rows)
+
                 # 只在有更新時顯示（減少輸出頻率）
                 if updated_count > 0 and (not hasattr(self, '_last_funding_display') or time.time() - self._last_funding_display >= 30):
-                    total_symbols = len(self.funding_rates)
+                    total_symbols = int(np.count_nonzero(self.funding_rates.tradable_view()))
                     spread_stats = self.get_spread_stats()
                     cache_count = len(self._spread_cache) if hasattr(self, '_spread_cache') else 0
                     stats_msg = f"WebSocket: 更新{updated_count}個資金費率，總計{total_symbols}個交易對 | 點差緩存: {cache_count}個"
@@ -451,6 +653,32 @@ class FundingRateTrader:
             print(f"錯誤詳情: {traceback.format_exc()}")
             print(f"原始數據前100字元: {str(message)[:100]}...")
 
+    def on_book_ticker(self, symbol: str, best_bid: float, best_ask: float):
+        """處理 !bookTicker 推送 - 原地更新最優買賣價並實時計算點差"""
+        book_data = self.book_tickers.get(symbol)
+        if book_data is None:
+            book_data = self.book_tickers[symbol] = {}
+        elif (book_data['bid_price'] == best_bid and book_data['ask_price'] == best_ask
+              and self.funding_rates.spread(symbol) is not None):
+            # 只有數量變化，點差不變（首個標記價格之前的推送寫不進點差，之後仍需補算）
+            book_data['update_time'] = time.time()
+            return
+        book_data['bid_price'] = best_bid
+        book_data['ask_price'] = best_ask
+        book_data['update_time'] = time.time()
+
+        if best_bid <= 0 or best_ask <= 0:
+            return
+        ref_price = self.funding_rates.mark_price(symbol)
+        if ref_price is None:
+            ref_price = (best_bid + best_ask) / 2
+        self._set_spread(symbol, ((best_ask - best_bid) / ref_price) * 100)
+
+    def has_live_book_ticker(self, symbol: str, max_age: float = 5.0) -> bool:
+        """檢查該交易對是否有最近的 bookTicker 數據（有則不需要REST點差）"""
+        book_data = self.book_tickers.get(symbol)
+        return book_data is not None and time.time() - book_data['update_time'] <= max_age
+
     def on_error(self, ws, error):
         """處理 WebSocket 錯誤 - 超智能重連"""
         self.ws_reconnect_count += 1
@@ -482,7 +710,7 @@ class FundingRateTrader:
         
         self.ws = None
         print(f"[{self.format_corrected_time()}] 等待 {reconnect_delay} 秒後重新連接...")
-        time.sleep(reconnect_delay)
+        time.sleep(reconnect_delay * self.reconnect_delay_scale)
         self.reconnect()
 
     def on_close(self, ws, close_status_code, close_msg):
@@ -507,7 +735,7 @@ class FundingRateTrader:
             print(f"[{self.format_corrected_time()}] 🔄 未知關閉原因，等待 {reconnect_delay} 秒後重連")
         
         self.ws = None
-        time.sleep(reconnect_delay)
+        time.sleep(reconnect_delay * self.reconnect_delay_scale)
         self.reconnect()
 
     def on_open(self, ws):
@@ -552,33 +780,25 @@ class FundingRateTrader:
                 except:
                     pass
             
-            # 幣安期貨暫時只支援標記價格的集合流，bookTicker需要單獨連接
-            # 先使用標記價格流，bookTicker功能後續添加
-            stream_url = "wss://fstream.binance.com/ws/!markPrice@arr"
-            print(f"[{self.format_corrected_time()}] 注意：期貨WebSocket暫時只獲取標記價格，點差數據使用API緩存（30秒更新最佳交易對）")
+            # 組合流：同一連接同時接收資金費率（!markPrice@arr）和全市場最優買賣價（!bookTicker）
+            # 點差由 bookTicker 實時計算，REST 訂單簿只作為冷啟動時的備援
+            stream_url = f"{self.fstream_url}/stream?streams=!markPrice@arr/!bookTicker"
             
             # 初始化重連計數器
             if not hasattr(self, 'ws_reconnect_count'):
                 self.ws_reconnect_count = 0
             
-            self.ws = websocket.WebSocketApp(
+            # 行情流由網關事件循環讀取（與下單共用同一事件循環），心跳30秒
+            self.ws = self.gateway.open_market_stream(
                 stream_url,
-                on_message=self.on_message,
-                on_error=self.on_error,
-                on_close=self.on_close,
-                on_open=self.on_open
+                on_message=lambda message: self.on_message(self.ws, message),
+                on_open=lambda: self.on_open(self.ws),
+                on_close=lambda code, msg: self.on_close(self.ws, code, msg),
+                on_error=lambda error: self.on_error(self.ws, error),
+                heartbeat=30
             )
             
-            # 在新線程中啟動 WebSocket - 超穩定設定
-            self.ws_thread = threading.Thread(target=lambda: self.ws.run_forever(
-                ping_interval=30,      # 增加到30秒 (減少心跳頻率)
-                ping_timeout=20,       # 增加到20秒 (更長超時容忍)
-                reconnect=5            # 自動重連間隔5秒
-            ))
-            self.ws_thread.daemon = True
-            self.ws_thread.start()
-            
-            print(f"[{self.format_corrected_time()}] WebSocket 線程已啟動 (資金費率) - 心跳30秒/超時20秒")
+            print(f"[{self.format_corrected_time()}] WebSocket 已由網關事件循環啟動 (資金費率+訂單簿) - 心跳30秒")
             
             # 等待 WebSocket 連接建立
             time.sleep(3)
@@ -590,6 +810,40 @@ class FundingRateTrader:
         finally:
             self.is_websocket_starting = False
 
+    def start_user_stream(self):
+        """啟動用戶數據流 - 斷線或重連後快照未載入前，持倉檢查自動回退到 REST"""
+        try:
+            self.user_stream = self._create_user_stream()
+            if self.user_stream is not None:
+                self.user_stream.start()
+                print(f"[{self.format_corrected_time()}] 用戶數據流已由網關事件循環啟動 (成交+持倉推送)")
+        except Exception as e:
+            print(f"[{self.format_corrected_time()}] 啟動用戶數據流失敗: {e}，持倉檢查使用 REST")
+
+    def user_stream_healthy(self) -> bool:
+        return self.user_stream is not None and self.user_stream.healthy
+
+    def _position_snapshot(self):
+        """用戶數據流(重)連接後的持倉快照（在網關執行緒池中調用）"""
+        return self.execute_api_call_with_timeout(
+            self.client.futures_position_information,
+            timeout=2.0,
+            max_retries=2,
+            lane=LANE_ACCOUNT
+        )
+
+    def _on_user_event(self, event: Dict):
+        """用戶數據流推送（網關事件循環中調用）：訂單成交推送驅動持倉狀態轉換，不必等待 REST 回應"""
+        if event.get('e') != ORDER_TRADE_UPDATE:
+            return
+        order = self.position_book.order(event['o']['i'])
+        if order is not None and self.position_state.on_order_update(order):
+            record = self.position_state.last
+            print(f"[{self.format_corrected_time()}] 成交推送: {record.symbol} ID:{order['order_id']} "
+                  f"均價:{order['avg_price']} → {record.state}")
+            if record.state == FAILED:
+                self.restage_entry(record.symbol)
+
     def get_spread(self, symbol: str) -> float:
         """獲取交易對的點差 (買賣價差百分比) - 按需精準緩存策略"""
         try:
@@ -600,11 +854,8 @@ class FundingRateTrader:
                 best_ask = book_data['ask_price']
                 
                 # 獲取標記價格作為參考
-                ref_price = None
-                if hasattr(self, 'funding_rates') and symbol in self.funding_rates:
-                    if 'mark_price' in self.funding_rates[symbol]:
-                        ref_price = self.funding_rates[symbol]['mark_price']
-                
+                ref_price = self.funding_rates.mark_price(symbol)
+
                 # 如果沒有標記價格，使用中間價
                 if ref_price is None:
                     ref_price = (best_bid + best_ask) / 2
@@ -648,20 +899,15 @@ class FundingRateTrader:
                 self._spread_update_in_progress = True
                 print(f"[{self.format_corrected_time()}] 開始智能點差緩存更新...")
                 
-                # 獲取資金費率高於閾值的交易對（智能篩選）
-                high_funding_symbols = []
-                if hasattr(self, 'funding_rates'):
-                    for symbol, data in self.funding_rates.items():
-                        if self.is_valid_symbol(symbol):
-                            funding_rate = data['funding_rate']
-                            abs_funding_rate = abs(funding_rate)
-                            # 只更新資金費率有潛力的交易對（閾值的80%）
-                            if abs_funding_rate >= self.funding_rate_threshold * 0.8:
-                                high_funding_symbols.append(symbol)
+                # 獲取資金費率高於閾值的交易對（智能篩選，向量化）
+                # 只更新資金費率有潛力的交易對（閾值的80%）
+                funding_rate_col, _, _, tradable = self.funding_rates.columns()
+                potential_rows = np.flatnonzero(tradable & (np.abs(funding_rate_col) >= self.funding_rate_threshold * 0.8))
+                symbols = self.funding_rates.symbols
+                # 已有 bookTicker 實時點差的交易對不需要REST（冷啟動備援）
+                high_funding_symbols = [symbols[row] for row in potential_rows if not self.has_live_book_ticker(symbols[row])]
                 
-                # 智能批量更新數量
-                # 基於API限制計算：1200請求/分鐘 = 20請求/秒
-                # 30秒窗口內安全使用500次 (留緩衝)，每次0.1秒間隔可處理約50個
+                # 智能批量更新數量（發送速度由權重預算控制）
                 max_symbols = min(50, len(high_funding_symbols))  # 減少到50個，但更精準
                 symbols_to_update = high_funding_symbols[:max_symbols]
                 
@@ -669,12 +915,14 @@ class FundingRateTrader:
                 start_time = time.time()
                 
                 for symbol in symbols_to_update:
+                    # 按權重預算發送（取代固定0.1秒延遲），額度不足時等到下個窗口，仍不足則結束本輪
+                    if not self.weight_budget.acquire_background(ENDPOINT_WEIGHTS['futures_order_book'], timeout=5.0):
+                        print(f"[{self.format_corrected_time()}] 權重預算不足，結束本輪點差更新: {self.weight_budget.format_status()}")
+                        break
                     try:
                         # 獲取標記價格
-                        mark_price = None
-                        if symbol in self.funding_rates and 'mark_price' in self.funding_rates[symbol]:
-                            mark_price = self.funding_rates[symbol]['mark_price']
-                        
+                        mark_price = self.funding_rates.mark_price(symbol)
+
                         # 獲取訂單簿數據
                         depth = self.client.futures_order_book(symbol=symbol, limit=5)
                         
@@ -686,11 +934,9 @@ class FundingRateTrader:
                             
                             # 更新緩存
                             self._spread_cache[symbol] = spread_pct
+                            self._set_spread(symbol, spread_pct)
                             updated_count += 1
                         
-                        # 避免API限制，適當延遲
-                        time.sleep(0.1)
-                        
                     except Exception as e:
                         print(f"[{self.format_corrected_time()}] 更新點差失敗 {symbol}: {e}")
                         continue
@@ -724,6 +970,10 @@ class FundingRateTrader:
     def _should_update_spread(self, symbol: str) -> bool:
         """檢查是否需要更新該交易對的點差"""
         try:
+            # bookTicker 實時推送中，不需要REST更新
+            if self.has_live_book_ticker(symbol):
+                return False
+
             # 確保緩存結構正確初始化
             if not hasattr(self, '_spread_cache_time') or not isinstance(self._spread_cache_time, dict):
                 self._spread_cache_time = {}
@@ -750,11 +1000,8 @@ class FundingRateTrader:
             current_time = time.time()
             
             # 獲取標記價格
-            mark_price = None
-            if hasattr(self, 'funding_rates') and symbol in self.funding_rates:
-                if 'mark_price' in self.funding_rates[symbol]:
-                    mark_price = self.funding_rates[symbol]['mark_price']
-            
+            mark_price = self.funding_rates.mark_price(symbol)
+
             # 獲取訂單簿數據
             depth = self.client.futures_order_book(symbol=symbol, limit=5)
             
@@ -767,6 +1014,7 @@ class FundingRateTrader:
                 # 更新單一交易對的緩存
                 self._spread_cache[symbol] = spread_pct
                 self._spread_cache_time[symbol] = current_time
+                self._set_spread(symbol, spread_pct)
                 
                 print(f"[{self.format_corrected_time()}] 精準更新點差: {symbol} = {spread_pct:.3f}%")
                 
@@ -781,6 +1029,12 @@ class FundingRateTrader:
             print(f"[{self.format_corrected_time()}] 更新單一點差失敗 {symbol}: {e}")
             # 錯誤時不更新緩存，使用舊數據或默認值
 
+    def _set_spread(self, symbol: str, spread_pct: float):
+        """寫入點差列並同步更新機會索引"""
+        row = self.funding_rates.set_spread(symbol, spread_pct)
+        if row is not None:
+            self.opportunity_index.update_rows((row,))
+
     def get_spread_stats(self):
         """獲取點差數據來源統計"""
         if hasattr(self, '_websocket_spread_count') and hasattr(self, '_api_spread_count'):
@@ -819,98 +1073,44 @@ class FundingRateTrader:
         if min_funding_rate is None:
             min_funding_rate = self.funding_rate_threshold
 
-        # 首先基於資金費率篩選出最有潛力的交易對
-        potential_opportunities = []
-        for symbol, data in self.funding_rates.items():
-            # 檢查交易對篩選
-            if TRADING_SYMBOLS:
-                if symbol not in TRADING_SYMBOLS:
-                    continue
-            else:
-                if symbol in EXCLUDED_SYMBOLS:
-                    continue
-            
-            funding_rate = data['funding_rate']
-            abs_funding_rate = abs(funding_rate)
-            
-            # 只考慮資金費率有潛力的交易對（閾值的80%以上）
-            if abs_funding_rate >= min_funding_rate * 0.8:
-                potential_opportunities.append({
-                    'symbol': symbol,
-                    'funding_rate': funding_rate,
-                    'abs_funding_rate': abs_funding_rate,
-                    'next_funding_time': data['next_funding_time'],
-                    'direction': 'long' if funding_rate < 0 else 'short'
-                })
-        
-        if not potential_opportunities:
-            return None
-        
-        # 按結算時間最近為第一優先，然後按資金費率排序（結算時間最近的優先，相同時間選資金費率最大的）
-        potential_opportunities.sort(key=lambda x: (x['next_funding_time'], -x['abs_funding_rate']))
-        
-        # 依次檢查所有候選，直到找到一個符合條件的
-        for candidate in potential_opportunities:
-            symbol = candidate['symbol']
-            
+        # 閾值與索引一致時直接讀取增量索引（O(1)），否則退回全量向量化排序
+        if min_funding_rate == self.opportunity_index.min_net_profit and self.max_spread == self.opportunity_index.max_spread:
+            pick_best = self.opportunity_index.peek
+        else:
+            def pick_best():
+                rows = self.opportunity_ranker.top_k(min_funding_rate, self.max_spread, 1)
+                return int(rows[0]) if rows.size else None
+
+        # 排名第一的候選點差過期時按需精準更新，更新後重新讀取（點差變大的候選會被排除）
+        refreshed = set()
+        for _ in range(5):
+            row = pick_best()
+            if row is None:
+                # 如果所有候選都不符合條件，返回None
+                return None
+
+            symbol = self.funding_rates.symbols[row]
+            if symbol in refreshed or not self._should_update_spread(symbol):
+                return self.opportunity_ranker.describe(row)
+
             # 針對候選更新點差（按需精準更新，避免頻繁調用）
-            if self._should_update_spread(symbol):
-                self.update_single_spread(symbol)
-            
-            # 重新計算淨收益（使用最新點差）
-            funding_rate = candidate['funding_rate'] 
-            net_profit, spread = self.calculate_net_profit(symbol, funding_rate)
-            
-            # 檢查最終的淨收益和點差條件
-            if net_profit >= min_funding_rate and spread <= self.max_spread:
-                return {
-                    'symbol': symbol,
-                    'funding_rate': funding_rate,
-                    'net_profit': net_profit,
-                    'spread': spread,
-                    'next_funding_time': candidate['next_funding_time'],
-                    'direction': candidate['direction']
-                }
-        
-        # 如果所有候選都不符合條件，返回None
-        return None
+            self.update_single_spread(symbol)
+            refreshed.add(symbol)
+
+        row = pick_best()
+        return self.opportunity_ranker.describe(row) if row is not None else None
 
     def display_current_rates(self):
         """顯示當前資金費率 - 按結算時間優先排序，顯示淨收益信息"""
         if not self.funding_rates:
             return
             
-        # 收集符合條件的交易對
-        opportunities = []
-        for symbol, data in self.funding_rates.items():
-            # 檢查交易對篩選
-            if TRADING_SYMBOLS:
-                if symbol not in TRADING_SYMBOLS:
-                    continue
-            else:
-                if symbol in EXCLUDED_SYMBOLS:
-                    continue
-            
-            funding_rate = data['funding_rate']
-            net_profit, spread = self.calculate_net_profit(symbol, funding_rate)
-            
-            # 檢查淨收益和點差條件
-            if net_profit >= self.funding_rate_threshold and spread <= self.max_spread:
-                opportunities.append({
-                    'symbol': symbol,
-                    'funding_rate': funding_rate,
-                    'net_profit': net_profit,
-                    'spread': spread,
-                    'next_funding_time': data['next_funding_time']
-                })
-        
-        if not opportunities:
+        # 淨收益 = |資金費率| - 點差 >= 閾值，點差 <= 最大點差；結算時間最近的優先，相同時間選淨收益最大的
+        row = self.opportunity_index.peek()
+        if row is None:
             return
-            
-        # 按結算時間最近為第一優先，然後按淨收益排序（結算時間最近的優先，相同時間選淨收益最大的）
-        opportunities.sort(key=lambda x: (x['next_funding_time'], -x['net_profit']))
-        best = opportunities[0]
-        
+        best = self.opportunity_ranker.describe(row)
+
         next_time = datetime.fromtimestamp(best['next_funding_time'] / 1000).strftime('%H:%M:%S')
         current_time = self.get_corrected_time()
         time_to_settlement = best['next_funding_time'] - current_time
@@ -924,10 +1124,21 @@ class FundingRateTrader:
         
         print(f"\r最佳: {best['symbol']} 資金費率:{best['funding_rate']:.4f}% | 點差:{best['spread']:.3f}% | 淨收益:{best['net_profit']:.3f}% 結算:{next_time} 倒數:{settlement_countdown}", end='', flush=True)
 
+    def _top_abs_funding_rates(self, n: int, rows=None) -> list:
+        """按資金費率絕對值取前n個交易對，返回 [(symbol, funding_rate), ...]"""
+        funding_rate_col, _, _, tradable = self.funding_rates.columns()
+        if rows is None:
+            rows = np.flatnonzero(tradable)
+        if len(rows) == 0 or n <= 0:
+            return []
+        order = np.argsort(-np.abs(funding_rate_col[rows]), kind='stable')[:n]
+        symbols = self.funding_rates.symbols
+        return [(symbols[row], float(funding_rate_col[row])) for row in rows[order]]
+
     def get_funding_rates(self) -> pd.DataFrame:
         """獲取所有交易對的資金費率"""
         try:
-            response = requests.get("https://fapi.binance.com/fapi/v1/premiumIndex")
+            response = requests.get(f"{self.fapi_url}/fapi/v1/premiumIndex")
             all_rates = response.json()
             
             rates = []
@@ -935,6 +1146,7 @@ class FundingRateTrader:
                 rates.append({
                     'symbol': data['symbol'],
                     'funding_rate': float(data['lastFundingRate']) * 100,
+                    'mark_price': float(data['markPrice']) if data.get('markPrice') else None,
                     'next_funding_time': data['nextFundingTime']
                 })
             
@@ -945,80 +1157,113 @@ class FundingRateTrader:
             print(f"\n錯誤: {str(e)}")
             return pd.DataFrame()
 
-    def open_position(self, symbol: str, direction: str, funding_rate: float, next_funding_time: int):
-        """開倉"""
+    def stage_orders(self, opportunity: dict):
+        """倒數階段預先構建並簽名最佳機會的進場單及其 reduceOnly 平倉單，已預簽名時只刷新簽名"""
+        symbol = opportunity['symbol']
+        direction = opportunity['direction']
+        staged = self.staged_orders
+        if (staged and staged['symbol'] == symbol and staged['direction'] == direction
+                and staged['next_funding_time'] == opportunity['next_funding_time']):
+            self.gateway.refresh_staged(staged['entry'])
+            self.gateway.refresh_staged(staged['close'])
+            return
+
+        current_price = self.funding_rates.mark_price(symbol)
+        if current_price is None:
+            return
+        try:
+            quantity = self.calculate_position_size(symbol, current_price)
+            side = 'BUY' if direction == 'long' else 'SELL'
+            close_side = 'SELL' if direction == 'long' else 'BUY'
+            self.staged_orders = {
+                'symbol': symbol,
+                'direction': direction,
+                'next_funding_time': opportunity['next_funding_time'],
+                'price': current_price,
+                'quantity': quantity,
+                'entry': self.gateway.stage_order(symbol=symbol, side=side, type='MARKET', quantity=quantity),
+                'close': self.gateway.stage_order(symbol=symbol, side=close_side, type='MARKET',
+                                                  quantity=quantity, reduceOnly=True)
+            }
+            print(f"[{self.format_corrected_time()}] 📝 已預簽名訂單: {symbol} {side} {quantity} (平倉 {close_side} reduceOnly)")
+        except Exception as e:
+            self.staged_orders = None
+            print(f"[{self.format_corrected_time()}] 預簽名訂單失敗: {symbol} - {e}")
+
+    def restage_entry(self, symbol: str):
+        """進場失敗（FAILED）後以新的 newClientOrderId 重新預簽名進場單，重試時不會沿用失敗訂單的ID"""
+        staged = self.staged_orders
+        if not staged or staged['symbol'] != symbol:
+            return
+        side = 'BUY' if staged['direction'] == 'long' else 'SELL'
+        staged['entry'] = self.gateway.stage_order(symbol=symbol, side=side, type='MARKET', quantity=staged['quantity'])
+
+    async def send_order(self, order, trigger_at: Optional[float] = None, timeout: float = 1.0, max_retries: int = 2):
+        """在網關事件循環中發送訂單（經 order_batcher），發送期間計入下單通道，背景API調用讓路"""
+        with self.admission.track(LANE_ORDER):
+            return await self.order_batcher.send(order, trigger_at, timeout=timeout, max_retries=max_retries)
+
+    def open_position(self, symbol: str, direction: str, funding_rate: float, next_funding_time: int, span=None,
+                      margin: Optional[float] = None, retry: bool = True):
+        """開倉；span 為調度器觸發時開始的階段計時（直接調用時從這裡開始）
+        margin 為本次保證金（組合模式分配，預設 MAX_POSITION_SIZE）；retry=False 時失敗不等待重試（組合模式）"""
+        # 觸發時間，用於統計觸發到請求寫入連接的延遲
+        trigger_at = time.perf_counter()
+        span = span or self.stage_latency.begin('entry', symbol, trigger_at)
+        span.mark('trigger', trigger_at)
+        staged = self.staged_orders
+        if staged and (staged['symbol'] != symbol or staged['direction'] != direction
+                       or (margin is not None and margin != self.max_position_size)):
+            staged = None
+        # IDLE → ENTRY_PENDING：同一交易對只允許一筆進行中的交易，總數不超過 PORTFOLIO_MAX_POSITIONS（CLOSED/FAILED 後立即可以再進場）
+        try:
+            record = self.position_state.begin_entry(symbol, direction, funding_rate, next_funding_time)
+        except PositionStateError as e:
+            print(f"[{self.format_corrected_time()}] 進場取消: {e}")
+            self.log_trade_step('entry', symbol, 'skip_existing_position', {'error': str(e)})
+            return
         try:
             # 🚀 極速進場 - 移除不必要的記錄，專注於速度
-            self.log_trade_step('entry', symbol, 'start', safe_json_serialize({
+            self.log_trade_step('entry', symbol, 'start', {
                 'direction': direction, 
                 'funding_rate': funding_rate,
                 'next_funding_time': next_funding_time
-            }))
-            
-            # 🚀 智能槓桿設置 - 只在必要時設置，大幅提升進場速度
-            leverage_set_time = 0
-            leverage_start_time = time.time()
+            })
             
-            if self.should_set_leverage(symbol):
-                # 使用帶超時的API調用 - 允許重試以確保槓桿設置成功
-                self.execute_api_call_with_timeout(
-                    self.client.futures_change_leverage,
-                    timeout=1.0,  # 1秒超時，平衡速度和穩定性
-                    max_retries=2,  # 允許重試2次，確保槓桿設置成功
-                    symbol=symbol, 
-                    leverage=self.leverage
-                )
-                leverage_set_time = int((time.time() - leverage_start_time) * 1000)
-                
-                # 更新槓桿緩存
-                self.leverage_cache[symbol] = self.leverage
-                self.leverage_cache_time[symbol] = time.time()
-                
-                self.log_trade_step('entry', symbol, 'leverage_set', {
-                    'leverage': self.leverage,
-                    'execution_time_ms': leverage_set_time
-                })
-            else:
-                leverage_set_time = 0
-                self.log_trade_step('entry', symbol, 'leverage_skipped', {
-                    'leverage': self.leverage,
-                    'reason': 'cached',
-                    'execution_time_ms': 0
-                })
+            # 槓桿在倒數階段已由 schedule_entry 提前設置；仍未確認時由下單協程先等待設置完成
+            leverage_future = self.prepare_leverage(symbol)
+            self.log_trade_step('entry', symbol, 'leverage_pending' if leverage_future else 'leverage_skipped', {
+                'leverage': self.leverage,
+                'reason': 'in_flight' if leverage_future else 'cached'
+            })
+            span.mark('leverage')
             
-            # 🚀 極速價格獲取 - 優先使用WebSocket，備用API
+            # 🚀 極速價格獲取 - 優先使用預簽名訂單的價格，其次WebSocket，備用API
             self.log_trade_step('entry', symbol, 'fetch_price_start', {})
             
-            # 優先使用WebSocket標記價格（1-3ms）
-            current_price = None
-            if hasattr(self, 'funding_rates') and symbol in self.funding_rates:
-                symbol_data = self.funding_rates[symbol]
-                if 'mark_price' in symbol_data:
-                    current_price = symbol_data['mark_price']
+            if staged:
+                current_price = staged['price']
+                self.log_trade_step('entry', symbol, 'price_from_staged_order', {'price': current_price})
+            else:
+                # 優先使用WebSocket標記價格（1-3ms）
+                current_price = self.funding_rates.mark_price(symbol)
+                if current_price is not None:
                     self.log_trade_step('entry', symbol, 'price_from_websocket', {'price': current_price})
             
-            # 如果無法從WebSocket獲取，則使用快速API
+            # 沒有標記價格（行情流尚未推送該交易對）：不在調度器線程上同步查詢REST，本次不進場
             if current_price is None:
-                try:
-                    ticker_24hr = self.client.futures_24hr_ticker(symbol=symbol)
-                    current_price = float(ticker_24hr['lastPrice'])
-                    self.log_trade_step('entry', symbol, 'price_from_24hr_ticker', {'price': current_price})
-                except Exception as e24:
-                    try:
-                        ticker = self.client.futures_symbol_ticker(symbol=symbol)
-                        current_price = float(ticker['price'])
-                        self.log_trade_step('entry', symbol, 'price_from_symbol_ticker', {'price': current_price})
-                    except Exception as esym:
-                        raise Exception(f"價格獲取失敗: {e24}, {esym}")
+                raise Exception("沒有該交易對的標記價格")
             
             self.log_trade_step('entry', symbol, 'fetch_price_success', {'price': current_price})
             self.record_entry_step('price_fetched', symbol=symbol, price=current_price)
+            span.mark('price')
             
             # 🚀 極速數量計算和訂單準備
             self.log_trade_step('entry', symbol, 'calculate_quantity_start', {'price': current_price})
-            quantity = self.calculate_position_size(symbol, current_price)
+            quantity = staged['quantity'] if staged else self.calculate_position_size(symbol, current_price, margin)
             self.log_trade_step('entry', symbol, 'calculate_quantity_success', {'quantity': quantity})
             self.record_entry_step('quantity_calculated', symbol=symbol, quantity=quantity)
+            span.mark('quantity')
             
             # 確定訂單方向
             side = 'BUY' if direction == 'long' else 'SELL'
@@ -1035,59 +1280,99 @@ class FundingRateTrader:
                 'type': 'MARKET'
             })
             
+            # 簽名在當前線程完成（預簽名訂單過期時重簽），事件循環中只負責寫入連接
+            if staged:
+                entry_order = staged['entry']
+                self.gateway.refresh_staged(entry_order)
+            else:
+                entry_order = self.gateway.stage_order(symbol=symbol, side=side, type='MARKET', quantity=quantity)
+            span.mark('sign')
+
             # 非阻塞異步發送訂單
             order_start_time = time.time()
             
-            def send_order_async():
-                try:
-                    # 極速模式：使用超時控制發送訂單
+            async def send_order_async():
+                # 極速模式：在網關事件循環中直接發送（共用連接池，wait_for 超時控制，失敗時重新簽名重試2次）
+                # 組合模式同時進場的訂單由 order_batcher 合併為批次請求
+                if leverage_future is not None:
                     try:
-                        order = self.execute_api_call_with_timeout(
-                            self.client.futures_create_order,
-                            timeout=1.0,  # 1秒超時，平衡速度和穩定性
-                            max_retries=2,  # 允許重試2次，確保進場成功
-                            symbol=symbol,
-                            side=side,
-                            type='MARKET',
-                            quantity=quantity
-                        )
+                        await asyncio.wrap_future(leverage_future)
                     except Exception as e:
-                        # 如果失敗，記錄錯誤但繼續執行
-                        print(f"[{self.format_corrected_time()}] ⚠️ 訂單發送失敗: {e}")
-                        # 假設成功，使用預設值
-                        order = {
-                            'orderId': f"fast_{int(time.time() * 1000)}",
-                            'executedQty': quantity,
-                            'avgPrice': current_price
-                        }
+                        await self.gateway.run_blocking(on_leverage_failed, e)
+                        return
+                try:
+                    order = await self.send_order(entry_order, trigger_at, timeout=1.0, max_retries=2)
+                except Exception as e:
+                    await self.gateway.run_blocking(on_order_failed, e)
+                    return
+                # 後續記錄在網關執行緒池中處理，不卡住事件循環
+                await self.gateway.run_blocking(on_order_sent, order, time.perf_counter())
+
+            def on_leverage_failed(e):
+                # 槓桿設置失敗，訂單未發出：ENTRY_PENDING → FAILED
+                self.position_state.entry_failed(record, f"leverage:{type(e).__name__}")
+                self.restage_entry(symbol)
+                print(f"[{self.format_corrected_time()}] ❌ 槓桿設置失敗，取消進場: {symbol} - {e}")
+                self.log_trade_step('entry', symbol, 'leverage_failed', {'error': str(e)})
+                self.record_entry_step('entry_failed', symbol=symbol, error=str(e))
+
+            def on_order_failed(e):
+                execution_time_ms = int((time.time() - order_start_time) * 1000)
+                self.on_order_rejected(e)
+                if isinstance(e, BinanceAPIException):
+                    # 交易所明確拒單：ENTRY_PENDING → FAILED，下一次結算可以直接進場
+                    self.position_state.entry_failed(record, f"rejected:{e.code}")
+                    self.restage_entry(symbol)
+                    print(f"[{self.format_corrected_time()}] ❌ 進場訂單被拒: {symbol} - {e} ({execution_time_ms}ms)")
+                    self.log_trade_step('entry', symbol, 'send_order_failed', {
+                        'error': str(e),
+                        'execution_time_ms': execution_time_ms
+                    })
+                    self.record_entry_step('entry_failed', symbol=symbol, error=str(e))
+                else:
+                    # 超時/連接錯誤：訂單可能已成交，保持 ENTRY_PENDING，等成交推送或倉位核對決定
+                    print(f"[{self.format_corrected_time()}] ⚠️ 進場訂單結果未知: {symbol} - {e} ({execution_time_ms}ms)，等待成交推送或倉位核對")
+                    self.log_trade_step('entry', symbol, 'send_order_unknown', {
+                        'error': str(e),
+                        'execution_time_ms': execution_time_ms
+                    })
+
+            def on_order_sent(order, acked_at):
+                try:
                     order_id = order['orderId']
                     execution_time_ms = int((time.time() - order_start_time) * 1000)
+                    trigger_to_wire_ms = entry_order.trigger_to_wire_ms
+                    wire_display = f" 觸發→寫入:{trigger_to_wire_ms:.2f}ms" if trigger_to_wire_ms is not None else ""
                     
-                    print(f"[{self.format_corrected_time()}] ⚡ 異步進場成功: {symbol} ID:{order_id} ({execution_time_ms}ms)")
+                    print(f"[{self.format_corrected_time()}] ⚡ 異步進場成功: {symbol} ID:{order_id} ({execution_time_ms}ms){wire_display}")
                     self.log_trade_step('entry', symbol, 'send_order_success', {
                         'order_id': order_id,
                         'execution_time_ms': execution_time_ms,
+                        'trigger_to_wire_ms': trigger_to_wire_ms,
+                        'staged': bool(staged),
                         'executed_qty': order.get('executedQty', '0'),
                         'avg_price': order.get('avgPrice', '0.00')
                     })
                     
-                    # 更新狀態
-                    self.current_position = {
-                        'symbol': symbol,
-                        'direction': direction,
-                        'quantity': quantity,
-                        'entry_price': current_price,
-                        'funding_rate': funding_rate,
-                        'next_funding_time': next_funding_time,
-                        'order_id': order_id
-                    }
-                    self.position_open_time = time.time()
+                    # ENTRY_PENDING → OPEN（成交推送先到時已轉換，這裡只補充訂單號）
+                    self.position_state.entry_acked(record, order_id, float(order.get('executedQty') or 0),
+                                                    float(order.get('avgPrice') or 0))
+
+                    # 各階段耗時：寫入連接（重試時沒有寫入時間，併入交易所回應）→ 交易所回應 → 持倉狀態更新
+                    if entry_order.wire_at is not None:
+                        span.mark('send', entry_order.wire_at)
+                    span.mark('ack', acked_at)
+                    total_ms = span.finish('fill')
+                    print(f"[{self.format_corrected_time()}] ⏱️ 進場各階段: {span.format()}（總計 {total_ms:.2f}ms）")
                     
                     # 記錄進倉成功
                     self.record_entry_step('entry_success', symbol=symbol, 
                                          order_id=order_id,
                                          executed_qty=order.get('executedQty', '0'),
                                          avg_price=order.get('avgPrice', '0.00'))
+
+                    # 連接池延遲統計（握手 vs 請求）
+                    print(f"[{self.format_corrected_time()}] {self.gateway.connection_stats.format_summary()}")
                     
                 except Exception as e:
                     execution_time_ms = int((time.time() - order_start_time) * 1000)
@@ -1097,62 +1382,25 @@ class FundingRateTrader:
                         'execution_time_ms': execution_time_ms
                     })
             
-            # 在新線程中發送訂單
-            import threading
-            order_thread = threading.Thread(target=send_order_async)
-            order_thread.daemon = True
-            order_thread.start()
+            # 提交到網關事件循環發送訂單（不再每筆訂單新建線程），之後的狀態轉換由回應/成交推送驅動
+            self.position_state.entry_sent(record, quantity, current_price)
+            self.gateway.submit(send_order_async())
             
             # 立即返回，不等待訂單完成
             print(f"[{self.format_corrected_time()}] ⚡ 異步進場已發送: {symbol} {side} {quantity}")
             
-            # 臨時記錄，實際數據將在異步線程中更新
-            temp_order_id = f"async_{int(time.time() * 1000)}"
-            self.log_trade_step('entry', symbol, 'send_order_async', {
-                'order_id': temp_order_id,
-                'execution_time_ms': 0,
-                'executed_qty': '0',
-                'avg_price': '0.00'
-            })
-            
-            # 記錄訂單發送時間
+            # 記錄訂單發送（訂單號在回應到達後記錄，這裡以交易id關聯）
             self.record_entry_step('order_sent', symbol=symbol, 
-                                 order_id=temp_order_id,
+                                 trade_id=record.trade_id,
                                  order_time_ms=0)  # 不計算時間
             
-            # 記錄進倉成功
-            self.record_entry_step('entry_success', symbol=symbol, 
-                                 order_id=temp_order_id,
-                                 executed_qty='0',
-                                 avg_price='0.00')
-            
-            # 注意：交易事件將在 log_trade_step 中記錄，避免重複
-            
             self.log_trade_step('entry', symbol, 'entry_complete', {
                 'direction': direction,
                 'quantity': quantity,
                 'price': current_price,
-                'order_id': temp_order_id
+                'trade_id': record.trade_id
             })
             
-            # 更新狀態
-            self.current_position = {
-                'symbol': symbol,
-                'direction': direction,
-                'quantity': quantity,
-                'entry_price': current_price,
-                'funding_rate': funding_rate,
-                'next_funding_time': next_funding_time,
-                'order_id': temp_order_id
-            }
-            self.position_open_time = time.time()
-            
-            # 添加開倉鎖定，防止重複開倉
-            self.entry_locked_until = time.time() + 2.0  # 鎖定2秒，防止重複開倉
-            
-            # 添加倉位檢查延遲，避免開倉後立即檢查
-            self.position_check_delay_until = time.time() + 0.3  # 延遲0.3秒再檢查倉位
-            
             # 記錄進場完成
             self.record_entry_step('entry_complete', symbol=symbol, 
                                  funding_rate=funding_rate, 
@@ -1173,11 +1421,17 @@ class FundingRateTrader:
             })
             
         except Exception as e:
+            # 訂單提交前失敗：ENTRY_PENDING → FAILED（已提交時由回應/推送/核對決定）
+            if record.entry_sent_at is None:
+                self.position_state.entry_failed(record, f"exception:{type(e).__name__}")
+                self.restage_entry(symbol)
             # 記錄進倉失敗
             self.record_entry_step('entry_failed', symbol=symbol, error=str(e))
             self.log_trade_event('entry_failed', symbol, {'error': str(e)})
             self.log_trade_step('entry', symbol, 'entry_failed', {'error': str(e)})
             print(f"[{self.format_corrected_time()}] 開倉失敗] {symbol} {direction} 原因: {e}")
+            if not retry:
+                return
             
             # 初始化重試機制
             if self.entry_retry_count == 0:
@@ -1201,14 +1455,15 @@ class FundingRateTrader:
                 time_to_settlement = self.entry_retry_settlement_time - current_time_ms
                 
                 if time_to_settlement > 0:
-                    print(f"[{self.format_corrected_time()}] 等待 {self.entry_retry_interval} 秒後重試進場...")
+                    print(f"[{self.format_corrected_time()}] {self.entry_retry_interval} 秒後重試進場...")
                     self.log_trade_step('entry', symbol, 'retry_wait', {
                         'wait_seconds': self.entry_retry_interval,
                         'time_to_settlement': time_to_settlement
                     })
-                    time.sleep(self.entry_retry_interval)
-                    # 重新嘗試進場
-                    self.open_position(symbol, direction, funding_rate, next_funding_time)
+                    # 重試交給調度器在到期時觸發，不在調度器線程上 sleep（其他進場/平倉事件照常執行）
+                    self.scheduler.schedule(('entry_retry', symbol, next_funding_time, self.entry_retry_count),
+                                            current_time_ms + self.entry_retry_interval * 1000,
+                                            self.open_position, symbol, direction, funding_rate, next_funding_time)
                 else:
                     print(f"[{self.format_corrected_time()}] 已過結算時間，停止進場重試")
                     self.log_trade_step('entry', symbol, 'retry_timeout', {})
@@ -1218,408 +1473,268 @@ class FundingRateTrader:
                 self.log_trade_step('entry', symbol, 'retry_max_reached', {})
                 self.entry_retry_count = 0
 
+    def schedule_post_close_processing(self, symbol, direction, quantity, order, position=None):
+        """平倉後的統計、記錄、通知、帳戶對帳交給平倉後處理流水線（不在平倉路徑上執行）
+        position 為平倉時的持倉記錄（PositionRecord.as_position()）"""
+        # 持倉記錄在轉換為 CLOSED 時已不再是進行中的交易，由調用方傳入平倉時的副本
+        job = {
+            'symbol': symbol,
+            'direction': direction,
+            'quantity': quantity,
+            'order': order,
+            'position': dict(position) if position else {},
+            'closed_at': time.time(),
+        }
+        if self.post_trade.submit(job):
+            print(f"[{self.format_corrected_time()}] 延後處理已排入佇列，將在{POST_CLOSE_DELAY:g}秒後執行: {symbol} "
+                  f"(佇列 {self.post_trade.depths()})")
+        else:
+            # 佇列滿：不阻塞平倉路徑，至少在系統日誌留下這筆平倉
+            print(f"[{self.format_corrected_time()}] ⚠️ 平倉後處理佇列已滿，略過統計和通知: {symbol} "
+                  f"訂單ID:{order.get('orderId', 'UNKNOWN')} | {self.post_trade.format_status()}")
+            self.log_system_event('post_trade_rejected', {
+                'symbol': symbol, 'direction': direction, 'quantity': quantity,
+                'order_id': order.get('orderId'), 'avg_price': order.get('avgPrice'),
+            })
 
+    # ========== 平倉後處理流水線（工作線程調用） ==========
 
-
-        
-        try:
-            # 新增：平倉延遲功能 (CLOSE_AFTER_SECONDS)
-            if hasattr(self, 'close_after_seconds') and self.close_after_seconds > 0:
-                print(f"[{self.format_corrected_time()}] 平倉延遲: {self.close_after_seconds:.3f}秒 (CLOSE_AFTER_SECONDS) ...")
-                self.write_trade_analysis('fast_close_delay', symbol,
-                                        delay_seconds=self.close_after_seconds,
-                                        delay_reason='平倉延遲執行')
-                time.sleep(self.close_after_seconds)
-            
-            # 記錄極速平倉開始
-            self.write_trade_analysis('fast_close_start', symbol, 
-                                    close_method='極速平倉',
-                                    direction=direction, 
-                                    quantity=quantity,
-                                    trigger_reason='時間觸發或手動')
-            
-            # 步驟1: 確定平倉方向
-            side = 'SELL' if direction == 'long' else 'BUY'
-            self.write_trade_analysis('fast_close_step_side_determined', symbol,
-                                    step_number='1',
-                                    action='確定平倉方向',
-                                    side=side,
-                                    logic=f'開倉方向 {direction} -> 平倉方向 {side}')
-            
-            # 步驟2: 準備API調用參數
-            api_params = {
-                'symbol': symbol,
-                'side': side,
-                'type': 'MARKET',
-                'quantity': quantity,
-                'reduceOnly': True
-            }
-            self.write_trade_analysis('fast_close_step_prepare_api', symbol,
-                                    step_number='2',
-                                    action='準備API參數',
-                                    api_method='futures_create_order',
-                                    parameters=api_params)
-            
-            # 步驟3: 發送API請求
-            self.write_trade_analysis('fast_close_step_api_call_start', symbol,
-                                    step_number='3',
-                                    action='開始API調用',
-                                    api_endpoint='futures_create_order')
-            
-            order_start_time = time.time()
-            # 直接發送平倉訂單 - 極速模式，不使用重試機制
-            try:
-                # 使用帶超時的API調用 - 允許重試以確保平倉成功
-                order = self.execute_api_call_with_timeout(
-                    self.client.futures_create_order,
-                    timeout=1.0,  # 1秒超時，平衡速度和穩定性
-                    max_retries=2,  # 允許重試2次，確保平倉成功
-                    symbol=symbol,
-                    side=side,
-                    type='MARKET',
-                    quantity=quantity,
-                    reduceOnly=True
-                )
-                order_end_time = time.time()
-                execution_time_ms = int((order_end_time - order_start_time) * 1000)
-                
-                # 記錄極速成功
-                if execution_time_ms > 1000:
-                    print(f"[{self.format_corrected_time()}] ⚠️ 平倉較慢: {execution_time_ms}ms")
-                else:
-                    print(f"[{self.format_corrected_time()}] ⚡ 極速平倉: {execution_time_ms}ms")
-                    
-            except Exception as e:
-                # 如果直接調用失敗，才使用重試機制
-                print(f"[{self.format_corrected_time()}] 直接平倉失敗，使用重試機制: {e}")
-                order = self.execute_api_call_with_timeout(
-                    self.client.futures_create_order,
-                    timeout=2,  # 進一步縮短超時時間
-                    max_retries=1,  # 只重試1次
-                    **api_params
-                )
-                order_end_time = time.time()
-                execution_time_ms = int((order_end_time - order_start_time) * 1000)
-            
-            # 步驟4: API回傳成功
-            self.write_trade_analysis('fast_close_step_api_response', symbol,
-                                    step_number='4',
-                                    action='API回傳成功',
-                                    execution_time_ms=execution_time_ms,
-                                    order_response=safe_json_serialize(order))
-            
-            # 簡單記錄成功
-            print(f"[{self.format_corrected_time()}] 極速平倉成功: {symbol} 訂單ID:{order['orderId']}")
-            
-            # 步驟5: 提取關鍵信息
-            order_id = order['orderId']
-            executed_qty = order.get('executedQty', 'N/A')
-            avg_price = order.get('avgPrice', 'N/A')
-            
-            self.write_trade_analysis('fast_close_step_extract_info', symbol,
-                                    step_number='5',
-                                    action='提取關鍵信息',
-                                    order_id=order_id,
-                                    executed_qty=executed_qty,
-                                    avg_price=avg_price)
-            
-            # 步驟6: 清空持倉記錄
-            self.write_trade_analysis('fast_close_step_clear_position', symbol,
-                                    step_number='6',
-                                    action='清空持倉記錄',
-                                    cleared_fields=['current_position', 'position_open_time', 'close_retry_count', 'is_closing'])
-            
-            # 清空持倉記錄
-            self.current_position = None
-            self.position_open_time = None
-            self.close_retry_count = 0
-            self.is_closing = False
-            
-            # 步驟7: 安排延後處理
-            self.write_trade_analysis('fast_close_step_schedule_post_process', symbol,
-                                    step_number='7',
-                                    action='安排延後處理',
-                                    delay_seconds=1.0,
-                                    post_process_tasks=['盈虧計算', '收益追蹤', '通知發送'])
-            
-            # 延後處理：盈虧計算、收益追蹤、通知等
-            self.schedule_post_close_processing(symbol, direction, quantity, order)
-            
-            # 記錄極速平倉成功
-            self.write_trade_analysis('fast_close_success', symbol, 
-                                    order_id=order_id, 
-                                    execution_time_ms=execution_time_ms,
-                                    executed_qty=executed_qty,
-                                    avg_price=avg_price,
-                                    close_method='極速平倉',
-                                    total_steps=7)
-            
-            return True
-            
-        except Exception as e:
-            print(f"[{self.format_corrected_time()}] 極速平倉失敗: {symbol} - {e}")
-            # 記錄極速平倉失敗 - 包含詳細錯誤信息
-            self.write_trade_analysis('fast_close_failed', symbol, 
-                                    error=str(e),
-                                    error_type=type(e).__name__,
-                                    close_method='極速平倉',
-                                    fallback_action='切換到完整平倉重試機制')
-            # 失敗時才使用完整的重試邏輯
-            return self.close_position_with_retry()
-    
-    def schedule_post_close_processing(self, symbol, direction, quantity, order):
-        """延後處理平倉後的統計、通知等非關鍵操作"""
-        # 保存當前持倉信息，因為稍後會被清空
-        current_position_backup = self.current_position.copy() if self.current_position else {}
-        position_open_time_backup = self.position_open_time
-        
-        # 從order中獲取實際的平倉價格和時間
+    def _post_trade_pnl(self, job: dict) -> dict:
+        """盈虧計算：確定平倉價、計算盈虧和持倉時間，寫交易日誌，生成交易記錄 job['trade']"""
+        symbol, direction, quantity, order = job['symbol'], job['direction'], job['quantity'], job['order']
+        current_position_backup = job['position']
+        position_open_time_backup = current_position_backup.get('opened_at')
         order_exit_price = float(order.get('avgPrice', 0)) if order.get('avgPrice') else None
         order_id = order.get('orderId', 'UNKNOWN')
-        order_time = time.time()
+        order_time = job['closed_at']
+        print(f"[{self.format_corrected_time()}] 延後處理開始: {symbol} 訂單ID:{order_id}")
+        
+        # 獲取平倉價格 - 優先使用訂單中的成交價，其次用戶數據流推送的成交均價，最後才重新獲取市價
+        pushed_exit_price = None
+        if not (order_exit_price and order_exit_price > 0) and order_id != 'UNKNOWN':
+            pushed_exit_price = self.position_book.fill_price(order_id, timeout=1.0 if self.user_stream_healthy() else 0)
+        if order_exit_price and order_exit_price > 0:
+            exit_price = order_exit_price
+            print(f"[{self.format_corrected_time()}] 使用訂單成交價: {exit_price}")
+        elif pushed_exit_price:
+            exit_price = pushed_exit_price
+            print(f"[{self.format_corrected_time()}] 使用成交推送均價: {exit_price}")
+        else:
+            ticker = self.client.futures_symbol_ticker(symbol=symbol)
+            exit_price = float(ticker['price'])
+            print(f"[{self.format_corrected_time()}] 重新獲取市價: {exit_price}")
         
-        def post_process():
-            try:
-                print(f"[{self.format_corrected_time()}] 延後處理開始: {symbol} 訂單ID:{order_id}")
-                
-                # 獲取平倉價格 - 優先使用訂單中的成交價，否則重新獲取
-                if order_exit_price and order_exit_price > 0:
-                    exit_price = order_exit_price
-                    print(f"[{self.format_corrected_time()}] 使用訂單成交價: {exit_price}")
-                else:
-                    ticker = self.client.futures_symbol_ticker(symbol=symbol)
-                    exit_price = float(ticker['price'])
-                    print(f"[{self.format_corrected_time()}] 重新獲取市價: {exit_price}")
-                
-                # 使用備份的進場價格，如果沒有就使用平倉價格
-                entry_price = current_position_backup.get('entry_price', exit_price)
-                funding_rate = current_position_backup.get('funding_rate', 0.0)
-                
-                # 修正空備份問題
-                if not current_position_backup:
-                    print(f"[{self.format_corrected_time()}] 警告：持倉備份為空，使用預設值")
-                    entry_price = exit_price
-                    funding_rate = 0.0
-                
-                # 計算盈虧
-                pnl = (exit_price - entry_price) * quantity if direction == 'long' else (entry_price - exit_price) * quantity
-                
-                # 計算持倉時間
-                if position_open_time_backup:
-                    position_duration = int(order_time - position_open_time_backup)
-                else:
-                    position_duration = 0
-                    print(f"[{self.format_corrected_time()}] 警告：開倉時間備份為空，持倉時間設為0")
-                
-                print(f"[{self.format_corrected_time()}] 交易資料計算完成: 進場價:{entry_price:.4f} 平倉價:{exit_price:.4f} 盈虧:{pnl:.4f} 持倉:{position_duration}秒")
-                
-                # 記錄詳細日誌
-                self.log_trade_event('close_success', symbol, {
-                    'direction': direction,
-                    'quantity': quantity,
-                    'entry_price': entry_price,
-                    'exit_price': exit_price,
-                    'pnl': pnl,
-                    'order_id': order['orderId'],
-                    'funding_rate': funding_rate,
-                    'position_duration_seconds': position_duration
-                })
-                
-                # 記錄詳細的平倉完成信息到記事本（延後處理版本）
-                self.write_trade_analysis('close_position_detail', symbol,
-                                        order_id=order['orderId'],
-                                        executed_qty=order.get('executedQty', quantity),
-                                        avg_price=order.get('avgPrice', exit_price),
-                                        # 完整的交易詳細信息
-                                        direction=direction,
-                                        quantity=quantity,
-                                        entry_price=entry_price,
-                                        exit_price=exit_price,
-                                        pnl=pnl,
-                                        funding_rate=funding_rate,
-                                        position_duration_seconds=position_duration,
-                                        processing_type='延後處理')
-                
-                # 收益追蹤和Telegram通知
-                if hasattr(self, 'profit_tracker') and self.profit_tracker:
-                    # 從訂單響應中提取更準確的時間戳
-                    order_time_from_api = order.get('updateTime') or order.get('time')
-                    
-                    # 使用API時間戳（如果有的話），否則使用程式記錄的時間
-                    if order_time_from_api:
-                        exit_timestamp_ms = int(order_time_from_api)
-                        print(f"[{self.format_corrected_time()}] 使用API時間戳: {exit_timestamp_ms}")
-                    else:
-                        exit_timestamp_ms = int(order_time * 1000)
-                        print(f"[{self.format_corrected_time()}] 使用程式時間戳: {exit_timestamp_ms}")
-                    
-                    trade_data = {
-                        'symbol': symbol,
-                        'direction': direction,
-                        'quantity': quantity,
-                        'entry_price': entry_price,
-                        'exit_price': exit_price,
-                        'pnl': pnl,
-                        'funding_rate': funding_rate,
-                        'order_id': order_id,
-                        'entry_timestamp': int(position_open_time_backup * 1000) if position_open_time_backup else int((order_time - 10) * 1000),
-                        'exit_timestamp': exit_timestamp_ms,
-                        'position_duration_seconds': position_duration,
-                        # 添加額外的時間精度信息
-                        'api_order_time': order_time_from_api,
-                        'program_order_time': int(order_time * 1000),
-                        'time_source': 'api' if order_time_from_api else 'program'
-                    }
-                    
-                    print(f"[{self.format_corrected_time()}] 交易資料準備: {trade_data}")
-                    
-                    # 添加交易記錄
-                    self.profit_tracker.add_trade(trade_data)
-                
-                    # 發送基本交易通知
-                    try:
-                        self.profit_tracker.send_trade_notification(trade_data)
-                        print(f"[{self.format_corrected_time()}] Telegram交易通知已發送: {symbol}")
-                    except Exception as notify_e:
-                        print(f"[{self.format_corrected_time()}] Telegram交易通知發送失敗: {notify_e}")
-                        import traceback
-                        traceback.print_exc()
-                
-                # 延後60秒發送詳細帳戶分析報告
-                def send_detailed_analysis():
-                    try:
-                        from account_analyzer import AccountAnalyzer
-                        from config import LEVERAGE
-                        from datetime import datetime
-                        
-                        analyzer = AccountAnalyzer()
-                        
-                        # 使用實際的交易時間範圍
-                        entry_time_ms = int(position_open_time_backup * 1000) if position_open_time_backup else int((order_time - 10) * 1000)
-                        exit_time_ms = int(order_time * 1000)
-                        
-                        # 擴大時間範圍以確保能找到交易記錄
-                        period = [{
-                            'symbol': symbol,
-                            'entry_time': entry_time_ms - 5000,  # 提前5秒
-                            'exit_time': exit_time_ms + 5000,    # 延後5秒
-                            'direction': direction,
-                            'quantity': quantity
-                        }]
-                        
-                        print(f"[{self.format_corrected_time()}] 查詢交易記錄: {symbol} 時間範圍:{datetime.fromtimestamp(entry_time_ms/1000).strftime('%H:%M:%S.%f')[:-3]} - {datetime.fromtimestamp(exit_time_ms/1000).strftime('%H:%M:%S.%f')[:-3]}")
-                        
-                        result = analyzer.analyze_trades_by_time_range(period)
-                        if result and result['trades_by_period']:
-                            detail = result['trades_by_period'][0]
-                            print(f"[{self.format_corrected_time()}] 找到交易記錄: 實際盈虧:{detail['realized_pnl']:.4f} 資金費:{detail['funding_fee']:.4f} 手續費:{detail['commission']:.4f}")
-                        else:
-                            print(f"[{self.format_corrected_time()}] 未找到交易記錄，使用程式計算值")
-                            # 創建虛擬的detail，使用程式計算的值
-                            # 估算手續費：倉位價值 * 0.04% (maker fee)
-                            estimated_commission = (quantity * entry_price + quantity * exit_price) * 0.0004
-                            # 估算資金費（如果確實獲得了資金費）
-                            estimated_funding = quantity * entry_price * (funding_rate / 100) if funding_rate != 0 else 0.0
-                            
-                            detail = {
-                                'symbol': symbol,
-                                'direction': direction,
-                                'entry_time': entry_time_ms,
-                                'exit_time': exit_time_ms,
-                                'realized_pnl': pnl,
-                                'funding_fee': estimated_funding,
-                                'commission': estimated_commission,
-                                'net_profit': pnl + estimated_funding - estimated_commission,
-                                'income_records': []
-                            }
-                            
-                            print(f"[{self.format_corrected_time()}] 虛擬detail創建:")
-                            print(f"  程式盈虧: {pnl:.4f}")
-                            print(f"  估算資金費: {estimated_funding:.4f}")
-                            print(f"  估算手續費: {estimated_commission:.4f}")
-                            print(f"  估算淨利: {detail['net_profit']:.4f}")
-                            
-                            # 計算倉位和保證金資訊
-                            position_value = quantity * entry_price
-                            margin_used = position_value / LEVERAGE
-                            
-                            # 計算報酬率（淨利 / 保證金）
-                            return_rate = (detail['net_profit'] / margin_used * 100) if margin_used > 0 else 0
-                            
-                            # 分析資金費詳細數據
-                            funding_details = ""
-                            funding_records = [inc for inc in detail.get('income_records', []) if inc['incomeType'] == 'FUNDING_FEE']
-                            if funding_records:
-                                funding_count = len(funding_records)
-                                positive_funding = sum(float(inc['income']) for inc in funding_records if float(inc['income']) > 0)
-                                negative_funding = sum(float(inc['income']) for inc in funding_records if float(inc['income']) < 0)
-                                
-                                # 計算資金費率（資金費 ÷ 持倉價值）
-                                total_funding_fee = detail['funding_fee']
-                                funding_rate_percentage = (total_funding_fee / position_value * 100) if position_value > 0 else 0
-                                
-                                funding_details = f"\n💰 <b>資金費詳細</b>\n"
-                                funding_details += f"資金費次數: {funding_count}\n"
-                                if positive_funding > 0:
-                                    funding_details += f"  ↗️ 收入: +{positive_funding:.4f} USDT\n"
-                                if negative_funding < 0:
-                                    funding_details += f"  ↘️ 支出: {negative_funding:.4f} USDT\n"
-                                funding_details += f"資金費總計: {detail['funding_fee']:.4f} USDT\n"
-                                funding_details += f"資金費率: {funding_rate_percentage:.4f}% (資金費/持倉價值)"
-                            else:
-                                funding_details = f"\n💰 <b>資金費詳細</b>\n資金費: {detail['funding_fee']:.4f} USDT (無記錄)\n資金費率: 0.0000%"
-                            
-                            # 計算完整的收益分解
-                            program_pnl = pnl
-                            actual_pnl = detail['realized_pnl'] 
-                            commission = detail['commission']
-                            funding_fee = detail['funding_fee']
-                            net_profit = detail['net_profit']
-                            
-                            # 計算理論淨利 = 程式盈虧 + 資金費 - 手續費
-                            theoretical_net = program_pnl + funding_fee - commission
-                            
-                            msg = (
-                                f"📊 <b>單筆真實收益分析</b> (⚡極速平倉)\n\n"
-                                f"<b>交易對:</b> {detail['symbol']}\n"
-                                f"<b>方向:</b> {detail['direction'].upper()}\n"
-                                f"<b>數量:</b> {quantity:,}\n"
-                                f"<b>倉位價值:</b> {position_value:.2f} USDT\n"
-                                f"<b>保證金:</b> {margin_used:.2f} USDT\n"
-                                f"<b>槓桿:</b> {LEVERAGE}x\n\n"
-                                f"⏰ <b>時間資訊</b>\n"
-                                f"<b>開倉時間:</b> {datetime.fromtimestamp(detail['entry_time']/1000).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]}\n"
-                                f"<b>平倉時間:</b> {datetime.fromtimestamp(detail['exit_time']/1000).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]}\n"
-                                f"<b>持倉時間:</b> {position_duration}秒\n"
-                                f"{funding_details}\n\n"
-                                f"📈 <b>收益分析</b>\n"
-                                f"<b>程式盈虧:</b> {program_pnl:.4f} USDT (理論價差收益)\n"
-                                f"<b>帳戶實際盈虧:</b> {actual_pnl:.4f} USDT\n"
-                                f"<b>資金費收入:</b> +{funding_fee:.4f} USDT\n"
-                                f"<b>手續費成本:</b> -{commission:.4f} USDT\n"
-                                f"<b>理論淨利:</b> {theoretical_net:.4f} USDT (程式盈虧+資金費-手續費)\n"
-                                f"<b>帳戶淨利:</b> {net_profit:.4f} USDT\n"
-                                f"<b>報酬率:</b> {return_rate:.2f}% (淨利/保證金)\n\n"
-                                f"<b>差異分析:</b> {net_profit - theoretical_net:.4f} USDT (帳戶-理論)\n"
-                                f"<b>程式vs帳戶:</b> {net_profit - program_pnl:.4f} USDT"
-                            )
-                            from profit_tracker import ProfitTracker
-                            ProfitTracker().send_telegram_message(msg)
-                            print(f"[{self.format_corrected_time()}] 極速平倉詳細分析報告已發送: {symbol}")
-                    except Exception as analysis_e:
-                        print(f"[{self.format_corrected_time()}] 極速平倉詳細分析報告發送失敗: {analysis_e}")
-                
-                # 60秒後發送詳細分析報告
-                import threading
-                threading.Timer(60, send_detailed_analysis).start()
-                
-                print(f"[{self.format_corrected_time()}] 延後處理完成: {symbol} 盈虧:{pnl:.4f} USDT 持倉:{position_duration}秒")
-            except Exception as e:
-                print(f"[{self.format_corrected_time()}] 延後處理失敗: {e}")
+        # 使用備份的進場價格，如果沒有就使用平倉價格
+        entry_price = current_position_backup.get('entry_price', exit_price)
+        funding_rate = current_position_backup.get('funding_rate', 0.0)
+        
+        # 修正空備份問題
+        if not current_position_backup:
+            print(f"[{self.format_corrected_time()}] 警告：持倉備份為空，使用預設值")
+            entry_price = exit_price
+            funding_rate = 0.0
+        
+        # 計算盈虧
+        pnl = (exit_price - entry_price) * quantity if direction == 'long' else (entry_price - exit_price) * quantity
+        
+        # 計算持倉時間
+        if position_open_time_backup:
+            position_duration = int(order_time - position_open_time_backup)
+        else:
+            position_duration = 0
+            print(f"[{self.format_corrected_time()}] 警告：開倉時間備份為空，持倉時間設為0")
+        
+        print(f"[{self.format_corrected_time()}] 交易資料計算完成: 進場價:{entry_price:.4f} 平倉價:{exit_price:.4f} 盈虧:{pnl:.4f} 持倉:{position_duration}秒")
+        
+        # 記錄詳細日誌
+        self.log_trade_event('close_success', symbol, {
+            'direction': direction,
+            'quantity': quantity,
+            'entry_price': entry_price,
+            'exit_price': exit_price,
+            'pnl': pnl,
+            'order_id': order['orderId'],
+            'funding_rate': funding_rate,
+            'position_duration_seconds': position_duration
+        })
         
-        # 在1秒後執行延後處理，避免影響後續交易
-        print(f"[{self.format_corrected_time()}] 延後處理已安排，將在1秒後執行: {symbol}")
-        threading.Timer(1.0, post_process).start()
+        # 記錄詳細的平倉完成信息到記事本（延後處理版本）
+        self.write_trade_analysis('close_position_detail', symbol,
+                                order_id=order['orderId'],
+                                executed_qty=order.get('executedQty', quantity),
+                                avg_price=order.get('avgPrice', exit_price),
+                                # 完整的交易詳細信息
+                                direction=direction,
+                                quantity=quantity,
+                                entry_price=entry_price,
+                                exit_price=exit_price,
+                                pnl=pnl,
+                                funding_rate=funding_rate,
+                                position_duration_seconds=position_duration,
+                                processing_type='延後處理')
+        
+        # 從訂單響應中提取更準確的時間戳，使用API時間戳（如果有的話），否則使用程式記錄的時間
+        order_time_from_api = order.get('updateTime') or order.get('time')
+        exit_timestamp_ms = int(order_time_from_api) if order_time_from_api else int(order_time * 1000)
+        job['trade'] = {
+            'symbol': symbol,
+            'direction': direction,
+            'quantity': quantity,
+            'entry_price': entry_price,
+            'exit_price': exit_price,
+            'pnl': pnl,
+            'funding_rate': funding_rate,
+            'order_id': order_id,
+            'entry_timestamp': int(position_open_time_backup * 1000) if position_open_time_backup else int((order_time - 10) * 1000),
+            'exit_timestamp': exit_timestamp_ms,
+            'position_duration_seconds': position_duration,
+            # 添加額外的時間精度信息
+            'api_order_time': order_time_from_api,
+            'program_order_time': int(order_time * 1000),
+            'time_source': 'api' if order_time_from_api else 'program'
+        }
+        print(f"[{self.format_corrected_time()}] 延後處理完成: {symbol} 盈虧:{pnl:.4f} USDT 持倉:{position_duration}秒")
+        return job
+
+    def _post_trade_persist(self, jobs: list) -> list:
+        """持久化：一批交易逐筆加入收益追蹤，trade_history.json 只重寫一次"""
+        if not self.profit_tracker:
+            return jobs
+        for job in jobs:
+            self.profit_tracker.add_trade(job['trade'], save=False)
+        self.profit_tracker.save_trade_history()
+        return jobs
+
+    def _post_trade_notify(self, job: dict) -> Optional[dict]:
+        """通知：發送基本交易通知；沒有收益追蹤器（不發 Telegram）時也不做帳戶對帳"""
+        if not self.profit_tracker:
+            return None
+        try:
+            self.profit_tracker.send_trade_notification(job['trade'])
+            print(f"[{self.format_corrected_time()}] Telegram交易通知已發送: {job['symbol']}")
+        except Exception as notify_e:
+            print(f"[{self.format_corrected_time()}] Telegram交易通知發送失敗: {notify_e}")
+            traceback.print_exc()
+        return job
+
+    def _post_trade_reconcile(self, jobs: list):
+        """帳戶對帳：平倉 RECONCILE_DELAY 秒後，相近時間平倉的交易合併為一次帳戶查詢，逐筆發送真實收益分析報告"""
+        if self._account_analyzer is None:
+            # 共用交易機器人的客戶端和權重預算，整個運行期間只建立一次
+            self._account_analyzer = AccountAnalyzer(weight_budget=self.weight_budget, client=self.client)
+        
+        # 擴大時間範圍以確保能找到交易記錄（提前/延後5秒）
+        periods = [{
+            'symbol': job['symbol'],
+            'entry_time': job['trade']['entry_timestamp'] - 5000,
+            'exit_time': job['trade']['program_order_time'] + 5000,
+            'direction': job['direction'],
+            'quantity': job['quantity']
+        } for job in jobs]
+        print(f"[{self.format_corrected_time()}] 查詢交易記錄: {', '.join(job['symbol'] for job in jobs)} "
+              f"時間範圍:{datetime.fromtimestamp(min(period['entry_time'] for period in periods) / 1000).strftime('%H:%M:%S.%f')[:-3]} - "
+              f"{datetime.fromtimestamp(max(period['exit_time'] for period in periods) / 1000).strftime('%H:%M:%S.%f')[:-3]}")
+        result = self._account_analyzer.analyze_trades_batch(periods)
+        
+        for index, job in enumerate(jobs):
+            symbol = job['symbol']
+            detail = result['trades_by_period'].get(index) if result else None
+            try:
+                msg = self._format_reconcile_report(job['trade'], detail)
+                self.profit_tracker.send_telegram_message(msg)
+                print(f"[{self.format_corrected_time()}] 極速平倉詳細分析報告已發送: {symbol}")
+            except Exception as analysis_e:
+                print(f"[{self.format_corrected_time()}] 極速平倉詳細分析報告發送失敗: {analysis_e}")
+
+    def _format_reconcile_report(self, trade: dict, detail: Optional[dict]) -> str:
+        """單筆真實收益分析報告；detail 為帳戶查詢結果，沒有成交記錄時以程式計算值估算"""
+        symbol, direction, quantity = trade['symbol'], trade['direction'], trade['quantity']
+        entry_price, exit_price, pnl = trade['entry_price'], trade['exit_price'], trade['pnl']
+        funding_rate = trade['funding_rate']
+        entry_time_ms, exit_time_ms = trade['entry_timestamp'], trade['program_order_time']
+        
+        if detail and detail['trade_records']:
+            print(f"[{self.format_corrected_time()}] 找到交易記錄: {symbol} 實際盈虧:{detail['realized_pnl']:.4f} 資金費:{detail['funding_fee']:.4f} 手續費:{detail['commission']:.4f}")
+            source = '帳戶記錄'
+        else:
+            print(f"[{self.format_corrected_time()}] 未找到交易記錄，使用程式計算值: {symbol}")
+            # 估算手續費：倉位價值 * 0.04% (maker fee)
+            estimated_commission = (quantity * entry_price + quantity * exit_price) * 0.0004
+            # 估算資金費（如果確實獲得了資金費）
+            estimated_funding = quantity * entry_price * (funding_rate / 100) if funding_rate != 0 else 0.0
+            detail = {
+                'realized_pnl': pnl,
+                'funding_fee': estimated_funding,
+                'commission': estimated_commission,
+                'net_profit': pnl + estimated_funding - estimated_commission,
+                'income_records': []
+            }
+            print(f"[{self.format_corrected_time()}] 估算: 程式盈虧:{pnl:.4f} 資金費:{estimated_funding:.4f} 手續費:{estimated_commission:.4f} 淨利:{detail['net_profit']:.4f}")
+            source = '程式估算（未找到帳戶記錄）'
+        
+        # 計算倉位和保證金資訊
+        position_value = quantity * entry_price
+        margin_used = position_value / LEVERAGE
+        
+        # 計算報酬率（淨利 / 保證金）
+        return_rate = (detail['net_profit'] / margin_used * 100) if margin_used > 0 else 0
+        
+        # 分析資金費詳細數據
+        funding_records = [inc for inc in detail.get('income_records', []) if inc['incomeType'] == 'FUNDING_FEE']
+        if funding_records:
+            funding_count = len(funding_records)
+            positive_funding = sum(float(inc['income']) for inc in funding_records if float(inc['income']) > 0)
+            negative_funding = sum(float(inc['income']) for inc in funding_records if float(inc['income']) < 0)
+            
+            # 計算資金費率（資金費 ÷ 持倉價值）
+            funding_rate_percentage = (detail['funding_fee'] / position_value * 100) if position_value > 0 else 0
+            
+            funding_details = f"\n💰 <b>資金費詳細</b>\n"
+            funding_details += f"資金費次數: {funding_count}\n"
+            if positive_funding > 0:
+                funding_details += f"  ↗️ 收入: +{positive_funding:.4f} USDT\n"
+            if negative_funding < 0:
+                funding_details += f"  ↘️ 支出: {negative_funding:.4f} USDT\n"
+            funding_details += f"資金費總計: {detail['funding_fee']:.4f} USDT\n"
+            funding_details += f"資金費率: {funding_rate_percentage:.4f}% (資金費/持倉價值)"
+        else:
+            funding_details = f"\n💰 <b>資金費詳細</b>\n資金費: {detail['funding_fee']:.4f} USDT (無記錄)\n資金費率: 0.0000%"
+        
+        # 計算完整的收益分解
+        program_pnl = pnl
+        actual_pnl = detail['realized_pnl']
+        commission = detail['commission']
+        funding_fee = detail['funding_fee']
+        net_profit = detail['net_profit']
+        
+        # 計算理論淨利 = 程式盈虧 + 資金費 - 手續費
+        theoretical_net = program_pnl + funding_fee - commission
+        
+        return (
+            f"📊 <b>單筆真實收益分析</b> (⚡極速平倉)\n\n"
+            f"<b>交易對:</b> {symbol}\n"
+            f"<b>方向:</b> {direction.upper()}\n"
+            f"<b>數量:</b> {quantity:,}\n"
+            f"<b>倉位價值:</b> {position_value:.2f} USDT\n"
+            f"<b>保證金:</b> {margin_used:.2f} USDT\n"
+            f"<b>槓桿:</b> {LEVERAGE}x\n\n"
+            f"⏰ <b>時間資訊</b>\n"
+            f"<b>開倉時間:</b> {datetime.fromtimestamp(entry_time_ms/1000).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]}\n"
+            f"<b>平倉時間:</b> {datetime.fromtimestamp(exit_time_ms/1000).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]}\n"
+            f"<b>持倉時間:</b> {trade['position_duration_seconds']}秒\n"
+            f"{funding_details}\n\n"
+            f"📈 <b>收益分析</b>\n"
+            f"<b>程式盈虧:</b> {program_pnl:.4f} USDT (理論價差收益)\n"
+            f"<b>帳戶實際盈虧:</b> {actual_pnl:.4f} USDT\n"
+            f"<b>資金費收入:</b> +{funding_fee:.4f} USDT\n"
+            f"<b>手續費成本:</b> -{commission:.4f} USDT\n"
+            f"<b>理論淨利:</b> {theoretical_net:.4f} USDT (程式盈虧+資金費-手續費)\n"
+            f"<b>帳戶淨利:</b> {net_profit:.4f} USDT\n"
+            f"<b>報酬率:</b> {return_rate:.2f}% (淨利/保證金)\n\n"
+            f"<b>差異分析:</b> {net_profit - theoretical_net:.4f} USDT (帳戶-理論)\n"
+            f"<b>程式vs帳戶:</b> {net_profit - program_pnl:.4f} USDT\n"
+            f"<b>資料來源:</b> {source}"
+        )
             
 
     
@@ -1631,14 +1746,25 @@ class FundingRateTrader:
 
 
 
-    def close_position(self, delay_seconds=0):
-        """詳細記錄平倉 - 每個步驟都記錄，支持延遲執行"""
-        if not self.current_position:
+    def close_position(self, delay_seconds=0, span=None, record=None):
+        """詳細記錄平倉 - 每個步驟都記錄，支持延遲執行；span 為調度器觸發時開始的階段計時
+        record 為要平倉的交易（預設為當前交易，組合模式由 fire_close 逐個傳入）
+        OPEN → CLOSE_PENDING 在發送前轉換，不在 OPEN（進場未確認、已在平倉）時返回False"""
+        record = record or self.position_state.active
+        if record is None or not self.position_state.begin_close(record):
             return False
             
-        symbol = self.current_position['symbol']
-        direction = self.current_position['direction'] 
-        quantity = self.current_position['quantity']
+        symbol = record.symbol
+        direction = record.direction
+        quantity = record.quantity
+
+        # 進場時一併預簽名的 reduceOnly 平倉單（交易對、方向、數量一致時才使用），只移除本交易對的預簽名訂單
+        staged = self.staged_orders
+        staged_close = None
+        if staged and staged['symbol'] == symbol:
+            self.staged_orders = None
+            if staged['direction'] == direction and staged['quantity'] == quantity:
+                staged_close = staged['close']
 
         # 新增：如有延遲，先sleep，並記錄log
         if delay_seconds > 0:
@@ -1655,29 +1781,47 @@ class FundingRateTrader:
             
             # 非阻塞異步發送平倉訂單
             close_start_time = time.time()
+            close_trigger_at = time.perf_counter()
+            span = span or self.stage_latency.begin('close', symbol, close_trigger_at)
+            span.mark('trigger', close_trigger_at)
+            # 平倉時簽名通常已超過有效時間，先在當前線程重簽（沒有預簽名平倉單時當場簽名），事件循環中直接發送
+            if staged_close is not None:
+                close_order = staged_close
+                self.gateway.refresh_staged(close_order)
+            else:
+                close_order = self.gateway.stage_order(symbol=symbol, side=side, type='MARKET', quantity=quantity,
+                                                       reduceOnly=True)
+            span.mark('sign')
             
-            def send_close_order_async():
+            async def send_close_order_async():
+                try:
+                    # 允許重試2次，確保平倉成功
+                    order = await self.send_order(close_order, close_trigger_at, timeout=1.0, max_retries=2)
+                except Exception as e:
+                    await self.gateway.run_blocking(on_close_failed, e)
+                    return
+                await self.gateway.run_blocking(on_close_sent, order, time.perf_counter())
+
+            def on_close_sent(order, acked_at):
                 try:
-                    # 使用帶超時的API調用 - 允許重試以確保平倉成功
-                    order = self.execute_api_call_with_timeout(
-                        self.client.futures_create_order,
-                        timeout=1.0,  # 1秒超時，平衡速度和穩定性
-                        max_retries=2,  # 允許重試2次，確保平倉成功
-                        symbol=symbol,
-                        side=side,
-                        type='MARKET',
-                        quantity=quantity,
-                        reduceOnly=True
-                    )
                     order_id = order['orderId']
                     execution_time_ms = int((time.time() - close_start_time) * 1000)
                     
-                    print(f"[{self.format_corrected_time()}] ⚡ 異步平倉成功: {symbol} ID:{order_id} ({execution_time_ms}ms)")
+                    trigger_to_wire_ms = close_order.trigger_to_wire_ms
+                    wire_display = f" 觸發→寫入:{trigger_to_wire_ms:.2f}ms" if trigger_to_wire_ms is not None else ""
+                    print(f"[{self.format_corrected_time()}] ⚡ 異步平倉成功: {symbol} ID:{order_id} ({execution_time_ms}ms){wire_display}")
                     
-                    # 清理狀態
-                    self.current_position = None
-                    self.position_open_time = None
-                    self.is_closing = False
+                    # CLOSE_PENDING → CLOSED（成交推送先到時已轉換，這裡只補充訂單號），之後可立即進場下一次結算
+                    self.position_state.close_acked(record, order_id, float(order.get('avgPrice') or 0))
+
+                    # 本次平倉各階段耗時，並輸出本輪結算後的累計階段直方圖
+                    if close_order.wire_at is not None:
+                        span.mark('send', close_order.wire_at)
+                    span.mark('ack', acked_at)
+                    total_ms = span.finish('fill')
+                    print(f"[{self.format_corrected_time()}] ⏱️ 平倉各階段: {span.format()}（總計 {total_ms:.2f}ms）")
+                    if not self.position_state.records():  # 組合模式在最後一筆平倉後輸出
+                        self.dump_stage_latency('settlement')
                     
                     # 記錄平倉完成
                     self.log_trade_step('close', symbol, 'close_complete', {
@@ -1686,21 +1830,23 @@ class FundingRateTrader:
                     })
                     
                     # 調用後處理（Telegram通知等）
-                    self.schedule_post_close_processing(symbol, direction, quantity, order)
+                    self.schedule_post_close_processing(symbol, direction, quantity, order, position=record.as_position())
                     
                 except Exception as e:
-                    execution_time_ms = int((time.time() - close_start_time) * 1000)
-                    print(f"[{self.format_corrected_time()}] ❌ 異步平倉失敗: {symbol} - {e} ({execution_time_ms}ms)")
-                    self.log_trade_step('close', symbol, 'close_failed', {
-                        'error': str(e),
-                        'execution_time_ms': execution_time_ms
-                    })
+                    on_close_failed(e)
+
+            def on_close_failed(e):
+                execution_time_ms = int((time.time() - close_start_time) * 1000)
+                # CLOSE_PENDING → OPEN：持倉仍在，後備平倉/強制平倉可以再次處理
+                self.position_state.close_rejected(record, f"close_failed:{type(e).__name__}")
+                print(f"[{self.format_corrected_time()}] ❌ 異步平倉失敗: {symbol} - {e} ({execution_time_ms}ms)")
+                self.log_trade_step('close', symbol, 'close_failed', {
+                    'error': str(e),
+                    'execution_time_ms': execution_time_ms
+                })
             
-            # 在新線程中發送平倉訂單
-            import threading
-            close_thread = threading.Thread(target=send_close_order_async)
-            close_thread.daemon = True
-            close_thread.start()
+            # 提交到網關事件循環發送平倉訂單
+            self.gateway.submit(send_close_order_async())
             
             # 立即返回，不等待平倉完成
             print(f"[{self.format_corrected_time()}] ⚡ 異步平倉已發送: {symbol} {side} {quantity}")
@@ -1708,6 +1854,7 @@ class FundingRateTrader:
             return True
             
         except Exception as e:
+            self.position_state.close_rejected(record, f"close_failed:{type(e).__name__}")
             print(f"[{self.format_corrected_time()}] ❌平倉失敗: {symbol} - {e}")
             
             # 記錄平倉失敗
@@ -1724,13 +1871,17 @@ class FundingRateTrader:
 
 
     def check_actual_position(self, symbol: str) -> dict:
-        """檢查實際倉位狀況"""
+        """檢查實際倉位狀況 - 用戶數據流正常時直接讀本地持倉簿（零請求權重）"""
         try:
+            if self.user_stream_healthy():
+                return self.position_book.position(symbol)
+
             # 獲取當前持倉信息
             positions = self.execute_api_call_with_timeout(
                 self.client.futures_position_information,
                 timeout=1.0,  # 1秒超時，平衡速度和穩定性
-                max_retries=2  # 重試2次，確保獲取成功
+                max_retries=2,  # 重試2次，確保獲取成功
+                lane=LANE_ACCOUNT
             )
             
             for pos in positions:
@@ -1781,16 +1932,19 @@ class FundingRateTrader:
             # 不要因為API錯誤就認為沒有持倉，返回None讓調用方決定
             return None
 
-    def force_close_position(self):
-        """強制平倉 - 使用市價單強制平倉，包含詳細分析記錄"""
-        if not self.current_position:
+    def force_close_position(self, record=None):
+        """強制平倉 - 使用市價單強制平倉，包含詳細分析記錄；先以實際倉位核對狀態（任何進行中狀態都可強制平倉）
+        record 為空時逐個強制平倉所有進行中的交易（組合模式）"""
+        if record is None:
+            for record in self.position_state.records():
+                self.force_close_position(record)
             return
             
-        symbol = self.current_position['symbol']
-        direction = self.current_position['direction']
-        quantity = self.current_position['quantity']
-        entry_price = self.current_position.get('entry_price', 0.0)
-        funding_rate = self.current_position.get('funding_rate', 0.0)
+        symbol = record.symbol
+        direction = record.direction
+        quantity = record.quantity
+        entry_price = record.entry_price
+        funding_rate = record.funding_rate
         
         try:
             # 記錄強制平倉開始時間和狀況
@@ -1802,8 +1956,8 @@ class FundingRateTrader:
             # 獲取市場狀況
             try:
                 book_ticker = self.book_tickers.get(symbol, {})
-                bid_price = float(book_ticker.get('bidPrice', 0))
-                ask_price = float(book_ticker.get('askPrice', 0))
+                bid_price = float(book_ticker.get('bid_price', 0))
+                ask_price = float(book_ticker.get('ask_price', 0))
                 spread_amount = ask_price - bid_price if bid_price and ask_price else 0
                 spread_percentage = (spread_amount / ask_price * 100) if ask_price > 0 else 0
                 market_liquidity = "優良" if spread_percentage < 0.05 else "正常" if spread_percentage < 0.1 else "較差" if spread_percentage < 0.2 else "很差"
@@ -1845,11 +1999,9 @@ class FundingRateTrader:
                                         check_result='無持倉',
                                         position_check_time_ms=position_check_time_ms,
                                         cleanup_actions=['清空持倉記錄', '重置重試計數器', '解除平倉鎖定'])
-                # 清空持倉記錄
-                self.current_position = None
-                self.position_open_time = None
+                # 持倉已不存在：OPEN/CLOSE_PENDING → CLOSED（進場未確認 → FAILED）
+                self.position_state.mark_closed(record, 'force_close_no_position')
                 self.close_retry_count = 0
-                self.is_closing = False
                 return
             
             # 比較預期vs實際倉位
@@ -1863,9 +2015,11 @@ class FundingRateTrader:
                 'has_discrepancy': direction != actual_position['direction'] or abs(quantity - actual_position['quantity']) >= 0.001
             }
             
-            # 使用實際倉位信息
+            # 使用實際倉位信息：核對後進行中的狀態回到 OPEN，再轉為 CLOSE_PENDING
             direction = actual_position['direction']
             quantity = actual_position['quantity']
+            self.position_state.reconcile(record, actual_position, 'force_close_reconcile')
+            self.position_state.begin_close(record, 'force_close')
             
             print(f"[{self.format_corrected_time()}] 🎯強制平倉確認: {symbol} {direction} {quantity} | 倉位檢查:{position_check_time_ms}ms | 流動性:{market_liquidity}")
             
@@ -1891,15 +2045,21 @@ class FundingRateTrader:
             # 執行強制平倉 - 非阻塞異步發送
             order_start_time = time.time()
             
-            def send_force_close_order_async():
+            async def send_force_close_order_async():
                 try:
                     # 使用帶超時的API調用 - 允許重試以確保強制平倉成功
-                    order = self.execute_api_call_with_timeout(
-                        self.client.futures_create_order,
+                    order = await self.send_order(
+                        order_params,
                         timeout=1.0,  # 1秒超時，平衡速度和穩定性
-                        max_retries=2,  # 允許重試2次，確保強制平倉成功
-                        **order_params
+                        max_retries=2  # 允許重試2次，確保強制平倉成功
                     )
+                except Exception as e:
+                    await self.gateway.run_blocking(on_force_close_failed, e)
+                    return
+                await self.gateway.run_blocking(on_force_close_sent, order)
+
+            def on_force_close_sent(order):
+                try:
                     order_end_time = time.time()
                     execution_time_ms = int((order_end_time - order_start_time) * 1000)
                     total_force_close_time_ms = int((order_end_time - force_close_start_time) * 1000)
@@ -1975,45 +2135,45 @@ class FundingRateTrader:
                     # 📝 記錄超詳細平倉分析
                     self.record_detailed_close_analysis(symbol, order)
                     
-                    # 🚀 安排延後處理（包含Telegram通知）
-                    self.schedule_post_close_processing(symbol, direction, quantity, order)
-                    
-                    # 清空持倉記錄
-                    self.current_position = None
-                    self.position_open_time = None
+                    # CLOSE_PENDING → CLOSED
+                    self.position_state.close_acked(record, order_id, avg_price, reason='force_close_ack')
                     self.close_retry_count = 0
-                    self.is_closing = False
+
+                    # 🚀 安排延後處理（包含Telegram通知）
+                    self.schedule_post_close_processing(symbol, direction, quantity, order, position=record.as_position())
                     
                 except Exception as e:
-                    error_time = time.time()
-                    total_error_time_ms = int((error_time - force_close_start_time) * 1000)
-                    
-                    print(f"[{self.format_corrected_time()}] ❌異步強制平倉失敗: {symbol} - {e} | 耗時:{total_error_time_ms}ms")
-                    
-                    # 詳細記錄強制平倉失敗（包含完整的錯誤分析）
-                    self.write_trade_analysis('force_close_detailed_failed', symbol, 
-                                            error=str(e),
-                                            error_type=type(e).__name__,
-                                            close_method='強制平倉',
-                                            failure_analysis={
-                                                'total_time_before_error_ms': total_error_time_ms,
-                                                'failure_stage': 'API調用' if 'order' in str(e).lower() else 'position_check' if 'position' in str(e).lower() else 'market_data' if 'ticker' in str(e).lower() else '未知',
-                                                'error_severity': 'critical' if 'connection' in str(e).lower() else 'high' if 'force' in str(e).lower() else 'moderate',
-                                                'is_final_attempt': True,
-                                                'retry_exhausted': True
-                                            },
-                                            retry_history={
-                                                'retry_count': self.close_retry_count,
-                                                'max_retry': self.max_close_retry,
-                                                'retry_duration_seconds': int(time.time() - self.close_retry_start_time) if self.close_retry_start_time else 0,
-                                                'final_attempt': True
-                                            })
+                    on_force_close_failed(e)
+
+            def on_force_close_failed(e):
+                error_time = time.time()
+                total_error_time_ms = int((error_time - force_close_start_time) * 1000)
+                # CLOSE_PENDING → OPEN：持倉可能仍在，保留記錄供定期清理/關閉時再次處理
+                self.position_state.close_rejected(record, f"force_close_failed:{type(e).__name__}")
+                
+                print(f"[{self.format_corrected_time()}] ❌異步強制平倉失敗: {symbol} - {e} | 耗時:{total_error_time_ms}ms")
+                
+                # 詳細記錄強制平倉失敗（包含完整的錯誤分析）
+                self.write_trade_analysis('force_close_detailed_failed', symbol, 
+                                        error=str(e),
+                                        error_type=type(e).__name__,
+                                        close_method='強制平倉',
+                                        failure_analysis={
+                                            'total_time_before_error_ms': total_error_time_ms,
+                                            'failure_stage': 'API調用' if 'order' in str(e).lower() else 'position_check' if 'position' in str(e).lower() else 'market_data' if 'ticker' in str(e).lower() else '未知',
+                                            'error_severity': 'critical' if 'connection' in str(e).lower() else 'high' if 'force' in str(e).lower() else 'moderate',
+                                            'is_final_attempt': True,
+                                            'retry_exhausted': True
+                                        },
+                                        retry_history={
+                                            'retry_count': self.close_retry_count,
+                                            'max_retry': self.max_close_retry,
+                                            'retry_duration_seconds': int(time.time() - self.close_retry_start_time) if self.close_retry_start_time else 0,
+                                            'final_attempt': True
+                                        })
             
-            # 在新線程中發送強制平倉訂單
-            import threading
-            force_close_thread = threading.Thread(target=send_force_close_order_async)
-            force_close_thread.daemon = True
-            force_close_thread.start()
+            # 提交到網關事件循環發送強制平倉訂單
+            self.gateway.submit(send_force_close_order_async())
             
             # 立即返回，不等待強制平倉完成
             print(f"[{self.format_corrected_time()}] ⚡ 異步強制平倉已發送: {symbol} {side} {quantity}")
@@ -2071,21 +2231,18 @@ class FundingRateTrader:
             
             # 重置重試計數器，避免無限重試
             self.close_retry_count = 0
-            self.is_closing = False
+            self.position_state.close_rejected(record, f"force_close_failed:{type(e).__name__}")
             
             print(f"[{self.format_corrected_time()}] ⚠️警告: 強制平倉失敗，持倉可能仍然存在，請手動檢查Binance帳戶")
 
     def check_position(self):
-        """檢查持倉狀態 - 定期同步實際倉位狀況"""
+        """檢查持倉狀態 - 定期同步實際倉位狀況
+        只核對 OPEN 的交易；ENTRY_PENDING 等待回應/成交推送，超過 ENTRY_ACK_TIMEOUT 仍無結果時由實際倉位決定 OPEN/FAILED"""
         try:
-            if not self.current_position:
-                return
-            
-            # 檢查是否在倉位檢查延遲期間
-            if hasattr(self, 'position_check_delay_until') and time.time() < self.position_check_delay_until:
-                remaining_delay = self.position_check_delay_until - time.time()
-                if remaining_delay > 0.1:  # 只顯示剩餘延遲大於0.1秒的情況
-                    print(f"[{self.format_corrected_time()}] 倉位檢查延遲中，剩餘 {remaining_delay:.1f} 秒")
+            # 平倉中、進場回應未到的交易不核對（取代開倉後固定延遲0.3秒再檢查）
+            records = [record for record in self.position_state.records()
+                       if record.state == OPEN or (record.state == ENTRY_PENDING and self.position_state.entry_overdue(record))]
+            if not records:
                 return
             
             # 添加持倉檢查頻率控制
@@ -2099,58 +2256,69 @@ class FundingRateTrader:
             
             self._last_position_check_time = current_time
             
-            symbol = self.current_position['symbol']
-            
-            # 檢查實際倉位狀況
-            actual_position = self.check_actual_position(symbol)
-            
-            if not actual_position:
-                # 檢查失敗，可能是API問題，不要立即清理持倉記錄
-                # 增加重試計數器，連續失敗多次才清理
-                if not hasattr(self, '_position_check_fail_count'):
-                    self._position_check_fail_count = 0
-                
-                self._position_check_fail_count += 1
-                
-                if self._position_check_fail_count >= 5:  # 連續失敗5次才清理（從3次改回5次）
-                    print(f"[{self.format_corrected_time()}] 倉位檢查連續失敗{self._position_check_fail_count}次，清理程式記錄")
-                    self.current_position = None
-                    self.position_open_time = None
-                    self.is_closing = False
-                    self._position_check_fail_count = 0
-                else:
-                    print(f"[{self.format_corrected_time()}] 倉位檢查失敗 ({self._position_check_fail_count}/5)，可能是API問題，保留持倉記錄")
-                return
-            
-            # 檢查成功，重置失敗計數器
-            if hasattr(self, '_position_check_fail_count'):
-                self._position_check_fail_count = 0
-            
-            # 檢查倉位信息是否一致
-            expected_direction = self.current_position['direction']
-            expected_quantity = self.current_position['quantity']
-            actual_direction = actual_position['direction']
-            actual_quantity = actual_position['quantity']
-            
-            # 檢查方向是否一致
-            if expected_direction != actual_direction:
-                print(f"[{self.format_corrected_time()}] 倉位同步: {symbol} 方向不一致，預期:{expected_direction}，實際:{actual_direction}")
-                self.current_position['direction'] = actual_direction
-            
-            # 檢查數量是否一致（允許小數點誤差）
-            if abs(expected_quantity - actual_quantity) > 0.001:
-                print(f"[{self.format_corrected_time()}] 倉位同步: {symbol} 數量不一致，預期:{expected_quantity}，實際:{actual_quantity}")
-                self.current_position['quantity'] = actual_quantity
-            
-            # 檢查未實現盈虧
-            unrealized_pnl = actual_position['unrealized_pnl']
-            if abs(unrealized_pnl) > 0.01:  # 只顯示有明顯盈虧的情況
-                print(f"[{self.format_corrected_time()}] 倉位狀態: {symbol} {actual_direction} 數量:{actual_quantity} 未實現盈虧:{unrealized_pnl:.2f} USDT")
+            for record in records:
+                self._check_record_position(record)
             
         except Exception as e:
             print(f"[{self.format_corrected_time()}] 檢查持倉狀態時發生錯誤: {str(e)}")
             print(f"[{self.format_corrected_time()}] 錯誤詳情: {traceback.format_exc()}")
 
+    def _check_record_position(self, record):
+        """以實際倉位核對單筆交易（check_position 對每筆進行中的交易調用）"""
+        symbol = record.symbol
+        
+        # 檢查實際倉位狀況
+        actual_position = self.check_actual_position(symbol)
+        
+        if record.state == ENTRY_PENDING:
+            # 進場結果未知（發送超時等）：有倉 → OPEN，無倉 → FAILED
+            state = self.position_state.reconcile(record, actual_position, 'entry_reconcile')
+            print(f"[{self.format_corrected_time()}] 進場回應逾時，倉位核對: {symbol} → {state}")
+            if state == FAILED:
+                self.restage_entry(symbol)
+            return
+        
+        if not actual_position:
+            # 檢查失敗，可能是API問題，不要立即清理持倉記錄
+            # 增加重試計數器（按交易對），連續失敗多次才清理
+            if not hasattr(self, '_position_check_fail_counts'):
+                self._position_check_fail_counts = {}
+            
+            fail_count = self._position_check_fail_counts.get(symbol, 0) + 1
+            self._position_check_fail_counts[symbol] = fail_count
+            
+            if fail_count >= 5:  # 連續失敗5次才清理（從3次改回5次）
+                print(f"[{self.format_corrected_time()}] {symbol} 倉位檢查連續失敗{fail_count}次，清理程式記錄")
+                self.position_state.mark_closed(record, 'position_missing')
+                self._position_check_fail_counts.pop(symbol, None)
+            else:
+                print(f"[{self.format_corrected_time()}] {symbol} 倉位檢查失敗 ({fail_count}/5)，可能是API問題，保留持倉記錄")
+            return
+        
+        # 檢查成功，重置失敗計數器
+        if hasattr(self, '_position_check_fail_counts'):
+            self._position_check_fail_counts.pop(symbol, None)
+        
+        # 檢查倉位信息是否一致
+        expected_direction = record.direction
+        expected_quantity = record.quantity
+        actual_direction = actual_position['direction']
+        actual_quantity = actual_position['quantity']
+        
+        # 檢查方向是否一致
+        if expected_direction != actual_direction:
+            print(f"[{self.format_corrected_time()}] 倉位同步: {symbol} 方向不一致，預期:{expected_direction}，實際:{actual_direction}")
+        
+        # 檢查數量是否一致（允許小數點誤差）
+        if abs(expected_quantity - actual_quantity) > 0.001:
+            print(f"[{self.format_corrected_time()}] 倉位同步: {symbol} 數量不一致，預期:{expected_quantity}，實際:{actual_quantity}")
+        self.position_state.sync(record, actual_direction, actual_quantity)
+        
+        # 檢查未實現盈虧
+        unrealized_pnl = actual_position['unrealized_pnl']
+        if abs(unrealized_pnl) > 0.01:  # 只顯示有明顯盈虧的情況
+            print(f"[{self.format_corrected_time()}] 倉位狀態: {symbol} {actual_direction} 數量:{actual_quantity} 未實現盈虧:{unrealized_pnl:.2f} USDT")
+
     def check_all_positions_and_cleanup(self):
         """定期清理 - 進倉成功後持續檢查30秒，每秒檢查，若有持倉就清理"""
         if not self.enable_position_cleanup:
@@ -2175,12 +2343,14 @@ class FundingRateTrader:
                 
             self.last_position_cleanup_time = current_time
             
-            # 檢查是否有進倉記錄且仍在清理時間內
-            if not self.current_position or not self.position_open_time:
+            # 檢查是否有已確認的進倉記錄且仍在清理時間內（進場未確認、平倉中時不清理；組合模式以最近進場的交易計時）
+            records = [record for record in self.position_state.records() if record.state == OPEN]
+            if not records:
                 return  # 沒有進倉記錄，不需要清理
+            record = max(records, key=lambda record: record.opened_at)
             
             # 計算進倉後的時間
-            position_age = current_time - self.position_open_time
+            position_age = current_time - record.opened_at
             
             # 如果超過清理時間，停止清理
             if position_age > self.position_timeout_seconds:
@@ -2188,12 +2358,16 @@ class FundingRateTrader:
             
 
             
-            # 獲取所有持倉信息
-            positions = self.execute_api_call_with_timeout(
-                self.client.futures_position_information,
-                timeout=1.0,  # 1秒超時，平衡速度和穩定性
-                max_retries=2  # 重試2次，確保獲取成功
-            )
+            # 獲取所有持倉信息：用戶數據流正常時讀本地持倉簿，否則定期輪詢（下單進行中時讓路）
+            if self.user_stream_healthy():
+                positions = self.position_book.position_rows()
+            else:
+                positions = self.execute_api_call_with_timeout(
+                    self.client.futures_position_information,
+                    timeout=1.0,  # 1秒超時，平衡速度和穩定性
+                    max_retries=2,  # 重試2次，確保獲取成功
+                    lane=LANE_BACKGROUND
+                )
             
             positions_to_cleanup = []
             
@@ -2210,6 +2384,11 @@ class FundingRateTrader:
                     if not self.is_valid_symbol(symbol):
                         continue
                     
+                    # 組合模式下其他交易仍在進場待確認/平倉中時不重複發送
+                    tracked = self.position_state.find(symbol)
+                    if tracked is not None and tracked.state != OPEN:
+                        continue
+                    
                     # 獲取倉位方向
                     direction = 'long' if position_amt > 0 else 'short'
                     quantity = abs(position_amt)
@@ -2224,7 +2403,8 @@ class FundingRateTrader:
                         'direction': direction,
                         'quantity': quantity,
                         'age_seconds': position_age,
-                        'reason': cleanup_reason
+                        'reason': cleanup_reason,
+                        'record': tracked  # 程式記錄的交易（其他交易對的持倉為None）
                     })
                     
                 except Exception as e:
@@ -2235,100 +2415,120 @@ class FundingRateTrader:
             if positions_to_cleanup:
                 print(f"[{self.format_corrected_time()}] 開始清理 {len(positions_to_cleanup)} 個超時倉位...")
                 
-                for pos_info in positions_to_cleanup:
-                    try:
-                        symbol = pos_info['symbol']
-                        direction = pos_info['direction']
-                        quantity = pos_info['quantity']
+                # 同一輪發現的多個倉位合併為批次平倉請求
+                with self.order_batcher.collect(len(positions_to_cleanup)):
+                    for pos_info in positions_to_cleanup:
+                        try:
+                            symbol = pos_info['symbol']
+                            direction = pos_info['direction']
+                            quantity = pos_info['quantity']
                         
-                        # 確定平倉方向（與持倉相反）
-                        side = 'SELL' if direction == 'long' else 'BUY'
+                            # 確定平倉方向（與持倉相反）
+                            side = 'SELL' if direction == 'long' else 'BUY'
                         
-                        print(f"[{self.format_corrected_time()}] 清理倉位: {symbol} {direction} 數量:{quantity}")
+                            print(f"[{self.format_corrected_time()}] 清理倉位: {symbol} {direction} 數量:{quantity}")
                         
-                        # 記錄倉位清理開始
-                        self.write_trade_analysis('cleanup_start', symbol, 
-                                                direction=direction, 
-                                                quantity=quantity,
-                                                age_seconds=pos_info['age_seconds'],
-                                                reason=pos_info['reason'])
+                            # 記錄倉位清理開始
+                            self.write_trade_analysis('cleanup_start', symbol, 
+                                                    direction=direction, 
+                                                    quantity=quantity,
+                                                    age_seconds=pos_info['age_seconds'],
+                                                    reason=pos_info['reason'])
                         
-                        # 非阻塞異步發送清理訂單
-                        order_start_time = time.time()
+                            # 非阻塞異步發送清理訂單
+                            order_start_time = time.time()
                         
-                        def send_cleanup_order_async():
-                            try:
-                                # 使用帶超時的API調用 - 允許重試以確保清理成功
-                                order = self.execute_api_call_with_timeout(
-                                    self.client.futures_create_order,
-                                    timeout=1.0,  # 1秒超時，平衡速度和穩定性
-                                    max_retries=2,  # 允許重試2次，確保清理成功
-                                    symbol=symbol,
-                                    side=side,
-                                    type='MARKET',
-                                    quantity=quantity,
-                                    reduceOnly=True  # 確保只平倉，不開新倉
-                                )
-                                order_end_time = time.time()
-                                execution_time_ms = int((order_end_time - order_start_time) * 1000)
+                            # 以預設參數綁定本輪迴圈變量（協程稍後才在事件循環中執行）
+                            async def send_cleanup_order_async(symbol=symbol, side=side, direction=direction,
+                                                               quantity=quantity, pos_info=pos_info,
+                                                               order_start_time=order_start_time):
+                                try:
+                                    # 使用帶超時的API調用 - 允許重試以確保清理成功
+                                    order = await self.send_order(
+                                        {
+                                            'symbol': symbol,
+                                            'side': side,
+                                            'type': 'MARKET',
+                                            'quantity': quantity,
+                                            'reduceOnly': True  # 確保只平倉，不開新倉
+                                        },
+                                        timeout=1.0,  # 1秒超時，平衡速度和穩定性
+                                        max_retries=2  # 允許重試2次，確保清理成功
+                                    )
+                                except Exception as e:
+                                    await self.gateway.run_blocking(on_cleanup_failed, e, symbol, direction,
+                                                                    quantity, order_start_time)
+                                    return
+                                await self.gateway.run_blocking(on_cleanup_sent, order, symbol, direction,
+                                                                quantity, pos_info, order_start_time)
+
+                            def on_cleanup_sent(order, symbol, direction, quantity, pos_info, order_start_time):
+                                try:
+                                    order_end_time = time.time()
+                                    execution_time_ms = int((order_end_time - order_start_time) * 1000)
                                 
-                                print(f"[{self.format_corrected_time()}] 異步超時倉位清理成功: {symbol} 訂單ID:{order['orderId']} ({execution_time_ms}ms)")
+                                    print(f"[{self.format_corrected_time()}] 異步超時倉位清理成功: {symbol} 訂單ID:{order['orderId']} ({execution_time_ms}ms)")
                                 
-                                # 記錄倉位清理成功  
-                                self.write_trade_analysis('cleanup_success', symbol, 
-                                                        order_id=order['orderId'],
-                                                        execution_time_ms=execution_time_ms,
-                                                        age_seconds=pos_info['age_seconds'],
-                                                        reason=pos_info['reason'])
+                                    # 記錄倉位清理成功  
+                                    self.write_trade_analysis('cleanup_success', symbol, 
+                                                            order_id=order['orderId'],
+                                                            execution_time_ms=execution_time_ms,
+                                                            age_seconds=pos_info['age_seconds'],
+                                                            reason=pos_info['reason'])
                                 
-                                # 記錄清理事件
-                                self.log_trade_event('timeout_cleanup', symbol, {
-                                    'direction': direction,
-                                    'quantity': quantity,
-                                    'age_seconds': pos_info['age_seconds'],
-                                    'order_id': order['orderId'],
-                                    'reason': pos_info['reason']
-                                })
+                                    # 記錄清理事件
+                                    self.log_trade_event('timeout_cleanup', symbol, {
+                                        'direction': direction,
+                                        'quantity': quantity,
+                                        'age_seconds': pos_info['age_seconds'],
+                                        'order_id': order['orderId'],
+                                        'reason': pos_info['reason']
+                                    })
+                                
+                                    # 程式記錄的交易：CLOSE_PENDING → CLOSED
+                                    tracked = pos_info['record']
+                                    if tracked is not None:
+                                        self.position_state.close_acked(tracked, order['orderId'], reason='cleanup_ack')
                                 
-                                # 🚀 安排延後處理（包含Telegram通知）
-                                self.schedule_post_close_processing(symbol, direction, quantity, order)
+                                    # 🚀 安排延後處理（包含Telegram通知）
+                                    self.schedule_post_close_processing(symbol, direction, quantity, order,
+                                                                        position=tracked.as_position() if tracked else None)
                                 
-                            except Exception as e:
+                                except Exception as e:
+                                    on_cleanup_failed(e, symbol, direction, quantity, order_start_time)
+
+                            def on_cleanup_failed(e, symbol, direction, quantity, order_start_time):
                                 execution_time_ms = int((time.time() - order_start_time) * 1000)
+                                tracked = self.position_state.find(symbol)
+                                if tracked is not None:
+                                    self.position_state.close_rejected(tracked, f"cleanup_failed:{type(e).__name__}")
                                 print(f"[{self.format_corrected_time()}] ❌ 異步清理倉位 {symbol} 失敗: {e} ({execution_time_ms}ms)")
-                                
+                            
                                 # 記錄倉位清理失敗
                                 self.write_trade_analysis('cleanup_failed', symbol, 
                                                         error=str(e),
                                                         direction=direction,
                                                         quantity=quantity)
-                                
+                            
                                 self.log_trade_event('timeout_cleanup_failed', symbol, {
                                     'error': str(e),
                                     'direction': direction,
                                     'quantity': quantity
                                 })
                         
-                        # 在新線程中發送清理訂單
-                        import threading
-                        cleanup_thread = threading.Thread(target=send_cleanup_order_async)
-                        cleanup_thread.daemon = True
-                        cleanup_thread.start()
+                            # 程式記錄的交易：OPEN → CLOSE_PENDING，避免主平倉重複發送
+                            if pos_info['record'] is not None:
+                                self.position_state.begin_close(pos_info['record'], 'cleanup')
                         
-                        # 立即返回，不等待清理完成
-                        print(f"[{self.format_corrected_time()}] ⚡ 異步清理倉位已發送: {symbol} {side} {quantity}")
+                            # 提交到網關事件循環發送清理訂單
+                            self.gateway.submit(send_cleanup_order_async())
                         
-                        # 如果清理的是我們程式記錄的倉位，清空記錄
-                        if (self.current_position and 
-                            self.current_position['symbol'] == symbol):
-                            print(f"[{self.format_corrected_time()}] 清空程式倉位記錄: {symbol}")
-                            self.current_position = None
-                            self.position_open_time = None
-                            self.is_closing = False
+                            # 立即返回，不等待清理完成（程式記錄的倉位在清理單回應後轉為 CLOSED）
+                            print(f"[{self.format_corrected_time()}] ⚡ 異步清理倉位已發送: {symbol} {side} {quantity}")
                             
-                    except Exception as e:
-                        print(f"[{self.format_corrected_time()}] 清理倉位 {pos_info.get('symbol', 'unknown')} 時出錯: {e}")
-                        continue
+                        except Exception as e:
+                            print(f"[{self.format_corrected_time()}] 清理倉位 {pos_info.get('symbol', 'unknown')} 時出錯: {e}")
+                            continue
                 
                 print(f"[{self.format_corrected_time()}] 超時倉位清理完成")
             else:
@@ -2338,6 +2538,237 @@ class FundingRateTrader:
             print(f"[{self.format_corrected_time()}] 定期檢查帳戶時發生錯誤: {str(e)}")
             print(f"[{self.format_corrected_time()}] 錯誤詳情: {traceback.format_exc()}")
 
+    def fire_entry(self, best_opportunity: dict, portfolio=None) -> bool:
+        """進場動作 - 由截止時間調度器在進場時間觸發，返回是否已開倉
+        portfolio 為組合模式選出的同一結算時間的機會列表，逐個提交到網關事件循環，合併為批次請求同時在途
+        檢查未通過時遞增重試序號，主循環下一個 tick 以新 key 重新安排（與原輪詢的重試行為一致，本結算時間已進場的交易對視為成功）"""
+        opportunities = [self._refresh_opportunity(opportunity) for opportunity in portfolio or [best_opportunity]]
+        with self.order_batcher.collect(len(opportunities)):
+            results = [self._check_and_enter(opportunity, self.stage_latency.begin('entry', opportunity['symbol']))
+                       for opportunity in opportunities]
+        if not all(results):
+            self._entry_skips = getattr(self, '_entry_skips', 0) + 1
+        return any(results)
+
+    def _refresh_opportunity(self, opportunity: dict) -> dict:
+        """以列存儲中的最新資金費率/點差重新計算機會（只讀記憶體，不發請求），保留組合分配的保證金"""
+        row = self.funding_rates.row_of(opportunity['symbol'])
+        if row is None:
+            return opportunity
+        fresh = self.opportunity_ranker.describe(row)
+        if fresh['next_funding_time'] != opportunity['next_funding_time']:
+            return opportunity
+        if 'margin' in opportunity:
+            fresh['margin'] = opportunity['margin']
+        return fresh
+
+    def select_portfolio(self, best_opportunity: dict) -> list:
+        """組合模式：在最佳機會的結算時間桶內取淨收益前 PORTFOLIO_MAX_POSITIONS 名
+        每個交易對保證金不超過 MAX_POSITION_SIZE，總保證金不超過 PORTFOLIO_TOTAL_MARGIN（按淨收益順序分配，分完即止）"""
+        if self.portfolio_max_positions <= 1:
+            return [best_opportunity]
+        settlement_time = best_opportunity['next_funding_time']
+        candidates = [best_opportunity]
+        # top_k 已按（結算時間, -淨收益）排序，取同一結算時間桶內的其他交易對
+        for row in self.opportunity_ranker.top_k(self.funding_rate_threshold, self.max_spread, self.portfolio_max_positions):
+            if len(candidates) >= self.portfolio_max_positions:
+                break
+            opportunity = self.opportunity_ranker.describe(int(row))
+            if opportunity['next_funding_time'] != settlement_time or opportunity['symbol'] == best_opportunity['symbol']:
+                continue
+            if self._should_update_spread(opportunity['symbol']):
+                # 與 get_best_opportunity 相同：候選點差過期時按需更新後重新讀取（點差變大的候選在進場前檢查被排除）
+                self.update_single_spread(opportunity['symbol'])
+                opportunity = self.opportunity_ranker.describe(int(row))
+            candidates.append(opportunity)
+
+        portfolio = []
+        remaining_margin = self.portfolio_total_margin
+        for opportunity in candidates:
+            margin = min(self.max_position_size, remaining_margin)
+            if margin <= 0:
+                break
+            portfolio.append(dict(opportunity, margin=margin))
+            remaining_margin -= margin
+        return portfolio
+
+    def _check_and_enter(self, best_opportunity: dict, span=None) -> bool:
+        """進場前檢查（進行中的交易、時鐘誤差、淨收益、點差），通過後開倉；span 為本次進場的階段計時
+        組合模式下機會帶有 margin（分配的保證金）"""
+        real_settlement_time = best_opportunity['next_funding_time']
+        time_to_entry = real_settlement_time - self.entry_before_seconds * 1000 - self.get_corrected_time()
+        print(f"\n[{self.format_corrected_time()}] 進場時間到！")
+        self.log_trade_step('entry', best_opportunity['symbol'], 'time_triggered', {
+            'time_to_entry': time_to_entry,
+            'entry_time_tolerance': self.entry_time_tolerance,
+            'scheduler_skew_p50_ms': self.scheduler.histogram.percentile(0.5),
+            'clock_uncertainty_ms': self.clock_model.uncertainty_ms(),
+            'settlement_time': datetime.fromtimestamp(real_settlement_time / 1000).strftime('%H:%M:%S.%f')
+        })
+
+        # 檢查是否有進行中的交易（進場待確認/持倉中/平倉中；上一筆 CLOSED/FAILED 後即可進場）
+        # 組合模式：同一結算時間的其他交易對可以同時進場，上一個結算時間的交易未結束前不進場
+        record = self.position_state.find(best_opportunity['symbol'])
+        if record is not None and record.next_funding_time == real_settlement_time and record.state != CLOSE_PENDING:
+            # 本結算時間已進場（組合中其他交易對未通過檢查而重新觸發時）：視為完成，不遞增重試序號
+            print(f"[{self.format_corrected_time()}] {best_opportunity['symbol']} 本結算時間已進場（{record.state}），跳過")
+            self.log_trade_step('entry', best_opportunity['symbol'], 'skip_already_entered', {'state': record.state})
+            return True
+        if record is None:
+            record = next((r for r in self.position_state.records() if r.next_funding_time != real_settlement_time), None)
+        if record is not None:
+            if record.state == CLOSE_PENDING:
+                print(f"[{self.format_corrected_time()}] 正在平倉，跳過進場")
+                self.log_trade_step('entry', best_opportunity['symbol'], 'skip_closing', {})
+            else:
+                print(f"[{self.format_corrected_time()}] 已有持倉（{record.state}），跳過進場")
+                self.log_trade_step('entry', best_opportunity['symbol'], 'skip_existing_position', safe_json_serialize({
+                    'current_position': record.as_position()
+                }))
+            return False
+
+        # 檢查時鐘誤差：誤差上界不小於進場提前量時，訂單可能在結算後才到達，拿不到資金費
+        clock_uncertainty = self.clock_model.uncertainty_ms()
+        if clock_uncertainty >= self.entry_before_seconds * 1000:
+            print(f"[{self.format_corrected_time()}] 進場取消：時鐘誤差上界 ±{clock_uncertainty:.1f}ms 不小於進場提前量 {self.entry_before_seconds * 1000:.0f}ms")
+            self.log_trade_step('entry', best_opportunity['symbol'], 'skip_clock_uncertainty', {
+                'clock_uncertainty_ms': clock_uncertainty,
+                'entry_before_ms': self.entry_before_seconds * 1000
+            })
+            return False
+
+        print(f"[{self.format_corrected_time()}] 進場時間到（結算前{self.entry_before_seconds}秒）！")
+
+        # 進場前最終檢查：淨收益和點差
+        final_net_profit = best_opportunity.get('net_profit', 0)
+        final_spread = best_opportunity.get('spread', 0)
+        funding_rate = best_opportunity['funding_rate']
+
+        print(f"[{self.format_corrected_time()}] 進場前檢查: {best_opportunity['symbol']} | 資金費率: {funding_rate:.4f}% | 點差: {final_spread:.3f}% | 淨收益: {final_net_profit:.3f}% (閾值:{self.funding_rate_threshold}%) | 方向: {best_opportunity['direction']}")
+
+        if final_net_profit < self.funding_rate_threshold:
+            print(f"[{self.format_corrected_time()}] 進場取消：淨收益{final_net_profit:.3f}%低於閾值{self.funding_rate_threshold}%")
+            self.log_trade_step('entry', best_opportunity['symbol'], 'skip_low_net_profit', {
+                'funding_rate': funding_rate,
+                'spread': final_spread,
+                'net_profit': final_net_profit,
+                'threshold': self.funding_rate_threshold
+            })
+            return False
+
+        if final_spread > self.max_spread:  # 點差超過配置閾值則跳過
+            print(f"[{self.format_corrected_time()}] 進場取消：點差過大{final_spread:.3f}% (>{self.max_spread}%)")
+            self.log_trade_step('entry', best_opportunity['symbol'], 'skip_high_spread', {
+                'spread': final_spread,
+                'max_spread': self.max_spread,
+                'net_profit': final_net_profit
+            })
+            return False
+
+        print(f"[{self.format_corrected_time()}] 檢查通過，開始進場: {best_opportunity['symbol']} | 資金費率: {funding_rate:.4f}% | 點差: {final_spread:.3f}% | 淨收益: {final_net_profit:.3f}% | 方向: {best_opportunity['direction']}")
+        self.log_trade_step('entry', best_opportunity['symbol'], 'start_entry', {
+            'funding_rate': funding_rate,
+            'direction': best_opportunity['direction'],
+            'spread': final_spread,
+            'net_profit': final_net_profit,
+            'entry_before_seconds': self.entry_before_seconds,
+            'settlement_time': datetime.fromtimestamp(real_settlement_time / 1000).strftime('%H:%M:%S.%f')
+        })
+
+        # 開倉（下單通道獨立准入，不等待進行中的背景API調用）
+        # 組合模式不做同步等待重試，避免阻塞同一批次其他交易對的進場
+        self.open_position(best_opportunity['symbol'], best_opportunity['direction'], best_opportunity['funding_rate'], best_opportunity['next_funding_time'], span=span,
+                           margin=best_opportunity.get('margin'), retry=self.portfolio_max_positions <= 1)
+        return True
+
+    def fire_close(self, settlement_time: int) -> bool:
+        """主平倉動作 - 由截止時間調度器在結算後 CLOSE_AFTER_SECONDS 秒觸發
+        組合模式下同一結算時間的所有交易逐個提交平倉單（預簽名平倉單的交易對優先），合併為批次請求同時在途"""
+        records = [record for record in self.position_state.records() if record.next_funding_time == settlement_time]
+        pending = [record for record in records if record.state == ENTRY_PENDING]
+        if pending:
+            # 進場回應/成交推送仍未到：以實際倉位核對後再決定是否平倉（用戶數據流斷開時需REST查詢，交給網關執行緒池）
+            self.gateway.submit(self.gateway.run_blocking(self._reconcile_and_close, settlement_time, pending))
+        records = [record for record in records if record.state == OPEN]
+        if not records:
+            return False
+        return self._close_records(settlement_time, records)
+
+    def _reconcile_and_close(self, settlement_time: int, records: list) -> bool:
+        """核對進場待確認的交易，確認持倉的照常平倉（在網關執行緒池中執行）"""
+        for record in records:
+            self.position_state.reconcile(record, self.check_actual_position(record.symbol), 'close_reconcile')
+        records = [record for record in records if record.state == OPEN]
+        return self._close_records(settlement_time, records) if records else False
+
+    def _close_records(self, settlement_time: int, records: list) -> bool:
+        """逐個提交同一結算時間的平倉單（預簽名平倉單的交易對優先），合併為批次請求同時在途"""
+        staged_symbol = self.staged_orders['symbol'] if self.staged_orders else None
+        records.sort(key=lambda record: record.symbol != staged_symbol)
+        symbols = ', '.join(record.symbol for record in records)
+        settlement_time_str = datetime.fromtimestamp(settlement_time / 1000).strftime('%H:%M:%S.%f')
+        trigger_time_str = self.format_corrected_time('%H:%M:%S.%f')
+        print(f"\n{'='*60}")
+        print(f"[{trigger_time_str}] 🎯 主平倉時間到！")
+        print(f"[{trigger_time_str}] 交易對: {symbols}")
+        print(f"[{trigger_time_str}] 結算時間: {settlement_time_str}")
+        print(f"[{trigger_time_str}] 平倉延遲: {self.close_after_seconds}秒（已在觸發時間計入）")
+        print(f"{'='*60}")
+        with self.order_batcher.collect(len(records)):
+            results = [self.close_position(span=self.stage_latency.begin('close', record.symbol), record=record)
+                       for record in records]
+        success = all(results)
+        if not success:
+            print(f"[{self.format_corrected_time()}] ⚠️ 主平倉失敗，將由後備平倉機制處理")
+        # 本輪進場/平倉的觸發偏差
+        print(self.scheduler.histogram.format())
+        return success
+
+    def dump_stage_latency(self, reason: str):
+        """輸出各階段延遲直方圖並寫入系統日誌（每次結算平倉後、程式關閉時）"""
+        print(f"[{self.format_corrected_time()}] {self.stage_latency.format_summary(self.entry_before_seconds * 1000)}")
+        details = {'reason': reason, 'stages': self.stage_latency.summary()}
+        if self.post_trade.submitted:
+            print(f"[{self.format_corrected_time()}] {self.post_trade.format_status()}")
+            details['post_trade'] = self.post_trade.status()
+        self.log_system_event('stage_latency', details)
+
+    def schedule_close(self):
+        """有進行中的交易時安排主平倉：結算後 CLOSE_AFTER_SECONDS 秒由截止時間調度器觸發（主循環與回放引擎共用）
+        進場待確認時也先安排，觸發時由 fire_close 核對狀態；組合模式同一結算時間只安排一次"""
+        for record in self.position_state.records():
+            settlement_time = record.next_funding_time
+            if record.state != CLOSE_PENDING and settlement_time > 0:
+                close_time_ms = settlement_time + self.close_after_seconds * 1000
+                self.scheduler.schedule(('close', settlement_time), close_time_ms, self.fire_close, settlement_time)
+
+    def schedule_entry(self, best_opportunity: dict, current_time_ms: int):
+        """進場前 prewarm_before_ms 內：預熱連接池、預簽名訂單，並安排在精確的進場時間觸發
+        （每個結算時間只進場一次，機會變化時更新；主循環與回放引擎共用）"""
+        real_settlement_time = best_opportunity['next_funding_time']
+        entry_time_ms = real_settlement_time - self.entry_before_seconds * 1000
+        time_to_entry = entry_time_ms - current_time_ms
+        if real_settlement_time <= current_time_ms or time_to_entry > self.prewarm_before_ms:
+            return
+        if time_to_entry > 0:
+            # 確保下單時TLS連接已建立（非阻塞，在網關事件循環中進行）
+            self.gateway.keep_warm()
+            self.stage_orders(best_opportunity)
+        key = ('entry', real_settlement_time, getattr(self, '_entry_skips', 0))
+        plan = self._entry_plan
+        if plan is not None and plan[0] == key and plan[1][:1] == (best_opportunity['symbol'],):
+            # 組合已選定且最佳機會未變：不重複選組合（可能觸發點差REST更新），也不重複入堆
+            return
+        portfolio = self.select_portfolio(best_opportunity)
+        symbols = tuple(opportunity['symbol'] for opportunity in portfolio)
+        if plan is not None and plan[0] == key and plan[1] == symbols:
+            return
+        self._entry_plan = (key, symbols)
+        if time_to_entry > 0:
+            for symbol in symbols:
+                self.prepare_leverage(symbol)
+        self.scheduler.schedule(key, entry_time_ms, self.fire_entry, best_opportunity, portfolio)
+
     def run(self):
         """運行交易機器人 - WebSocket模式：使用真實結算時間進行交易"""
         print("=== 資金費率套利機器人啟動 ===")
@@ -2345,6 +2776,7 @@ class FundingRateTrader:
         print(f"最大保證金: {MAX_POSITION_SIZE} USDT")
         print(f"槓桿倍數: {LEVERAGE}")
         print(f"目標倉位大小: {MAX_POSITION_SIZE * LEVERAGE} USDT")
+        print(f"組合模式: 每個結算時間最多 {self.portfolio_max_positions} 個交易對，保證金總額 {self.portfolio_total_margin} USDT")
         print(f"最小資金費率: {MIN_FUNDING_RATE}%")
         print(f"最大點差閾值: {MAX_SPREAD}%")
         print(f"進場提前時間: {ENTRY_BEFORE_SECONDS} 秒")
@@ -2392,6 +2824,7 @@ class FundingRateTrader:
         
         # 啟動 WebSocket 連接
         self.start_websocket()
+        self.start_user_stream()
         
         # 主循環 - WebSocket模式
         try:
@@ -2409,7 +2842,7 @@ class FundingRateTrader:
                             'current_position': self.current_position is not None,
                             'funding_rates_count': len(self.funding_rates),
                             'time_offset': self.time_offset,
-                            'websocket_connected': self.ws and self.ws.sock and self.ws.sock.connected
+                            'websocket_connected': bool(self.ws and self.ws.connected)
                         })
                         self._last_status_log_time = time.time()
                     
@@ -2420,18 +2853,7 @@ class FundingRateTrader:
                             print(f"[{self.format_corrected_time()}] 更新資金費率: {updated_count} 個交易對")
                         self._last_funding_update_time = time.time()
                     
-                    # 🔒 併發安全檢查：如果API調用正在進行，跳過非關鍵操作
-                    if self.is_api_calling:
-                        api_duration = time.time() - self.api_call_start_time
-                        if api_duration < self.max_api_call_duration:
-                            # API調用正在進行且未超時，跳過非關鍵操作
-                            time.sleep(0.1)  # 短暫等待
-                            continue
-                        else:
-                            # API調用可能卡住，記錄警告但繼續執行
-                            print(f"[{self.format_corrected_time()}] ⚠️ 檢測到長時間API調用，已運行{api_duration:.1f}秒")
-                    
-                    # 檢查持倉狀態
+                    # 檢查持倉狀態（背景API調用在下單進行中時由准入控制器讓路）
                     self.check_position()
                     
                     # 定期清理 - 進倉成功後持續檢查30秒，每秒檢查，若有持倉就清理
@@ -2439,43 +2861,13 @@ class FundingRateTrader:
                     
                     # 添加調試信息（每10秒顯示一次）
                     if not hasattr(self, '_last_debug_time') or time.time() - self._last_debug_time >= 10:
-                        api_status = "進行中" if self.is_api_calling else "空閒"
-                        print(f"[DEBUG] 主循環狀態: 持倉={self.current_position is not None}, 平倉中={self.is_closing}, API狀態={api_status}, 資金費率數量={len(self.funding_rates)}")
+                        api_status = self.admission.format_status()
+                        print(f"[DEBUG] 主循環狀態: 持倉狀態={self.position_state.state}, API狀態={api_status}, 資金費率數量={len(self.funding_rates)}")
                         self._last_debug_time = time.time()
                     
-                    # 🎯 **簡化平倉檢查：兩種模式**
-                    if self.current_position and not self.is_closing:
-                        # 獲取當前持倉的結算時間
-                        current_position_settlement_time = self.current_position.get('next_funding_time', 0)
-                        if current_position_settlement_time > 0:
-                            # 計算當前時間
-                            current_time_ms = self.get_corrected_time()
-                            symbol = self.current_position['symbol']
-                            
-                            # **模式1：主平倉** - 結算後延遲X秒平倉
-                            close_time_ms = current_position_settlement_time + self.close_after_seconds * 1000
-                            time_to_close = close_time_ms - current_time_ms
-                            
-                            if time_to_close <= 0:
-                                settlement_time_str = datetime.fromtimestamp(current_position_settlement_time / 1000).strftime('%H:%M:%S.%f')
-                                trigger_time_str = self.format_corrected_time('%H:%M:%S.%f')
-                                print(f"\n{'='*60}")
-                                print(f"[{trigger_time_str}] 🎯 主平倉時間到！")
-                                print(f"[{trigger_time_str}] 交易對: {symbol}")
-                                print(f"[{trigger_time_str}] 結算時間: {settlement_time_str}")
-                                print(f"[{trigger_time_str}] 平倉延遲: {self.close_after_seconds}秒")
-                                print(f"[{trigger_time_str}] 開始執行平倉... (將延遲{self.close_after_seconds}秒)")
-                                print(f"{'='*60}")
-                                self.is_closing = True
-                                success = self.close_position(delay_seconds=self.close_after_seconds)
-                                if not success:
-                                    print(f"[{self.format_corrected_time()}] ⚠️ 主平倉失敗，將由後備平倉機制處理")
-                                time.sleep(1)
-                                continue
-                            
-                            # **模式2：後備平倉** - 已關閉，不再每秒檢查
-                            # 如果主平倉失敗，依賴定期清理機制處理
-                            pass
+                    # 🎯 **簡化平倉檢查**：主平倉由截止時間調度器在結算後X秒精確觸發
+                    # 後備平倉已關閉，如果主平倉失敗，依賴定期清理機制處理
+                    self.schedule_close()
                     
                     # 獲取校正後的時間
                     now = datetime.now()
@@ -2483,6 +2875,8 @@ class FundingRateTrader:
                     
                     # 使用WebSocket篩選出的最佳機會
                     best_opportunity = self.get_best_opportunity()
+                    if best_opportunity:
+                        self.next_settlement_time = best_opportunity['next_funding_time']
                     
                     # 🔍 調試信息：檢查是否有最佳機會
                     if not hasattr(self, '_last_debug_opportunity_time') or time.time() - self._last_debug_opportunity_time >= 30.0:
@@ -2515,18 +2909,12 @@ class FundingRateTrader:
                             
                             # 顯示前5個最高資金費率的情況
                             if self.funding_rates:
-                                high_funding_symbols = []
-                                for symbol, data in self.funding_rates.items():
-                                    funding_rate = data['funding_rate']
-                                    abs_funding_rate = abs(funding_rate)
-                                    high_funding_symbols.append((symbol, funding_rate, abs_funding_rate))
-                                
-                                high_funding_symbols.sort(key=lambda x: -x[2])  # 按絕對值排序
+                                high_funding_symbols = self._top_abs_funding_rates(5)  # 按絕對值排序
                                 print(f"[{self.format_corrected_time()}] 🔍 前5個最高資金費率:")
-                                
+
                                 # 收集前5個機會的詳細信息
                                 top_opportunities = []
-                                for i, (symbol, rate, abs_rate) in enumerate(high_funding_symbols[:5]):
+                                for i, (symbol, rate) in enumerate(high_funding_symbols):
                                     try:
                                         net_profit, spread = self.calculate_net_profit(symbol, rate)
                                         print(f"[{self.format_corrected_time()}]   {i+1}. {symbol}: 資金費率{rate:+.4f}% 點差{spread:.3f}% 淨收益{net_profit:+.3f}% (閾值:{self.funding_rate_threshold}%)")
@@ -2576,6 +2964,9 @@ class FundingRateTrader:
                             # 計算平倉時間（結算後 CLOSE_AFTER_SECONDS 秒）
                             close_time_ms = real_settlement_time + self.close_after_seconds * 1000
                             time_to_close = close_time_ms - current_time_ms
+
+                            # 進場前幾秒預熱連接、預簽名訂單，並由截止時間調度器安排精確的進場時間
+                            self.schedule_entry(best_opportunity, current_time_ms)
                             
                             # 顯示倒數計時 - 每秒顯示一次
                             if time_to_entry > 0:
@@ -2625,104 +3016,10 @@ class FundingRateTrader:
                                     
                                     # 格式化顯示，顯示資金費率、點差、淨收益
                                     funding_rate = best_opportunity['funding_rate']
-                                    status_line = f"[{self.format_corrected_time()}] 倒計時: 進場{entry_countdown:>12} | 平倉{close_countdown:>12} | 結算:{settlement_time_str:>8} | 結算倒數{settlement_countdown:>12} | 最佳: {best_opportunity['symbol']:<10} 資金費率:{funding_rate:.4f}% | 點差:{spread:.3f}% | 淨收益:{net_profit:.3f}%{status} {best_opportunity['direction']:<4} | 時間差:{self.time_offset:+5d}ms {self._close_method_display}"
+                                    status_line = f"[{self.format_corrected_time()}] 倒計時: 進場{entry_countdown:>12} | 平倉{close_countdown:>12} | 結算:{settlement_time_str:>8} | 結算倒數{settlement_countdown:>12} | 最佳: {best_opportunity['symbol']:<10} 資金費率:{funding_rate:.4f}% | 點差:{spread:.3f}% | 淨收益:{net_profit:.3f}%{status} {best_opportunity['direction']:<4} | 時間差:{self.time_offset:+5d}±{self.clock_model.uncertainty_ms():.1f}ms {self._close_method_display}"
                                     print(status_line)
                                     self._last_display_sec = entry_secs
-                            
 
-                            
-                            # 檢查是否接近進場時間
-                            if time_to_entry <= self.entry_time_tolerance:  # 使用配置的進場時間容差
-                                print(f"\n[{self.format_corrected_time()}] 進場時間到！")
-                                self.log_trade_step('entry', best_opportunity['symbol'], 'time_triggered', safe_json_serialize({
-                                    'time_to_entry': time_to_entry,
-                                    'entry_time_tolerance': self.entry_time_tolerance,
-                                    'settlement_time': datetime.fromtimestamp(real_settlement_time / 1000).strftime('%H:%M:%S.%f')
-                                }))
-                                
-                                # 檢查是否已有持倉
-                                if self.current_position:
-                                    print(f"[{self.format_corrected_time()}] 已有持倉，跳過進場")
-                                    self.log_trade_step('entry', best_opportunity['symbol'], 'skip_existing_position', safe_json_serialize({
-                                        'current_position': self.current_position
-                                    }))
-                                    time.sleep(self.check_interval)
-                                    continue
-                                
-                                # 檢查是否在平倉狀態
-                                if self.is_closing:
-                                    print(f"[{self.format_corrected_time()}] 正在平倉，跳過進場")
-                                    self.log_trade_step('entry', best_opportunity['symbol'], 'skip_closing', {})
-                                    time.sleep(self.check_interval)
-                                    continue
-                                
-                                # 檢查是否在開倉鎖定期間
-                                if hasattr(self, 'entry_locked_until') and time.time() < self.entry_locked_until:
-                                    remaining_lock = self.entry_locked_until - time.time()
-                                    print(f"[{self.format_corrected_time()}] 開倉鎖定中，剩餘 {remaining_lock:.1f} 秒，跳過進場")
-                                    self.log_trade_step('entry', best_opportunity['symbol'], 'skip_locked', safe_json_serialize({
-                                        'remaining_lock': remaining_lock
-                                    }))
-                                    time.sleep(self.check_interval)
-                                    continue
-                                
-                                print(f"[{self.format_corrected_time()}] 進場時間到（結算前{self.entry_before_seconds}秒）！")
-                                
-                                # 進場前最終檢查：淨收益和點差
-                                final_net_profit = best_opportunity.get('net_profit', 0)
-                                final_spread = best_opportunity.get('spread', 0)
-                                funding_rate = best_opportunity['funding_rate']
-                                
-                                print(f"[{self.format_corrected_time()}] 進場前檢查: {best_opportunity['symbol']} | 資金費率: {funding_rate:.4f}% | 點差: {final_spread:.3f}% | 淨收益: {final_net_profit:.3f}% (閾值:{self.funding_rate_threshold}%) | 方向: {best_opportunity['direction']}")
-                                
-                                if final_net_profit < self.funding_rate_threshold:
-                                    print(f"[{self.format_corrected_time()}] 進場取消：淨收益{final_net_profit:.3f}%低於閾值{self.funding_rate_threshold}%")
-                                    self.log_trade_step('entry', best_opportunity['symbol'], 'skip_low_net_profit', safe_json_serialize({
-                                        'funding_rate': funding_rate,
-                                        'spread': final_spread,
-                                        'net_profit': final_net_profit,
-                                        'threshold': self.funding_rate_threshold
-                                    }))
-                                    time.sleep(self.check_interval)
-                                    continue
-                                
-                                if final_spread > self.max_spread:  # 點差超過配置閾值則跳過
-                                    print(f"[{self.format_corrected_time()}] 進場取消：點差過大{final_spread:.3f}% (>{self.max_spread}%)")
-                                    self.log_trade_step('entry', best_opportunity['symbol'], 'skip_high_spread', safe_json_serialize({
-                                        'spread': final_spread,
-                                        'max_spread': self.max_spread,
-                                        'net_profit': final_net_profit
-                                    }))
-                                    time.sleep(self.check_interval)
-                                    continue
-                                
-                                print(f"[{self.format_corrected_time()}] 檢查通過，開始進場: {best_opportunity['symbol']} | 資金費率: {funding_rate:.4f}% | 點差: {final_spread:.3f}% | 淨收益: {final_net_profit:.3f}% | 方向: {best_opportunity['direction']}")
-                                self.log_trade_step('entry', best_opportunity['symbol'], 'start_entry', safe_json_serialize({
-                                    'funding_rate': funding_rate,
-                                    'direction': best_opportunity['direction'],
-                                    'spread': final_spread,
-                                    'net_profit': final_net_profit,
-                                    'entry_before_seconds': self.entry_before_seconds,
-                                    'settlement_time': datetime.fromtimestamp(real_settlement_time / 1000).strftime('%H:%M:%S.%f')
-                                }))
-                                
-                                # 🔒 進場前併發檢查
-                                if self.is_api_calling:
-                                    print(f"[{self.format_corrected_time()}] 檢測到API調用進行中，延遲進場以避免衝突")
-                                    self.log_trade_step('entry', best_opportunity['symbol'], 'delayed_for_api', {
-                                        'api_call_duration': time.time() - self.api_call_start_time
-                                    })
-                                    time.sleep(0.2)  # 等待API調用完成
-                                    
-                                    # 再次檢查
-                                    if self.is_api_calling:
-                                        print(f"[{self.format_corrected_time()}] API調用仍在進行，取消此次進場")
-                                        self.log_trade_step('entry', best_opportunity['symbol'], 'cancelled_for_api', {})
-                                        time.sleep(self.check_interval)
-                                        continue
-                                
-                                # 開倉
-                                self.open_position(best_opportunity['symbol'], best_opportunity['direction'], best_opportunity['funding_rate'], best_opportunity['next_funding_time'])
                     else:
                         # 沒有篩選出符合條件的交易對，顯示詳細等待信息
                         if not hasattr(self, '_last_no_opportunity_time') or time.time() - self._last_no_opportunity_time >= 10.0:
@@ -2730,22 +3027,20 @@ class FundingRateTrader:
                             total_pairs = len(self.funding_rates) if self.funding_rates else 0
                             if total_pairs > 0:
                                 # 🔍 詳細調試信息
-                                low_rate_count = 0
                                 high_spread_count = 0
                                 spread_error_count = 0
-                                potential_count = 0
-                                
-                                for symbol, data in self.funding_rates.items():
-                                    funding_rate = data['funding_rate']
-                                    abs_funding_rate = abs(funding_rate)
-                                    
-                                    # 檢查是否資金費率太低
-                                    if abs_funding_rate < self.funding_rate_threshold * 0.8:
-                                        low_rate_count += 1
-                                        continue
-                                    
+
+                                # 檢查是否資金費率太低（向量化計數）
+                                funding_rate_col, _, _, tradable = self.funding_rates.columns()
+                                potential_rows = np.flatnonzero(tradable & (np.abs(funding_rate_col) >= self.funding_rate_threshold * 0.8))
+                                potential_count = int(potential_rows.size)
+                                low_rate_count = int(np.count_nonzero(tradable)) - potential_count
+                                symbols = self.funding_rates.symbols
+
+                                for row in potential_rows:
                                     # 資金費率有潛力，檢查點差
-                                    potential_count += 1
+                                    symbol = symbols[row]
+                                    funding_rate = float(funding_rate_col[row])
                                     try:
                                         net_profit, spread = self.calculate_net_profit(symbol, funding_rate)
                                         if spread > self.max_spread:
@@ -2762,15 +3057,8 @@ class FundingRateTrader:
                                 # 如果大部分都是點差問題，顯示前3個最高資金費率的情況
                                 if high_spread_count > potential_count * 0.5:  # 超過一半是點差問題
                                     print(f"[{self.format_corrected_time()}] 🔍 主要問題：點差過大，檢查前3個最高資金費率:")
-                                    high_funding_symbols = []
-                                    for symbol, data in self.funding_rates.items():
-                                        funding_rate = data['funding_rate']
-                                        abs_funding_rate = abs(funding_rate)
-                                        if abs_funding_rate >= self.funding_rate_threshold * 0.8:
-                                            high_funding_symbols.append((symbol, funding_rate, abs_funding_rate))
-                                    
-                                    high_funding_symbols.sort(key=lambda x: -x[2])  # 按絕對值排序
-                                    for i, (symbol, rate, abs_rate) in enumerate(high_funding_symbols[:3]):
+                                    high_funding_symbols = self._top_abs_funding_rates(3, rows=potential_rows)  # 按絕對值排序
+                                    for i, (symbol, rate) in enumerate(high_funding_symbols):
                                         try:
                                             net_profit, spread = self.calculate_net_profit(symbol, rate)
                                             print(f"[{self.format_corrected_time()}]   {i+1}. {symbol}: 資金費率{rate:+.3f}% 點差{spread:.3f}% 淨收益{net_profit:+.3f}%")
@@ -2787,7 +3075,7 @@ class FundingRateTrader:
                 except Exception as e:
                     print(f"[ERROR] 主循環錯誤: {e}")
                     print(f"[ERROR] 錯誤詳情: {traceback.format_exc()}")
-                    print(f"[ERROR] 當前狀態: 持倉={self.current_position is not None}, 平倉中={self.is_closing}")
+                    print(f"[ERROR] 當前狀態: 持倉狀態={self.position_state.state}")
                     time.sleep(5)
         except Exception as e:
             print(f"[ERROR] 主循環發生嚴重錯誤: {e}")
@@ -2798,8 +3086,8 @@ class FundingRateTrader:
         """析構函數 - 程式關閉時清理"""
         try:
             # 刷新所有緩存的記錄
-            if hasattr(self, '_analysis_buffer'):
-                self._flush_analysis_buffer()
+            if hasattr(self, 'trade_journal'):
+                self.trade_journal.flush()
                 
             if hasattr(self, 'current_position') and self.current_position:
                 print(f"[{self.format_corrected_time()}] 程式關閉，發現持倉，嘗試清理...")
@@ -2849,7 +3137,7 @@ class FundingRateTrader:
                 backoff_time = 20  # 長期重連
             
             print(f"[{self.format_corrected_time()}] 等待 {backoff_time} 秒後重連...")
-            time.sleep(backoff_time)
+            time.sleep(backoff_time * self.reconnect_delay_scale)
             
             # 重新啟動 WebSocket
             self.start_websocket()
@@ -2862,7 +3150,7 @@ class FundingRateTrader:
             # 如果重連失敗，增加等待時間
             backoff_time = min(15 + self.ws_reconnect_count * 3, 120)
             print(f"[{self.format_corrected_time()}] 等待 {backoff_time} 秒後重新嘗試...")
-            time.sleep(backoff_time)
+            time.sleep(backoff_time * self.reconnect_delay_scale)
             self.reconnect()
         finally:
             self.is_reconnecting = False
@@ -2922,6 +3210,7 @@ class FundingRateTrader:
             except Exception as notify_e:
                 print(f"[{self.format_corrected_time()}] Exception 處理器發送停止通知失敗: {notify_e}")
         finally:
+            self.dump_stage_latency('shutdown')
             # 確保程式關閉時清理
             if self.current_position:
                 print(f"[{self.format_corrected_time()}] 程式異常退出，嘗試清理持倉...")
@@ -2936,15 +3225,31 @@ class FundingRateTrader:
                 except Exception as e:
                     print(f"[{self.format_corrected_time()}] 發送關閉通知失敗: {e}")
             print(f"[{self.format_corrected_time()}] 程式已關閉")
+            if self.user_stream is not None:
+                self.user_stream.stop()
+            # 等待已平倉交易的盈虧、記錄和通知完成（尚未到期的帳戶對帳放棄）
+            self.post_trade.stop()
+            self.log_writer.stop()
+            self.trade_journal.close()
+            self.stop_gateway()
+
+    def stop_gateway(self):
+        """取消仍在進行的槓桿預載/設置，再停止調度器與網關事件循環"""
+        for future in (self._preload_future, *self._leverage_futures.values()):
+            if future is not None and not future.done():
+                future.cancel()
+        self.scheduler.stop()
+        self.gateway.stop()
 
     def get_quantity_precision(self, symbol: str) -> int:
-        """獲取交易對的數量精度 - 已簡化，保留兼容性"""
-        return 0
+        """獲取交易對的數量精度（市價單步長的小數位數），沒有過濾器記錄時為0"""
+        symbol_filter = self.symbol_filters.get(symbol)
+        return symbol_filter.quantity_precision if symbol_filter else 0
 
     def format_quantity(self, symbol: str, quantity: float) -> float:
-        """格式化數量到正確的精度 - 極簡化版本，避免過度精確"""
-        # 對於所有交易對，直接取整數，避免精度問題
-        return int(quantity)
+        """格式化數量到正確的精度 - 按 stepSize 向下取整，沒有過濾器記錄時取整數"""
+        symbol_filter = self.symbol_filters.get(symbol)
+        return symbol_filter.round_quantity(quantity) if symbol_filter else int(quantity)
 
     def initialize_trading(self):
         """初始化交易環境"""
@@ -2961,6 +3266,11 @@ class FundingRateTrader:
                 print(f"[{self.format_corrected_time()}] 警告: 可用餘額不足，無法開倉")
                 return False
             
+            # 組合模式：保證金總額不超過可用餘額（至少可開一個 MAX_POSITION_SIZE 的倉位）
+            if self.portfolio_max_positions > 1 and self.portfolio_total_margin > available_balance:
+                print(f"[{self.format_corrected_time()}] 警告: 組合保證金總額 {self.portfolio_total_margin:.2f} USDT 超過可用餘額，調整為 {available_balance:.2f} USDT")
+                self.portfolio_total_margin = available_balance
+            
             # 啟動時檢查是否有遺留持倉
             print(f"[{self.format_corrected_time()}] 檢查是否有遺留持倉...")
             positions = self.client.futures_position_information()
@@ -2979,6 +3289,16 @@ class FundingRateTrader:
                     })
                     print(f"[{self.format_corrected_time()}] 發現遺留持倉: {symbol} {direction} 數量:{quantity}")
             
+            # 從持倉狀態日誌恢復的交易：與實際持倉核對，仍有持倉時恢復為 OPEN，由主平倉在結算後處理（已過時立即觸發）
+            for record in self.position_state.records():
+                actual = next((pos for pos in legacy_positions if pos['symbol'] == record.symbol), None)
+                if actual is None:
+                    self.position_state.mark_closed(record, 'recovered_no_position')
+                else:
+                    self.position_state.reconcile(record, actual, 'recovered')
+                    legacy_positions.remove(actual)
+                print(f"[{self.format_corrected_time()}] 恢復的交易 {record.symbol} 核對後狀態: {record.state}")
+            
             if legacy_positions:
                 print(f"[{self.format_corrected_time()}] 發現 {len(legacy_positions)} 個遺留持倉")
                 print(f"[{self.format_corrected_time()}] 建議手動檢查或等待定期清理機制處理")
@@ -3031,43 +3351,41 @@ class FundingRateTrader:
             return False
 
     def sync_server_time(self):
-        """同步 Binance 服務器時間 - 考慮網路延遲的精確同步"""
+        """同步 Binance 服務器時間 - 連續採樣一組 serverTime，以低延遲樣本擬合偏移與漂移"""
         try:
-            # 記錄請求前的本地時間
-            local_time_before = int(time.time() * 1000)
-            
-            # 獲取服務器時間
-            server_time = self.client.get_server_time()
-            
-            # 記錄請求後的本地時間
-            local_time_after = int(time.time() * 1000)
-            
-            # 計算網路延遲
-            network_delay = local_time_after - local_time_before
-            
-            # 估算請求中點的本地時間（補償網路延遲的一半）
-            adjusted_local_time = local_time_before + (network_delay / 2)
+            def fetch_server_time():
+                # 經網關連接池請求，與下單共用熱連接
+                response = self.gateway.run(self.gateway.request('GET', '/fapi/v1/time', timeout=1.0), timeout=2.0)
+                return response['serverTime']
+
+            collected = self.clock_model.sample_burst(fetch_server_time)
+            if collected == 0:
+                raise Exception("所有時間採樣均失敗")
+            summary = self.clock_model.fit()
             
             old_offset = self.time_offset
-            self.time_offset = int(server_time['serverTime'] - adjusted_local_time)
-            self.last_sync_time = local_time_after
+            self.time_offset = int(round(summary['offset_ms']))
+            self.last_sync_time = int(time.time() * 1000)
             
-            print(f"[{self.format_corrected_time()}] 時間同步: 本地時間差 {self.time_offset}ms (變化: {self.time_offset - old_offset}ms) 網路延遲: {network_delay}ms")
+            print(f"[{self.format_corrected_time()}] 時間同步: 本地時間差 {self.time_offset}ms (變化: {self.time_offset - old_offset}ms) "
+                  f"誤差上界 ±{summary['uncertainty_ms']:.1f}ms 漂移 {summary['drift_ppm']:+.1f}ppm 最低網路延遲: {summary['min_rtt_ms']:.1f}ms "
+                  f"({collected}個新樣本，擬合使用{summary['used']}/{summary['samples']}個)")
             
             # 記錄時間同步事件
             self.log_system_event('time_sync', {
-                'server_time': server_time['serverTime'],
-                'local_time_before': local_time_before,
-                'local_time_after': local_time_after,
-                'network_delay': network_delay,
-                'adjusted_local_time': adjusted_local_time,
+                'samples_collected': collected,
+                'samples_used': summary['used'],
+                'min_rtt_ms': summary['min_rtt_ms'],
+                'residual_std_ms': summary['residual_std_ms'],
+                'drift_ppm': summary['drift_ppm'],
+                'uncertainty_ms': summary['uncertainty_ms'],
                 'time_offset': self.time_offset,
                 'offset_change': self.time_offset - old_offset
             })
             
             # 如果網路延遲過大，給出警告
-            if network_delay > 100:  # 超過100ms
-                print(f"[{self.format_corrected_time()}] ⚠️ 網路延遲較大 ({network_delay}ms)，可能影響交易精度")
+            if summary['min_rtt_ms'] > 100:  # 超過100ms
+                print(f"[{self.format_corrected_time()}] ⚠️ 網路延遲較大 ({summary['min_rtt_ms']:.1f}ms)，可能影響交易精度")
             
             return True
         except Exception as e:
@@ -3077,7 +3395,13 @@ class FundingRateTrader:
 
     def get_corrected_time(self):
         """獲取校正後的時間（毫秒）"""
-        return int(time.time() * 1000) + self.time_offset
+        return int(self.get_corrected_time_precise())
+
+    def get_corrected_time_precise(self) -> float:
+        """獲取校正後的時間（毫秒，保留小數）- 時鐘模型擬合後使用模型（含漂移），否則用固定偏移"""
+        if self.clock_model.ready:
+            return self.clock_model.server_ms()
+        return time.time() * 1000 + self.time_offset
 
     def get_corrected_datetime(self):
         """獲取校正後的datetime對象"""
@@ -3091,83 +3415,58 @@ class FundingRateTrader:
 
     def should_sync_time(self):
         """檢查是否需要同步時間"""
-        current_time = int(time.time() * 1000)
-        return current_time - self.last_sync_time > self.sync_interval * 1000
+        # 距離結算越近同步越頻繁，進場前最後幾秒不採樣
+        ms_to_settlement = self.next_settlement_time - self.get_corrected_time() if self.next_settlement_time else None
+        return self.clock_model.should_sync(ms_to_settlement)
 
     def log_trade_event(self, event_type: str, symbol: str, details: dict):
-        """記錄交易事件"""
-        timestamp = self.format_corrected_time('%Y-%m-%d %H:%M:%S.%f')
-        log_entry = {
-            'timestamp': timestamp,
-            'event_type': event_type,
-            'symbol': symbol,
-            'details': safe_json_serialize(details)
-        }
-        self.logger.info(f"TRADE: {json.dumps(log_entry, ensure_ascii=False)}")
+        """記錄交易事件（只入佇列，由日誌線程格式化寫出；details 交出後不得再修改）"""
+        self.log_writer.submit(('TRADE', self.get_corrected_time_precise(), event_type, symbol, details))
 
     def log_system_event(self, event_type: str, details: dict):
-        """記錄系統事件"""
-        timestamp = self.format_corrected_time('%Y-%m-%d %H:%M:%S.%f')
-        log_entry = {
-            'timestamp': timestamp,
-            'event_type': event_type,
-            'details': safe_json_serialize(details)
-        }
-        self.logger.info(f"SYSTEM: {json.dumps(log_entry, ensure_ascii=False)}")
+        """記錄系統事件（只入佇列，由日誌線程格式化寫出；details 交出後不得再修改）"""
+        self.log_writer.submit(('SYSTEM', self.get_corrected_time_precise(), event_type, details))
 
     def log_trade_step(self, step: str, symbol: str, action: str, details: dict = None):
-        """記錄交易步驟 - 包含所有print內容"""
-        timestamp = self.format_corrected_time('%Y-%m-%d %H:%M:%S.%f')
-        log_entry = {
-            'timestamp': timestamp,
-            'step': step,
-            'symbol': symbol,
-            'action': action,
-            'details': safe_json_serialize(details or {})
-        }
-        self.logger.info(f"STEP: {json.dumps(log_entry, ensure_ascii=False)}")
+        """記錄交易步驟 - 包含所有print內容（只入佇列，由日誌線程格式化寫出；details 交出後不得再修改）"""
+        self.log_writer.submit(('STEP', self.get_corrected_time_precise(), step, symbol, action, details))
+
+    def _format_log_entry(self, entry: tuple) -> str:
+        """日誌線程調用：把佇列條目轉為 TRADE:/SYSTEM:/STEP: JSON 行，時間為入佇列時的校正時間"""
+        kind, corrected_ms = entry[0], entry[1]
+        timestamp = datetime.fromtimestamp(int(corrected_ms) / 1000).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+        if kind == 'STEP':
+            _, _, step, symbol, action, details = entry
+            log_entry = {
+                'timestamp': timestamp,
+                'step': step,
+                'symbol': symbol,
+                'action': action,
+                'details': safe_json_serialize(details or {})
+            }
+        elif kind == 'TRADE':
+            _, _, event_type, symbol, details = entry
+            log_entry = {
+                'timestamp': timestamp,
+                'event_type': event_type,
+                'symbol': symbol,
+                'details': safe_json_serialize(details)
+            }
+        else:
+            _, _, event_type, details = entry
+            log_entry = {
+                'timestamp': timestamp,
+                'event_type': event_type,
+                'details': safe_json_serialize(details)
+            }
+        return f"{kind}: {json.dumps(log_entry, ensure_ascii=False)}"
 
     def log_debug_analysis(self, analysis_type: str, details: dict):
-        """記錄調試分析信息到trade_analysis文件"""
+        """記錄調試分析信息到交易事件日誌（調試分析是重要信息，立即落盤）"""
         try:
-            import os
-            os.makedirs('logs', exist_ok=True)
-            
-            timestamp = self.format_corrected_time('%Y-%m-%d %H:%M:%S.%f')
-            display_time = timestamp[:23]
-            
-            # 根據分析類型生成內容
-            if analysis_type == 'opportunity_analysis':
-                content = f"\n{'='*60}\n"
-                content += f"🔍 機會分析報告 - {display_time}\n"
-                content += f"總交易對數量: {details.get('total_pairs', 'N/A')}\n"
-                content += f"資金費率閾值: {details.get('threshold', 'N/A')}%\n"
-                content += f"最大點差閾值: {details.get('max_spread', 'N/A')}%\n"
-                content += f"找到機會: {'是' if details.get('found_opportunity') else '否'}\n"
-                content += f"{'='*60}\n"
-                
-                # 添加前5個最高資金費率的詳細信息
-                if 'top_opportunities' in details:
-                    for i, opp in enumerate(details['top_opportunities']):
-                        content += f"[{display_time}] {i+1}. {opp['symbol']}: 資金費率{opp['funding_rate']:+.4f}% 點差{opp['spread']:.3f}% 淨收益{opp['net_profit']:+.3f}% (閾值:{details.get('threshold', 'N/A')}%)\n"
-                
-                content += f"{'='*60}\n\n"
-            
-            # 直接寫入兩個文件（調試分析是重要信息，立即寫入）
-            # 寫入按日期命名的文件
-            analysis_file = f"logs/trade_analysis_{datetime.now().strftime('%Y%m%d')}.txt"
-            with open(analysis_file, 'a', encoding='utf-8') as f:
-                f.write(content)
-                f.flush()
-            
-            # 同時寫入原本的 trade_analysis.txt 文件
-            legacy_file = "logs/trade_analysis.txt"
-            with open(legacy_file, 'a', encoding='utf-8') as f:
-                f.write(content)
-                f.flush()
-                
+            self.trade_journal.append(analysis_type, '', self.get_corrected_time_precise(), details, flush=True)
         except Exception as e:
-            print(f"[{self.format_corrected_time()}] 寫入調試分析文件失敗: {e}")
+            print(f"[{self.format_corrected_time()}] 寫入調試分析記錄失敗: {e}")
 
     def record_entry_step(self, step: str, symbol: str, **kwargs):
         """記錄進場步驟"""
@@ -3202,803 +3501,13 @@ class FundingRateTrader:
         self.write_trade_analysis(step, symbol, **clean_kwargs)
 
     def write_trade_analysis(self, step: str, symbol: str, **kwargs):
-        """寫入交易分析記事本 - 易讀格式，包含進場、平倉、指令發送接收等"""
-        try:
-            # 確保logs目錄存在
-            import os
-            os.makedirs('logs', exist_ok=True)
-            
-            timestamp = self.format_corrected_time('%Y-%m-%d %H:%M:%S.%f')
-            # 顯示時間時包含毫秒 (取前23個字符：2025-06-29 22:00:00.123)
-            display_time = timestamp[:23]
-            
-            # 效率優化: 批量記錄緩存
-            if not hasattr(self, '_analysis_buffer'):
-                self._analysis_buffer = []
-                self._buffer_start_time = time.time()
-            
-            # 檢查是否為關鍵步驟（需要立即寫入）
-            critical_steps = [
-                'entry_success', 'entry_failed', 'entry_complete',
-                'close_position', 'close_position_detail',
-                'fast_close_success', 'fast_close_failed',
-                'ultra_fast_close_success', 'ultra_fast_close_failed',
-                'force_close_success', 'force_close_failed',
-                'minimal_close_complete', 'minimal_close_failed',
-                # 新增超高速平倉步驟
-                'ultra_speed_close_start', 'ultra_speed_close_success', 
-                'ultra_speed_close_failed', 'ultra_speed_close_error',
-                'ultra_speed_close_complete',
-                # 即時平倉步驟
-                'instant_close_success', 'instant_close_failed',
-                # 新增的詳細記錄步驟
-                'close_with_full_context', 'close_market_analysis',
-                'close_network_analysis', 'close_balance_analysis'
-            ]
-            
-            is_critical = step in critical_steps
-            is_buffer_timeout = (time.time() - self._buffer_start_time) > 2.0  # 2秒超時
-            is_buffer_full = len(self._analysis_buffer) >= 20  # 緩存滿20條
-            
-            # 根據不同步驟記錄不同內容
-            # ========== 進場相關步驟 ==========
-            if step == 'entry_start':
-                content = f"\n{'='*60}\n"
-                content += f"🚀 開始進場: {symbol}\n"
-                content += f"時間: {timestamp}\n"
-                content += f"方向: {kwargs.get('direction', 'N/A')}\n"
-                content += f"資金費率: {kwargs.get('funding_rate', 'N/A')}%\n"
-                content += f"結算時間: {kwargs.get('settlement_time', 'N/A')}\n"
-                content += f"{'='*60}\n"
-                
-            elif step == 'leverage_set':
-                content = f"[{display_time}] ⚙️ 槓桿設置完成: {kwargs.get('leverage', 'N/A')}倍\n"
-                
-            elif step == 'entry_price_fetched':
-                content = f"[{display_time}] 📊 價格獲取完成: {kwargs.get('price', 'N/A')}\n"
-                
-            elif step == 'entry_quantity_calculated':
-                content = f"[{display_time}] 📏 數量計算完成: {kwargs.get('quantity', 'N/A')}\n"
-                
-            elif step == 'entry_order_sent':
-                content = f"[{display_time}] 📤 進場訂單發送: ID:{kwargs.get('order_id', 'N/A')} 耗時:{kwargs.get('order_time_ms', 'N/A')}ms\n"
-                
-            elif step == 'entry_success':
-                content = f"[{display_time}] ✅ 進場成功: 成交量:{kwargs.get('executed_qty', 'N/A')} 均價:{kwargs.get('avg_price', 'N/A')}\n"
-                content += f"[{display_time}] 🎯 預期盈利: {kwargs.get('expected_profit', 'N/A')} USDT\n"
-                
-            elif step == 'entry_failed':
-                content = f"[{display_time}] ❌ 進場失敗: {kwargs.get('error', 'N/A')}\n"
-                
-            elif step == 'entry_complete':
-                content = f"[{display_time}] 🏁 進場完成\n"
-                content += f"{'='*60}\n\n"
-                
-            # ========== 平倉相關步驟 ==========
-            elif step == 'close_start':
-                content = f"\n{'='*60}\n"
-                content += f"開始平倉: {symbol}\n"
-                content += f"時間: {timestamp}\n"
-                content += f"方向: {kwargs.get('direction', 'N/A')}\n"
-                content += f"數量: {kwargs.get('quantity', 'N/A')}\n"
-                content += f"{'='*60}\n"
-                
-            elif step == 'close_price_fetched':
-                content = f"[{display_time}] 價格獲取完成: {kwargs.get('price', 'N/A')}\n"
-                
-            elif step == 'close_order_sent':
-                content = f"[{display_time}] 訂單發送完成: ID:{kwargs.get('order_id', 'N/A')} 耗時:{kwargs.get('order_time_ms', 'N/A')}ms\n"
-                
-            elif step == 'close_success':
-                content = f"[{display_time}] ✅ 平倉訂單成功: 成交量:{kwargs.get('executed_qty', 'N/A')} 均價:{kwargs.get('avg_price', 'N/A')}\n"
-                
-            elif step == 'close_failed':
-                content = f"[{display_time}] ❌ 平倉失敗: {kwargs.get('error', 'N/A')}\n"
-                
-            elif step == 'close_position':
-                content = f"[{display_time}] ✅ 平倉完成\n"
-                content += f"[{display_time}] 📊 交易總結:\n"
-                content += f"[{display_time}]    ├─ 方向: {kwargs.get('direction', 'N/A').upper()}\n"
-                content += f"[{display_time}]    ├─ 數量: {kwargs.get('quantity', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 進場價: {kwargs.get('entry_price', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 平倉價: {kwargs.get('exit_price', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 盈虧: {kwargs.get('pnl', 'N/A')} USDT\n"
-                content += f"[{display_time}]    ├─ 資金費率: {kwargs.get('funding_rate', 'N/A')}%\n"
-                content += f"[{display_time}]    ├─ 持倉時間: {kwargs.get('position_duration_seconds', 'N/A')} 秒\n"
-                content += f"[{display_time}]    ├─ 執行時間: {kwargs.get('execution_time_ms', 'N/A')} ms\n"
-                content += f"[{display_time}]    ├─ 重試次數: {kwargs.get('retry_count', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 訂單ID: {kwargs.get('order_id', 'N/A')}\n"
-                content += f"{'='*60}\n\n"
-                
-            # 極速平倉相關步驟
-            elif step == 'fast_close_delay':
-                content = f"[{display_time}] ⏰ 平倉延遲: {kwargs.get('delay_seconds', 'N/A')}秒 ({kwargs.get('delay_reason', 'N/A')})\n"
-                
-            elif step == 'fast_close_start':
-                content = f"\n{'='*60}\n"
-                content += f"🚀 開始極速平倉: {symbol}\n"
-                content += f"時間: {timestamp}\n"
-                content += f"方向: {kwargs.get('direction', 'N/A')}\n"
-                content += f"數量: {kwargs.get('quantity', 'N/A')}\n"
-                content += f"{'='*60}\n"
-                
-            elif step == 'fast_close_success':
-                content = f"[{display_time}] ✅ 極速平倉成功: ID:{kwargs.get('order_id', 'N/A')} 耗時:{kwargs.get('execution_time_ms', 'N/A')}ms\n"
-                content += f"[{display_time}] 成交量:{kwargs.get('executed_qty', 'N/A')} 均價:{kwargs.get('avg_price', 'N/A')}\n"
-                # 如果有詳細信息，則顯示
-                if kwargs.get('direction'):
-                    content += f"[{display_time}] 📊 交易總結:\n"
-                    content += f"[{display_time}]    ├─ 方向: {kwargs.get('direction', 'N/A').upper()}\n"
-                    content += f"[{display_time}]    ├─ 數量: {kwargs.get('quantity', 'N/A')}\n"
-                    content += f"[{display_time}]    ├─ 進場價: {kwargs.get('entry_price', 'N/A')}\n"
-                    content += f"[{display_time}]    ├─ 平倉價: {kwargs.get('exit_price', 'N/A')}\n"
-                    content += f"[{display_time}]    ├─ 盈虧: {kwargs.get('pnl', 'N/A')} USDT\n"
-                    content += f"[{display_time}]    ├─ 資金費率: {kwargs.get('funding_rate', 'N/A')}%\n"
-                    content += f"[{display_time}]    └─ 持倉時間: {kwargs.get('position_duration_seconds', 'N/A')} 秒\n"
-                content += f"{'='*60}\n\n"
-                
-            elif step == 'fast_close_failed':
-                content = f"[{display_time}] ❌ 極速平倉失敗: {kwargs.get('error', 'N/A')}\n"
-                content += f"{'='*60}\n\n"
-                
-            # 超級極速平倉相關步驟
-            elif step == 'ultra_fast_close_success':
-                content = f"[{display_time}] ⚡ 超級極速平倉成功: ID:{kwargs.get('order_id', 'N/A')} 耗時:{kwargs.get('execution_time_ms', 'N/A')}ms\n"
-                content += f"[{display_time}] 📊 方向:{kwargs.get('direction', 'N/A').upper()} 數量:{kwargs.get('quantity', 'N/A')}\n"
-                content += f"[{display_time}] 🚀 方法:{kwargs.get('close_method', 'N/A')}\n"
-                content += f"{'='*60}\n\n"
-                
-            elif step == 'ultra_fast_close_failed':
-                content = f"[{display_time}] ❌ 超級極速平倉失敗: {kwargs.get('error', 'N/A')}\n"
-                content += f"[{display_time}] 🔄 回退方案: {kwargs.get('fallback', 'N/A')}\n"
-                content += f"{'='*60}\n\n"
-                
-            # 即時平倉相關步驟  
-            elif step == 'instant_close_success':
-                content = f"[{display_time}] ⚡ 即時平倉成功: {symbol} | {kwargs.get('execution_time_ms', 'N/A')}ms | ID:{kwargs.get('order_id', 'N/A')}\n"
-                content += f"[{display_time}] 🚀 方法: {kwargs.get('method', '即時平倉')}\n"
-                content += f"{'='*60}\n\n"
-                
-            elif step == 'instant_close_failed':
-                content = f"[{display_time}] ❌ 即時平倉失敗: {kwargs.get('error', 'N/A')}\n"
-                content += f"[{display_time}] 🔄 回退方案: 強制平倉\n"
-                content += f"{'='*60}\n\n"
-
-            # 超高速平倉相關步驟
-            elif step == 'ultra_speed_close_start':
-                content = f"\n{'='*70}\n"
-                content += f"⚡ 超高速平倉啟動: {symbol}\n"
-                content += f"時間: {timestamp}\n"
-                content += f"優化等級: {kwargs.get('optimization_level', 'N/A')}\n"
-                content += f"方向: {kwargs.get('direction', 'N/A')}\n"
-                content += f"數量: {kwargs.get('quantity', 'N/A')}\n"
-                content += f"進場價: {kwargs.get('entry_price', 'N/A')}\n"
-                content += f"資金費率: {kwargs.get('funding_rate', 'N/A')}%\n"
-                content += f"{'='*70}\n"
-                
-            elif step == 'ultra_speed_order_prepare':
-                content = f"[{display_time}] 📤 訂單準備: {kwargs.get('side', 'N/A')} {kwargs.get('quantity', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 類型: {kwargs.get('order_type', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 僅減倉: {kwargs.get('reduce_only', 'N/A')}\n"
-                
-            elif step == 'ultra_speed_order_executed':
-                content = f"[{display_time}] ⚡ 訂單執行: ID:{kwargs.get('order_id', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 狀態: {kwargs.get('status', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 成交量: {kwargs.get('executed_qty', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 成交價: {kwargs.get('avg_price', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 訂單耗時: {kwargs.get('order_time_ms', 'N/A')}ms\n"
-                content += f"[{display_time}]    └─ 總耗時: {kwargs.get('total_time_ms', 'N/A')}ms\n"
-                
-            elif step == 'ultra_speed_close_success':
-                content = f"[{display_time}] ✅ 超高速平倉成功: 耗時:{kwargs.get('execution_time_ms', 'N/A')}ms\n"
-                content += f"[{display_time}] 📊 交易結果:\n"
-                content += f"[{display_time}]    ├─ 進場價: {kwargs.get('entry_price', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 平倉價: {kwargs.get('exit_price', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 盈虧: {kwargs.get('pnl', 'N/A')} USDT\n"
-                content += f"[{display_time}]    ├─ 盈虧%: {kwargs.get('pnl_percentage', 'N/A')}%\n"
-                content += f"[{display_time}]    └─ 效率: {kwargs.get('close_efficiency', 'N/A')}\n"
-                
-            elif step == 'ultra_speed_close_failed':
-                content = f"[{display_time}] ⚠️ 超高速平倉失敗: {kwargs.get('error_reason', 'N/A')}\n"
-                content += f"[{display_time}] 📊 失敗詳情:\n"
-                content += f"[{display_time}]    ├─ 訂單狀態: {kwargs.get('order_status', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 成交量: {kwargs.get('executed_qty', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 執行時間: {kwargs.get('execution_time_ms', 'N/A')}ms\n"
-                content += f"[{display_time}]    └─ 可能原因: {kwargs.get('possible_causes', 'N/A')}\n"
-                
-            elif step == 'ultra_speed_close_error':
-                content = f"[{display_time}] ❌ 超高速平倉異常: {kwargs.get('error', 'N/A')}\n"
-                content += f"[{display_time}] 🔧 錯誤詳情:\n"
-                content += f"[{display_time}]    ├─ 錯誤類型: {kwargs.get('error_type', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 執行時間: {kwargs.get('execution_time_ms', 'N/A')}ms\n"
-                content += f"[{display_time}]    └─ 恢復動作: {kwargs.get('recovery_action', 'N/A')}\n"
-                
-            elif step == 'ultra_speed_close_complete':
-                content = f"[{display_time}] 🏁 超高速平倉完成: 成功:{kwargs.get('success', 'N/A')}\n"
-                content += f"[{display_time}] 📊 最終狀態:\n"
-                content += f"[{display_time}]    ├─ 清理完成: {kwargs.get('cleanup_completed', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 總執行時間: {kwargs.get('total_execution_time_ms', 'N/A')}ms\n"
-                content += f"{'='*70}\n\n"
-                
-            # 平倉完成詳細記錄（延後處理）
-            elif step == 'close_position_detail':
-                content = f"[{display_time}] 📋 平倉詳細總結 ({kwargs.get('processing_type', '延後處理')})\n"
-                content += f"[{display_time}] 📊 完整交易數據:\n"
-                content += f"[{display_time}]    ├─ 交易對: {symbol}\n"
-                content += f"[{display_time}]    ├─ 方向: {kwargs.get('direction', 'N/A').upper()}\n"
-                content += f"[{display_time}]    ├─ 數量: {kwargs.get('quantity', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 進場價: {kwargs.get('entry_price', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 平倉價: {kwargs.get('exit_price', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 盈虧: {kwargs.get('pnl', 'N/A')} USDT\n"
-                content += f"[{display_time}]    ├─ 資金費率: {kwargs.get('funding_rate', 'N/A')}%\n"
-                content += f"[{display_time}]    ├─ 持倉時間: {kwargs.get('position_duration_seconds', 'N/A')} 秒\n"
-                content += f"[{display_time}]    ├─ 訂單ID: {kwargs.get('order_id', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 成交量: {kwargs.get('executed_qty', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 成交均價: {kwargs.get('avg_price', 'N/A')}\n"
-                content += f"[{display_time}] ✅ 所有記錄和統計已完成\n"
-                content += f"{'='*60}\n\n"
-                
-            # ========== 新增超詳細記錄類型 ==========
-            elif step == 'close_with_full_context':
-                content = f"\n{'='*90}\n"
-                content += f"🎯 超詳細平倉記錄: {symbol}\n"
-                content += f"時間: {timestamp}\n"
-                content += f"{'='*90}\n"
-                
-                # 1. 訂單執行詳情
-                order_details = kwargs.get('order_details', {})
-                content += f"📋 訂單執行詳情:\n"
-                content += f"   ├─ 訂單ID: {order_details.get('order_id', 'N/A')}\n"
-                content += f"   ├─ 訂單狀態: {order_details.get('status', 'N/A')}\n"
-                content += f"   ├─ 訂單類型: {order_details.get('type', 'N/A')}\n"
-                content += f"   ├─ 訂單方向: {order_details.get('side', 'N/A')}\n"
-                content += f"   ├─ 委託數量: {order_details.get('orig_qty', 'N/A')}\n"
-                content += f"   ├─ 成交數量: {order_details.get('executed_qty', 'N/A')}\n"
-                content += f"   ├─ 成交均價: {order_details.get('avg_price', 'N/A')}\n"
-                content += f"   ├─ 成交金額: {order_details.get('cumulative_quote_qty', 'N/A')}\n"
-                content += f"   ├─ 手續費: {order_details.get('commission', 'N/A')}\n"
-                content += f"   ├─ 手續費資產: {order_details.get('commission_asset', 'N/A')}\n"
-                content += f"   ├─ 創建時間: {order_details.get('time', 'N/A')}\n"
-                content += f"   └─ 更新時間: {order_details.get('update_time', 'N/A')}\n"
-                
-                # 2. 網絡與API質量
-                network_quality = kwargs.get('network_quality', {})
-                content += f"🌐 網絡與API質量:\n"
-                content += f"   ├─ API響應時間: {network_quality.get('api_response_ms', 'N/A')}ms\n"
-                content += f"   ├─ 連接狀態: {network_quality.get('connection_status', 'N/A')}\n"
-                content += f"   └─ 請求質量評分: {network_quality.get('request_quality_score', 'N/A')}\n"
-                
-                # 3. 賬戶餘額變化
-                balance_changes = kwargs.get('balance_changes', {})
-                content += f"💰 賬戶餘額變化:\n"
-                content += f"   ├─ 平倉前餘額: {balance_changes.get('balance_before', 'N/A')} USDT\n"
-                content += f"   ├─ 平倉後餘額: {balance_changes.get('balance_after', 'N/A')} USDT\n"
-                content += f"   ├─ 餘額變化: {balance_changes.get('balance_change', 'N/A')} USDT\n"
-                content += f"   ├─ 可用餘額: {balance_changes.get('available_balance', 'N/A')} USDT\n"
-                content += f"   ├─ 佔用保證金: {balance_changes.get('used_margin', 'N/A')} USDT\n"
-                content += f"   ├─ 未實現盈虧: {balance_changes.get('unrealized_pnl', 'N/A')} USDT\n"
-                content += f"   └─ 錢包餘額: {balance_changes.get('wallet_balance', 'N/A')} USDT\n"
-                
-                # 4. 市場深度與流動性
-                market_depth = kwargs.get('market_depth', {})
-                content += f"📊 市場深度與流動性:\n"
-                content += f"   ├─ 最佳買價: {market_depth.get('best_bid', 'N/A')}\n"
-                content += f"   ├─ 最佳賣價: {market_depth.get('best_ask', 'N/A')}\n"
-                content += f"   ├─ 買價量: {market_depth.get('bid_qty', 'N/A')}\n"
-                content += f"   ├─ 賣價量: {market_depth.get('ask_qty', 'N/A')}\n"
-                content += f"   ├─ 點差: {market_depth.get('spread', 'N/A')}\n"
-                content += f"   ├─ 點差百分比: {market_depth.get('spread_percentage', 'N/A')}%\n"
-                content += f"   └─ 流動性評分: {market_depth.get('liquidity_score', 'N/A')}\n"
-                
-                # 5. 系統性能指標
-                system_metrics = kwargs.get('system_metrics', {})
-                content += f"⚡ 系統性能指標:\n"
-                content += f"   ├─ CPU使用率: {system_metrics.get('cpu_usage', 'N/A')}%\n"
-                content += f"   ├─ 記憶體使用: {system_metrics.get('memory_usage', 'N/A')}%\n"
-                content += f"   ├─ 線程數: {system_metrics.get('thread_count', 'N/A')}\n"
-                content += f"   ├─ 處理時間: {system_metrics.get('processing_time_ms', 'N/A')}ms\n"
-                content += f"   └─ 系統負載: {system_metrics.get('system_load', 'N/A')}\n"
-                
-                content += f"{'='*90}\n\n"
-                
-            # ========== 市場數據分析記錄 ==========
-            elif step == 'close_market_analysis':
-                content = f"\n{'='*80}\n"
-                content += f"📊 平倉市場分析: {symbol}\n"
-                content += f"時間: {timestamp}\n"
-                content += f"{'='*80}\n"
-                
-                # 24小時統計
-                daily_stats = kwargs.get('daily_stats', {})
-                content += f"📈 24小時統計:\n"
-                content += f"   ├─ 開盤價: {daily_stats.get('open_price', 'N/A')}\n"
-                content += f"   ├─ 最高價: {daily_stats.get('high_price', 'N/A')}\n"
-                content += f"   ├─ 最低價: {daily_stats.get('low_price', 'N/A')}\n"
-                content += f"   ├─ 收盤價: {daily_stats.get('close_price', 'N/A')}\n"
-                content += f"   ├─ 成交量: {daily_stats.get('volume', 'N/A')}\n"
-                content += f"   ├─ 成交額: {daily_stats.get('quote_volume', 'N/A')}\n"
-                content += f"   ├─ 漲跌幅: {daily_stats.get('price_change_percent', 'N/A')}%\n"
-                content += f"   └─ 波動率: {daily_stats.get('volatility', 'N/A')}%\n"
-                
-                content += f"{'='*80}\n\n"
-                
-            # ========== 極簡平倉相關步驟 ==========
-            elif step == 'minimal_close_start':
-                content = f"\n{'='*60}\n"
-                content += f"⚡ 開始極簡平倉: {symbol}\n"
-                content += f"時間: {timestamp}\n"
-                content += f"策略: {kwargs.get('strategy', 'N/A')}\n"
-                content += f"優化等級: {kwargs.get('optimization_level', 'N/A')}\n"
-                content += f"方向: {kwargs.get('direction', 'N/A')}\n"
-                content += f"數量: {kwargs.get('quantity', 'N/A')}\n"
-                content += f"進場價: {kwargs.get('entry_price', 'N/A')}\n"
-                content += f"資金費率: {kwargs.get('funding_rate', 'N/A')}%\n"
-                content += f"{'='*60}\n"
-                
-            elif step == 'minimal_close_prepare':
-                content = f"[{display_time}] 📤 {kwargs.get('action', '準備訂單')}\n"
-                content += f"[{display_time}]    ├─ 訂單方向: {kwargs.get('side', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 訂單類型: {kwargs.get('order_type', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 僅減倉: {kwargs.get('reduce_only', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 優化: {kwargs.get('no_checks', 'N/A')}\n"
-                
-            elif step == 'minimal_close_order_success':
-                content = f"[{display_time}] ✅ 極簡訂單成功: ID:{kwargs.get('order_id', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 執行時間: {kwargs.get('execution_time_ms', 'N/A')}ms\n"
-                content += f"[{display_time}]    ├─ 成交量: {kwargs.get('executed_qty', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 成交價: {kwargs.get('avg_price', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 狀態: {kwargs.get('order_status', 'N/A')}\n"
-                
-            elif step == 'minimal_close_complete':
-                content = f"[{display_time}] 🎯 極簡平倉完成\n"
-                content += f"[{display_time}] 📊 最終交易總結:\n"
-                content += f"[{display_time}]    ├─ 交易對: {symbol}\n"
-                content += f"[{display_time}]    ├─ 方向: {kwargs.get('direction', 'N/A').upper()}\n"
-                content += f"[{display_time}]    ├─ 數量: {kwargs.get('quantity', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 進場價: {kwargs.get('entry_price', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 平倉價: {kwargs.get('exit_price', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 盈虧: {kwargs.get('pnl', 'N/A')} USDT\n"
-                content += f"[{display_time}]    ├─ 資金費率: {kwargs.get('funding_rate', 'N/A')}%\n"
-                content += f"[{display_time}]    ├─ 持倉時間: {kwargs.get('position_duration_seconds', 'N/A')} 秒\n"
-                content += f"[{display_time}]    ├─ 執行時間: {kwargs.get('execution_time_ms', 'N/A')} ms\n"
-                content += f"[{display_time}]    ├─ 重試次數: {kwargs.get('retry_count', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 檢查次數: {kwargs.get('total_checks', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 處理類型: {kwargs.get('processing_type', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 訂單ID: {kwargs.get('order_id', 'N/A')}\n"
-                content += f"[{display_time}] ⚡ 極簡平倉策略執行完成\n"
-                content += f"{'='*60}\n\n"
-                
-            elif step == 'minimal_close_failed':
-                content = f"[{display_time}] ❌ 極簡平倉失敗: {kwargs.get('error', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 方向: {kwargs.get('direction', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 數量: {kwargs.get('quantity', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 重試: {kwargs.get('retry_attempt', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 清理: {kwargs.get('cleanup_action', 'N/A')}\n"
-                content += f"{'='*60}\n\n"
-                
-            # ========== 平倉方式選擇 ==========
-            elif step == 'close_decision_start':
-                content = f"\n{'='*60}\n"
-                content += f"🤔 平倉方式選擇開始: {symbol}\n"
-                content += f"時間: {timestamp}\n"
-                content += f"CLOSE_BEFORE_SECONDS: {kwargs.get('close_before_seconds', 'N/A')}\n"
-                content += f"{'='*60}\n"
-                
-            elif step == 'close_decision_made':
-                content = f"[{display_time}] ✅ 選擇平倉方式: {kwargs.get('chosen_method', 'N/A')}\n"
-                content += f"[{display_time}] 📋 選擇原因: {kwargs.get('reason', 'N/A')}\n"
-                content += f"[{display_time}] 🔧 處理邏輯: {kwargs.get('logic', 'N/A')}\n"
-                
-            # ========== 極速平倉詳細步驟 ==========
-            elif step.startswith('fast_close_step_'):
-                step_name = step.replace('fast_close_step_', '')
-                content = f"[{display_time}] 步驟{kwargs.get('step_number', '?')}: {kwargs.get('action', step_name)}\n"
-                
-                if step_name == 'side_determined':
-                    content += f"[{display_time}]    └─ {kwargs.get('logic', 'N/A')}\n"
-                elif step_name == 'prepare_api':
-                    content += f"[{display_time}]    ├─ API方法: {kwargs.get('api_method', 'N/A')}\n"
-                    content += f"[{display_time}]    └─ 參數: {kwargs.get('parameters', 'N/A')}\n"
-                elif step_name == 'api_call_start':
-                    content += f"[{display_time}]    └─ 端點: {kwargs.get('api_endpoint', 'N/A')}\n"
-                elif step_name == 'api_response':
-                    content += f"[{display_time}]    ├─ 執行時間: {kwargs.get('execution_time_ms', 'N/A')}ms\n"
-                    content += f"[{display_time}]    └─ 回傳成功\n"
-                elif step_name == 'extract_info':
-                    content += f"[{display_time}]    ├─ 訂單ID: {kwargs.get('order_id', 'N/A')}\n"
-                    content += f"[{display_time}]    ├─ 成交量: {kwargs.get('executed_qty', 'N/A')}\n"
-                    content += f"[{display_time}]    └─ 均價: {kwargs.get('avg_price', 'N/A')}\n"
-                elif step_name == 'clear_position':
-                    content += f"[{display_time}]    └─ 清空: {kwargs.get('cleared_fields', 'N/A')}\n"
-                elif step_name == 'schedule_post_process':
-                    content += f"[{display_time}]    ├─ 延遲: {kwargs.get('delay_seconds', 'N/A')}秒\n"
-                    content += f"[{display_time}]    └─ 任務: {kwargs.get('post_process_tasks', 'N/A')}\n"
-                    
-            # ========== 完整平倉詳細步驟 ==========
-            elif step.startswith('complete_close_step_'):
-                step_name = step.replace('complete_close_step_', '')
-                content = f"[{display_time}] 步驟{kwargs.get('step_number', '?')}: {kwargs.get('action', step_name)}\n"
-                
-                if step_name == 'retry_check':
-                    content += f"[{display_time}]    ├─ 重試次數: {kwargs.get('retry_count', 'N/A')}\n"
-                    content += f"[{display_time}]    └─ 原因: {kwargs.get('reason', 'N/A')}\n"
-                elif step_name == 'api_position_check':
-                    content += f"[{display_time}]    └─ API方法: {kwargs.get('api_method', 'N/A')}\n"
-                elif step_name == 'no_position':
-                    content += f"[{display_time}]    ├─ 結果: {kwargs.get('result', 'N/A')}\n"
-                    content += f"[{display_time}]    └─ 清理: {kwargs.get('cleanup_actions', 'N/A')}\n"
-                elif step_name == 'position_validation':
-                    content += f"[{display_time}]    ├─ 預期方向/實際: {kwargs.get('expected_direction', 'N/A')}/{kwargs.get('actual_direction', 'N/A')}\n"
-                    content += f"[{display_time}]    └─ 預期數量/實際: {kwargs.get('expected_quantity', 'N/A')}/{kwargs.get('actual_quantity', 'N/A')}\n"
-                elif step_name in ['direction_fix', 'quantity_fix']:
-                    content += f"[{display_time}]    ├─ 預期: {kwargs.get('expected', 'N/A')}\n"
-                    content += f"[{display_time}]    ├─ 實際: {kwargs.get('actual', 'N/A')}\n"
-                    content += f"[{display_time}]    └─ 處理: {kwargs.get('action_taken', 'N/A')}\n"
-                elif step_name == 'first_attempt':
-                    content += f"[{display_time}]    ├─ 方向: {kwargs.get('direction', 'N/A')}\n"
-                    content += f"[{display_time}]    ├─ 數量: {kwargs.get('quantity', 'N/A')}\n"
-                    content += f"[{display_time}]    └─ 原因: {kwargs.get('reason', 'N/A')}\n"
-                elif step_name == 'start_process':
-                    content += f"[{display_time}]    ├─ 確認方向: {kwargs.get('validated_direction', 'N/A')}\n"
-                    content += f"[{display_time}]    └─ 確認數量: {kwargs.get('validated_quantity', 'N/A')}\n"
-                elif step_name == 'fetch_price_start':
-                    content += f"[{display_time}]    ├─ API方法: {kwargs.get('api_method', 'N/A')}\n"
-                    content += f"[{display_time}]    └─ 原因: {kwargs.get('reason', 'N/A')}\n"
-                elif step_name == 'fetch_price_success':
-                    content += f"[{display_time}]    ├─ 價格: {kwargs.get('current_price', 'N/A')}\n"
-                    content += f"[{display_time}]    └─ 耗時: {kwargs.get('fetch_time_ms', 'N/A')}ms\n"
-                elif step_name == 'determine_side':
-                    content += f"[{display_time}]    └─ {kwargs.get('logic', 'N/A')}\n"
-                elif step_name == 'prepare_order':
-                    content += f"[{display_time}]    ├─ 參數: {kwargs.get('order_params', 'N/A')}\n"
-                    content += f"[{display_time}]    └─ 參考價格: {kwargs.get('current_price', 'N/A')}\n"
-                elif step_name == 'send_order_start':
-                    content += f"[{display_time}]    ├─ API方法: {kwargs.get('api_method', 'N/A')}\n"
-                    content += f"[{display_time}]    └─ 參數: {kwargs.get('order_params', 'N/A')}\n"
-                elif step_name == 'order_response':
-                    content += f"[{display_time}]    ├─ 執行時間: {kwargs.get('execution_time_ms', 'N/A')}ms\n"
-                    content += f"[{display_time}]    ├─ 訂單ID: {kwargs.get('order_id', 'N/A')}\n"
-                    content += f"[{display_time}]    ├─ 成交量: {kwargs.get('executed_qty', 'N/A')}\n"
-                    content += f"[{display_time}]    └─ 均價: {kwargs.get('avg_price', 'N/A')}\n"
-                    
-            # ========== 完整平倉開始 ==========
-            elif step == 'complete_close_start':
-                content = f"\n{'='*60}\n"
-                content += f"🔧 開始完整平倉: {symbol}\n"
-                content += f"時間: {timestamp}\n"
-                content += f"方向: {kwargs.get('direction', 'N/A')}\n"
-                content += f"數量: {kwargs.get('quantity', 'N/A')}\n"
-                content += f"重試次數: {kwargs.get('retry_count', 'N/A')}\n"
-                content += f"包含功能: {kwargs.get('includes_features', 'N/A')}\n"
-                content += f"{'='*60}\n"
-                
-            # 強制平倉相關步驟
-            elif step == 'force_close_start':
-                content = f"\n{'='*60}\n"
-                content += f"⚡ 開始強制平倉: {symbol}\n"
-                content += f"時間: {timestamp}\n"
-                content += f"方向: {kwargs.get('direction', 'N/A')}\n"
-                content += f"數量: {kwargs.get('quantity', 'N/A')}\n"
-                content += f"{'='*60}\n"
-                
-            elif step == 'force_close_success':
-                content = f"[{display_time}] ✅ 強制平倉成功: ID:{kwargs.get('order_id', 'N/A')} 耗時:{kwargs.get('execution_time_ms', 'N/A')}ms\n"
-                content += f"[{display_time}] 重試次數:{kwargs.get('retry_count', 'N/A')} 實際進場價:{kwargs.get('actual_entry_price', 'N/A')} 未實現盈虧:{kwargs.get('unrealized_pnl', 'N/A')}\n"
-                content += f"{'='*60}\n\n"
-                
-            elif step == 'force_close_failed':
-                content = f"[{display_time}] ❌ 強制平倉失敗: {kwargs.get('error', 'N/A')} (重試次數:{kwargs.get('retry_count', 'N/A')})\n"
-                content += f"{'='*60}\n\n"
-                
-            elif step == 'force_close_no_position':
-                content = f"[{display_time}] ℹ️ 強制平倉檢查: 已無持倉，無需平倉\n"
-                content += f"{'='*60}\n\n"
-                
-            # 倉位清理相關步驟  
-            elif step == 'cleanup_start':
-                content = f"\n{'='*60}\n"
-                content += f"🧹 開始清理超時倉位: {symbol}\n"
-                content += f"時間: {timestamp}\n"
-                content += f"方向: {kwargs.get('direction', 'N/A')}\n"
-                content += f"數量: {kwargs.get('quantity', 'N/A')}\n"
-                content += f"持倉時間: {kwargs.get('age_seconds', 'N/A')} 秒\n"
-                content += f"清理原因: {kwargs.get('reason', 'N/A')}\n"
-                content += f"{'='*60}\n"
-                
-            elif step == 'cleanup_success':
-                content = f"[{display_time}] ✅ 倉位清理成功: ID:{kwargs.get('order_id', 'N/A')} 耗時:{kwargs.get('execution_time_ms', 'N/A')}ms\n"
-                content += f"[{display_time}] 持倉時間:{kwargs.get('age_seconds', 'N/A')}秒 原因:{kwargs.get('reason', 'N/A')}\n"
-                content += f"{'='*60}\n\n"
-                
-            elif step == 'cleanup_failed':
-                content = f"[{display_time}] ❌ 倉位清理失敗: {kwargs.get('error', 'N/A')}\n"
-                content += f"[{display_time}] 方向:{kwargs.get('direction', 'N/A')} 數量:{kwargs.get('quantity', 'N/A')}\n"
-                content += f"{'='*60}\n\n"
-                
-            # ========== 新增詳細記錄類型 ==========
-            # 超級極速平倉詳細記錄
-            elif step == 'ultra_fast_close_detailed_start':
-                content = f"\n{'='*80}\n"
-                content += f"⚡ 超級極速平倉啟動: {symbol}\n"
-                content += f"時間: {timestamp}\n"
-                content += f"最佳化等級: {kwargs.get('optimization_level', 'N/A')}\n"
-                
-                # 交易基本信息
-                trade_info = kwargs.get('trade_basic_info', {})
-                content += f"📊 交易信息:\n"
-                content += f"   ├─ 方向: {trade_info.get('direction', 'N/A')}\n"
-                content += f"   ├─ 數量: {trade_info.get('quantity', 'N/A')}\n"
-                content += f"   ├─ 進場價: {trade_info.get('entry_price', 'N/A')}\n"
-                content += f"   └─ 資金費率: {trade_info.get('funding_rate', 'N/A')}%\n"
-                
-                # 市場快照
-                market_info = kwargs.get('market_snapshot', {})
-                content += f"📈 市場狀況:\n"
-                content += f"   ├─ 買價: {market_info.get('bid_price', 'N/A')}\n"
-                content += f"   ├─ 賣價: {market_info.get('ask_price', 'N/A')}\n"
-                content += f"   ├─ 中間價: {market_info.get('mid_price', 'N/A')}\n"
-                content += f"   ├─ 點差: {market_info.get('spread_percentage', 'N/A')}\n"
-                content += f"   └─ 流動性: {market_info.get('liquidity_rating', 'N/A')}\n"
-                
-                # 系統狀態
-                system_info = kwargs.get('system_status', {})
-                content += f"🔧 系統狀態:\n"
-                content += f"   ├─ 校正時間: {system_info.get('corrected_time_ms', 'N/A')}ms\n"
-                content += f"   ├─ 時間偏移: {system_info.get('time_offset_ms', 'N/A')}ms\n"
-                content += f"   ├─ 重試次數: {system_info.get('retry_count', 'N/A')}\n"
-                content += f"   └─ 首次嘗試: {system_info.get('is_first_attempt', 'N/A')}\n"
-                
-                content += f"{'='*80}\n"
-                
-            elif step == 'ultra_fast_close_detailed_success':
-                content = f"[{display_time}] ✅ 超級極速平倉成功: ID:{kwargs.get('order_id', 'N/A')}\n"
-                
-                # 執行結果
-                exec_result = kwargs.get('execution_result', {})
-                content += f"[{display_time}] 📊 執行結果:\n"
-                content += f"[{display_time}]    ├─ 訂單狀態: {exec_result.get('order_status', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 成交量: {exec_result.get('executed_qty', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 成交價: {exec_result.get('avg_price', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 執行方向: {exec_result.get('side_executed', 'N/A')}\n"
-                
-                # 效能指標
-                performance = kwargs.get('performance_metrics', {})
-                content += f"[{display_time}] ⚡ 效能指標:\n"
-                content += f"[{display_time}]    ├─ API響應: {performance.get('api_response_time_ms', 'N/A')}ms\n"
-                content += f"[{display_time}]    ├─ 總處理時間: {performance.get('total_process_time_ms', 'N/A')}ms\n"
-                content += f"[{display_time}]    ├─ 準備時間: {performance.get('api_prepare_time_ms', 'N/A')}ms\n"
-                content += f"[{display_time}]    ├─ 效率評分: {performance.get('efficiency_score', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 速度評級: {performance.get('speed_rating', 'N/A')}\n"
-                
-                # 價格執行分析
-                price_analysis = kwargs.get('price_execution_analysis', {})
-                if price_analysis:
-                    content += f"[{display_time}] 💰 價格分析:\n"
-                    content += f"[{display_time}]    ├─ 滑點: {price_analysis.get('slippage_percentage', 'N/A')}\n"
-                    content += f"[{display_time}]    ├─ 相對中間價: {price_analysis.get('vs_mid_price', 'N/A')}\n"
-                    content += f"[{display_time}]    └─ 執行品質: {price_analysis.get('execution_quality', 'N/A')}\n"
-                
-                # 市場條件影響
-                market_impact = kwargs.get('market_condition_impact', {})
-                content += f"[{display_time}] 📊 市場影響:\n"
-                content += f"[{display_time}]    ├─ 流動性: {market_impact.get('market_liquidity', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 執行時點差: {market_impact.get('spread_at_execution', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 最佳執行窗口: {market_impact.get('optimal_execution_window', 'N/A')}\n"
-                
-                content += f"{'='*80}\n\n"
-                
-            elif step == 'ultra_fast_close_detailed_failed':
-                content = f"[{display_time}] ❌ 超級極速平倉失敗: {kwargs.get('error', 'N/A')}\n"
-                content += f"[{display_time}] 錯誤類型: {kwargs.get('error_type', 'N/A')}\n"
-                
-                # 失敗分析
-                failure_analysis = kwargs.get('failure_analysis', {})
-                content += f"[{display_time}] 🔍 失敗分析:\n"
-                content += f"[{display_time}]    ├─ 失敗前耗時: {failure_analysis.get('total_time_before_error_ms', 'N/A')}ms\n"
-                content += f"[{display_time}]    ├─ 失敗階段: {failure_analysis.get('failure_stage', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 嚴重程度: {failure_analysis.get('error_severity', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 建議重試: {failure_analysis.get('retry_recommended', 'N/A')}\n"
-                
-                # 失敗時上下文
-                context = kwargs.get('context_at_failure', {})
-                content += f"[{display_time}] 📋 失敗上下文:\n"
-                content += f"[{display_time}]    ├─ 方向: {context.get('direction', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 數量: {context.get('quantity', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 重試次數: {context.get('retry_count', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 市場流動性: {context.get('market_liquidity', 'N/A')}\n"
-                
-                content += f"[{display_time}] 🔄 回退方案: {kwargs.get('fallback_action', 'N/A')}\n"
-                content += f"[{display_time}] ➡️ 下個方法: {kwargs.get('next_method', 'N/A')}\n"
-                content += f"{'='*80}\n\n"
-                
-            # 強制平倉詳細記錄
-            elif step == 'force_close_detailed_start':
-                content = f"\n{'='*80}\n"
-                content += f"🚨 強制平倉開始: {symbol}\n"
-                content += f"時間: {timestamp}\n"
-                content += f"觸發原因: {kwargs.get('trigger_reason', 'N/A')}\n"
-                
-                # 初始倉位信息
-                initial_pos = kwargs.get('initial_position', {})
-                content += f"📊 初始倉位:\n"
-                content += f"   ├─ 方向: {initial_pos.get('direction', 'N/A')}\n"
-                content += f"   ├─ 數量: {initial_pos.get('quantity', 'N/A')}\n"
-                content += f"   ├─ 進場價: {initial_pos.get('entry_price', 'N/A')}\n"
-                content += f"   └─ 資金費率: {initial_pos.get('funding_rate', 'N/A')}%\n"
-                
-                # 系統狀態
-                system_status = kwargs.get('system_status', {})
-                content += f"🔧 系統狀態:\n"
-                content += f"   ├─ 重試次數: {system_status.get('retry_count', 'N/A')}/{system_status.get('max_retry', 'N/A')}\n"
-                content += f"   ├─ 重試歷時: {system_status.get('retry_duration_seconds', 'N/A')}秒\n"
-                content += f"   └─ 校正時間: {system_status.get('corrected_time_ms', 'N/A')}ms\n"
-                
-                # 市場條件
-                market_cond = kwargs.get('market_conditions', {})
-                content += f"📈 市場條件:\n"
-                content += f"   ├─ 買價: {market_cond.get('bid_price', 'N/A')}\n"
-                content += f"   ├─ 賣價: {market_cond.get('ask_price', 'N/A')}\n"
-                content += f"   ├─ 點差: {market_cond.get('spread_percentage', 'N/A')}\n"
-                content += f"   └─ 流動性: {market_cond.get('liquidity_status', 'N/A')}\n"
-                
-                content += f"{'='*80}\n"
-                
-            elif step == 'force_close_detailed_success':
-                content = f"[{display_time}] ✅ 強制平倉成功: ID:{kwargs.get('order_id', 'N/A')}\n"
-                
-                # 執行結果
-                exec_result = kwargs.get('execution_result', {})
-                content += f"[{display_time}] 📊 執行結果:\n"
-                content += f"[{display_time}]    ├─ 訂單狀態: {exec_result.get('order_status', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 成交量: {exec_result.get('executed_qty', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 成交價: {exec_result.get('avg_price', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 執行方向: {exec_result.get('side_executed', 'N/A')}\n"
-                
-                # 效能指標
-                performance = kwargs.get('performance_metrics', {})
-                content += f"[{display_time}] ⚡ 效能指標:\n"
-                content += f"[{display_time}]    ├─ API響應: {performance.get('api_response_time_ms', 'N/A')}ms\n"
-                content += f"[{display_time}]    ├─ 總處理時間: {performance.get('total_process_time_ms', 'N/A')}ms\n"
-                content += f"[{display_time}]    ├─ 倉位檢查: {performance.get('position_check_time_ms', 'N/A')}ms\n"
-                content += f"[{display_time}]    └─ 執行品質: {performance.get('execution_quality', 'N/A')}\n"
-                
-                # 市場執行分析
-                market_exec = kwargs.get('market_execution_analysis', {})
-                content += f"[{display_time}] 💰 市場執行:\n"
-                content += f"[{display_time}]    ├─ 滑點: {market_exec.get('slippage_percentage', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 流動性消耗: {market_exec.get('liquidity_consumption', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 市場影響: {market_exec.get('market_impact', 'N/A')}\n"
-                
-                # 重試上下文
-                retry_context = kwargs.get('retry_context', {})
-                content += f"[{display_time}] 🔄 重試歷程:\n"
-                content += f"[{display_time}]    ├─ 重試次數: {retry_context.get('retry_count', 'N/A')}/{retry_context.get('max_retry', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 重試歷時: {retry_context.get('retry_duration_seconds', 'N/A')}秒\n"
-                content += f"[{display_time}]    └─ 前次狀況: {retry_context.get('previous_attempts', 'N/A')}\n"
-                
-                # 倉位校正
-                position_recon = kwargs.get('position_reconciliation', {})
-                content += f"[{display_time}] 📋 倉位校正:\n"
-                content += f"[{display_time}]    ├─ 原始進場價: {position_recon.get('original_entry_price', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 實際進場價: {position_recon.get('actual_entry_price', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 未實現盈虧: {position_recon.get('unrealized_pnl', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 保證金類型: {position_recon.get('margin_type', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 倉位準確性: {position_recon.get('position_accuracy', 'N/A')}\n"
-                
-                content += f"{'='*80}\n\n"
-                
-            elif step == 'force_close_detailed_failed':
-                content = f"[{display_time}] ❌ 強制平倉失敗: {kwargs.get('error', 'N/A')}\n"
-                content += f"[{display_time}] 錯誤類型: {kwargs.get('error_type', 'N/A')}\n"
-                
-                # 失敗分析
-                failure_analysis = kwargs.get('failure_analysis', {})
-                content += f"[{display_time}] 🔍 失敗分析:\n"
-                content += f"[{display_time}]    ├─ 失敗前耗時: {failure_analysis.get('total_time_before_error_ms', 'N/A')}ms\n"
-                content += f"[{display_time}]    ├─ 失敗階段: {failure_analysis.get('failure_stage', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 嚴重程度: {failure_analysis.get('error_severity', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 最終嘗試: {failure_analysis.get('is_final_attempt', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 重試已耗盡: {failure_analysis.get('retry_exhausted', 'N/A')}\n"
-                
-                # 重試歷史
-                retry_history = kwargs.get('retry_history', {})
-                content += f"[{display_time}] 📊 重試歷史:\n"
-                content += f"[{display_time}]    ├─ 重試次數: {retry_history.get('retry_count', 'N/A')}/{retry_history.get('max_retry', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 重試歷時: {retry_history.get('retry_duration_seconds', 'N/A')}秒\n"
-                content += f"[{display_time}]    └─ 全部失敗: {retry_history.get('all_attempts_failed', 'N/A')}\n"
-                
-                # 失敗時上下文
-                context = kwargs.get('context_at_failure', {})
-                content += f"[{display_time}] 📋 失敗上下文:\n"
-                content += f"[{display_time}]    ├─ 方向: {context.get('direction', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 數量: {context.get('quantity', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 市場流動性: {context.get('market_liquidity', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 有實際倉位: {context.get('has_actual_position', 'N/A')}\n"
-                
-                # 影響評估
-                impact = kwargs.get('impact_assessment', {})
-                content += f"[{display_time}] ⚠️ 影響評估:\n"
-                content += f"[{display_time}]    ├─ 倉位狀態: {impact.get('position_status', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 風險等級: {impact.get('risk_level', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 需人工介入: {impact.get('manual_intervention_required', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 建議動作: {impact.get('suggested_actions', 'N/A')}\n"
-                
-                content += f"{'='*80}\n\n"
-                
-            # 其他新增的詳細記錄類型
-            elif step == 'force_close_no_position_detailed':
-                content = f"[{display_time}] ℹ️ 強制平倉檢查: {kwargs.get('check_result', 'N/A')}\n"
-                content += f"[{display_time}] 檢查耗時: {kwargs.get('position_check_time_ms', 'N/A')}ms\n"
-                content += f"[{display_time}] 清理動作: {kwargs.get('cleanup_actions', 'N/A')}\n"
-                content += f"{'='*60}\n\n"
-                
-            elif step == 'force_close_position_validated':
-                content = f"[{display_time}] ✅ 倉位驗證完成: 耗時{kwargs.get('position_check_time_ms', 'N/A')}ms\n"
-                
-                # 實際倉位信息
-                actual_pos = kwargs.get('actual_position', {})
-                content += f"[{display_time}] 📊 實際倉位:\n"
-                content += f"[{display_time}]    ├─ 方向: {actual_pos.get('direction', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 數量: {actual_pos.get('quantity', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 進場價: {actual_pos.get('entry_price', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 未實現盈虧: {actual_pos.get('unrealized_pnl', 'N/A')}\n"
-                
-                # 倉位比較
-                pos_comp = kwargs.get('position_comparison', {})
-                content += f"[{display_time}] 🔍 倉位比較:\n"
-                content += f"[{display_time}]    ├─ 方向匹配: {pos_comp.get('direction_match', 'N/A')}\n"
-                content += f"[{display_time}]    ├─ 數量匹配: {pos_comp.get('quantity_match', 'N/A')}\n"
-                content += f"[{display_time}]    └─ 有差異: {pos_comp.get('has_discrepancy', 'N/A')}\n"
-                
-                content += f"[{display_time}] 將使用實際倉位: {kwargs.get('will_use_actual_position', 'N/A')}\n"
-                
-            elif step == 'ultra_fast_api_prepare':
-                content = f"[{display_time}] 🔧 API準備: {kwargs.get('api_method', 'N/A')}\n"
-                content += f"[{display_time}] 預期方向: {kwargs.get('expected_side', 'N/A')}\n"
-                content += f"[{display_time}] 準備耗時: {kwargs.get('prepare_time_ms', 'N/A')}ms\n"
-                content += f"[{display_time}] 訂單參數: {kwargs.get('order_params', 'N/A')}\n"
-                
-            else:
-                # 其他步驟的一般記錄
-                content = f"[{display_time}] {step}: {kwargs}\n"
-            
-            # 效率優化: 使用緩存機制減少I/O操作
-            self._analysis_buffer.append(content)
-            
-            # 只在以下情況才立即寫入:
-            # 1. 關鍵步驟 (交易完成、失敗等)
-            # 2. 緩存滿了 (20條記錄)  
-            # 3. 緩存超時 (2秒)
-            if is_critical or is_buffer_full or is_buffer_timeout:
-                self._flush_analysis_buffer()
-                
-        except Exception as e:
-            print(f"[{self.format_corrected_time()}] 記錄平倉分析失敗: {e}")
-    
-    def _flush_analysis_buffer(self):
-        """批量寫入緩存的分析記錄"""
+        """寫入交易事件日誌 - 進場、平倉、指令發送接收等，易讀格式由 journal_render.py 離線生成"""
         try:
-            if hasattr(self, '_analysis_buffer') and self._analysis_buffer:
-                content = ''.join(self._analysis_buffer)
-                
-                # 寫入按日期命名的文件
-                analysis_file = f"logs/trade_analysis_{datetime.now().strftime('%Y%m%d')}.txt"
-                with open(analysis_file, 'a', encoding='utf-8') as f:
-                    f.write(content)
-                    f.flush()
-                
-                # 同時寫入原本的 trade_analysis.txt 文件
-                legacy_file = "logs/trade_analysis.txt"
-                with open(legacy_file, 'a', encoding='utf-8') as f:
-                    f.write(content)
-                    f.flush()
-                
-                # 重置緩存
-                self._analysis_buffer = []
-                self._buffer_start_time = time.time()
-                
+            # 關鍵步驟（交易完成、失敗等）立即落盤，其餘由日誌緩衝，最多2秒
+            self.trade_journal.append(step, symbol, self.get_corrected_time_precise(), kwargs,
+                                      flush=step in FLUSH_STEPS)
         except Exception as e:
-            print(f"[{self.format_corrected_time()}] 批量寫入分析記錄失敗: {e}")
+            print(f"[{self.format_corrected_time()}] 記錄交易分析失敗: {e}")
 
     def print_detailed_timestamps(self, symbol: str):
         """顯示詳細的時間記錄"""
@@ -4012,20 +3521,18 @@ class FundingRateTrader:
             for step, data in self.close_timestamps[symbol].items():
                 print(f"  {step}: {data['timestamp']} - {data['details']}")
                 
-    def calculate_position_size(self, symbol: str, current_price: float) -> float:
-        """計算持倉數量"""
+    def calculate_position_size(self, symbol: str, current_price: float, margin: Optional[float] = None) -> float:
+        """計算持倉數量；margin 為保證金（預設 MAX_POSITION_SIZE）"""
         # 計算目標倉位大小：保證金 × 槓桿
-        target_position_value = self.max_position_size * self.leverage
-        
-        # 計算數量：目標倉位大小 / 價格
-        quantity = target_position_value / current_price
-        
-        # 極簡數量格式化：直接取整，確保數量不會太小
-        quantity = int(quantity)
+        target_position_value = (margin if margin is not None else self.max_position_size) * self.leverage
         
-        # 確保數量至少為1
-        if quantity < 1:
-            quantity = 1
+        # 計算數量：目標倉位大小 / 價格，按 stepSize 向下取整，不足 minQty/最小名義價值時提高到最小可下單數量
+        symbol_filter = self.symbol_filters.get(symbol)
+        if symbol_filter:
+            quantity = symbol_filter.quantity_for_notional(target_position_value, current_price)
+        else:
+            # 沒有過濾器記錄（交易所信息尚未載入）：直接取整，確保數量至少為1
+            quantity = max(int(target_position_value / current_price), 1)
             
         print(f"[{self.format_corrected_time()}] 計算數量: 價格={current_price}, 目標倉位={target_position_value} USDT, 原始數量={target_position_value / current_price:.6f}, 最終數量={quantity}, 實際倉位={quantity * current_price:.2f} USDT, 所需保證金={(quantity * current_price) / self.leverage:.2f} USDT")
         
@@ -4037,13 +3544,14 @@ class FundingRateTrader:
             # 獲取最新的資金費率數據
             df = self.get_funding_rates()
             
-            # 更新資金費率字典
-            self.funding_rates = {}
-            for _, row in df.iterrows():
-                self.funding_rates[row['symbol']] = {
-                    'funding_rate': row['funding_rate'],
-                    'next_funding_time': row['next_funding_time']
-                }
+            # 原地寫入列式存儲，不重建整張表
+            last_update = self.get_corrected_time()
+            updated_rows = []
+            for row in df.itertuples(index=False):
+                mark_price = row.mark_price if row.mark_price is not None and not pd.isna(row.mark_price) else None
+                updated_rows.append(self.funding_rates.update(row.symbol, float(row.funding_rate), mark_price,
+                                                              int(row.next_funding_time), last_update))
+            self.opportunity_index.update_rows(updated_rows)
             
             return len(df)
         except Exception as e:
@@ -4246,76 +3754,31 @@ class FundingRateTrader:
             print(f"[{self.format_corrected_time()}] 獲取網絡質量信息失敗: {e}")
             return {}
     
-    def execute_api_call_with_timeout(self, api_func, *args, max_retries=3, timeout=3, **kwargs):
-        """執行API調用，包含超時處理和重試機制（併發保護版）"""
-        
-        # 🔒 併發保護：檢查是否可以進行API調用
-        with self.api_call_lock:
-            # 檢查是否超過最大併發數
-            if self.concurrent_api_calls >= self.max_concurrent_api_calls:
-                wait_time = 0.1
-                print(f"[{self.format_corrected_time()}] 🔒 API調用排隊中，等待{wait_time}秒...")
-                time.sleep(wait_time)
-                
-                # 再次檢查
-                if self.concurrent_api_calls >= self.max_concurrent_api_calls:
-                    raise Exception(f"API調用忙碌，已達到最大併發數限制: {self.max_concurrent_api_calls}")
-            
-            # 檢查是否有長時間運行的API調用
-            if self.is_api_calling:
-                stuck_duration = time.time() - self.api_call_start_time
-                if stuck_duration > self.max_api_call_duration:
-                    print(f"[{self.format_corrected_time()}] 🚨 檢測到卡住的API調用，已運行{stuck_duration:.1f}秒，重置狀態")
-                    self.is_api_calling = False
-                    self.concurrent_api_calls = 0
-                else:
-                    raise Exception(f"API調用進行中，已運行{stuck_duration:.1f}秒，請稍後重試")
-            
-            # 設置API調用狀態
-            self.is_api_calling = True
-            self.api_call_start_time = time.time()
-            self.concurrent_api_calls += 1
-        
-        try:
+    def execute_api_call_with_timeout(self, api_func, *args, max_retries=3, timeout=3, lane=None, **kwargs):
+        """執行API調用，包含超時處理和重試機制（分道准入版）
+        lane: 'order' | 'account' | 'background'，未指定時下單/撤單走下單通道，其餘走背景通道"""
+        
+        # 🔒 分道准入：各通道獨立的併發上限，背景通道在下單進行中時讓路（拋出 ApiBusyError）
+        lane = lane or self.admission.lane_for(api_func)
+        # 同步REST調用會卡住網關事件循環（行情流、下單都在上面），事件循環內應改用協程或 gateway.run_blocking
+        if self.gateway.in_loop_thread():
+            raise RuntimeError(f"不可在網關事件循環線程內同步調用 {getattr(api_func, '__name__', api_func)}")
+        # 背景通道按權重預算申請，額度不足時不發送（下單與帳戶通道不受限）
+        if lane == LANE_BACKGROUND and not self.weight_budget.try_acquire_background(
+                WeightBudget.weight_of(api_func, **kwargs)):
+            raise ApiBusyError(f"權重預算不足，跳過背景調用 {api_func.__name__}（{self.weight_budget.format_status()}）")
+        with self.admission.admit(lane, timeout=1.0 if lane == LANE_ORDER else 0.1):
+            # 下單交給網關：帶 newClientOrderId，請求已寫出後失敗時先查詢再決定是否重送，不會重複下單
+            if getattr(api_func, '__name__', '') == 'futures_create_order' and not args:
+                return self.gateway.run(self.gateway.create_order(timeout=timeout, max_retries=max_retries, **kwargs))
             # 執行重試邏輯
             for attempt in range(max_retries + 1):
                 try:
                     start_time = time.time()
                     
-                    # 執行API調用 - 使用線程超時控制（跨平台）
-                    import threading
-                    import queue
-                    
-                    result_queue = queue.Queue()
-                    error_queue = queue.Queue()
-                    
-                    def api_call_worker():
-                        try:
-                            result = api_func(*args, **kwargs)
-                            result_queue.put(result)
-                        except Exception as e:
-                            error_queue.put(e)
-                    
-                    # 在新線程中執行API調用
-                    worker_thread = threading.Thread(target=api_call_worker)
-                    worker_thread.daemon = True
-                    worker_thread.start()
-                    
-                    # 等待結果或超時
-                    try:
-                        worker_thread.join(timeout=timeout)
-                        if worker_thread.is_alive():
-                            raise TimeoutError(f"API調用超時: {timeout}秒")
-                        
-                        # 檢查是否有錯誤
-                        if not error_queue.empty():
-                            raise error_queue.get()
-                        
-                        # 獲取結果
-                        result = result_queue.get_nowait()
-                        execution_time = int((time.time() - start_time) * 1000)
-                    except queue.Empty:
-                        raise TimeoutError(f"API調用超時: {timeout}秒")
+                    # 執行API調用 - 由網關事件循環以 asyncio.wait_for 控制超時（不再每次新建線程和佇列）
+                    result = self.gateway.run(self.gateway.call(api_func, *args, timeout=timeout, **kwargs))
+                    execution_time = int((time.time() - start_time) * 1000)
                     
                     # 記錄成功調用
                     if execution_time > 2000:  # 超過2秒的極慢調用
@@ -4325,23 +3788,15 @@ class FundingRateTrader:
                     
                     return result
                         
-                except (requests.exceptions.Timeout, requests.exceptions.RequestException, BinanceAPIException) as e:
+                except (requests.exceptions.Timeout, requests.exceptions.RequestException, aiohttp.ClientError, BinanceAPIException) as e:
                     execution_time = int((time.time() - start_time) * 1000)
+                    # 幣安錯誤只重試限流/時間戳，其餘（參數、保證金等）重試結果相同
+                    retryable = not isinstance(e, BinanceAPIException) or e.code in RETRYABLE_CODES
                     
-                    if attempt < max_retries:
+                    if attempt < max_retries and retryable:
                         backoff_time = (0.5 * (2 ** attempt))  # 指數退避：0.5s, 1s, 2s
                         print(f"[{self.format_corrected_time()}] ⚠️ API調用超時重試 {attempt+1}/{max_retries}: {api_func.__name__} - {execution_time}ms, 等待{backoff_time:.1f}秒後重試")
-                        
-                        # 🔒 重試期間暫時釋放鎖定，但保持計數
-                        with self.api_call_lock:
-                            self.is_api_calling = False
-                        
                         time.sleep(backoff_time)
-                        
-                        # 重新獲取鎖定
-                        with self.api_call_lock:
-                            self.is_api_calling = True
-                            self.api_call_start_time = time.time()
                     else:
                         print(f"[{self.format_corrected_time()}] ❌ API調用最終失敗: {api_func.__name__} - {execution_time}ms, 錯誤: {e}")
                         raise e
@@ -4352,16 +3807,6 @@ class FundingRateTrader:
                     raise e
             
             raise Exception(f"API調用失敗，已重試{max_retries}次")
-            
-        finally:
-            # 🔒 無論成功失敗都要重置狀態
-            with self.api_call_lock:
-                self.is_api_calling = False
-                self.concurrent_api_calls = max(0, self.concurrent_api_calls - 1)
-                
-                # 如果有其他等待的API調用，記錄狀態
-                if self.concurrent_api_calls > 0:
-                    print(f"[{self.format_corrected_time()}] 📋 API調用完成，仍有{self.concurrent_api_calls}個調用進行中")
     
     def safe_api_call(self, api_func, *args, **kwargs):
         """安全的API調用包裝器"""
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 模組都在倉庫根目錄（沒有套件結構），測試從根目錄導入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
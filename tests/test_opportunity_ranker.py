@@ -0,0 +1,101 @@
+"""機會排序：向量化 top_k / best、增量索引 peek 與舊做法的結果一致"""
+
+import numpy as np
+import pytest
+
+from funding_rate_store import FundingRateStore
+from opportunity_ranker import OpportunityIndex, OpportunityRanker, _legacy_best
+
+HOUR_MS = 3600000
+BASE_TIME = 1760000000000 // HOUR_MS * HOUR_MS
+
+
+def make_store(rows, symbol_filter=None):
+    """rows: (symbol, 資金費率, 結算時間偏移小時, 點差或None)"""
+    store = FundingRateStore(capacity=4, symbol_filter=symbol_filter)
+    for symbol, funding_rate, hours, spread in rows:
+        store.update(symbol, funding_rate, 1.0, BASE_TIME + hours * HOUR_MS, BASE_TIME)
+        if spread is not None:
+            store.set_spread(symbol, spread)
+    return store
+
+
+def ranked_symbols(ranker, min_net_profit=0.1, max_spread=1.0, k=5):
+    return [ranker.store.symbols[row] for row in ranker.top_k(min_net_profit, max_spread, k)]
+
+
+def test_nearest_settlement_first_then_net_profit():
+    store = make_store([
+        ('AUSDT', 0.9, 2, 0.05),
+        ('BUSDT', 0.3, 1, 0.05),
+        ('CUSDT', -0.6, 1, 0.05),
+        ('DUSDT', 0.5, 1, 0.30),
+    ])
+    assert ranked_symbols(OpportunityRanker(store)) == ['CUSDT', 'BUSDT', 'DUSDT', 'AUSDT']
+
+
+def test_thresholds_and_symbol_filter_exclude_rows():
+    store = make_store([
+        ('AUSDT', 0.12, 1, 0.05),    # 淨收益 0.07 < 0.1
+        ('BUSDT', 0.8, 1, 0.6),      # 點差超過上限
+        ('CUSDT', 0.8, 0, None),     # 未知點差按默認 0.05
+        ('DUSDT', 0.8, 1, 0.05),
+        ('EXCLUDED', 2.0, 1, 0.01),
+    ], symbol_filter=lambda symbol: symbol.endswith('USDT'))
+    ranker = OpportunityRanker(store)
+    assert ranked_symbols(ranker, max_spread=0.5) == ['CUSDT', 'DUSDT']
+    assert ranker.describe(store.row_of('CUSDT'))['spread'] == ranker.default_spread
+
+
+def test_top_k_limits_across_settlement_buckets():
+    store = make_store([(f"S{i}USDT", 0.2 + i * 0.1, i % 3, 0.05) for i in range(9)])
+    ranker = OpportunityRanker(store)
+    assert len(ranked_symbols(ranker, k=4)) == 4
+    assert ranked_symbols(ranker, k=4) == ranked_symbols(ranker, k=9)[:4]
+    assert ranker.top_k(0.1, 1.0, 0).size == 0
+    assert OpportunityRanker(FundingRateStore()).best(0.1, 1.0) is None
+
+
+def test_describe_matches_opportunity_dict():
+    store = make_store([('AUSDT', -0.4, 1, 0.1)])
+    opportunity = OpportunityRanker(store).best(0.1, 1.0)
+    assert opportunity == {'symbol': 'AUSDT', 'funding_rate': -0.4, 'net_profit': pytest.approx(0.3), 'spread': 0.1,
+                           'next_funding_time': BASE_TIME + HOUR_MS, 'direction': 'long'}
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_best_matches_legacy_and_index(seed):
+    rng = np.random.default_rng(seed)
+    store = FundingRateStore(capacity=8)
+    rates, spreads = {}, {}
+    for i in range(300):
+        symbol = f"SYM{i:03d}USDT"
+        funding_rate = float(rng.normal(0, 0.2))
+        next_funding_time = BASE_TIME + HOUR_MS * int(rng.integers(1, 4))
+        spread = float(rng.uniform(0.01, 0.3))
+        store.update(symbol, funding_rate, 1.0, next_funding_time, BASE_TIME)
+        store.set_spread(symbol, spread)
+        rates[symbol] = {'funding_rate': funding_rate, 'next_funding_time': next_funding_time}
+        spreads[symbol] = spread
+
+    ranker = OpportunityRanker(store)
+    index = OpportunityIndex(store, 0.1, 0.25)
+    index.rebuild()
+    for _ in range(20):
+        legacy = _legacy_best(rates, spreads, 0.1, 0.25)
+        best = ranker.best(0.1, 0.25)
+        assert (legacy is None) == (best is None)
+        if legacy is not None:
+            assert best['symbol'] == legacy['symbol']
+            assert best['net_profit'] == pytest.approx(legacy['net_profit'])
+            assert store.symbols[index.peek()] == best['symbol']
+
+        # 一幀推送：部分交易對資金費率/點差變化，索引只更新變化的行
+        moved = np.flatnonzero(rng.random(store.size) < 0.1)
+        for row in moved.tolist():
+            symbol = store.symbols[row]
+            rates[symbol]['funding_rate'] = float(rng.normal(0, 0.2))
+            spreads[symbol] = float(rng.uniform(0.01, 0.3))
+            store.update(symbol, rates[symbol]['funding_rate'], 1.0, rates[symbol]['next_funding_time'], BASE_TIME)
+            store.set_spread(symbol, spreads[symbol])
+        index.update_rows(moved)
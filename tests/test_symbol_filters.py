@@ -0,0 +1,105 @@
+"""交易對過濾器：以記錄的 exchangeInfo 過濾器做隨機性質檢查與已知取整用例"""
+
+import math
+import random
+
+import pytest
+
+from exchange_cache import ExchangeCache
+from symbol_filters import SAMPLE_EXCHANGE_INFO, SymbolFilter, SymbolFilterTable, run_property_checks
+
+SYMBOL_INFOS = {item['symbol']: item for item in SAMPLE_EXCHANGE_INFO['symbols']}
+
+
+@pytest.fixture(scope='module')
+def table():
+    table = SymbolFilterTable()
+    table.load_exchange_info(SAMPLE_EXCHANGE_INFO)
+    return table
+
+
+@pytest.mark.parametrize('seed', [1, 7, 42])
+@pytest.mark.parametrize('symbol', sorted(SYMBOL_INFOS))
+def test_property_checks(symbol, seed):
+    cases = run_property_checks({'symbols': [SYMBOL_INFOS[symbol]]}, cases_per_symbol=500, seed=seed)
+    assert cases == 500
+
+
+@pytest.mark.parametrize('symbol, raw, expected', [
+    ('BTCUSDT', 0.0123456, 0.012),
+    ('BTCUSDT', 22286.17, 22286.17),   # 22286.17 / 0.001 = 22286169.999996 不可被取成 22286.169
+    ('ETHUSDT', 0.6409, 0.64),
+    ('ETHUSDT', 0.64099999999, 0.641),  # 浮點尾差視為剛好在步長上
+    ('XRPUSDT', 145.56, 145.5),
+    ('DOGEUSDT', 324.9, 324),
+    ('1000PEPEUSDT', 178011.99, 178011),
+])
+def test_round_quantity_floors_to_step(table, symbol, raw, expected):
+    quantity = table.get(symbol).round_quantity(raw)
+    assert quantity == expected
+    assert isinstance(quantity, int) == (table.get(symbol).market_lot.decimals == 0)
+
+
+@pytest.mark.parametrize('symbol, price, buy, sell', [
+    ('BTCUSDT', 67250.34, 67250.3, 67250.4),
+    ('ETHUSDT', 3120.456, 3120.45, 3120.46),
+    ('DOGEUSDT', 0.1234567, 0.12345, 0.12346),
+    ('1000PEPEUSDT', 0.011234567, 0.0112345, 0.0112346),
+])
+def test_round_price_never_worse_than_requested(table, symbol, price, buy, sell):
+    item = table.get(symbol)
+    assert item.round_price(price, 'BUY') == buy
+    assert item.round_price(price, 'SELL') == sell
+    assert item.round_price(buy, 'BUY') == buy
+
+
+@pytest.mark.parametrize('symbol, price, expected', [
+    ('BTCUSDT', 67250.3, 0.002),   # 100 USDT 最小名義價值
+    ('ETHUSDT', 3120.45, 0.007),   # 20 USDT
+    ('DOGEUSDT', 0.12345, 41),     # 5 USDT
+    ('XRPUSDT', 100000.0, 0.1),    # minQty 比名義價值要求更高
+])
+def test_min_quantity_meets_min_qty_and_notional(table, symbol, price, expected):
+    item = table.get(symbol)
+    assert item.min_quantity(price) == expected
+    assert item.check(expected, price) == (True, '')
+
+
+def test_quantity_for_notional_is_capped_by_market_lot(table):
+    item = table.get('SOLUSDT')
+    assert item.quantity_for_notional(1e9, 150.0) == 5000              # MARKET_LOT_SIZE maxQty
+    assert item.quantity_for_notional(1e9, 150.0, market=False) == 1000000
+
+
+def test_check_reports_each_violation(table):
+    item = table.get('BTCUSDT')
+    assert not item.check(0, 67250.3)[0]
+    assert '步長' in item.check(0.0015, 67250.3)[1]
+    assert '最大數量' in item.check(121, 67250.3)[1]
+    assert '名義價值' in item.check(0.001, 67250.3)[1]
+    assert item.check(0.001, 67250.3, reduce_only=True) == (True, '')
+    assert 'tick' in item.check(0.002, 67250.35, market=False)[1]
+
+
+def test_missing_filters_fall_back_to_integer_steps():
+    item = SymbolFilter.from_symbol_info({'symbol': 'NEWUSDT', 'filters': []})
+    assert item.round_quantity(12.9) == 12
+    assert item.min_quantity(1.0) == 0
+    assert item.market_lot.maximum == math.inf
+
+
+def test_cache_rows_build_the_same_filters():
+    cache = ExchangeCache(':memory:')
+    cache.save_exchange_info(SAMPLE_EXCHANGE_INFO)
+    cached = SymbolFilterTable()
+    assert cached.load_cache_rows(cache.all_symbols()) == len(SYMBOL_INFOS)
+    rng = random.Random(3)
+    for symbol, info in SYMBOL_INFOS.items():
+        expected = SymbolFilter.from_symbol_info(info)
+        item = cached.get(symbol)
+        for _ in range(50):
+            price = 10 ** rng.uniform(-6, 5)
+            notional = 10 ** rng.uniform(0, 5)
+            assert item.quantity_for_notional(notional, price) == expected.quantity_for_notional(notional, price)
+            assert item.round_price(price, 'SELL') == expected.round_price(price, 'SELL')
+    cache.close()
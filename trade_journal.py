@@ -0,0 +1,334 @@
+"""
+交易事件二進制日誌（追加寫入）
+取代每次刷新都重新打開兩個文字檔（trade_analysis_YYYYMMDD.txt 與 trade_analysis.txt）的寫法：
+每天一個 logs/trade_journal_YYYYMMDD.bin，文件句柄常駐，每條記錄為長度前綴的固定結構
+（步驟id、交易對id、校正時間ms、帶類型的欄位），可讀文字由 journal_render.py 離線生成
+
+文件格式：
+    文件頭  b'FRTJ' + 版本(u8)
+    記錄    u32 長度 + 內容
+      定義  u8 0 | u16 id | utf-8 字串          步驟名、交易對、欄位名首次出現時寫入（字串表）
+      事件  u8 1 | u16 步驟id | u16 交易對id | f64 時間ms | u16 欄位數 | (u16 欄位名id, 值)...
+    值      u8 類型 + 內容：None/True/False、i64、f64、字串(u32長度+utf-8)、列表/字典（u32個數+元素，字典鍵為字串表id）、
+            其他對象以 str() 保存
+"""
+
+import numbers
+import os
+import struct
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+
+JOURNAL_DIR = 'logs'
+JOURNAL_PREFIX = 'trade_journal'
+JOURNAL_MAGIC = b'FRTJ'
+JOURNAL_VERSION = 1
+JOURNAL_BUFFER_SIZE = 64 * 1024
+JOURNAL_FLUSH_INTERVAL = 2.0  # 非關鍵步驟最多緩存2秒
+
+# 需要立即落盤的關鍵步驟（交易完成、失敗等）
+FLUSH_STEPS = frozenset([
+    'entry_success', 'entry_failed', 'entry_complete',
+    'close_position', 'close_position_detail',
+    'fast_close_success', 'fast_close_failed',
+    'ultra_fast_close_success', 'ultra_fast_close_failed',
+    'force_close_success', 'force_close_failed',
+    'minimal_close_complete', 'minimal_close_failed',
+    'ultra_speed_close_start', 'ultra_speed_close_success',
+    'ultra_speed_close_failed', 'ultra_speed_close_error',
+    'ultra_speed_close_complete',
+    'instant_close_success', 'instant_close_failed',
+    'close_with_full_context', 'close_market_analysis',
+    'close_network_analysis', 'close_balance_analysis',
+])
+
+RECORD_DEFINE = 0
+RECORD_EVENT = 1
+
+TAG_NONE, TAG_TRUE, TAG_FALSE, TAG_INT, TAG_FLOAT, TAG_STR, TAG_LIST, TAG_DICT, TAG_REPR = range(9)
+
+_LENGTH = struct.Struct('<I')
+_DEFINE = struct.Struct('<BH')
+_EVENT = struct.Struct('<BHHdH')
+_KEY = struct.Struct('<H')
+_INT = struct.Struct('<Bq')
+_FLOAT = struct.Struct('<Bd')
+_SIZED = struct.Struct('<BI')
+_HEADER = JOURNAL_MAGIC + bytes([JOURNAL_VERSION])
+_MAX_ID = 0xFFFF
+
+
+class JournalFormatError(Exception):
+    """文件頭不符或版本不支持"""
+
+
+def journal_path(day: datetime, directory: str = JOURNAL_DIR, prefix: str = JOURNAL_PREFIX) -> str:
+    return os.path.join(directory, f"{prefix}_{day.strftime('%Y%m%d')}.bin")
+
+
+def _encode_value(value, out: bytearray, intern):
+    if value is None:
+        out.append(TAG_NONE)
+    elif value is True:
+        out.append(TAG_TRUE)
+    elif value is False:
+        out.append(TAG_FALSE)
+    elif isinstance(value, float):
+        out += _FLOAT.pack(TAG_FLOAT, value)
+    elif isinstance(value, numbers.Integral) and -(1 << 63) <= value < (1 << 63):
+        out += _INT.pack(TAG_INT, int(value))
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        out += _SIZED.pack(TAG_STR, len(data))
+        out += data
+    elif isinstance(value, dict):
+        out += _SIZED.pack(TAG_DICT, len(value))
+        for key, item in value.items():
+            out += _KEY.pack(intern(str(key)))
+            _encode_value(item, out, intern)
+    elif isinstance(value, (list, tuple)):
+        out += _SIZED.pack(TAG_LIST, len(value))
+        for item in value:
+            _encode_value(item, out, intern)
+    elif isinstance(value, numbers.Real):  # numpy 浮點等
+        out += _FLOAT.pack(TAG_FLOAT, float(value))
+    else:
+        data = str(value).encode('utf-8')
+        out += _SIZED.pack(TAG_REPR, len(data))
+        out += data
+
+
+def _decode_value(data: bytes, offset: int, strings: Dict[int, str]) -> Tuple[object, int]:
+    tag = data[offset]
+    if tag == TAG_NONE:
+        return None, offset + 1
+    if tag == TAG_TRUE:
+        return True, offset + 1
+    if tag == TAG_FALSE:
+        return False, offset + 1
+    if tag == TAG_INT:
+        return _INT.unpack_from(data, offset)[1], offset + _INT.size
+    if tag == TAG_FLOAT:
+        return _FLOAT.unpack_from(data, offset)[1], offset + _FLOAT.size
+    size = _SIZED.unpack_from(data, offset)[1]
+    offset += _SIZED.size
+    if tag in (TAG_STR, TAG_REPR):
+        return data[offset:offset + size].decode('utf-8'), offset + size
+    if tag == TAG_LIST:
+        items = []
+        for _ in range(size):
+            item, offset = _decode_value(data, offset, strings)
+            items.append(item)
+        return items, offset
+    if tag == TAG_DICT:
+        result = {}
+        for _ in range(size):
+            key = strings[_KEY.unpack_from(data, offset)[0]]
+            result[key], offset = _decode_value(data, offset + _KEY.size, strings)
+        return result, offset
+    raise JournalFormatError(f"未知的值類型 {tag}")
+
+
+def _iter_records(data: bytes) -> Iterator[Tuple[int, bytes]]:
+    """(記錄結束位置, 記錄內容)；尾部不完整的記錄（寫入中途崩潰）忽略"""
+    if not data.startswith(JOURNAL_MAGIC):
+        raise JournalFormatError("不是交易事件日誌文件")
+    if data[len(JOURNAL_MAGIC)] != JOURNAL_VERSION:
+        raise JournalFormatError(f"不支持的日誌版本 {data[len(JOURNAL_MAGIC)]}")
+    offset = len(_HEADER)
+    while offset + _LENGTH.size <= len(data):
+        length = _LENGTH.unpack_from(data, offset)[0]
+        end = offset + _LENGTH.size + length
+        if end > len(data):
+            return
+        yield end, data[offset + _LENGTH.size:end]
+        offset = end
+
+
+def read_journal(path: str) -> Iterator[Tuple[str, str, float, Dict]]:
+    """逐條讀出 (步驟, 交易對, 校正時間ms, 欄位)"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    strings: Dict[int, str] = {}
+    for _, record in _iter_records(data):
+        if record[0] == RECORD_DEFINE:
+            strings[_DEFINE.unpack_from(record)[1]] = record[_DEFINE.size:].decode('utf-8')
+            continue
+        _, step_id, symbol_id, timestamp_ms, count = _EVENT.unpack_from(record)
+        offset = _EVENT.size
+        fields = {}
+        for _ in range(count):
+            key = strings[_KEY.unpack_from(record, offset)[0]]
+            fields[key], offset = _decode_value(record, offset + _KEY.size, strings)
+        yield strings[step_id], strings[symbol_id], timestamp_ms, fields
+
+
+class TradeJournal:
+    """按天切分的追加寫入日誌 - 單一常駐文件句柄，寫入線程安全；首次寫入時才創建文件"""
+
+    def __init__(self, directory: str = JOURNAL_DIR, prefix: str = JOURNAL_PREFIX,
+                 buffer_size: int = JOURNAL_BUFFER_SIZE, flush_interval: float = JOURNAL_FLUSH_INTERVAL):
+        self.directory = directory
+        self.prefix = prefix
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.path: Optional[str] = None
+        self.records = 0
+        self.bytes_written = 0
+        self._file = None
+        self._strings: Dict[str, int] = {}
+        self._day_end_ms = 0.0
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def append(self, step: str, symbol: str, timestamp_ms: float, fields: Optional[Dict] = None,
+               flush: bool = False):
+        """追加一條事件；flush=True 或距上次落盤超過 flush_interval 時立即落盤"""
+        with self._lock:
+            if self._file is None or timestamp_ms >= self._day_end_ms:
+                self._open(timestamp_ms)
+            added: List[str] = []
+
+            def intern(text: str) -> int:
+                string_id = self._strings.get(text)
+                if string_id is None:
+                    string_id = len(self._strings)
+                    if string_id > _MAX_ID:
+                        raise ValueError("字串表已滿（單日超過65536個不同的步驟/交易對/欄位名）")
+                    self._strings[text] = string_id
+                    added.append(text)
+                return string_id
+
+            fields = fields or {}
+            try:
+                body = bytearray(_EVENT.pack(RECORD_EVENT, intern(step), intern(symbol or ''), timestamp_ms,
+                                             len(fields)))
+                for key, value in fields.items():
+                    body += _KEY.pack(intern(str(key)))
+                    _encode_value(value, body, intern)
+            except Exception:
+                # 編碼失敗時撤銷本條新增的字串，字串表與文件內容保持一致
+                for text in added:
+                    del self._strings[text]
+                raise
+            out = bytearray()
+            defines = [_DEFINE.pack(RECORD_DEFINE, self._strings[text]) + text.encode('utf-8') for text in added]
+            for record in defines + [body]:
+                out += _LENGTH.pack(len(record))
+                out += record
+            self._file.write(out)
+            self.records += 1
+            self.bytes_written += len(out)
+            if flush or time.monotonic() - self._flushed_at > self.flush_interval:
+                self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._flush_locked()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _flush_locked(self):
+        self._file.flush()
+        self._flushed_at = time.monotonic()
+
+    def _open(self, timestamp_ms: float):
+        """打開（或切換到）時間戳所在日期的文件；續寫已有文件時恢復字串表並截去不完整的尾部記錄"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        day = datetime.fromtimestamp(timestamp_ms / 1000)
+        midnight = day.replace(hour=0, minute=0, second=0, microsecond=0)
+        self._day_end_ms = (midnight + timedelta(days=1)).timestamp() * 1000
+        self.path = journal_path(day, self.directory, self.prefix)
+        os.makedirs(self.directory, exist_ok=True)
+        self._strings = {}
+        valid_end = 0
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= len(_HEADER):
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            valid_end = len(_HEADER)
+            for valid_end, record in _iter_records(data):
+                if record[0] == RECORD_DEFINE:
+                    self._strings[record[_DEFINE.size:].decode('utf-8')] = _DEFINE.unpack_from(record)[1]
+        if valid_end:
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid_end)
+            self._file = open(self.path, 'ab', buffering=self.buffer_size)
+        else:
+            self._file = open(self.path, 'wb', buffering=self.buffer_size)
+            self._file.write(_HEADER)
+        self._flushed_at = time.monotonic()
+
+
+# 使用示例：python trade_journal.py [次數]  （一次進場+平倉的分析記錄：舊的雙文字檔寫法 vs 二進制日誌）
+if __name__ == "__main__":
+    import sys
+    import tempfile
+
+    trades = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    steps = [
+        ('entry_start', {'direction': 'long', 'funding_rate': -0.5836, 'settlement_time': '08:00:00.000'}),
+        ('leverage_set', {'leverage': 20}),
+        ('entry_price_fetched', {'price': 27123.4}),
+        ('entry_quantity_calculated', {'quantity': 0.012}),
+        ('entry_order_sent', {'order_id': 8389765492, 'order_time_ms': 4.8}),
+        ('entry_success', {'executed_qty': 0.012, 'avg_price': 27123.5}),
+        ('close_position_detail', {'order_id': 8389765501, 'executed_qty': 0.012, 'avg_price': 27120.1,
+                                   'position': {'direction': 'long', 'quantity': 0.012, 'entry_price': 27123.5},
+                                   'timing': [1.2, 3.4, 5.6]}),
+    ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        dated_file = os.path.join(directory, 'trade_analysis_20250101.txt')
+        legacy_file = os.path.join(directory, 'trade_analysis.txt')
+        buffer = []
+        start = time.perf_counter()
+        for trade in range(trades):
+            for step, fields in steps:
+                buffer.append(f"[2025-01-01 08:00:00.000] {step}: {fields}\n")
+                if step in FLUSH_STEPS:  # 舊寫法：關鍵步驟時重新打開兩個文件追加
+                    content = ''.join(buffer)
+                    for path in (dated_file, legacy_file):
+                        with open(path, 'a', encoding='utf-8') as f:
+                            f.write(content)
+                            f.flush()
+                    buffer = []
+        text_seconds = time.perf_counter() - start
+        text_bytes = os.path.getsize(dated_file) + os.path.getsize(legacy_file)
+
+        journal = TradeJournal(directory)
+        start = time.perf_counter()
+        now_ms = time.time() * 1000
+        for trade in range(trades):
+            for index, (step, fields) in enumerate(steps):
+                journal.append(step, 'BTCUSDT', now_ms + index, fields, flush=step in FLUSH_STEPS)
+        journal.close()
+        journal_seconds = time.perf_counter() - start
+        journal_bytes = os.path.getsize(journal.path)
+
+        events = list(read_journal(journal.path))
+        assert len(events) == trades * len(steps)
+        assert events[-1][0] == 'close_position_detail' and events[-1][3] == steps[-1][1]
+
+        per_trade = len(steps)
+        print(f"{trades} 次交易，每次 {per_trade} 條分析記錄")
+        print(f"  雙文字檔: {text_seconds / trades * 1e6:8.1f}µs/次交易 | 寫入 {text_bytes / 1024:8.1f}KB")
+        print(f"  二進制日誌: {journal_seconds / trades * 1e6:8.1f}µs/次交易 | 寫入 {journal_bytes / 1024:8.1f}KB")
+
+        # 續寫：重新打開同一天的文件時沿用字串表，截去不完整的尾部記錄
+        with open(journal.path, 'ab') as f:
+            f.write(b'\x40\x00\x00\x00\x01')
+        journal = TradeJournal(directory)
+        journal.append('entry_start', 'ETHUSDT', now_ms + 10, {'direction': 'short'}, flush=True)
+        journal.close()
+        events = list(read_journal(journal.path))
+        assert len(events) == trades * per_trade + 1 and events[-1][:2] == ('entry_start', 'ETHUSDT')
+        print(f"  續寫檢查通過：共 {len(events)} 條")
@@ -0,0 +1,356 @@
+"""
+用戶數據流（listenKey）與本地持倉/成交簿
+建立並定期續期 listenKey，在網關事件循環中讀取私有推送：
+ORDER_TRADE_UPDATE 累計每筆訂單的成交（均價、成交量、手續費、已實現盈虧），ACCOUNT_UPDATE 覆蓋持倉與餘額；
+持倉檢查與平倉價格改為本地查詢（推送級延遲、零請求權重），每次(重)連接後以一次 REST 持倉快照補齊斷線期間的變化
+"""
+
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+import aiohttp
+
+LISTEN_KEY_PATH = '/fapi/v1/listenKey'
+LISTEN_KEY_KEEPALIVE = 30 * 60        # listenKey 60分鐘無續期即失效，每30分鐘續期一次（秒）
+RECONNECT_DELAYS = (0.5, 1, 2, 5, 10)  # 斷線後第N次重連前的等待（秒），之後固定取最後一個
+MAX_TRACKED_ORDERS = 1000              # 成交簿保留最近的訂單數
+
+ORDER_TRADE_UPDATE = 'ORDER_TRADE_UPDATE'
+ACCOUNT_UPDATE = 'ACCOUNT_UPDATE'
+LISTEN_KEY_EXPIRED = 'listenKeyExpired'
+TERMINAL_ORDER_STATUSES = frozenset({'FILLED', 'CANCELED', 'EXPIRED', 'REJECTED', 'EXPIRED_IN_MATCH'})
+POSITION_EPSILON = 1e-12
+
+
+class PositionBook:
+    """私有流維護的持倉與成交簿 - 推送在網關線程寫入，主循環/背景線程讀取；持倉按交易時間取新，亂序的舊更新忽略"""
+
+    def __init__(self, max_orders: int = MAX_TRACKED_ORDERS):
+        self.positions: Dict[str, Dict] = {}    # symbol -> {amount(帶方向), entry_price, unrealized_pnl, margin_type, isolated_margin, update_time}
+        self.orders: 'OrderedDict[int, Dict]' = OrderedDict()
+        self.balances: Dict[str, float] = {}
+        self.max_orders = max_orders
+        self.last_event_ms = 0
+        self.events = 0
+        self._cond = threading.Condition()
+
+    # ========== 寫入 ==========
+
+    def _set_position(self, symbol: str, amount: float, entry_price: float, unrealized_pnl: float,
+                      margin_type: str, isolated_margin: float, update_time: int):
+        current = self.positions.get(symbol)
+        if current is not None and update_time < current['update_time']:
+            return
+        if abs(amount) < POSITION_EPSILON:
+            # 平倉後保留一條零持倉記錄作為時間基準，避免較舊的快照把已平的持倉寫回
+            amount = 0.0
+        self.positions[symbol] = {'amount': amount, 'entry_price': entry_price, 'unrealized_pnl': unrealized_pnl,
+                                  'margin_type': margin_type, 'isolated_margin': isolated_margin,
+                                  'update_time': update_time}
+
+    def load_positions(self, positions: List[Dict]):
+        """以 REST positionRisk 快照補齊（只覆蓋比本地更新的交易對）"""
+        with self._cond:
+            for pos in positions:
+                margin_type = pos.get('marginType', 'cross')
+                self._set_position(pos['symbol'], float(pos['positionAmt']), float(pos.get('entryPrice', 0)),
+                                   float(pos.get('unRealizedProfit', 0)), margin_type,
+                                   float(pos.get('isolatedMargin', 0)) if margin_type == 'isolated' else 0.0,
+                                   int(pos.get('updateTime', 0)))
+            self._cond.notify_all()
+
+    def apply_account_update(self, event: Dict):
+        update = event.get('a', {})
+        update_time = int(event.get('T') or event.get('E') or 0)
+        with self._cond:
+            for balance in update.get('B', []):
+                self.balances[balance['a']] = float(balance['wb'])
+            for pos in update.get('P', []):
+                if pos.get('ps', 'BOTH') != 'BOTH':
+                    continue  # 只支持單向持倉模式
+                margin_type = pos.get('mt', 'cross')
+                self._set_position(pos['s'], float(pos['pa']), float(pos.get('ep', 0)), float(pos.get('up', 0)),
+                                   margin_type, float(pos.get('iw', 0)) if margin_type == 'isolated' else 0.0,
+                                   update_time)
+            self._touch(event)
+
+    def apply_order_update(self, event: Dict):
+        update = event['o']
+        order_id = int(update['i'])
+        with self._cond:
+            order = self.orders.get(order_id)
+            if order is None:
+                order = self.orders[order_id] = {
+                    'order_id': order_id, 'symbol': update['s'], 'client_order_id': update.get('c', ''),
+                    'side': update.get('S', ''), 'reduce_only': bool(update.get('R', False)),
+                    'status': '', 'executed_qty': 0.0, 'avg_price': 0.0, 'last_fill_price': 0.0,
+                    'commission': 0.0, 'realized_pnl': 0.0, 'trade_ids': [], 'update_time': 0}
+                while len(self.orders) > self.max_orders:
+                    self.orders.popitem(last=False)
+            update_time = int(update.get('T') or event.get('E') or 0)
+            if update.get('x') == 'TRADE' and update.get('t') not in order['trade_ids']:
+                order['trade_ids'].append(update.get('t'))
+                order['last_fill_price'] = float(update.get('L', 0))
+                order['commission'] += float(update.get('n', 0))
+                order['realized_pnl'] += float(update.get('rp', 0))
+            executed_qty = float(update.get('z', 0))
+            if executed_qty >= order['executed_qty']:
+                order['executed_qty'] = executed_qty
+                order['avg_price'] = float(update.get('ap', 0)) or order['avg_price']
+            if update_time >= order['update_time'] and order['status'] not in TERMINAL_ORDER_STATUSES:
+                order['status'] = update.get('X', order['status'])
+                order['update_time'] = update_time
+            self._touch(event)
+
+    def _touch(self, event: Dict):
+        self.last_event_ms = int(event.get('E', 0)) or self.last_event_ms
+        self.events += 1
+        self._cond.notify_all()
+
+    # ========== 讀取 ==========
+
+    def position(self, symbol: str) -> Optional[Dict]:
+        """與 check_actual_position 相同的格式；無持倉返回None"""
+        with self._cond:
+            pos = self.positions.get(symbol)
+            if pos is None or pos['amount'] == 0:
+                return None
+            return {
+                'symbol': symbol,
+                'direction': 'long' if pos['amount'] > 0 else 'short',
+                'quantity': abs(pos['amount']),
+                'entry_price': pos['entry_price'],
+                'unrealized_pnl': pos['unrealized_pnl'],
+                'margin_type': pos['margin_type'],
+                'isolated_margin': pos['isolated_margin']
+            }
+
+    def position_rows(self) -> List[Dict]:
+        """有持倉的交易對，欄位與 REST positionRisk 相同（供原本遍歷 futures_position_information 的代碼直接使用）"""
+        with self._cond:
+            return [{'symbol': symbol, 'positionAmt': str(pos['amount']), 'entryPrice': str(pos['entry_price']),
+                     'unRealizedProfit': str(pos['unrealized_pnl']), 'marginType': pos['margin_type'],
+                     'isolatedMargin': str(pos['isolated_margin']), 'updateTime': pos['update_time']}
+                    for symbol, pos in self.positions.items() if pos['amount'] != 0]
+
+    def order(self, order_id) -> Optional[Dict]:
+        with self._cond:
+            order = self.orders.get(int(order_id))
+            return dict(order) if order is not None else None
+
+    def wait_for_fill(self, order_id, timeout: float = 1.0) -> Optional[Dict]:
+        """等待訂單進入終態（成交/撤銷/過期），超時返回當前狀態（可能為None）"""
+        order_id = int(order_id)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                order = self.orders.get(order_id)
+                if order is not None and order['status'] in TERMINAL_ORDER_STATUSES:
+                    return dict(order)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return dict(order) if order is not None else None
+                self._cond.wait(remaining)
+
+    def fill_price(self, order_id, timeout: float = 0.0) -> Optional[float]:
+        """訂單成交均價；timeout > 0 時等待成交推送"""
+        order = self.wait_for_fill(order_id, timeout) if timeout > 0 else self.order(order_id)
+        if order is None or order['executed_qty'] <= 0 or order['avg_price'] <= 0:
+            return None
+        return order['avg_price']
+
+
+class UserDataStream:
+    """listenKey 生命週期 + 私有流讀取，在網關事件循環中運行；healthy 為真時本地持倉簿可替代 REST 查詢"""
+
+    def __init__(self, gateway, stream_base_url: str, book: PositionBook,
+                 snapshot: Optional[Callable[[], List[Dict]]] = None,
+                 keepalive_interval: float = LISTEN_KEY_KEEPALIVE, heartbeat: float = 30.0,
+                 on_event: Optional[Callable[[Dict], None]] = None,
+                 log: Optional[Callable[[str], None]] = None):
+        self.gateway = gateway
+        self.stream_base_url = stream_base_url
+        self.book = book
+        self.snapshot = snapshot  # 阻塞的 REST positionRisk 調用，在網關執行緒池執行
+        self.keepalive_interval = keepalive_interval
+        self.heartbeat = heartbeat
+        self.on_event = on_event
+        self.log = log or print
+        self.listen_key: Optional[str] = None
+        self.connects = 0
+        self.keepalives = 0
+        self._ws = None
+        self._synced = False
+        self._closing = False
+        self._future = None
+
+    @property
+    def connected(self) -> bool:
+        return self._ws is not None and not self._ws.closed
+
+    @property
+    def healthy(self) -> bool:
+        """已連接且本次連接後的持倉快照已載入"""
+        return self.connected and self._synced
+
+    def start(self) -> 'UserDataStream':
+        if self._future is None or self._future.done():
+            self._closing = False
+            self._future = self.gateway.submit(self._run())
+        return self
+
+    def stop(self, timeout: float = 5.0):
+        """關閉私有流並刪除 listenKey（不觸發重連）"""
+        self._closing = True
+        if self._future is not None:
+            self.gateway.loop.call_soon_threadsafe(self._future.cancel)
+        if self.listen_key:
+            try:
+                self.gateway.run(self.gateway.request('DELETE', LISTEN_KEY_PATH, {'listenKey': self.listen_key},
+                                                      timeout=timeout), timeout=timeout + 1)
+            except Exception:
+                pass
+            self.listen_key = None
+
+    # ========== listenKey ==========
+
+    async def _create_listen_key(self) -> str:
+        response = await self.gateway.request_with_retry('POST', LISTEN_KEY_PATH, timeout=5.0)
+        return response['listenKey']
+
+    async def _keepalive(self):
+        while True:
+            await asyncio.sleep(self.keepalive_interval)
+            try:
+                await self.gateway.request_with_retry('PUT', LISTEN_KEY_PATH, {'listenKey': self.listen_key},
+                                                      timeout=5.0)
+                self.keepalives += 1
+            except Exception as e:
+                # 續期失敗（listenKey 已失效等）時斷開，由主循環重新建立
+                self.log(f"listenKey 續期失敗: {e}，重新建立私有流")
+                self.listen_key = None
+                if self._ws is not None:
+                    await self._ws.close()
+                return
+
+    # ========== 讀取循環 ==========
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        failures = 0
+        while not self._closing:
+            keepalive = None
+            try:
+                if not self.listen_key:
+                    self.listen_key = await self._create_listen_key()
+                url = f"{self.stream_base_url}/ws/{self.listen_key}"
+                async with self.gateway.stream_session.ws_connect(url, heartbeat=self.heartbeat,
+                                                                  autoping=True) as ws:
+                    self._ws = ws
+                    self.connects += 1
+                    keepalive = asyncio.ensure_future(self._keepalive())
+                    # 先連接再取快照：斷線期間的變化由快照補齊，快照與推送按交易時間取新，先後順序無關
+                    if self.snapshot is not None:
+                        self.book.load_positions(await loop.run_in_executor(None, self.snapshot))
+                    self._synced = True
+                    failures = 0
+                    self.log(f"用戶數據流已連接（第{self.connects}次），本地持倉 {len(self.book.position_rows())} 個")
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            if self._dispatch(json.loads(msg.data)):
+                                break
+                        elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                self.log(f"用戶數據流錯誤: {e}")
+            finally:
+                self._ws = None
+                self._synced = False
+                if keepalive is not None:
+                    keepalive.cancel()
+            if self._closing:
+                return
+            delay = RECONNECT_DELAYS[min(failures, len(RECONNECT_DELAYS) - 1)]
+            self.log(f"用戶數據流已斷開，{delay}秒後重連")
+            await asyncio.sleep(delay)
+
+    def _dispatch(self, event: Dict) -> bool:
+        """處理一條推送；返回True表示需要重建 listenKey 並重連"""
+        event_type = event.get('e')
+        if event_type == ORDER_TRADE_UPDATE:
+            self.book.apply_order_update(event)
+        elif event_type == ACCOUNT_UPDATE:
+            self.book.apply_account_update(event)
+        elif event_type == LISTEN_KEY_EXPIRED:
+            self.log("listenKey 已過期，重新建立")
+            self.listen_key = None
+            return True
+        if self.on_event is not None:
+            self.on_event(event)
+        return False
+
+
+# 使用示例：python user_stream.py  （本地模擬交易所：下單後由推送更新持倉與成交均價，並測試 listenKey 過期重連）
+if __name__ == "__main__":
+    from async_gateway import AsyncGateway
+    from fake_exchange import FakeBinanceServer
+
+    server = FakeBinanceServer(seed=7).start()
+    gateway = AsyncGateway('demo-key', 'demo-secret', base_url=server.base_url)
+    gateway.start()
+    book = PositionBook()
+
+    def snapshot():
+        return gateway.run(gateway.position_information(timeout=2.0))
+
+    stream = UserDataStream(gateway, server.stream_url, book, snapshot=snapshot,
+                            log=lambda message: print(f"  [{time.strftime('%H:%M:%S')}] {message}")).start()
+    try:
+        deadline = time.time() + 5
+        while not stream.healthy and time.time() < deadline:
+            time.sleep(0.05)
+        assert stream.healthy, "用戶數據流未能建立"
+
+        latencies = []
+        for side, reduce_only in (('BUY', False), ('SELL', True), ('SELL', False), ('BUY', True)):
+            start = time.perf_counter()
+            order = gateway.run(gateway.create_order(symbol='ETHUSDT', side=side, type='MARKET', quantity=1,
+                                                     reduceOnly=reduce_only or None, timeout=2.0))
+            fill = book.wait_for_fill(order['orderId'], timeout=2.0)
+            latencies.append((time.perf_counter() - start) * 1000)
+            # 持倉由緊隨其後的 ACCOUNT_UPDATE 更新（每筆成交兩條推送）
+            deadline = time.time() + 2
+            while book.events < 2 * len(latencies) and time.time() < deadline:
+                time.sleep(0.001)
+            assert fill and abs(fill['avg_price'] - float(order['avgPrice'])) < 1e-6
+            local = book.position('ETHUSDT')
+            rest = [p for p in snapshot() if p['symbol'] == 'ETHUSDT'][0]
+            print(f"{side:4} reduceOnly={reduce_only!s:5} | 推送均價 {fill['avg_price']:.2f} 手續費 {fill['commission']:.4f} "
+                  f"| 本地持倉 {local['direction'] + ' ' + str(local['quantity']) if local else '無'} "
+                  f"| REST positionAmt {rest['positionAmt']}")
+            assert (local['quantity'] if local else 0) == abs(float(rest['positionAmt']))
+        print(f"下單→成交推送: p50 {sorted(latencies)[len(latencies) // 2]:.1f}ms | 推送 {book.events} 條")
+
+        start = time.perf_counter()
+        for _ in range(10000):
+            book.position('ETHUSDT')
+        print(f"本地持倉查詢: {(time.perf_counter() - start) / 10000 * 1e6:.2f}µs/次（REST positionRisk 權重5）")
+
+        connects = stream.connects
+        server.expire_listen_keys()
+        deadline = time.time() + 5
+        while stream.connects == connects and time.time() < deadline:
+            time.sleep(0.05)
+        assert stream.connects > connects, "listenKey 過期後未重連"
+        print(f"listenKey 過期後已重建並重連（listenKey {stream.listen_key[:8]}...）")
+    finally:
+        stream.stop()
+        gateway.stop()
+        server.stop()
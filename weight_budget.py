@@ -0,0 +1,335 @@
+"""
+請求權重預算
+從每個響應的 X-MBX-USED-WEIGHT-1M / X-MBX-ORDER-COUNT-* 標頭讀取交易所已計的用量，
+結合本地已發送但尚未回報的請求，預測當前窗口剩餘額度；
+背景任務（點差刷新、槓桿預載、帳戶分析）只能使用扣除下單路徑保留額度之後的部分
+"""
+
+import math
+import threading
+import time
+from typing import Callable, Dict, Mapping, Optional
+
+WEIGHT_LIMIT_1M = 2400      # U本位合約 REQUEST_WEIGHT 每分鐘上限
+ORDER_LIMIT_10S = 300       # 每10秒下單數上限
+ORDER_LIMIT_1M = 1200       # 每分鐘下單數上限
+ORDER_RESERVE_WEIGHT = 300  # 保留給下單路徑（槓桿設置、持倉核對、時間同步）的權重
+
+# python-binance 方法名 -> 請求權重（未列出的按1計）
+ENDPOINT_WEIGHTS = {
+    'futures_order_book': 2,           # limit 5/10/20/50
+    'futures_position_information': 5,
+    'futures_account': 5,
+    'futures_account_balance': 5,
+    'futures_account_trades': 5,
+    'futures_income_history': 30,
+    'futures_24hr_ticker': 40,         # 不帶 symbol 時
+    'futures_mark_price': 10,          # 不帶 symbol 時
+    'futures_exchange_info': 1,
+    'futures_change_leverage': 1,
+    'futures_create_order': 0,         # 下單不計權重，計入下單數
+    'futures_place_batch_order': 5,    # 批次下單（最多5筆），每筆計入下單數
+}
+
+
+class WeightBudget:
+    """權重預算 - 窗口按服務器時間的整分鐘對齊，交易所標頭為準，本地預估補齊尚未回報的請求"""
+
+    def __init__(self, time_provider: Callable[[], float] = lambda: time.time() * 1000,
+                 weight_limit: int = WEIGHT_LIMIT_1M, reserve_weight: int = ORDER_RESERVE_WEIGHT,
+                 window_ms: int = 60000, order_limit_10s: int = ORDER_LIMIT_10S, order_limit_1m: int = ORDER_LIMIT_1M):
+        self.time_provider = time_provider
+        self.weight_limit = weight_limit
+        self.reserve_weight = reserve_weight
+        self.window_ms = window_ms
+        self.order_limit_10s = order_limit_10s
+        self.order_limit_1m = order_limit_1m
+        self._lock = threading.Lock()
+        self._window = -1
+        self._reported_weight = 0   # 交易所回報的本窗口用量
+        self._pending_weight = 0    # 最後一次回報之後本地已發送的權重
+        self._background_weight = 0  # 本窗口批准給背景任務的權重（其餘用量視為下單路徑）
+        self._last_foreground = reserve_weight  # 上一窗口下單路徑的用量（尚無記錄時按保留額度估計）
+        self._started_ms = time_provider()  # 啟動所在的窗口只從啟動時開始計算消耗速度
+        self.order_count_10s = 0
+        self.order_count_1m = 0
+        self._banned_until = 0.0    # 429/418 後 Retry-After 截止時間（服務器時間毫秒）
+        self.background_granted = 0
+        self.background_denied = 0
+        self.rate_limited = 0
+
+    # ========== 窗口 ==========
+
+    def _roll(self, now_ms: float):
+        window = int(now_ms // self.window_ms)
+        if window != self._window:
+            consecutive = window == self._window + 1
+            if self._window >= 0:
+                self._last_foreground = self._foreground_rate((self._window + 1) * self.window_ms) if consecutive else 0
+            # 窗口末批准、尚未回報的請求可能在新窗口才被交易所計入，先算在新窗口，收到回報後抵銷
+            carried = self._pending_weight if consecutive else 0
+            self._window = window
+            self._reported_weight = 0
+            self._pending_weight = carried
+            self._background_weight = carried
+
+    def _foreground_weight(self) -> int:
+        return max(self._reported_weight + self._pending_weight - self._background_weight, 0)
+
+    def _foreground_rate(self, now_ms: float) -> float:
+        """本窗口下單路徑每窗口的消耗速度（從窗口開始或啟動時起算，至少按十分之一窗口計，避免少量樣本放大）"""
+        observed = min(now_ms - self._window * self.window_ms, now_ms - self._started_ms)
+        return self._foreground_weight() / max(observed, self.window_ms * 0.1) * self.window_ms
+
+    def _projected_foreground(self, now_ms: float) -> int:
+        """預測下單路徑在本窗口餘下時間還會用掉的權重：本窗口預計總用量（本窗口與上一窗口速度的較大者）減去已用量
+        （下單路徑的請求是離散的，按總量而不是按剩餘時間比例估計，窗口末的最後一個請求也有額度）"""
+        expected = max(self._last_foreground, self._foreground_rate(now_ms))
+        return max(math.ceil(expected - self._foreground_weight()), 0)
+
+    def ms_to_window_reset(self) -> float:
+        now_ms = self.time_provider()
+        return self.window_ms - now_ms % self.window_ms
+
+    # ========== 記錄 ==========
+
+    def update_from_headers(self, headers: Mapping, status: Optional[int] = None):
+        """讀取響應標頭（requests / aiohttp 的標頭都不區分大小寫）"""
+        used = headers.get('X-MBX-USED-WEIGHT-1M') or headers.get('X-MBX-USED-WEIGHT-1m')
+        orders_10s = headers.get('X-MBX-ORDER-COUNT-10S') or headers.get('X-MBX-ORDER-COUNT-10s')
+        orders_1m = headers.get('X-MBX-ORDER-COUNT-1M') or headers.get('X-MBX-ORDER-COUNT-1m')
+        retry_after = headers.get('Retry-After')
+        with self._lock:
+            now_ms = self.time_provider()
+            self._roll(now_ms)
+            if used is not None:
+                # 回報的增量只抵銷已記入的本地用量，在途（交易所尚未計入）的部分仍保留
+                used = int(used)
+                self._pending_weight = max(self._pending_weight - max(used - self._reported_weight, 0), 0)
+                self._reported_weight = used
+            if orders_10s is not None:
+                self.order_count_10s = int(orders_10s)
+            if orders_1m is not None:
+                self.order_count_1m = int(orders_1m)
+            if status in (418, 429):
+                self.rate_limited += 1
+                wait_ms = int(retry_after) * 1000 if retry_after else self.window_ms - now_ms % self.window_ms
+                self._banned_until = max(self._banned_until, now_ms + wait_ms)
+
+    def note_request(self, weight: int):
+        """記錄一個已發送、尚未收到回報的請求"""
+        with self._lock:
+            self._roll(self.time_provider())
+            self._pending_weight += weight
+
+    @staticmethod
+    def weight_of(api_func, **params) -> int:
+        name = getattr(api_func, '__name__', str(api_func))
+        if name in ('futures_24hr_ticker', 'futures_mark_price') and params.get('symbol'):
+            return 1
+        return ENDPOINT_WEIGHTS.get(name, 1)
+
+    # ========== 額度 ==========
+
+    def used_weight(self) -> int:
+        with self._lock:
+            self._roll(self.time_provider())
+            return self._reported_weight + self._pending_weight
+
+    def headroom(self, background: bool = True) -> int:
+        """當前窗口剩餘權重；background=True 時扣除下單路徑保留額度"""
+        if self.time_provider() < self._banned_until:
+            return 0
+        remaining = self.weight_limit - self.used_weight()
+        return remaining - self.reserve_weight if background else remaining
+
+    def predicted_headroom(self) -> int:
+        """按下單路徑目前的消耗速度，預測窗口結束時剩餘的背景額度（背景任務不再申請時）"""
+        with self._lock:
+            now_ms = self.time_provider()
+            self._roll(now_ms)
+            used = self._reported_weight + self._pending_weight
+            return int(self.weight_limit - self.reserve_weight - used - self._projected_foreground(now_ms))
+
+    def order_headroom(self) -> int:
+        return min(self.order_limit_10s - self.order_count_10s, self.order_limit_1m - self.order_count_1m)
+
+    def try_acquire_background(self, weight: int) -> bool:
+        """背景任務申請權重，額度足夠時立即記入並返回True
+        申請後預測的窗口末剩餘（扣除下單路徑預計還會用掉的權重）低於保留額度時拒絕"""
+        with self._lock:
+            now_ms = self.time_provider()
+            self._roll(now_ms)
+            remaining = (self.weight_limit - self.reserve_weight - self._reported_weight - self._pending_weight
+                         - self._projected_foreground(now_ms))
+            if now_ms < self._banned_until or remaining < weight:
+                self.background_denied += 1
+                return False
+            self._pending_weight += weight
+            self._background_weight += weight
+            self.background_granted += 1
+            return True
+
+    def _wait_next_window(self, deadline: float) -> bool:
+        """睡眠到下個窗口（或限流解除），超過截止時間返回False"""
+        now_ms = self.time_provider()
+        if now_ms < self._banned_until:
+            wait = (self._banned_until - now_ms) / 1000
+        else:
+            wait = self.ms_to_window_reset() / 1000 + 0.01
+        wait = min(wait, deadline - time.time())
+        if wait <= 0:
+            return False
+        time.sleep(wait)
+        return True
+
+    def acquire_background(self, weight: int, timeout: float = 0.0) -> bool:
+        """申請背景權重，額度不足時等待到下個窗口（最多 timeout 秒）"""
+        deadline = time.time() + timeout
+        while not self.try_acquire_background(weight):
+            if not self._wait_next_window(deadline):
+                return False
+        return True
+
+    def wait_for_headroom(self, weight: int, timeout: float = 0.0) -> bool:
+        """等待背景額度足夠（不記入用量，由實際發送請求的一方申請）"""
+        deadline = time.time() + timeout
+        while self.headroom() < weight:
+            if not self._wait_next_window(deadline):
+                return False
+        return True
+
+    # ========== 掛載 ==========
+
+    def attach_to_client(self, client):
+        """在 python-binance Client 的 requests.Session 上掛載響應鉤子，所有響應自動回報用量"""
+        def _hook(response, *args, **kwargs):
+            self.update_from_headers(response.headers, response.status_code)
+            return response
+        client.session.hooks.setdefault('response', []).append(_hook)
+
+    def status(self) -> Dict:
+        return {
+            'used_weight': self.used_weight(),
+            'weight_limit': self.weight_limit,
+            'background_headroom': self.headroom(),
+            'predicted_headroom': self.predicted_headroom(),
+            'order_count_10s': self.order_count_10s,
+            'order_count_1m': self.order_count_1m,
+            'background_granted': self.background_granted,
+            'background_denied': self.background_denied,
+            'rate_limited': self.rate_limited,
+        }
+
+    def format_status(self) -> str:
+        stats = self.status()
+        return (f"權重 {stats['used_weight']}/{stats['weight_limit']} | 背景剩餘 {stats['background_headroom']} "
+                f"(預測窗口末 {stats['predicted_headroom']}) | 下單數 10s:{stats['order_count_10s']} 1m:{stats['order_count_1m']} | "
+                f"背景 通過{stats['background_granted']}/拒絕{stats['background_denied']} | 限流 {stats['rate_limited']}")
+
+
+# ========== 本地模擬交易所 ==========
+
+def run_fake_exchange_test(window_ms: int = 2000, weight_limit: int = 200, reserve_weight: int = 60,
+                           seconds: float = 6.0) -> Dict:
+    """本地模擬交易所：按窗口計權重，超限返回429；背景任務全速刷新訂單簿、下單路徑定期查詢持倉，
+    驗證背景任務受預算限制後下單路徑不會被限流"""
+    import asyncio
+    from aiohttp import web
+    from async_gateway import AsyncGateway
+
+    clock = lambda: time.time() * 1000
+    state = {'window': -1, 'used': 0, 'rejected': 0, 'served': 0}
+
+    def charge(weight: int):
+        window = int(clock() // window_ms)
+        if window != state['window']:
+            state['window'], state['used'] = window, 0
+        state['used'] += weight
+        headers = {'X-MBX-USED-WEIGHT-1M': str(state['used'])}
+        if state['used'] > weight_limit:
+            state['rejected'] += 1
+            headers['Retry-After'] = '1'
+            return web.json_response({'code': -1003, 'msg': 'Too many requests'}, status=429, headers=headers)
+        state['served'] += 1
+        return web.json_response({}, headers=headers)
+
+    async def depth(request):
+        return charge(2)
+
+    async def position(request):
+        return charge(5)
+
+    app = web.Application()
+    app.router.add_get('/fapi/v1/depth', depth)
+    app.router.add_get('/fapi/v2/positionRisk', position)
+    ready = threading.Event()
+    server = {}
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        loop.run_until_complete(site.start())
+        server['port'] = site._server.sockets[0].getsockname()[1]
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    ready.wait(5)
+
+    budget = WeightBudget(clock, weight_limit=weight_limit, reserve_weight=reserve_weight, window_ms=window_ms)
+    gateway = AsyncGateway('key', 'secret', base_url=f"http://127.0.0.1:{server['port']}", time_provider=lambda: int(clock()),
+                           weight_budget=budget)
+    gateway.start()
+    stop = threading.Event()
+    result = {'background_ok': 0, 'background_skipped': 0, 'order_ok': 0, 'order_failed': 0,
+              'min_background_headroom': budget.headroom()}
+
+    def background_job():
+        while not stop.is_set():
+            if not budget.acquire_background(2, timeout=0.05):
+                result['background_skipped'] += 1
+                continue
+            try:
+                gateway.run(gateway.request('GET', '/fapi/v1/depth', {'symbol': 'BTCUSDT', 'limit': 5}), timeout=2)
+                result['background_ok'] += 1
+            except Exception:
+                pass
+
+    workers = [threading.Thread(target=background_job, daemon=True) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        try:
+            gateway.run(gateway.request('GET', '/fapi/v2/positionRisk', signed=True), timeout=2)
+            result['order_ok'] += 1
+        except Exception:
+            result['order_failed'] += 1
+        # 窗口內用量只增不減，取樣最小值即各窗口末的背景剩餘
+        result['min_background_headroom'] = min(result['min_background_headroom'], budget.headroom())
+        time.sleep(0.25)  # 每窗口約8次 × 5權重，在保留額度之內
+    stop.set()
+    for worker in workers:
+        worker.join(timeout=2)
+    gateway.stop()
+    result['server_rejected'] = state['rejected']
+    result['budget'] = budget.format_status()
+    return result
+
+
+# 使用示例：python weight_budget.py
+if __name__ == "__main__":
+    print("=== 本地模擬交易所：窗口2秒、上限200權重、保留60給下單路徑 ===")
+    outcome = run_fake_exchange_test()
+    print(f"背景請求 成功{outcome['background_ok']} 因預算跳過{outcome['background_skipped']} | "
+          f"下單路徑 成功{outcome['order_ok']} 失敗{outcome['order_failed']} | 交易所429 {outcome['server_rejected']}次")
+    print(outcome['budget'])
+    print(f"背景剩餘最小值 {outcome['min_background_headroom']}")
+    assert outcome['order_failed'] == 0, "下單路徑被限流"
+    assert outcome['server_rejected'] == 0, "背景任務超出預算"
+    assert outcome['min_background_headroom'] >= 0, "背景任務佔用了下單路徑的保留額度"
+    print("✅ 背景任務只使用下單路徑之外的額度，未觸發限流")
@@ -0,0 +1,256 @@
+"""
+WebSocket 幀解碼器
+可插拔的 JSON 後端：msgspec（類型化結構，直接解碼為記錄）> orjson > 標準庫 json，
+標記價格數組直接解碼為 NumPy 列，bookTicker 直接解碼為 (symbol, 買價, 賣價)，不經過中間 dict
+"""
+
+import json
+import sys
+import time
+import tracemalloc
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+# 幀類型
+MARK_PRICE = 'mark_price'    # !markPrice@arr
+BOOK_TICKER = 'book_ticker'  # !bookTicker
+CONTROL = 'control'          # 訂閱確認等其他消息
+
+
+class MarkPriceBatch:
+    """一幀標記價格數據（列式），funding_rate 為原始小數，未乘100"""
+
+    __slots__ = ('symbols', 'funding_rate', 'mark_price', 'next_funding_time')
+
+    def __init__(self, symbols: List[str], funding_rate: np.ndarray, mark_price: np.ndarray,
+                 next_funding_time: np.ndarray):
+        self.symbols = symbols
+        self.funding_rate = funding_rate
+        self.mark_price = mark_price
+        self.next_funding_time = next_funding_time
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+
+def _to_float(value) -> float:
+    # 交割合約的資金費率欄位為空字串
+    return float(value) if value else np.nan
+
+
+if msgspec is not None:
+    class _MarkPriceItem(msgspec.Struct):
+        s: str
+        r: str  # 交割合約為空字串，由 _to_float 解析
+        p: float
+        T: int
+
+    class _BookTickerItem(msgspec.Struct):
+        s: str
+        b: float
+        a: float
+
+    class _Envelope(msgspec.Struct):
+        stream: str
+        data: msgspec.Raw
+
+
+class FrameDecoder:
+    """WebSocket 幀解碼器 - backend: 'auto' | 'msgspec' | 'orjson' | 'json'"""
+
+    def __init__(self, backend: str = 'auto'):
+        if backend == 'auto':
+            backend = 'msgspec' if msgspec is not None else 'orjson' if orjson is not None else 'json'
+        if backend == 'msgspec' and msgspec is None:
+            raise ImportError("msgspec 未安裝")
+        if backend == 'orjson' and orjson is None:
+            raise ImportError("orjson 未安裝")
+        self.backend = backend
+        self._loads = orjson.loads if backend == 'orjson' else json.loads
+
+        if backend == 'msgspec':
+            # strict=False 允許把幣安的字串數字直接解碼為 float
+            self._envelope_decoder = msgspec.json.Decoder(_Envelope)
+            self._mark_price_decoder = msgspec.json.Decoder(List[_MarkPriceItem], strict=False)
+            self._book_ticker_decoder = msgspec.json.Decoder(_BookTickerItem, strict=False)
+
+    def decode(self, message) -> Tuple[str, object]:
+        """解碼一幀，返回 (幀類型, 內容)
+        MARK_PRICE -> MarkPriceBatch，BOOK_TICKER -> (symbol, 買價, 賣價)，CONTROL -> 原始解碼結果"""
+        if self.backend == 'msgspec':
+            result = self._decode_msgspec(message)
+            if result is not None:
+                return result
+        return self._decode_generic(self._loads(message))
+
+    # ========== msgspec ==========
+
+    def _decode_msgspec(self, message) -> Optional[Tuple[str, object]]:
+        try:
+            if message[:10] in ('{"stream":', b'{"stream":'):
+                envelope = self._envelope_decoder.decode(message)
+                stream, payload = envelope.stream, envelope.data
+            elif message[:1] in ('[', b'['):
+                stream, payload = '!markPrice@arr', message
+            else:
+                return None
+
+            if stream == '!bookTicker':
+                item = self._book_ticker_decoder.decode(payload)
+                return BOOK_TICKER, (item.s, item.b, item.a)
+            if stream == '!markPrice@arr':
+                items = self._mark_price_decoder.decode(payload)
+                count = len(items)
+                return MARK_PRICE, MarkPriceBatch(
+                    [item.s for item in items],
+                    np.fromiter((_to_float(item.r) for item in items), dtype=np.float64, count=count),
+                    np.fromiter((item.p for item in items), dtype=np.float64, count=count),
+                    np.fromiter((item.T for item in items), dtype=np.int64, count=count))
+            return None
+        except msgspec.DecodeError:
+            # 格式不符，交由通用路徑處理
+            return None
+
+    # ========== orjson / json ==========
+
+    def _decode_generic(self, data) -> Tuple[str, object]:
+        if isinstance(data, dict) and 'stream' in data:
+            stream = data['stream']
+            data = data['data']
+            if stream == '!bookTicker':
+                return BOOK_TICKER, (data['s'], float(data['b']), float(data['a']))
+
+        if isinstance(data, list):
+            count = len(data)
+            return MARK_PRICE, MarkPriceBatch(
+                [item['s'] for item in data],
+                np.fromiter((_to_float(item['r']) for item in data), dtype=np.float64, count=count),
+                np.fromiter((_to_float(item['p']) for item in data), dtype=np.float64, count=count),
+                np.fromiter((item['T'] for item in data), dtype=np.int64, count=count))
+
+        if isinstance(data, dict) and data.get('e') == 'bookTicker':
+            return BOOK_TICKER, (data['s'], float(data['b']), float(data['a']))
+        return CONTROL, data
+
+
+# ========== 回放基準測試 ==========
+
+def _synthetic_frames(symbol_count: int = 300, book_ticker_per_mark_price: int = 50) -> List[str]:
+    """生成與幣安格式一致的樣本幀（沒有錄製文件時使用）"""
+    rng = np.random.default_rng(11)
+    now = int(time.time() * 1000)
+    symbols = [f"SYM{i:04d}USDT" for i in range(symbol_count)]
+    # 末尾混入交割合約：實盤 !markPrice@arr 中其資金費率為空字串
+    delivery_symbols = ['BTCUSDT_251226', 'ETHUSDT_251226']
+    mark_price_frame = json.dumps({'stream': '!markPrice@arr', 'data': [
+        {'e': 'markPriceUpdate', 'E': now, 's': symbol, 'p': f"{rng.uniform(0.01, 50000):.8f}",
+         'i': f"{rng.uniform(0.01, 50000):.8f}", 'P': f"{rng.uniform(0.01, 50000):.8f}",
+         'r': '' if symbol in delivery_symbols else f"{rng.normal(0, 0.0005):.8f}",
+         'T': 0 if symbol in delivery_symbols else now + 3600000}
+        for symbol in symbols + delivery_symbols]}, separators=(',', ':'))
+    frames = [mark_price_frame]
+    for i in range(book_ticker_per_mark_price):
+        symbol = symbols[i % symbol_count]
+        bid = rng.uniform(0.01, 50000)
+        frames.append(json.dumps({'stream': '!bookTicker', 'data': {
+            'e': 'bookTicker', 'u': 400900217 + i, 'E': now, 'T': now, 's': symbol,
+            'b': f"{bid:.4f}", 'B': '31.21', 'a': f"{bid * 1.0002:.4f}", 'A': '40.66'}}, separators=(',', ':')))
+    return frames
+
+
+def load_frames(path: str) -> List[str]:
+    """讀取錄製的幀文件（每行一幀原始消息）"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def capture_frames(path: str, seconds: float = 30.0,
+                   url: str = "wss://fstream.binance.com/stream?streams=!markPrice@arr/!bookTicker") -> int:
+    """錄製實盤幀到文件，供回放基準測試使用"""
+    import websocket
+
+    ws = websocket.create_connection(url, timeout=10)
+    count = 0
+    deadline = time.time() + seconds
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            while time.time() < deadline:
+                f.write(ws.recv() + '\n')
+                count += 1
+    finally:
+        ws.close()
+    return count
+
+
+def run_replay_benchmark(frames: List[str], backends=None, rounds: int = 20) -> List[dict]:
+    """回放幀，測量各後端的每秒幀數和每幀記憶體分配"""
+    if backends is None:
+        backends = [name for name, module in (('msgspec', msgspec), ('orjson', orjson), ('json', json)) if module]
+    results = []
+    for backend in backends:
+        decoder = FrameDecoder(backend)
+        for frame in frames:
+            decoder.decode(frame)  # 預熱
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for frame in frames:
+                decoder.decode(frame)
+        elapsed = time.perf_counter() - start
+        total = rounds * len(frames)
+
+        # 每幀分配：tracemalloc 下回放一輪，統計每幀分配峰值與殘留的記憶體塊數
+        tracemalloc.start()
+        blocks_before = tracemalloc.take_snapshot()
+        peak_bytes = 0
+        for frame in frames:
+            tracemalloc.reset_peak()
+            decoder.decode(frame)
+            peak_bytes = max(peak_bytes, tracemalloc.get_traced_memory()[1])
+        blocks_after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        allocated_blocks = sum(stat.count_diff for stat in blocks_after.compare_to(blocks_before, 'lineno')
+                               if stat.count_diff > 0)
+
+        results.append({
+            'backend': backend,
+            'frames_per_sec': total / elapsed if elapsed > 0 else 0,
+            'us_per_frame': elapsed / total * 1e6,
+            'blocks_per_frame': allocated_blocks / len(frames),
+            'peak_kb': peak_bytes / 1024
+        })
+    return results
+
+
+# 使用示例：
+#   python ws_decoder.py                      使用合成樣本幀
+#   python ws_decoder.py --capture frames.txt 錄製30秒實盤幀
+#   python ws_decoder.py frames.txt           回放錄製的幀
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == '--capture':
+        captured = capture_frames(sys.argv[2])
+        print(f"已錄製 {captured} 幀到 {sys.argv[2]}")
+        sys.exit(0)
+
+    if len(sys.argv) >= 2:
+        frames = load_frames(sys.argv[1])
+        print(f"=== 回放 {len(frames)} 幀（{sys.argv[1]}） ===")
+    else:
+        frames = _synthetic_frames()
+        print(f"=== 回放 {len(frames)} 幀（合成樣本：1幀標記價格 + {len(frames) - 1}幀bookTicker） ===")
+
+    for result in run_replay_benchmark(frames):
+        print(f"{result['backend']:>8} | {result['frames_per_sec']:10.0f} 幀/秒 | {result['us_per_frame']:8.1f}µs/幀 | "
+              f"殘留 {result['blocks_per_frame']:.1f} 塊/幀 | 峰值 {result['peak_kb']:.1f}KB")